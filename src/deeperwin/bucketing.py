@@ -0,0 +1,248 @@
+"""
+Shape bucketing for shared pre-training and optimization of many geometries.
+
+All jitted/pmapped steps of the shared training loops are compiled once per input signature, i.e. once per combination of
+number of up-/dn-electrons and ions (and tree-structure of the fixed parameters). To avoid a re-compilation for every molecule,
+geometries can be padded to a small set of shapes ("buckets") with ghost particles:
+Ghost ions have charge Z=0 and are placed far away from the molecule. Ghost electrons sit at fixed positions close to the
+molecule and are never moved by the MCMC. Masks of the real particles (fixed_params['padding']) remove all contributions of the
+ghosts from the wavefunction (see deeperwin.model.padding) and from the hamiltonian, so that the wavefunction, local energies
+and samples of the real particles are unchanged.
+"""
+import collections
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from deeperwin.configuration import Configuration, ModelConfig, PhysicalConfig, ShapeBucketingConfig
+from deeperwin.mcmc import MCMCState
+
+LOGGER = logging.getLogger("dpe")
+
+ShapeBucket = collections.namedtuple("ShapeBucket", "n_up, n_dn, n_ions")
+
+GHOST_ION_SPACING = 100.0
+"""Distance (in bohr) between ghost ions and from the center of the molecule to the first ghost ion"""
+
+GHOST_EL_SPACING = 0.5
+"""Distance (in bohr) between ghost electrons and from the center of the molecule to the first ghost electron"""
+
+
+def get_geometry_shape(physical_config: PhysicalConfig) -> ShapeBucket:
+    """Shape of the un-padded geometry"""
+    return ShapeBucket(physical_config.n_up, physical_config.n_dn, len(physical_config.Z))
+
+
+def _round_up(n, bucket_size, n_max):
+    return min(-(-n // bucket_size) * bucket_size, n_max)
+
+
+def get_shape_buckets(model_config: ModelConfig,
+                      physical_configs: List[PhysicalConfig],
+                      bucketing_config: ShapeBucketingConfig) -> List[ShapeBucket]:
+    """
+    Returns the shape bucket of each geometry.
+
+    The number of up- and dn-electrons and the number of ions are rounded up to multiples of the bucket sizes, but never exceed
+    the largest shapes the wavefunction model is defined for (see WavefunctionDefinition).
+    """
+    from deeperwin.model import construct_wavefunction_definition
+    wf_def = construct_wavefunction_definition(model_config, physical_configs)
+    buckets = []
+    for physical_config in physical_configs:
+        n_up, n_dn, n_ions = get_geometry_shape(physical_config)
+        buckets.append(ShapeBucket(_round_up(n_up, bucketing_config.electron_bucket_size, wf_def.max_n_up_orbitals),
+                                   _round_up(n_dn, bucketing_config.electron_bucket_size, wf_def.max_n_dn_orbitals),
+                                   _round_up(n_ions, bucketing_config.ion_bucket_size, wf_def.max_n_ions)))
+    n_shapes = len(set(get_geometry_shape(p) for p in physical_configs))
+    LOGGER.info(f"Shape bucketing: {len(physical_configs)} geometries with {n_shapes} distinct shapes padded to {len(set(buckets))} buckets")
+    return buckets
+
+
+def check_shape_bucketing_support(config: Configuration):
+    """Raises a NotImplementedError for all settings, for which ghost particles would change the wavefunction or the sampling"""
+    model_config = config.model
+    if (model_config.embedding is None) or (model_config.embedding.name not in ["ferminet", "dpe4"]):
+        raise NotImplementedError("Shape bucketing is only implemented for the ferminet and dpe4 embeddings")
+    if model_config.features.concatenate_el_ion_features:
+        raise NotImplementedError("Shape bucketing requires concatenate_el_ion_features=False, since otherwise the size of the "
+                                  "electron features depends on the number of ions")
+    orbital_config = model_config.orbitals
+    if orbital_config.baseline_orbitals or orbital_config.envelope_orbitals:
+        raise NotImplementedError("Shape bucketing is only implemented for transferable atomic orbitals without baseline/envelope orbitals")
+    tao_config = orbital_config.transferable_atomic_orbitals
+    if (tao_config is None) or (tao_config.name != "taos") or tao_config.phisnet_model:
+        raise NotImplementedError("Shape bucketing is only implemented for transferable atomic orbitals (taos) without PhisNet")
+    gnn_config = tao_config.orb_feature_gnn
+    if gnn_config and (gnn_config.n_iterations > 0):
+        mp_config = gnn_config.message_passing
+        if gnn_config.attention or (mp_config is None) or (mp_config.weighting != "linear") or (mp_config.aggregation != "sum"):
+            raise NotImplementedError("Shape bucketing requires an orbital feature GNN without attention, using linear weighting and sum-aggregation")
+    if config.optimization.shared_optimization.distortion:
+        raise NotImplementedError("Shape bucketing is not implemented for distortions of the geometries")
+    mcmc_configs = [config.optimization.mcmc] + ([config.pre_training.mcmc] if config.pre_training else [])
+    for mcmc_config in mcmc_configs:
+        if mcmc_config.proposal.name.endswith("one_el") or (mcmc_config.determinant_updates != "full") or mcmc_config.delayed_acceptance:
+            raise NotImplementedError("Shape bucketing requires all-electron proposals without determinant updates or delayed acceptance")
+
+
+def get_electron_indices(n_up: int, n_dn: int, bucket: ShapeBucket) -> np.ndarray:
+    """Indices of the real electrons in the padded electron axis, which is ordered [up-electrons, ghost up, dn-electrons, ghost dn]"""
+    return np.concatenate([np.arange(n_up), bucket.n_up + np.arange(n_dn)]).astype(int)
+
+
+def build_padding_masks(n_up: int, n_dn: int, n_ions: int, bucket: ShapeBucket) -> Dict[str, jnp.ndarray]:
+    el_mask = np.zeros(bucket.n_up + bucket.n_dn)
+    el_mask[get_electron_indices(n_up, n_dn, bucket)] = 1.0
+    ion_mask = np.zeros(bucket.n_ions)
+    ion_mask[:n_ions] = 1.0
+    return dict(el_mask=jnp.array(el_mask), ion_mask=jnp.array(ion_mask))
+
+
+def pad_geometry(R, Z, bucket: ShapeBucket):
+    """Appends ghost ions with Z=0, which are far away from the molecule and from each other"""
+    n_ghosts = bucket.n_ions - R.shape[-2]
+    offsets = GHOST_ION_SPACING * np.arange(1, n_ghosts + 1)[:, None] * np.array([1.0, 0.0, 0.0])
+    R_ghost = jnp.mean(R, axis=-2, keepdims=True) + offsets
+    return jnp.concatenate([R, R_ghost.astype(R.dtype)], axis=-2), jnp.concatenate([Z, jnp.zeros(n_ghosts, dtype=Z.dtype)])
+
+
+def pad_electron_coordinates(r, R, n_up: int, n_dn: int, bucket: ShapeBucket):
+    """
+    Inserts ghost electrons into electron coordinates r [... x n_el x 3].
+
+    The ghosts are placed at fixed, distinct positions close to the center of the (un-padded) ions R.
+    """
+    n_el_padded = bucket.n_up + bucket.n_dn
+    ind_real = get_electron_indices(n_up, n_dn, bucket)
+    ind_ghost = np.setdiff1d(np.arange(n_el_padded), ind_real)
+    offsets = GHOST_EL_SPACING * np.arange(1, len(ind_ghost) + 1)[:, None] * np.ones(3) / np.sqrt(3)
+    r_ghost = jnp.mean(R, axis=-2) + offsets
+    r_padded = jnp.zeros(r.shape[:-2] + (n_el_padded, 3), dtype=r.dtype)
+    r_padded = r_padded.at[..., ind_real, :].set(r)
+    r_padded = r_padded.at[..., ind_ghost, :].set(jnp.broadcast_to(r_ghost, r.shape[:-2] + r_ghost.shape).astype(r.dtype))
+    return r_padded
+
+
+def pad_slater_matrices(mo_up, mo_dn, n_up: int, n_dn: int, bucket: ShapeBucket):
+    """Zero-pads Slater matrices [... x n_up/n_dn x n_orbitals] of the un-padded geometry to the padded electron and orbital axes"""
+    n_el_padded = bucket.n_up + bucket.n_dn
+    if mo_up.shape[-1] == n_up + n_dn:  # full_det
+        ind_orb = (get_electron_indices(n_up, n_dn, bucket),) * 2
+        n_orb_padded = (n_el_padded, n_el_padded)
+    else:
+        ind_orb = (np.arange(n_up), np.arange(n_dn))
+        n_orb_padded = (bucket.n_up, bucket.n_dn)
+
+    padded = []
+    for mo, n_el, n_el_bucket, ind, n_orb in zip([mo_up, mo_dn], [n_up, n_dn], [bucket.n_up, bucket.n_dn], ind_orb, n_orb_padded):
+        mo_padded = jnp.zeros(mo.shape[:-2] + (n_el_bucket, n_orb), dtype=mo.dtype)
+        padded.append(mo_padded.at[..., :n_el, ind].set(mo))
+    return tuple(padded)
+
+
+def pad_mcmc_state(mcmc_state: MCMCState, physical_config: PhysicalConfig, bucket: ShapeBucket) -> MCMCState:
+    """Pads a (merged) MCMC state with ghost particles; the ghost electrons are marked in mcmc_state.el_mask and never moved"""
+    n_up, n_dn, n_ions = get_geometry_shape(physical_config)
+    R, Z = pad_geometry(mcmc_state.R, mcmc_state.Z, bucket)
+    return mcmc_state.replace(r=pad_electron_coordinates(mcmc_state.r, mcmc_state.R, n_up, n_dn, bucket),
+                              R=R,
+                              Z=Z,
+                              el_mask=build_padding_masks(n_up, n_dn, n_ions, bucket)["el_mask"],
+                              mo_inv=None,
+                              log_det=None,
+                              sign_det=None,
+                              log_psi_sqr_surrogate=None)
+
+
+def unpad_mcmc_state(mcmc_state: MCMCState, physical_config: PhysicalConfig, bucket: Optional[ShapeBucket]) -> MCMCState:
+    """Removes all ghost particles from a (merged) MCMC state. log_psi_sqr is unaffected by the padding and is kept."""
+    if (bucket is None) or (mcmc_state.el_mask is None):
+        return mcmc_state
+    n_up, n_dn, n_ions = get_geometry_shape(physical_config)
+    return mcmc_state.replace(r=mcmc_state.r[..., get_electron_indices(n_up, n_dn, bucket), :],
+                              R=mcmc_state.R[:n_ions],
+                              Z=mcmc_state.Z[:n_ions],
+                              el_mask=None)
+
+
+def pad_fixed_params(fixed_params: Dict, physical_config: PhysicalConfig, bucket: ShapeBucket) -> Dict:
+    """
+    Returns the fixed parameters of the wavefunction model for a padded geometry.
+
+    Only the inputs of the model are kept (and padded), so that all geometries of a bucket share the same tree-structure and
+    shapes. In particular the baseline solution (e.g. the atomic orbitals, whose structure depends on the molecule) is dropped.
+    """
+    n_up, n_dn, n_ions = get_geometry_shape(physical_config)
+    n_ghost_ions = bucket.n_ions - n_ions
+    padded = dict(input=dict(fixed_params.get("input") or {}), padding=build_padding_masks(n_up, n_dn, n_ions, bucket))
+    if "local_rotations" in padded["input"]:
+        rotations = padded["input"]["local_rotations"]
+        padded["input"]["local_rotations"] = jnp.concatenate([rotations, jnp.tile(jnp.eye(3, dtype=rotations.dtype), [n_ghost_ions, 1, 1])])
+    if "transferable_atomic_orbitals" in fixed_params:
+        features = []
+        for f, n_orb, n_orb_bucket in zip(fixed_params["transferable_atomic_orbitals"]["features"], [n_up, n_dn], [bucket.n_up, bucket.n_dn]):
+            features.append(jnp.pad(f[:, :n_orb, :], ((0, n_ghost_ions), (0, n_orb_bucket - n_orb), (0, 0))))
+        padded["transferable_atomic_orbitals"] = dict(features=features)
+    return padded
+
+
+def get_input_signature(*inputs):
+    """Tree-structure, shapes and dtypes of all inputs, i.e. everything that triggers a re-compilation of a jitted function when changed"""
+    leaves, treedef = jax.tree_util.tree_flatten(inputs)
+    return treedef, tuple((np.shape(x), str(getattr(x, "dtype", type(x)))) for x in leaves)
+
+
+class CompilationStats:
+    """
+    Number of compilations and compile time of a training loop, grouped by shape (bucket).
+
+    A step is counted as compilation whenever it is called with a combination of static arguments and input signature that has not
+    been seen before. Its compile time is measured as the wall-time of this first step (which therefore blocks until its results
+    are available) and is dominated by compilation.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.n_compilations = collections.Counter()
+        self.t_compilation = collections.defaultdict(float)
+        self.geometries = collections.defaultdict(set)
+        self._signatures = set()
+        self._pending: Optional[Tuple[ShapeBucket, float]] = None
+
+    def start_step(self, bucket: ShapeBucket, idx_geom: int, static_args, *inputs):
+        self.geometries[bucket].add(idx_geom)
+        signature = (static_args, get_input_signature(*inputs))
+        if signature in self._signatures:
+            self._pending = None
+        else:
+            self._signatures.add(signature)
+            self._pending = (bucket, time.perf_counter())
+
+    def end_step(self, *outputs):
+        if self._pending is None:
+            return
+        bucket, t_start = self._pending
+        self._pending = None
+        jax.block_until_ready(outputs)
+        t_compile = time.perf_counter() - t_start
+        self.n_compilations[bucket] += 1
+        self.t_compilation[bucket] += t_compile
+        LOGGER.debug(f"{self.name}: Compiled new step for shape {tuple(bucket)} in {t_compile:.1f} sec")
+
+    def get_summary(self) -> List[Dict]:
+        return [dict(n_up=bucket.n_up,
+                     n_dn=bucket.n_dn,
+                     n_ions=bucket.n_ions,
+                     n_geometries=len(self.geometries[bucket]),
+                     n_compilations=self.n_compilations[bucket],
+                     t_compilation=self.t_compilation[bucket]) for bucket in sorted(self.geometries)]
+
+    def log_summary(self):
+        for s in self.get_summary():
+            LOGGER.info(f"{self.name}: shape n_up={s['n_up']}, n_dn={s['n_dn']}, n_ions={s['n_ions']}: {s['n_geometries']} geometries, "
+                        f"{s['n_compilations']} compilations, {s['t_compilation']:.1f} sec compile time")
+        LOGGER.info(f"{self.name}: {sum(self.n_compilations.values())} compilations in total, "
+                    f"{sum(self.t_compilation.values()):.1f} sec compile time")
@@ -1,7 +1,11 @@
+import atexit
+import concurrent.futures
+import json
 import logging
 import os
 import pickle
 import re
+import threading
 
 import ruamel.yaml
 
@@ -12,13 +16,17 @@ import numpy as np
 import haiku as hk
 import zipfile
 from dataclasses import dataclass, fields
-from typing import Optional, Any, List, Union
+from typing import Optional, Any, List, Union, Dict, Callable
 from deeperwin.utils.utils import split_params
+from deeperwin.utils.tensor_archive import write_tree, read_tree, BlobStore
+from deeperwin.utils.history_store import HistoryFileReference, read_history_dataframe, read_history_snapshot
+
+LOGGER = logging.getLogger("dpe")
 
 @dataclass
 class RunData:
     config: Optional[Union[Configuration, dict]] = None
-    history: Optional[List[dict]] = None
+    history: Optional[Union[List[dict], HistoryFileReference]] = None
     summary: Optional[dict] = None
     metadata: Optional[dict] = None
     params: Optional[dict] = None
@@ -28,6 +36,9 @@ class RunData:
     mcmc_state: Optional[MCMCState] = None
     clipping_state: Optional[Any] = None
 
+# Fields of RunData, which are not stored as text files (config.yml, history.csv, summary.csv), but as pytrees
+ARRAY_FIELDS = ["metadata", "params", "ema_params", "fixed_params", "opt_state", "mcmc_state", "clipping_state"]
+
 def write_history(f, history, delim=';'):
     keys = set()
     for h in history:
@@ -37,48 +48,270 @@ def write_history(f, history, delim=';'):
         line = delim.join([str(h.get(k, "")) for k in keys])
         f.write((line + "\n").encode("utf-8"))
 
-def save_run(fname, data: RunData):
-    with zipfile.ZipFile(fname, "w", zipfile.ZIP_BZIP2) as zf:
+_blob_stores: Dict[str, BlobStore] = {}
+
+
+def get_blob_store(directory: str) -> BlobStore:
+    """Returns the blob store of a directory; the store is kept for the lifetime of the process, so that its hashes are memoized"""
+    directory = os.path.abspath(directory)
+    if directory not in _blob_stores:
+        _blob_stores[directory] = BlobStore(directory)
+    return _blob_stores[directory]
+
+
+def save_run(fname, data: RunData, checkpoint_format: str = "pickle", compression: Optional[str] = None,
+             blob_dir: Optional[str] = None, embed_history: bool = False):
+    """
+    Writes the run data to a zip file. The file is written under a temporary name and renamed when complete, so that an
+    interrupted write never leaves a truncated checkpoint behind.
+
+    Args:
+        checkpoint_format: 'pickle': BZIP2-compressed pickles of each field. 'tensors': tree structure as JSON and leaves as raw
+            arrays, which can be memory-mapped when loading (see deeperwin.utils.tensor_archive)
+        compression: Compression of the array leaves for the 'tensors' format: None, 'zlib', 'zstd' or 'lz4'
+        blob_dir: For the 'tensors' format, store the array leaves in a content-addressed blob store in this directory instead of
+            inside the zip file, so that arrays shared by many checkpoints are only stored once (see delete_unreferenced_blobs)
+        embed_history: If the history is a HistoryFileReference, copy the referenced rows of the history file into the checkpoint
+            (e.g. when exporting it from the run directory) instead of only storing the reference
+    """
+    fname_tmp = fname + ".tmp"
+    blobs = _write_run_zip(fname_tmp, data, checkpoint_format, compression, blob_dir, embed_history)
+    os.replace(fname_tmp, fname)
+    _release_blobs(fname)
+    if blobs:
+        get_blob_store(blob_dir).set_references(fname, blobs)
+
+
+def _release_blobs(fname):
+    """Drops the blob references of a checkpoint of this run, which has been overwritten or deleted"""
+    for blob_store in _blob_stores.values():
+        blob_store.release(fname)
+
+def _write_run_zip(fname, data: RunData, checkpoint_format="pickle", compression=None, blob_dir=None, embed_history=False):
+    assert checkpoint_format in ["pickle", "tensors"], f"Unknown checkpoint format: {checkpoint_format}"
+    blob_store = get_blob_store(blob_dir) if (blob_dir and checkpoint_format == "tensors") else None
+    zip_compression = zipfile.ZIP_BZIP2 if checkpoint_format == "pickle" else zipfile.ZIP_DEFLATED
+    blobs = set()
+    with zipfile.ZipFile(fname, "w", zip_compression) as zf:
         if data.config is not None:
             with zf.open("config.yml", "w", force_zip64=True) as f:
                 if hasattr(data.config, "save"):
                     data.config.save(f)
                 else:
-                    ruamel.yaml.YAML().dump(data, f)
+                    ruamel.yaml.YAML().dump(data.config, f)
 
-        if data.history is not None:
+        if isinstance(data.history, HistoryFileReference) and embed_history:
+            # Copy the already encoded rows of the (append-only) history file instead of re-encoding them
+            zf.writestr("history.bin", read_history_snapshot(data.history), compress_type=zipfile.ZIP_STORED)
+        elif isinstance(data.history, HistoryFileReference):
+            # Only reference the (append-only) history file instead of rewriting the full history in every checkpoint
+            history_fname = os.path.relpath(os.path.abspath(data.history.fname), os.path.dirname(os.path.abspath(fname)))
+            zf.writestr("history.ref", json.dumps(dict(fname=history_fname, n_rows=data.history.n_rows, n_bytes=data.history.n_bytes)))
+        elif data.history is not None:
             with zf.open("history.csv", "w", force_zip64=True) as f:
                 write_history(f, data.history)
         if data.summary is not None:
             with zf.open("summary.csv", "w", force_zip64=True) as f:
                 lines = [f"{k};{v}" for k,v in data.summary.items()]
                 f.write("\n".join(lines).encode("utf-8"))
-        for field in fields(RunData):
-            key = field.name
+        for key in ARRAY_FIELDS:
             value = getattr(data, key)
-            if (value is not None) and (key not in ['config', 'history', 'summary']):
-                with zf.open(key+".pkl", "w", force_zip64=True) as f:
-                    pickle.dump(value, f)
+            if value is None:
+                continue
+            if checkpoint_format == "tensors":
+                try:
+                    blobs.update(write_tree(zf, key, value, compression, blob_store))
+                    continue
+                except TypeError as e:
+                    LOGGER.warning(f"Cannot store {key} as tensors ({e}); storing it as pickle instead")
+            with zf.open(key+".pkl", "w", force_zip64=True) as f:
+                pickle.dump(value, f)
+    return blobs
+
+class CheckpointWriter:
+    """
+    Serialises and writes checkpoints in a background thread, so that training can continue while a checkpoint is written.
+
+    Jobs are executed one after another in submission order (i.e. a deletion of obsolete checkpoints never overtakes a save).
+    At most max_pending jobs can be in flight; further submissions block until a job has finished. Arrays must already be on the
+    host when a save is submitted (see snapshot_run_data), since the device buffers may be donated by the next optimization step.
+    """
+    def __init__(self, max_pending: int = 2):
+        assert max_pending >= 1, "At least one checkpoint must be allowed to be in flight"
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint_writer")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = []
+
+    def submit(self, func, *args, **kwargs):
+        self._slots.acquire()
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._on_done)
+        self._pending = [f for f in self._pending if not f.done()] + [future]
+        return future
 
-def load_run(fname, parse_config=True, parse_csv=False, load_pkl=True):
+    def _on_done(self, future):
+        self._slots.release()
+        if future.exception() is not None:
+            LOGGER.error(f"Background checkpoint job failed: {future.exception()!r}")
+
+    def wait(self):
+        """Blocks until all submitted jobs have finished"""
+        pending, self._pending = self._pending, []
+        concurrent.futures.wait(pending)
+
+    def shutdown(self):
+        self.wait()
+        self._executor.shutdown(wait=True)
+
+
+_checkpoint_writer: Optional[CheckpointWriter] = None
+
+
+def configure_checkpoint_writer(background: bool, max_pending: int = 2):
+    """Enables (or disables) writing checkpoints in a background thread for this process"""
+    global _checkpoint_writer
+    if _checkpoint_writer is not None:
+        _checkpoint_writer.shutdown()
+    _checkpoint_writer = CheckpointWriter(max_pending) if background else None
+
+
+def wait_for_pending_checkpoints():
+    """Blocks until all checkpoints, which are being written in the background, are complete"""
+    if _checkpoint_writer is not None:
+        n_pending = len([f for f in _checkpoint_writer._pending if not f.done()])
+        if n_pending:
+            LOGGER.debug(f"Waiting for {n_pending} pending checkpoint jobs")
+        _checkpoint_writer.wait()
+
+
+atexit.register(wait_for_pending_checkpoints)
+
+
+def snapshot_run_data(data: RunData) -> RunData:
+    """Returns a copy of the run data, in which all arrays have been transferred to the host and all mutable containers are copied"""
+    data = RunData(**{f.name: getattr(data, f.name) for f in fields(RunData)})
+    for key in ["params", "ema_params", "fixed_params", "opt_state", "mcmc_state", "clipping_state"]:
+        setattr(data, key, jax.device_get(getattr(data, key)))
+    if (data.history is not None) and not isinstance(data.history, HistoryFileReference):
+        data.history = list(data.history)
+    if data.summary is not None:
+        data.summary = dict(data.summary)
+    if data.metadata is not None:
+        data.metadata = dict(data.metadata)
+    return data
+
+
+def save_run_async(fname, data: RunData, checkpoint_format: str = "pickle", compression: Optional[str] = None,
+                   blob_dir: Optional[str] = None):
+    """Saves the run data in the background writer if enabled (see configure_checkpoint_writer), otherwise immediately"""
+    if _checkpoint_writer is None:
+        save_run(fname, data, checkpoint_format, compression, blob_dir)
+    else:
+        _checkpoint_writer.submit(save_run, fname, snapshot_run_data(data), checkpoint_format, compression, blob_dir)
+
+
+class LazyRunData(RunData):
+    """
+    RunData, whose parts are only read and decoded from the checkpoint file on first access (see load_run with lazy=True).
+
+    Assigning a part discards its pending loader.
+    """
+    def __init__(self, loaders: Dict[str, Callable[[], Any]]):
+        object.__setattr__(self, "_loaders", {})
+        super().__init__()
+        object.__setattr__(self, "_loaders", dict(loaders))
+
+    def __getattribute__(self, name):
+        loaders = object.__getattribute__(self, "_loaders")
+        if name in loaders:
+            object.__setattr__(self, name, loaders.pop(name)())
+        return object.__getattribute__(self, name)
+
+    def __setattr__(self, name, value):
+        object.__getattribute__(self, "_loaders").pop(name, None)
+        object.__setattr__(self, name, value)
+
+
+def _get_part_loader(fname, members, key, parse_config=True, mmap=False, strict=True) -> Optional[Callable[[], Any]]:
+    """Returns a function, which reads and decodes a single part of a checkpoint, or None if the part is not in the checkpoint"""
+    def _read_member(member, decode):
+        def _load():
+            with zipfile.ZipFile(fname, "r") as zf:
+                with zf.open(member, "r") as f:
+                    return decode(f)
+        return _load
+
+    if key == "config" and ("config.yml" in members):
+        return _read_member("config.yml", Configuration.load if parse_config else ruamel.yaml.YAML().load)
+    if key == "history" and ("history.bin" in members):
+        # Exported checkpoints contain a copy of the history
+        return _read_member("history.bin", lambda f: read_history_dataframe(f.read()))
+    if key == "history" and ("history.ref" in members):
+        def _read_history_file(f):
+            ref = _decode_history_reference(fname, f)
+            return read_history_dataframe(ref.fname, n_rows=ref.n_rows)
+        return _read_member("history.ref", _read_history_file)
+    if f"{key}.csv" in members:
+        def _read_csv(f):
+            import pandas as pd
+            return pd.read_csv(f, sep=";")
+        return _read_member(f"{key}.csv", _read_csv)
+    if f"{key}.json" in members:
+        def _load_tree():
+            with zipfile.ZipFile(fname, "r") as zf:
+                return read_tree(fname, zf, key, mmap, strict)
+        return _load_tree
+    if f"{key}.pkl" in members:
+        return _read_member(f"{key}.pkl", pickle.load)
+    return None
+
+
+def _decode_history_reference(fname, f) -> HistoryFileReference:
+    ref = json.load(f)
+    return HistoryFileReference(os.path.join(os.path.dirname(os.path.abspath(fname)), ref["fname"]), ref["n_rows"], ref["n_bytes"])
+
+
+def load_history_reference(fname) -> Optional[HistoryFileReference]:
+    """Returns the reference to the rows of the run's history file, which a checkpoint contains, or None if it has no such reference"""
+    with zipfile.ZipFile(fname, "r") as zf:
+        if "history.ref" not in zf.namelist():
+            return None
+        with zf.open("history.ref", "r") as f:
+            return _decode_history_reference(fname, f)
+
+
+def load_run(fname, parse_config=True, parse_csv=False, load_pkl=True, mmap=False, parts: Optional[List[str]] = None, lazy=False,
+             strict=True):
+    """
+    Loads a checkpoint written by save_run (in either format).
+
+    Args:
+        parse_config: Parse the config into a Configuration object. Otherwise it is returned as (raw) dict
+        parse_csv: Load history and summary as pandas DataFrames. Ignored if parts is given
+        load_pkl: Load the array fields (params, opt_state, mcmc_state, etc.). Ignored if parts is given
+        mmap: For checkpoints in the 'tensors' format, return uncompressed arrays as read-only memory-maps into the file, which are
+            only read from disk when accessed
+        parts: Names of the RunData fields to load, e.g. ["config", "params"]; all other fields are None.
+            None: the config, history/summary if parse_csv and all array fields if load_pkl
+        lazy: Return a LazyRunData, which only reads and decodes each part on first access
+        strict: For checkpoints in the 'tensors' format, fail if the class of a stored object (e.g. a namedtuple or dataclass of
+            haiku/kfac_jax) cannot be imported. Otherwise, its fields are returned as dict
+    """
+    with zipfile.ZipFile(fname, "r") as zf:
+        members = set(zf.namelist())
+    all_parts = [f.name for f in fields(RunData)]
+    if parts is None:
+        parts = ["config"] + (["history", "summary"] if parse_csv else []) + (ARRAY_FIELDS if load_pkl else [])
+    for key in parts:
+        assert key in all_parts, f"Unknown part of checkpoint: {key}; must be one of {all_parts}"
+
+    loaders = {key: _get_part_loader(fname, members, key, parse_config, mmap, strict) for key in parts}
+    loaders = {key: loader for key, loader in loaders.items() if loader is not None}
+    if lazy:
+        return LazyRunData(loaders)
     data = RunData()
-    with zipfile.ZipFile(fname, "r") as zip:
-        fnames = zip.namelist()
-        if "config.yml" in fnames:
-            with zip.open("config.yml", "r") as f:
-                if parse_config:
-                    data.config = Configuration.load(f)
-                else:
-                    data.config = ruamel.yaml.YAML().load(f)
-        for field in fnames:
-            key, extension = os.path.splitext(field)
-            if (extension == '.pkl') and load_pkl:
-                with zip.open(field, "r") as f:
-                    setattr(data, key, pickle.load(f))
-            elif (extension == '.csv') and parse_csv:
-                import pandas as pd
-                with zip.open(field, "r") as f:
-                    setattr(data, key, pd.read_csv(f, sep=";"))
+    for key, loader in loaders.items():
+        setattr(data, key, loader())
     return data
 
 
@@ -88,7 +321,7 @@ def load_data_for_reuse(config: Configuration, raw_config):
 
     if config.reuse.path is not None:
         # Load the old data; only parse the config if we want to reuse it, otherwise ignore
-        reuse_data = load_run(config.reuse.path, parse_config=config.reuse.reuse_config)
+        reuse_data = load_run(config.reuse.path, parse_config=config.reuse.reuse_config, lazy=True)
 
         if config.reuse.reuse_config:
             _, config = config.update_configdict_and_validate(reuse_data.config.dict(), build_flattend_dict(raw_config))
@@ -125,7 +358,7 @@ def load_data_for_reuse(config: Configuration, raw_config):
             params_to_reuse, _ = split_params(params_to_reuse, config.reuse.reuse_modules)
         logger.debug(f"Reusing {hk.data_structures.tree_size(params_to_reuse)} ema weights")
     if config.reuse.path_phisnet is not None:
-        phisnet_data = load_run(config.reuse.path_phisnet, parse_config=False)
+        phisnet_data = load_run(config.reuse.path_phisnet, parse_config=False, parts=["config", "params"])
         phisnet_params = phisnet_data.params
         phisnet_params = jax.tree_util.tree_map(jax.numpy.array, phisnet_params)
         logger.debug(f"Reusing {hk.data_structures.tree_size(phisnet_params)} PhisNet weights and reusing phisnet config from phisnet checkpoint")
@@ -146,12 +379,41 @@ def is_checkpoint_required(n_epoch: int, checkpoint_config: CheckpointConfig):
 
 
 def delete_obsolete_checkpoints(n_epoch, chkpt_config: CheckpointConfig, prefix="", directory="."):
+    if _checkpoint_writer is not None:
+        # Queue behind pending saves, so that checkpoints, which are still being written, are deleted as well
+        _checkpoint_writer.submit(_delete_obsolete_checkpoints, n_epoch, chkpt_config, prefix, directory)
+    else:
+        _delete_obsolete_checkpoints(n_epoch, chkpt_config, prefix, directory)
+
+
+def _delete_obsolete_checkpoints(n_epoch, chkpt_config: CheckpointConfig, prefix="", directory="."):
     fnames = [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
     for fname in fnames:
-        match = re.match(prefix + r"chkpt(\d+).zip", fname)
+        match = re.match(re.escape(prefix) + r"chkpt(\d+)\.zip$", fname)
         if not match:
             continue
         n = int(match.group(1))
         if (n < n_epoch) and (n % chkpt_config.keep_every_n_epochs) and (n not in chkpt_config.additional_n_epochs):
             logging.getLogger("dpe").debug(f"Deleting old checkpoint: {fname}")
-            os.remove(os.path.join(directory, fname))
\ No newline at end of file
+            os.remove(os.path.join(directory, fname))
+            _release_blobs(os.path.join(directory, fname))
+
+
+def delete_unreferenced_blobs(blob_dir: str):
+    """
+    Deletes the blobs, which have been created by this run and are no longer referenced by any of its checkpoints (or by any other
+    run sharing the blob store). Blobs of other runs are never deleted and no checkpoints are re-read (see BlobStore.delete_released)
+    """
+    if _checkpoint_writer is not None:
+        # Queue behind pending saves and deletions of checkpoints
+        _checkpoint_writer.submit(_delete_unreferenced_blobs, blob_dir)
+    else:
+        _delete_unreferenced_blobs(blob_dir)
+
+
+def _delete_unreferenced_blobs(blob_dir: str):
+    if not os.path.isdir(blob_dir):
+        return
+    n_deleted = get_blob_store(blob_dir).delete_released()
+    if n_deleted:
+        logging.getLogger("dpe").debug(f"Deleted {n_deleted} unreferenced checkpoint blobs in {blob_dir}")
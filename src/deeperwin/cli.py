@@ -15,8 +15,12 @@ def main(args=None):
         from deeperwin.process_molecule import process_single_molecule
         process_single_molecule(args.config_file)
     elif args.command == "convert-checkpoint":
-        from deeperwin.run_tools.convert_checkpoint import convert_checkpoint
-        convert_checkpoint(args.input_file, args.output_file)
+        if args.format is None:
+            from deeperwin.run_tools.convert_checkpoint import convert_checkpoint
+            convert_checkpoint(args.input_file, args.output_file)
+        else:
+            from deeperwin.run_tools.convert_checkpoint import convert_checkpoint_format
+            convert_checkpoint_format(args.input_file, args.output_file, args.format, args.compression)
     elif args.command == "run-multiple-shared":
         from deeperwin.process_molecule import process_multiple_molecules_shared
         process_multiple_molecules_shared(args.config_file)
@@ -29,6 +33,25 @@ def main(args=None):
     elif args.command == "train-phisnet":
         from deeperwin.run_tools.train_phisnet import train_phisnet
         train_phisnet(args.config_file)
+    elif args.command == "benchmark":
+        if args.cpu:
+            import os
+            os.environ["JAX_PLATFORMS"] = "cpu"
+        if args.benchmark == "wavefunction":
+            from deeperwin.run_tools.benchmark import main as run_benchmark
+            run_benchmark(args)
+        elif args.benchmark == "scaling":
+            from deeperwin.run_tools.benchmark_scaling import main as run_scaling_benchmark
+            run_scaling_benchmark(args)
+        elif args.benchmark == "mcmc":
+            from deeperwin.run_tools.benchmark_mcmc import main as run_mcmc_benchmark
+            run_mcmc_benchmark(args)
+        elif args.benchmark == "srcg":
+            from deeperwin.run_tools.benchmark_srcg import main as run_srcg_benchmark
+            run_srcg_benchmark(args)
+        elif args.benchmark == "checkpoint":
+            from deeperwin.run_tools.benchmark_checkpoint import main as run_checkpoint_benchmark
+            run_checkpoint_benchmark(args)
     elif args.command == "select-gpus":
         from deeperwin.run_tools.available_gpus import assign_free_GPU_ids
         print(assign_free_GPU_ids(n_gpus=args.n_gpus, sleep_seconds=args.sleep))
@@ -99,8 +122,65 @@ def _parse_input_args(args=None):
                                                  help="Convert a checkpoint from an old to a newer format to allow reuse with newer code versions")
     parser_convert_chkpt.add_argument("input_file", help="Filename of old checkpoint to convert")
     parser_convert_chkpt.add_argument("output_file", help="Target filename for converted checkpiont")
+    parser_convert_chkpt.add_argument("--format", choices=["pickle", "tensors"], default=None,
+                                      help="Re-write the checkpoint in the given file format instead of converting old parameter names")
+    parser_convert_chkpt.add_argument("--compression", choices=["zlib", "zstd", "lz4"], default=None,
+                                      help="Compression of the arrays when converting to the tensors format")
+
+
+    # Sub-parser for benchmarks
+    parser_benchmark = subparsers.add_parser("benchmark", help="Run performance benchmarks and write the results as JSON")
+    parser_benchmark.add_argument("--cpu", action="store_true", help="Run the benchmark on CPU, even if GPUs are available")
+    benchmark_subparsers = parser_benchmark.add_subparsers(dest="benchmark")
+    benchmark_subparsers.required = True
+    parser_benchmark_wf = benchmark_subparsers.add_parser("wavefunction",
+                                                          help="Time forward pass, gradient, local energy and optimizer step across embeddings")
+    parser_benchmark_wf.add_argument("--embeddings", nargs="+", default=["ferminet", "dpe4", "dpe1", "gnn", "transformer", "axial_transformer", "e3mpnn"])
+    parser_benchmark_wf.add_argument("--orbitals", nargs="+", default=["envelope", "baseline", "taos"])
+    parser_benchmark_wf.add_argument("--n-el", type=int, nargs="+", default=[4, 8, 16], help="Number of electrons (=length of the H-chain)")
+    parser_benchmark_wf.add_argument("--batch-size", type=int, nargs="+", default=[64, 256], help="Number of walkers")
+    parser_benchmark_wf.add_argument("--programs", nargs="+", default=["log_psi_sqr", "grad_r", "local_energy", "opt_step"])
+    parser_benchmark_wf.add_argument("--n-reps", type=int, default=3, help="Number of timed calls after the first (compiling) call")
+    parser_benchmark_wf.add_argument("--float64", action="store_true", help="Use double precision instead of single precision")
+    parser_benchmark_wf.add_argument("--output", "-o", default="benchmark_wavefunction.json", help="Output JSON file")
+    parser_benchmark_wf.add_argument("--compare", default=None, help="JSON file of a previous benchmark to compare against")
+    parser_benchmark_scaling = benchmark_subparsers.add_parser("scaling",
+                                                               help="Run a short optimization for a sweep over device count (emulated on CPU) and walker count")
+    parser_benchmark_scaling.add_argument("config_file", help="Config file of the optimization, e.g. sample_configs/getting_started/config_basic.yml")
+    parser_benchmark_scaling.add_argument("--n-devices", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser_benchmark_scaling.add_argument("--n-walkers", type=int, nargs="+", default=[256, 1024])
+    parser_benchmark_scaling.add_argument("--n-epochs", type=int, default=20, help="Number of timed optimization epochs per point")
+    parser_benchmark_scaling.add_argument("--n-warmup-epochs", type=int, default=3, help="Number of untimed epochs (incl. compilation) per point")
+    parser_benchmark_scaling.add_argument("--output", "-o", default="benchmark_scaling.json", help="Output JSON file")
+    parser_benchmark_mcmc = benchmark_subparsers.add_parser("mcmc", help="Compare MCMC proposals by acceptance, autocorrelation and effective samples per second")
+    parser_benchmark_mcmc.add_argument("--proposals", nargs="+", default=["normal", "cauchy", "langevin", "local", "normal_one_el", "local_one_el"])
+    parser_benchmark_mcmc.add_argument("--checkpoint", default=None, help="Checkpoint of a trained wavefunction to sample; default: baseline wavefunction of each molecule")
+    parser_benchmark_mcmc.add_argument("--molecules", nargs="+", default=["LiH", "C", "N2", "Ethene"], help="Molecules to sample with their baseline wavefunction")
+    parser_benchmark_mcmc.add_argument("--n-walkers", type=int, default=256)
+    parser_benchmark_mcmc.add_argument("--n-burn-in", type=int, default=500)
+    parser_benchmark_mcmc.add_argument("--n-samples", type=int, default=200, help="Number of recorded local energies per walker")
+    parser_benchmark_mcmc.add_argument("--n-steps-per-sample", type=int, default=1, help="Number of MCMC steps between recorded local energies")
+    parser_benchmark_mcmc.add_argument("--float64", action="store_true", help="Use double precision instead of single precision")
+    parser_benchmark_mcmc.add_argument("--output", "-o", default="benchmark_mcmc.json", help="Output JSON file")
+    parser_benchmark_mcmc.add_argument("--report", default="benchmark_mcmc.md", help="Output file for the comparison report")
+    parser_benchmark_srcg = benchmark_subparsers.add_parser("srcg",
+                                                            help="Compare time per step and energy convergence of SRCG with/without CG tolerance and low-precision matvecs")
+    parser_benchmark_srcg.add_argument("config_file", help="Config file of an optimization using the srcg optimizer")
+    parser_benchmark_srcg.add_argument("--variants", nargs="+", default=["maxiter", "tol"],
+                                       help="Variants to run; low_precision and tol_low_precision require --fisher-matmul-dtype")
+    parser_benchmark_srcg.add_argument("--cg-tol", type=float, default=1e-3, help="Relative residual tolerance of the tol-variants")
+    parser_benchmark_srcg.add_argument("--fisher-matmul-dtype", default=None, choices=["float16", "bfloat16", "float32"],
+                                       help="Dtype of the Fisher matrix-vector products of the low_precision-variants")
+    parser_benchmark_srcg.add_argument("--n-epochs", type=int, default=200, help="Number of optimization epochs per variant")
+    parser_benchmark_srcg.add_argument("--n-warmup-epochs", type=int, default=3, help="Number of epochs (incl. compilation) excluded from the timings")
+    parser_benchmark_srcg.add_argument("--output", "-o", default="benchmark_srcg.json", help="Output JSON file")
+    parser_benchmark_chkpt = benchmark_subparsers.add_parser("checkpoint", help="Compare save time, load time and file size of the checkpoint formats")
+    parser_benchmark_chkpt.add_argument("checkpoint", help="Checkpoint (of any format) to re-write in each format")
+    parser_benchmark_chkpt.add_argument("--variants", nargs="+", default=["pickle_bzip2", "tensors", "tensors_zlib", "tensors_zstd", "tensors_lz4"])
+    parser_benchmark_chkpt.add_argument("--n-reps", type=int, default=3, help="Number of saves/loads per variant (the median is reported)")
+    parser_benchmark_chkpt.add_argument("--tmp-dir", default=None, help="Directory for the temporary checkpoints; default: system temp dir")
+    parser_benchmark_chkpt.add_argument("--output", "-o", default="benchmark_checkpoint.json", help="Output JSON file")
 
-   
     # Allowed args: None (uses sys.argv[1:]), list or string
     if args is not None:
         if isinstance(args, str):
@@ -1014,6 +1014,22 @@ class LocalStepsizeProposalConfig(ConfigBaseclass):
     r_max: float = 1
     """Max stepsize for electron move"""
 
+class MCMCAdaptiveInterStepsConfig(ConfigBaseclass):
+    """Config for adapting the number of MCMC inter-steps to the measured autocorrelation time of the chain"""
+
+    min_inter_steps: int = 5
+    """Lower bound for the number of MCMC steps between epochs"""
+
+    max_inter_steps: int = 100
+    """Upper bound for the number of MCMC steps between epochs"""
+
+    target_tau_factor: float = 2.0
+    """Number of MCMC steps between epochs, in units of the estimated integrated autocorrelation time"""
+
+    smoothing: float = 0.9
+    """Factor for the exponential moving average of the autocorrelation time across epochs"""
+
+
 class MCMCConfig(ConfigBaseclass):
     """Config for Markov-Chain-Monte-Carlo integration"""
 
@@ -1047,6 +1063,21 @@ class MCMCConfig(ConfigBaseclass):
     proposal: Union[MCMCSimpleProposalConfig, LocalStepsizeProposalConfig, MCMCLangevinProposalConfig] = MCMCSimpleProposalConfig()
     """Type of proposal function to use for MCMC steps"""
 
+    determinant_updates: Literal["full", "sherman_morrison"] = "full"
+    """How to evaluate the acceptance ratio of a proposed move. 'full' re-evaluates the wavefunction for all electrons. 'sherman_morrison' keeps the inverse Slater matrices in the MCMC state and uses rank-1 determinant updates; requires a single-electron proposal and orbitals that only depend on their own electron. This is only supported for pre-training with sampling_density='reference'; optimization and evaluation sample the wavefunction, whose orbitals depend on all electrons, and reject this option."""
+
+    determinant_refresh_interval: int = 100
+    """Number of MCMC steps after which the inverse Slater matrices are re-computed from scratch when using sherman_morrison determinant updates"""
+
+    delayed_acceptance: bool = False
+    """Use two-stage (delayed-acceptance) Metropolis-Hastings: Proposals are first screened with the baseline (HF/CASSCF) wavefunction and only the survivors need to be evaluated with the full wavefunction. Detailed balance w.r.t. the full wavefunction is kept exactly by the second stage. Requires baseline orbitals or transferable atomic orbitals in the model."""
+
+    delayed_acceptance_capacity: float = 0.5
+    """Fraction of walkers for which the full wavefunction is evaluated in a compacted batch during delayed acceptance. If more walkers survive the first stage, the full wavefunction is evaluated for all walkers."""
+
+    adaptive_inter_steps: Optional[MCMCAdaptiveInterStepsConfig] = None
+    """Adapt the number of MCMC steps between epochs to the measured autocorrelation time. n_inter_steps is then only used as initial value. None: always use n_inter_steps"""
+
 class MCMCConfigPreTrain(MCMCConfig):
     n_inter_steps = 1
     n_burn_in = 0
@@ -1156,6 +1187,12 @@ class OptimizerConfigKFAC(ConfigBaseclass):
     update_inverse_period: int = 1
     """Period of how often the fisher matrix is being updated (in batches). e.g. update_inverse_period==1 means that it is updated after every gradient step."""
 
+    async_inverses: bool = False
+    """Compute the inverses of the Kronecker factors asynchronously on the host CPU (every update_inverse_period steps), instead of inside the optimizer step on the training devices. Steps use the latest finished inverses, which may be up to max_inverse_staleness steps old"""
+
+    max_inverse_staleness: int = 10
+    """Maximum age (in optimizer steps, >= 1) of the asynchronously computed inverses. If the inverses are older, the optimizer step waits for the pending inversion. Only used with async_inverses"""
+
     n_burn_in: int = 0
     min_damping: float = 1e-4
     curvature_ema: float = 0.95
@@ -1213,6 +1250,31 @@ class SRCGOptimizerConfig(ConfigBaseclass):
     maxiter: int = 100
     linearize_jvp: bool = True
 
+    cg_tol: float = 1e-5
+    """Relative residual |S x - g| / |g|, at which CG is stopped before reaching maxiter. 0: always run maxiter iterations"""
+
+    fisher_matmul_dtype: Optional[Literal["float16", "bfloat16", "float32"]] = None
+    """Dtype of the dense layers (inputs and weights of all hk.Linear layers) in the JVP/VJP of the Fisher matrix-vector products of CG. The batch (electron and ion coordinates, fixed parameters), all other parameters, determinants, reductions over electrons and walkers, the reductions across devices and the CG iteration are always kept in (at least) float32. None: use the parameter dtype"""
+
+    solver: Literal["cg", "woodbury"] = "cg"
+    """How to solve S x = g for the natural gradient. 'cg': conjugate gradients in parameter space. 'woodbury': exact solve in the (n_samples x n_samples) sample space via the Woodbury identity, which is much cheaper when the number of parameters far exceeds the total number of walkers. Requires the per-sample Jacobian of all devices in memory; preconditioner, initial_guess and maxiter are ignored"""
+
+    jacobian_chunk_size: Optional[int] = 64
+    """Number of walkers, for which per-sample gradients are computed at once when building the Jacobian for the woodbury solver. None: all walkers at once"""
+
+
+class LocalEnergyConfig(ConfigBaseclass):
+    """Config for the computation of local energies"""
+
+    laplacian: Literal["loop", "forward", "hutchinson"] = "loop"
+    """How to compute the laplacian of log(psi^2). loop: linearize the gradient and loop over all 3N coordinates (low memory). forward: propagate value, gradient and laplacian forward through the network in a single pass (forward laplacian; faster, but every activation carries its jacobian w.r.t. all 3N coordinates). hutchinson: unbiased stochastic estimate from n_hutchinson_probes random probe vectors; only supported for optimization, evaluation always needs an exact laplacian"""
+
+    n_hutchinson_probes: int = 4
+    """Number of Rademacher probe vectors per walker for the hutchinson laplacian estimator. At least 2 probes are required to estimate the variance added by the estimator"""
+
+    chunk_size: Optional[int] = None
+    """Maximum number of walkers per device for which local energies are computed simultaneously. Larger batches are processed sequentially in chunks of this size to bound the memory required for the laplacian. None: all walkers at once"""
+
 
 class ForceEvaluationConfig(ConfigBaseclass):
     use: bool = True
@@ -1226,6 +1288,8 @@ class EvaluationConfig(ConfigBaseclass):
     n_epochs: int = 10_000
     calculate_energies: bool = True
     forces: Optional[ForceEvaluationConfig] = None
+    local_energy: LocalEnergyConfig = LocalEnergyConfig()
+    """How to compute local energies during evaluation"""
 
 class IntermediateEvaluationConfig(EvaluationConfig):
     mcmc: MCMCConfigEvaluation = MCMCConfigEvaluation()
@@ -1260,6 +1324,16 @@ class DistortionConfig(ConfigBaseclass):
     init_distortion_age: Literal["random", "zero"] = "random"
 
 
+class ShapeBucketingConfig(ConfigBaseclass):
+    """Pads all geometries of a shared optimization with ghost electrons and ions to a small set of shapes (buckets), so that only one program per bucket needs to be compiled instead of one per molecule"""
+
+    electron_bucket_size: int = 4
+    """Number of up- and dn-electrons are each padded to the next multiple of this value (capped by the largest molecule)"""
+
+    ion_bucket_size: int = 4
+    """Number of ions is padded to the next multiple of this value (capped by the largest molecule)"""
+
+
 class SharedOptimizationConfig(ConfigBaseclass):
     use: bool = True
 
@@ -1278,6 +1352,12 @@ class SharedOptimizationConfig(ConfigBaseclass):
 
     distortion: Optional[DistortionConfig] = None
 
+    shape_bucketing: Optional[ShapeBucketingConfig] = None
+    """Pad geometries to shape buckets during shared pre-training and optimization to avoid re-compilation for every molecule. None: use the exact shape of each molecule"""
+
+    deduplicate_checkpoints: bool = False
+    """Store the arrays of the per-geometry checkpoints in a common content-addressed blob store (logging.pickle.checkpoint_blob_dir, which is set to checkpoint_blobs if it is None), so that the shared parameters and optimizer state are stored once per checkpoint epoch instead of once per geometry, and unchanged fixed_params are never rewritten. Every geometry checkpoint contains the optimizer state and can be restored on its own. Requires the tensors checkpoint format"""
+
 
 class CheckpointConfig(ConfigBaseclass):
     replace_every_n_epochs: int = 1000
@@ -1310,6 +1390,9 @@ class OptimizationConfig(ConfigBaseclass):
     clipping: ClippingConfig = ClippingConfig()
     """Config for clipping the local energies in the loss function. Clipping significantly improves optimization stability."""
 
+    local_energy: LocalEnergyConfig = LocalEnergyConfig()
+    """How to compute local energies during optimization"""
+
     intermediate_eval: IntermediateEvaluationConfig = IntermediateEvaluationConfig()
     """Config for running intermediate evaluation runs during wavefunction optimization to obtain accurate estimates of current accuracy"""
 
@@ -1324,10 +1407,31 @@ class OptimizationConfig(ConfigBaseclass):
 
     init_clipping_with_None: bool = False
 
+    metrics_flush_every: int = 1
+    """Number of epochs for which metrics are kept on the devices before being transferred to the host and logged in bulk. Larger values avoid blocking the host every epoch, but delay the detection of non-finite energies (stop_on_nan) by up to this many epochs"""
+
+    async_metrics: bool = False
+    """Transfer and log buffered metrics from a background thread"""
+
+    epochs_per_dispatch: Optional[int] = None
+    """If set, fuse cache refresh, MCMC inter-steps, local energies and parameter update of each epoch into a single compiled program and run this many epochs per dispatch to the devices. Only scalar metrics are transferred to the host; per-walker quantities are not logged. Requires an optimizer with a traceable step, i.e. srcg or a standard optax optimizer (e.g. adam), and is not supported for kfac; None uses the regular epoch loop"""
+
     @property
     def n_epochs_total(self):
         return self.n_epochs_prev + self.n_epochs
 
+    @root_validator
+    def fused_epochs_require_traceable_optimizer(cls, values):
+        if values.get("epochs_per_dispatch") is None:
+            return values
+        optimizer = values.get("optimizer")
+        if not isinstance(optimizer, (StandardOptimizerConfig, SRCGOptimizerConfig)):
+            raise ValueError(f"epochs_per_dispatch is not supported for optimizer {getattr(optimizer, 'name', None)}: Fused epochs require "
+                             f"srcg or a standard optax optimizer (e.g. adam)")
+        if values["epochs_per_dispatch"] < 1:
+            raise ValueError(f"epochs_per_dispatch must be >= 1, got {values['epochs_per_dispatch']}")
+        return values
+
     # @root_validator
     # def scale_lr_for_shared_modules(cls, values):
     #     if values['shared_optimization'] is None:
@@ -1682,6 +1786,21 @@ class BasicLoggerConfig(LoggerBaseConfig):
 class PickleLoggerConfig(LoggerBaseConfig):
     fname: str = 'results.bz2'
 
+    checkpoint_format: Literal["pickle", "tensors"] = "pickle"
+    """File format of checkpoints. pickle: BZIP2-compressed pickles. tensors: tree structure as JSON and arrays as raw buffers, which is faster to write and read, can be memory-mapped when loading, and does not depend on the pickled classes of haiku/kfac_jax"""
+
+    checkpoint_compression: Optional[Literal["zlib", "zstd", "lz4"]] = None
+    """Fast (level 1) compression of the arrays in tensors-checkpoints. zstd and lz4 require the zstandard and lz4 packages. Compressed arrays cannot be memory-mapped when loading. None: store uncompressed"""
+
+    incremental_history: bool = False
+    """Append the metric history incrementally to history.bin (a columnar, append-only file, see deeperwin.utils.history_store) in the output directory. Checkpoints then only reference the rows written so far instead of containing the history, i.e. they can only be loaded together with history.bin (use convert-checkpoint to obtain a self-contained checkpoint). A run restarted from a checkpoint in the same directory continues history.bin after the rows of the checkpoint. Otherwise the full history is kept in memory and written as history.csv into every checkpoint"""
+
+    history_flush_every: int = 1000
+    """Number of history rows, which are buffered in memory before being appended to history.bin. Buffered rows are also flushed before every checkpoint"""
+
+    checkpoint_blob_dir: Optional[str] = None
+    """Directory (relative to the working directory of the run), in which the arrays of tensors-checkpoints are stored as content-addressed blobs instead of inside each checkpoint, so that identical arrays (e.g. the shared parameters of all geometries of a shared optimization) are only stored once. Checkpoints then only remain loadable together with this directory; use convert-checkpoint to obtain a self-contained checkpoint. Blobs are only deleted by the run that created them, once no checkpoint of any run sharing the directory references them. None: store arrays inside each checkpoint, unless optimization.shared_optimization.deduplicate_checkpoints is enabled"""
+
 
 class LoggingConfig(ConfigBaseclass):
     tags: List[str] = []
@@ -1732,6 +1851,37 @@ class ComputationConfig(ConfigBaseclass):
     float_precision: Literal["float32", "float64"] = "float32"
     disable_tensor_cores: bool = True
     use_profiler: bool = False
+    """Measure the device-synchronised wall time of each phase of an optimization epoch (MCMC, optimizer step, checkpointing, logging) and log it as opt_t_<phase>. Synchronisation slightly reduces throughput. Only whole compiled programs are timed: the laplacian, the potential energy and the clipping/reductions of the loss are part of the optimizer step (opt_t_opt_step) and are not reported separately; use profiler_trace_epochs to resolve them"""
+
+    profiler_trace_epochs: Optional[List[int]] = None
+    """Optimization epochs [start, end) for which a JAX profiler trace is recorded. None disables tracing"""
+
+    profiler_trace_dir: str = "profiler_trace"
+    """Directory to which the JAX profiler trace is written"""
+
+    n_init_workers: int = 1
+    """Number of processes to initialize the fixed parameters (e.g. baseline calculations) of multiple geometries in parallel. 1 initializes all geometries serially in the main process"""
+
+    baseline_cache_dir: Optional[str] = None
+    """Directory of a persistent cache for baseline solutions (HF/CASSCF orbitals and energies), which is shared between runs, restarts and local processes. None disables the cache"""
+
+    baseline_cache_max_size_mb: float = 1000
+    """Maximum size of the baseline cache; least recently used entries are evicted beyond this size"""
+
+    compilation_cache_dir: Optional[str] = None
+    """Directory of a persistent XLA compilation cache, which is shared between runs and restarts. None disables the cache"""
+
+    compilation_cache_min_compile_time_secs: float = 1.0
+    """Only programs, whose compilation takes at least this long, are stored in the persistent compilation cache"""
+
+    n_aot_warmup_threads: int = 0
+    """Number of threads to compile the programs of the optimization ahead-of-time and in parallel before the burn-in. 0 disables the warm-up"""
+
+    background_checkpoints: bool = False
+    """Serialise and write checkpoints in a background thread, so that training continues while a checkpoint is written. Arrays are copied to the host before training continues"""
+
+    max_pending_checkpoints: int = 2
+    """Maximum number of checkpoints being written in the background at the same time; saving a further checkpoint blocks until one has finished"""
 
 
 class PreTrainingConfig(ConfigBaseclass):
@@ -1817,6 +1967,28 @@ class Configuration(ConfigBaseclass):
                 values['experiment_name'] = values["physical"].name
         return values
 
+    @root_validator
+    def delayed_acceptance_requires_baseline_orbitals(cls, values):
+        mcmc_configs = [values[key].mcmc for key in ["pre_training", "optimization", "evaluation"] if values.get(key) is not None]
+        if (values.get("model") is None) or not any(mcmc.delayed_acceptance for mcmc in mcmc_configs):
+            return values
+        orbitals = values["model"].orbitals
+        if (orbitals.baseline_orbitals is None) and (orbitals.transferable_atomic_orbitals is None):
+            raise ValueError("Delayed-acceptance MCMC uses the baseline (HF/CASSCF) wavefunction as surrogate and therefore requires "
+                             "model.orbitals.baseline_orbitals or model.orbitals.transferable_atomic_orbitals")
+        return values
+
+    @root_validator
+    def sherman_morrison_only_for_reference_sampling(cls, values):
+        for key in ["optimization", "evaluation"]:
+            if (values.get(key) is not None) and (values[key].mcmc.determinant_updates != "full"):
+                raise ValueError(f"{key}.mcmc.determinant_updates='sherman_morrison' is not supported: The orbitals of the wavefunction "
+                                 f"depend on all electrons, so a one-electron move is not a rank-1 update of the Slater matrices")
+        pretrain_config = values.get("pre_training")
+        if (pretrain_config is not None) and (pretrain_config.mcmc.determinant_updates != "full") and (pretrain_config.sampling_density != "reference"):
+            raise ValueError("pre_training.mcmc.determinant_updates='sherman_morrison' requires pre_training.sampling_density='reference'")
+        return values
+
     # @root_validator
     # def no_reuse_while_shared(cls, values):
     #     if (values['optimization'].shared_optimization is not None) and (values['reuse'] is not None):
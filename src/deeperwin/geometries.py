@@ -1,12 +1,13 @@
 from dataclasses import dataclass
-from typing import Dict, Tuple
+from typing import Dict, Tuple, Optional
 import scipy
 from jax import numpy as jnp
 from deeperwin.configuration import Configuration, PhysicalConfig, DistortionConfig
 from deeperwin.loggers import LoggerCollection, WavefunctionLogger
 from deeperwin.mcmc import MCMCState
+from deeperwin.bucketing import ShapeBucket, get_geometry_shape, pad_fixed_params, pad_mcmc_state, unpad_mcmc_state
 from deeperwin.run_tools.dispatch import idx_to_job_name
-from deeperwin.utils.utils import LOGGER, get_el_ion_distance_matrix, setup_job_dir, PERIODIC_TABLE, ANGSTROM_IN_BOHR
+from deeperwin.utils.utils import LOGGER, get_from_devices, get_el_ion_distance_matrix, setup_job_dir, PERIODIC_TABLE, ANGSTROM_IN_BOHR
 from deeperwin.utils.setup_utils import initialize_training_loggers
 import numpy as np
 
@@ -30,6 +31,8 @@ class GeometryDataStore:
     n_opt_epochs: int = 0
     n_opt_epochs_last_dist: int = 0
     last_epoch_optimized: int = 0
+    bucket: Optional[ShapeBucket] = None
+    unpadded_fixed_params: Dict = None
 
 
     def init_wave_function_logger(self, config: Configuration, params: Dict) -> None:
@@ -38,6 +41,40 @@ class GeometryDataStore:
         loggers = initialize_training_loggers(config, params, self.fixed_params, True, self.idx, job_dir, True)
         self.wavefunction_logger = WavefunctionLogger(loggers, prefix="opt", n_step=config.optimization.n_epochs_prev, smoothing=0.05)
 
+    @property
+    def shape(self) -> ShapeBucket:
+        """Shape (n_up, n_dn, n_ions) of the geometry as seen by the model, i.e. including ghost particles"""
+        return self.bucket or get_geometry_shape(self.physical_config)
+
+    def apply_shape_bucket(self, bucket: ShapeBucket) -> None:
+        """
+        Pads the geometry with ghost particles to the shape of the bucket (see deeperwin.bucketing).
+
+        spin_state, mcmc_state and fixed_params are replaced by their padded counterparts. The original fixed_params are kept in
+        unpadded_fixed_params; fixed_params and mcmc_state must not be replicated/split across devices.
+        """
+        self.bucket = bucket
+        self.unpadded_fixed_params = self.fixed_params
+        self.fixed_params = pad_fixed_params(self.fixed_params, self.physical_config, bucket)
+        self.mcmc_state = pad_mcmc_state(self.mcmc_state, self.physical_config, bucket)
+        self.spin_state = (bucket.n_up, bucket.n_dn)
+
+    def get_unpadded_state(self) -> Tuple[Dict, MCMCState]:
+        """Returns fixed_params (on the host) and merged mcmc_state of the original geometry, e.g. for checkpoints and evaluation"""
+        mcmc_state = self.mcmc_state.merge_devices()
+        if self.bucket is None:
+            return get_from_devices(self.fixed_params), mcmc_state
+        return self.unpadded_fixed_params, unpad_mcmc_state(mcmc_state, self.physical_config, self.bucket)
+
+    def remove_shape_bucket(self) -> None:
+        """Reverts apply_shape_bucket; afterwards fixed_params are on the host and mcmc_state is merged"""
+        if self.bucket is None:
+            return
+        self.fixed_params, self.mcmc_state = self.get_unpadded_state()
+        self.spin_state = (self.physical_config.n_up, self.physical_config.n_dn)
+        self.bucket = None
+        self.unpadded_fixed_params = None
+
 def parse_xyz(xyz_content):
     """
     Parse the content of an XYZ file
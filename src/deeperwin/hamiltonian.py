@@ -4,15 +4,18 @@ Computation of local energies and forces.
 import jax
 import numpy as np
 from jax import numpy as jnp
-from deeperwin.configuration import ForceEvaluationConfig
+from deeperwin.configuration import ForceEvaluationConfig, LocalEnergyConfig
+from deeperwin.utils.forward_laplacian import forward_laplacian
 from deeperwin.utils.utils import get_el_ion_distance_matrix, get_full_distance_matrix
 import functools
 
-def get_el_el_potential_energy(r_el):
+def get_el_el_potential_energy(r_el, el_mask=None):
     n_el = r_el.shape[-2]
     eye = jnp.eye(n_el)
     dist_matrix = get_full_distance_matrix(r_el)
     E_pot = jnp.triu(1.0 / (dist_matrix + eye), k=1)  # add eye to diagonal to prevent div/0
+    if el_mask is not None:
+        E_pot *= el_mask[:, None] * el_mask[None, :]
     return jnp.sum(E_pot, axis=[-2, -1])
 
 
@@ -25,11 +28,19 @@ def get_ion_ion_potential_energy(R, Z):
     return jnp.sum(E_pot, axis=[-2, -1])
 
 
-def get_potential_energy(r, R, Z):
+def get_potential_energy(r, R, Z, E_pot_ion_ion=None, el_mask=None):
+    """
+    E_pot_ion_ion only depends on the geometry and can be passed in to avoid recomputing it for every walker.
+    For geometries padded with ghost particles, el_mask excludes all interactions of ghost electrons; ghost ions have Z=0 and do not interact.
+    """
     _, dist_el_ion = get_el_ion_distance_matrix(r, R)
-    E_pot_el_ions = -jnp.sum(Z / dist_el_ion, axis=[-2, -1])
-    E_pot_el_el = get_el_el_potential_energy(r)
-    E_pot_ion_ion = get_ion_ion_potential_energy(R, Z)
+    E_pot_el_ions = Z / dist_el_ion
+    if el_mask is not None:
+        E_pot_el_ions *= el_mask[:, None]
+    E_pot_el_ions = -jnp.sum(E_pot_el_ions, axis=[-2, -1])
+    E_pot_el_el = get_el_el_potential_energy(r, el_mask)
+    if E_pot_ion_ion is None:
+        E_pot_ion_ion = get_ion_ion_potential_energy(R, Z)
     return E_pot_el_el + E_pot_el_ions + E_pot_ion_ion
 
 
@@ -49,6 +60,127 @@ def get_kinetic_energy(log_psi_squared, trainable_params, spin_state, r, R, Z, f
     laplacian = 0.25 * jnp.sum(grad_value**2) + 0.5 * jax.lax.fori_loop(0, n_coords, _loop_body, 0.0)
     return -0.5 * laplacian
 
+
+def get_kinetic_energy_forward_laplacian(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params):
+    """
+    Forward laplacian: Value, gradient and laplacian of log(psi^2) are propagated forward through the network in a single pass.
+
+    Every intermediate quantity carries its Jacobian w.r.t. the 3N electron coordinates and its summed laplacian (see
+    deeperwin.utils.forward_laplacian), so no reverse-mode pass and no loop over the 3N coordinates is required.
+    """
+    psi_func = lambda r: log_psi_squared(trainable_params, *spin_state, r, R, Z, fixed_params)
+    _, grad_value, laplacian = forward_laplacian(psi_func)(r)
+    laplacian = 0.25 * jnp.sum(grad_value**2) + 0.5 * laplacian
+    return -0.5 * laplacian
+
+
+def get_kinetic_energy_hutchinson(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params, rng, n_probes):
+    """
+    Unbiased stochastic estimate of the kinetic energy, using the Hutchinson trace estimator tr(H) = E[v^T H v] for the laplacian.
+
+    Requires n_probes Hessian-vector products instead of 3N. The gradient term is computed exactly.
+
+    Returns:
+        Tuple of (E_kin, variance of the E_kin estimate). The variance is nan for a single probe vector.
+    """
+    grad_psi_func = lambda r: jax.grad(log_psi_squared, argnums=3)(trainable_params,
+                                                                   *spin_state,
+                                                                   r.reshape([-1, 3]),
+                                                                   R, Z, fixed_params
+                                                                   ).flatten()
+
+    grad_value, jvp_func = jax.linearize(grad_psi_func, r.flatten())
+    probes = jax.random.rademacher(rng, (n_probes, grad_value.shape[0]), dtype=r.dtype)
+    hessian_quad_forms = jnp.sum(jax.vmap(jvp_func)(probes) * probes, axis=-1)
+    laplacian = 0.25 * jnp.sum(grad_value**2) + 0.5 * jnp.mean(hessian_quad_forms)
+    laplacian_var = 0.25 * jnp.var(hessian_quad_forms, ddof=1) / n_probes
+    return -0.5 * laplacian, 0.25 * laplacian_var
+
+
+def map_over_walker_chunks(func, chunk_size, *batched_args):
+    """
+    Evaluates func(*batched_args) sequentially on chunks of at most chunk_size walkers (using lax.map) to bound peak memory.
+
+    All batched_args must have the walker axis as leading axis. If the number of walkers is not divisible by chunk_size, the last chunk
+    is padded with copies of the first walkers, whose results are discarded.
+    """
+    batch_size = batched_args[0].shape[0]
+    if (chunk_size is None) or (batch_size <= chunk_size):
+        return func(*batched_args)
+    n_chunks = -(-batch_size // chunk_size)
+    n_pad = n_chunks * chunk_size - batch_size
+
+    def _pad_and_split(x):
+        x = jnp.concatenate([x, x[:n_pad]], axis=0)
+        return x.reshape((n_chunks, chunk_size) + x.shape[1:])
+
+    outputs = jax.lax.map(lambda args: func(*args), tuple(_pad_and_split(x) for x in batched_args))
+    return jax.tree_util.tree_map(lambda y: y.reshape((-1,) + y.shape[2:])[:batch_size], outputs)
+
+
+def _get_el_mask(fixed_params):
+    # Mask of real electrons for geometries that are padded with ghost particles (see deeperwin.bucketing)
+    return (fixed_params.get("padding") or {}).get("el_mask")
+
+
+def build_local_energy_func(config: LocalEnergyConfig = None):
+    """
+    Returns a function with the same arguments as get_local_energy, using the kinetic energy backend specified in the config.
+
+    The returned function yields a tuple (E_loc, E_loc_estimator_var), where the second entry is the variance added by a stochastic
+    laplacian estimator (0 for exact methods). The hutchinson estimator draws its probe vectors from per-walker keys in fixed_params['rng_laplacian'].
+    If config.chunk_size is set, walkers are processed in sequential chunks of this size.
+    """
+    config = config or LocalEnergyConfig()
+    if config.laplacian == "hutchinson":
+        @functools.partial(jax.vmap, in_axes=(None, None, None, 0, None, None, None, 0, None, None))
+        def _local_energy_hutchinson(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params, rng, E_pot_ion_ion, el_mask):
+            with jax.named_scope("laplacian"):
+                E_kin, E_kin_var = get_kinetic_energy_hutchinson(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params,
+                                                                 rng, config.n_hutchinson_probes)
+            with jax.named_scope("potential"):
+                E_pot = get_potential_energy(r, R, Z, E_pot_ion_ion, el_mask)
+            return E_kin + E_pot, E_kin_var
+
+        def local_energy_func(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params):
+            if "rng_laplacian" not in fixed_params:
+                raise ValueError("The hutchinson laplacian estimator requires per-walker keys in fixed_params['rng_laplacian']")
+            rng = fixed_params["rng_laplacian"]
+            fixed_params = {k: v for k, v in fixed_params.items() if k != "rng_laplacian"}
+            E_pot_ion_ion = get_ion_ion_potential_energy(R, Z)
+            el_mask = _get_el_mask(fixed_params)
+            return map_over_walker_chunks(
+                lambda r_, rng_: _local_energy_hutchinson(log_psi_squared, trainable_params, spin_state, r_, R, Z, fixed_params, rng_,
+                                                          E_pot_ion_ion, el_mask),
+                config.chunk_size, r, rng
+            )
+        return local_energy_func
+
+    if config.laplacian == "loop":
+        kinetic_energy_func = get_kinetic_energy
+    elif config.laplacian == "forward":
+        kinetic_energy_func = get_kinetic_energy_forward_laplacian
+    else:
+        raise ValueError(f"Unknown laplacian method: {config.laplacian}")
+
+    @functools.partial(jax.vmap, in_axes=(None, None, None, 0, None, None, None, None, None))
+    def _local_energy(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params, E_pot_ion_ion, el_mask):
+        with jax.named_scope("laplacian"):
+            E_kin = kinetic_energy_func(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params)
+        with jax.named_scope("potential"):
+            E_pot = get_potential_energy(r, R, Z, E_pot_ion_ion, el_mask)
+        return E_kin + E_pot, jnp.zeros_like(E_kin)
+
+    def local_energy_func(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params):
+        E_pot_ion_ion = get_ion_ion_potential_energy(R, Z)
+        el_mask = _get_el_mask(fixed_params)
+        return map_over_walker_chunks(
+            lambda r_: _local_energy(log_psi_squared, trainable_params, spin_state, r_, R, Z, fixed_params, E_pot_ion_ion, el_mask),
+            config.chunk_size, r
+        )
+    return local_energy_func
+
+
 @functools.partial(jax.vmap, in_axes=(None, None, None, 0, None, None, None))
 def get_local_energy(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params):
     E_kin = get_kinetic_energy(log_psi_squared, trainable_params, spin_state, r, R, Z, fixed_params)
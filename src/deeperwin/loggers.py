@@ -5,7 +5,9 @@ Logging of metrics and weights to local disk and web services.
 import logging
 import time
 import os.path
+import queue
 import sys
+import threading
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any, Literal, Optional
 
@@ -15,8 +17,12 @@ import wandb
 
 from deeperwin.configuration import LoggingConfig, BasicLoggerConfig, LoggerBaseConfig, PickleLoggerConfig, \
     WandBConfig, Configuration
-from deeperwin.checkpoints import save_run, RunData
+from deeperwin.checkpoints import save_run_async, RunData
 from deeperwin.utils.utils import without_cache
+from deeperwin.utils.history_store import HistoryWriter, HistoryFileReference, HISTORY_FNAME
+
+# Optimizer statistics (e.g. norms of parameters and gradients) that are logged alongside the energies
+OPT_STATS_PREFIXES = ('param_norm', 'grad_norm', 'precon_grad_norm', 'norm_constraint_factor', 'norm_constraint', 'cg_', 'inverse_')
 
 
 def build_dpe_root_logger(config: BasicLoggerConfig):
@@ -105,7 +111,7 @@ class LoggerCollection(DataLogger):
 
     def __init__(self, config: LoggingConfig, name: str, use_wandb_group: bool = False,
                        exp_idx_in_group: Optional[int] = None, save_path: str = ".", prefix: str = '',
-                       parallel_wandb_logging: bool = False):
+                       parallel_wandb_logging: bool = False, resume_history: Optional[HistoryFileReference] = None):
         super(LoggerCollection, self).__init__(config, name, save_path)
 
         if use_wandb_group:
@@ -115,16 +121,18 @@ class LoggerCollection(DataLogger):
             group_name = None
             experiment_name = name
 
-        self.loggers: List[DataLogger] = self.build_loggers(config, group_name, experiment_name, save_path, prefix, parallel_wandb_logging)
+        self.loggers: List[DataLogger] = self.build_loggers(config, group_name, experiment_name, save_path, prefix, parallel_wandb_logging,
+                                                             resume_history)
 
     @staticmethod
     def build_loggers(config: LoggingConfig, group_name: Optional[str], experiment_name: str, 
-                      save_path: str = ".", prefix: str = '', parallel_wandb_logging: bool = False):
+                      save_path: str = ".", prefix: str = '', parallel_wandb_logging: bool = False,
+                      resume_history: Optional[HistoryFileReference] = None):
         loggers = []
         if config.basic is not None:
             loggers.append(BasicLogger(config.basic, experiment_name, save_path, prefix))
         if config.pickle is not None:
-            loggers.append(PickleLogger(config.pickle, experiment_name, save_path, config.log_opt_state))
+            loggers.append(PickleLogger(config.pickle, experiment_name, save_path, config.log_opt_state, resume_history))
         if config.wandb is not None:
             if parallel_wandb_logging:
                 loggers.append(WandBParallelLogger(config.wandb, group_name, experiment_name, save_path, prefix))
@@ -342,14 +350,26 @@ class BasicLogger(DataLogger):
         self.logger.info(msg)
 
 
+def _to_host_array(x):
+    # Host arrays are kept as they are (instead of being copied), so that checkpoint blob stores can recognize identical arrays
+    return x if isinstance(x, np.ndarray) else np.array(x)
+
+
 class PickleLogger(DataLogger):
     """
-    Logger that stores full history in memory and dumps it as a binary file on exit.
+    Logger that stores the full history and writes it, together with the summary and the model state, into checkpoints.
+
+    By default the history is kept in memory and written as history.csv into every checkpoint. With incremental_history, it is
+    instead appended to history.bin in the output directory and checkpoints only reference the rows written so far.
     """
 
-    def __init__(self, config: PickleLoggerConfig, name, save_path=".", log_opt_state=True):
+    def __init__(self, config: PickleLoggerConfig, name, save_path=".", log_opt_state=True,
+                 resume_history: Optional[HistoryFileReference] = None):
         super().__init__(config, name, save_path)
-        self.history = []
+        if config.incremental_history:
+            self.history = HistoryWriter(os.path.join(save_path, HISTORY_FNAME), config.history_flush_every, resume_history)
+        else:
+            self.history = []
         self.summary = dict()
         self.config = None
         self.meta_data = dict()
@@ -380,11 +400,11 @@ class PickleLogger(DataLogger):
     def log_checkpoint(self, n_epoch, params=None, fixed_params=None, mcmc_state=None, opt_state=None, clipping_state=None, ema_params=None, prefix=""):
         data = RunData(config=self.config,
                        metadata=dict(n_epochs=n_epoch, **self.meta_data),
-                       history=self.history,
+                       history=self.history.get_reference() if isinstance(self.history, HistoryWriter) else self.history,
                        summary=self.summary,
-                       params=jax.tree_util.tree_map(np.array, params),
+                       params=jax.tree_util.tree_map(_to_host_array, params),
                        fixed_params=fixed_params,
-                       ema_params=jax.tree_util.tree_map(np.array, ema_params),
+                       ema_params=jax.tree_util.tree_map(_to_host_array, ema_params),
                        opt_state=opt_state,
                        mcmc_state=mcmc_state,
                        clipping_state=clipping_state)
@@ -392,7 +412,12 @@ class PickleLogger(DataLogger):
             fname = os.path.join(self.save_path, f"{prefix}chkpt.zip")
         else:
             fname = os.path.join(self.save_path, f"{prefix}chkpt{n_epoch:06d}.zip")
-        save_run(fname, data)
+        save_run_async(fname, data, self.logger_config.checkpoint_format, self.logger_config.checkpoint_compression,
+                       self.logger_config.checkpoint_blob_dir)
+
+    def on_run_end(self):
+        if isinstance(self.history, HistoryWriter):
+            self.history.flush()
 
 class WavefunctionLogger:
     def __init__(self, loggers: LoggerCollection, prefix = "", n_step=0, smoothing=0.05):
@@ -437,6 +462,12 @@ class WavefunctionLogger:
             metrics["mcmc_stepsize"] = float(mcmc_state.stepsize)
             metrics["mcmc_acc_rate"] = float(mcmc_state.acc_rate)
             metrics["mcmc_max_age"] = np.max(mcmc_state.walker_age)
+            if mcmc_state.acc_rate_stage1 is not None:
+                metrics["mcmc_acc_rate_stage1"] = float(mcmc_state.acc_rate_stage1)
+                metrics["mcmc_acc_rate_stage2"] = float(mcmc_state.acc_rate_stage2)
+            if mcmc_state.n_inter_steps is not None:
+                metrics["mcmc_n_inter_steps"] = int(mcmc_state.n_inter_steps)
+                metrics["mcmc_autocorr_time"] = float(mcmc_state.autocorr_time)
             if self._mcmc_state_old:
                 delta_r = np.linalg.norm(mcmc_state.r - self._mcmc_state_old.r, axis=-1)
                 metrics["mcmc_delta_r_mean"] = np.mean(delta_r)
@@ -445,7 +476,7 @@ class WavefunctionLogger:
 
         if opt_stats is not None:
             for key in opt_stats:
-                if key.startswith(('param_norm', 'grad_norm', 'precon_grad_norm', 'norm_constraint_factor', 'norm_constraint')):
+                if key.startswith(OPT_STATS_PREFIXES):
                     metrics[key] = opt_stats[key]
 
         for key in ["E_mean", "error_E_mean", "forces"]:
@@ -456,7 +487,7 @@ class WavefunctionLogger:
                 metrics[f"{key}_smooth"] = smoothed
 
         t = time.time()
-        metrics["t_epoch"] = t - self._time
+        metrics.setdefault("t_epoch", t - self._time)
         self._time = t
         metrics = {f"{self.prefix}_{k}": v for k, v in metrics.items()}
         if extra_metrics:
@@ -487,3 +518,93 @@ class WavefunctionLogger:
 
 
 
+
+
+class MetricsBuffer:
+    """
+    Buffers per-epoch metrics as (unfetched) device arrays and passes them to WavefunctionLoggers in bulk.
+
+    Pushing metrics does not block the host on the devices. Every flush_every epochs all buffered metrics are transferred to
+    the host with a single device_get and logged, either synchronously or by a background thread. Non-finite energies are
+    detected during this transfer, i.e. with a delay of at most flush_every epochs (plus one batch in flight when using a
+    background thread). The extra_metrics of the epoch with the first non-finite energy (e.g. its geom_id) are kept in
+    non_finite_extra_metrics. Call flush() before accessing the loggers from the main thread (e.g. for checkpoints) and hold lock while
+    doing so; all metrics are logged while holding lock. Call close() at the end.
+    """
+    def __init__(self, flush_every: int = 1, use_thread: bool = False):
+        self.flush_every = flush_every
+        self.non_finite_epoch = None
+        self.non_finite_energy = None
+        self.non_finite_extra_metrics = None
+        self.lock = threading.RLock()
+        self._buffer = []
+        self._n_epochs_buffered = 0
+        self._time = time.time()
+        self._queue = None
+        if use_thread:
+            self._queue = queue.Queue(maxsize=1)
+            self._thread = threading.Thread(target=self._worker, daemon=True)
+            self._thread.start()
+
+    def push(self, wf_logger: WavefunctionLogger, metrics: Dict[str, Any], n_epoch: int, E_ref=None, epoch=None,
+             extra_metrics=None, n_epochs: int = 1):
+        """
+        Adds the metrics of n_epochs epochs, starting at optimization epoch n_epoch.
+
+        For n_epochs > 1, all metrics must have a leading axis of length n_epochs and epoch must be None.
+        """
+        t = time.time()
+        t_epoch = (t - self._time) / n_epochs
+        self._time = t
+        self._buffer.append((wf_logger, metrics, n_epoch, E_ref, epoch, extra_metrics, n_epochs, t_epoch))
+        self._n_epochs_buffered += n_epochs
+        if self._n_epochs_buffered >= self.flush_every:
+            self._submit()
+
+    def flush(self):
+        """Logs all buffered metrics and waits until they have been consumed"""
+        self._submit()
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        self.flush()
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+
+    def _submit(self):
+        if not self._buffer:
+            return
+        batch, self._buffer, self._n_epochs_buffered = self._buffer, [], 0
+        if self._queue is None:
+            self._log_batch(batch)
+        else:
+            self._queue.put(batch)
+
+    def _worker(self):
+        while True:
+            batch = self._queue.get()
+            try:
+                if batch is None:
+                    return
+                self._log_batch(batch)
+            except Exception:
+                logging.getLogger("dpe").exception("Failed to log buffered metrics")
+            finally:
+                self._queue.task_done()
+
+    def _log_batch(self, batch):
+        all_metrics = jax.device_get([entry[1] for entry in batch])
+        with self.lock:
+            for (wf_logger, _, n_epoch, E_ref, epoch, extra_metrics, n_epochs, t_epoch), metrics in zip(batch, all_metrics):
+                for i in range(n_epochs):
+                    metrics_epoch = {k: np.asarray(v) if n_epochs == 1 else np.asarray(v)[i] for k, v in metrics.items()}
+                    metrics_epoch = {k: v.item() if v.ndim == 0 else v for k, v in metrics_epoch.items()}
+                    metrics_epoch.setdefault("t_epoch", t_epoch)
+                    E = metrics_epoch.get("E_mean", 0.0)
+                    if (self.non_finite_epoch is None) and not np.isfinite(E):
+                        self.non_finite_extra_metrics = dict(extra_metrics or {})
+                        self.non_finite_epoch, self.non_finite_energy = n_epoch + i, E
+                    wf_logger.log_step(metrics_epoch, E_ref=E_ref, extra_metrics=extra_metrics, epoch=epoch)
@@ -4,15 +4,16 @@ Logic for Markov chain Monte Carlo (MCMC) steps.
 
 import copy
 import functools
-from typing import Dict, Tuple
+from typing import Callable, Dict, Tuple
 import jax
 import jax.numpy as jnp
 import numpy as np
 import chex
 
 from deeperwin.configuration import MCMCConfig, MCMCLangevinProposalConfig, PhysicalConfig, LocalStepsizeProposalConfig
-from deeperwin.utils.utils import get_el_ion_distance_matrix, pmap, pmean, batch_rng_split, merge_from_devices
+from deeperwin.utils.utils import get_el_ion_distance_matrix, pmap, pmean, psum, batch_rng_split, merge_from_devices
 from deeperwin.orbitals import initialize_walkers_with_exponential_radial_pdf
+from deeperwin.model.wavefunction import get_full_slater_matrix, sum_of_determinants_from_slogdet, build_log_psi_squared_baseline
 
 @chex.dataclass
 class MCMCState:
@@ -28,6 +29,19 @@ class MCMCState:
     stepsize: jnp.array = jnp.array(1e-2)
     step_nr: jnp.array = jnp.array(0, dtype=int)
     acc_rate: jnp.array = jnp.array(0.0)
+    # Only used for Sherman-Morrison single-electron updates; recomputed at the start of every MCMC run and not persisted
+    mo_inv: jnp.array = None  # [batch-size x n_dets x n_el x n_el]
+    log_det: jnp.array = None  # [batch-size x n_dets]
+    sign_det: jnp.array = None  # [batch-size x n_dets]
+    # Only used for delayed acceptance; the surrogate values are recomputed at the start of every MCMC run
+    log_psi_sqr_surrogate: jnp.array = None  # [batch-size]
+    acc_rate_stage1: jnp.array = None
+    acc_rate_stage2: jnp.array = None
+    # Only used for adaptive inter-steps
+    n_inter_steps: jnp.array = None
+    autocorr_time: jnp.array = None
+    # Only used for geometries padded with ghost particles (see deeperwin.bucketing): 1 for real, 0 for ghost electrons, which are never moved
+    el_mask: jnp.array = None  # [n_el]
 
     def build_batch(self, fixed_params: Dict):
         return self.r, self.R, self.Z, fixed_params
@@ -76,6 +90,8 @@ class MCMCState:
             return x[jax.process_index()]
 
         def _tile(x):
+            if x is None:
+                return None
             return jnp.tile(x, [jax.local_device_count()] + [1] * x.ndim)
 
         return MCMCState(r=_split(self.r),
@@ -86,7 +102,12 @@ class MCMCState:
                          Z=_tile(self.Z),
                          stepsize=_tile(self.stepsize),
                          step_nr=_tile(self.step_nr),
-                         acc_rate=_tile(self.acc_rate)
+                         acc_rate=_tile(self.acc_rate),
+                         acc_rate_stage1=_tile(self.acc_rate_stage1),
+                         acc_rate_stage2=_tile(self.acc_rate_stage2),
+                         n_inter_steps=_tile(self.n_inter_steps),
+                         autocorr_time=_tile(self.autocorr_time),
+                         el_mask=_tile(self.el_mask),
                          )
 
     def merge_devices(self):
@@ -102,10 +123,43 @@ class MCMCState:
                          Z=self.Z[0],
                          stepsize=self.stepsize[0],
                          step_nr=self.step_nr[0],
-                         acc_rate=self.acc_rate[0]
+                         acc_rate=self.acc_rate[0],
+                         acc_rate_stage1=None if self.acc_rate_stage1 is None else self.acc_rate_stage1[0],
+                         acc_rate_stage2=None if self.acc_rate_stage2 is None else self.acc_rate_stage2[0],
+                         n_inter_steps=None if self.n_inter_steps is None else self.n_inter_steps[0],
+                         autocorr_time=None if self.autocorr_time is None else self.autocorr_time[0],
+                         el_mask=None if self.el_mask is None else self.el_mask[0],
                          )
 
-MCMC_BATCH_AXES = MCMCState(r=0, R=None, Z=None, log_psi_sqr=0, walker_age=0, rng_state=0, stepsize=None, step_nr=None, acc_rate=None)
+def get_mcmc_metrics(state: MCMCState, r_old=None) -> Dict[str, jnp.array]:
+    """
+    Returns scalar statistics of an MCMC state as device arrays, without blocking the host.
+
+    Works for merged states as well as states that are split across (local) devices. If r_old is given, the mean and median
+    displacement of the walkers since r_old are included.
+    """
+    is_split = state.r.ndim == 4
+    def _first(x):
+        return x[0] if is_split else x
+
+    metrics = dict(mcmc_stepsize=_first(state.stepsize),
+                   mcmc_acc_rate=_first(state.acc_rate),
+                   mcmc_max_age=jnp.max(state.walker_age))
+    if state.acc_rate_stage1 is not None:
+        metrics["mcmc_acc_rate_stage1"] = _first(state.acc_rate_stage1)
+        metrics["mcmc_acc_rate_stage2"] = _first(state.acc_rate_stage2)
+    if state.n_inter_steps is not None:
+        metrics["mcmc_n_inter_steps"] = _first(state.n_inter_steps)
+        metrics["mcmc_autocorr_time"] = _first(state.autocorr_time)
+    if r_old is not None:
+        delta_r = jnp.linalg.norm(state.r - r_old, axis=-1)
+        metrics["mcmc_delta_r_mean"] = jnp.mean(delta_r)
+        metrics["mcmc_delta_r_median"] = jnp.median(delta_r)
+    return metrics
+
+MCMC_BATCH_AXES = MCMCState(r=0, R=None, Z=None, log_psi_sqr=0, walker_age=0, rng_state=0, stepsize=None, step_nr=None, acc_rate=None,
+                            mo_inv=0, log_det=0, sign_det=0, log_psi_sqr_surrogate=0, acc_rate_stage1=None, acc_rate_stage2=None,
+                            n_inter_steps=None, autocorr_time=None, el_mask=None)
 
 def _resize_array(x, new_length):
     old_length = x.shape[0]
@@ -125,13 +179,26 @@ def resize_nr_of_walkers(state: MCMCState, n_walkers_new):
     new_state.log_psi_sqr = _resize_array(state.log_psi_sqr, n_walkers_new)
     new_state.walker_age = _resize_array(state.walker_age, n_walkers_new)
     new_state.rng_state = jax.random.split(state.rng_state[0], n_walkers_new)
+    new_state.mo_inv, new_state.log_det, new_state.sign_det = None, None, None
+    new_state.log_psi_sqr_surrogate = None
     return new_state
 
+def _mask_displacement(state: MCMCState, delta_r, index=None):
+    """
+    Ghost electrons of padded geometries stay at their position; their contributions to the proposal ratio therefore vanish.
+    For single-electron proposals, delta_r is the displacement of electron index only.
+    """
+    if state.el_mask is None:
+        return delta_r
+    if index is not None:
+        return delta_r * state.el_mask[index]
+    return delta_r * state.el_mask[:, None]
+
 @functools.partial(jax.vmap, in_axes=(MCMC_BATCH_AXES,), out_axes=(MCMC_BATCH_AXES, 0))
 def _propose_normal(state: MCMCState):
     new_state = copy.copy(state)
     new_state.rng_state, subkey = jax.random.split(state.rng_state)
-    new_state.r += jax.random.normal(subkey, state.r.shape) * state.stepsize
+    new_state.r += _mask_displacement(state, jax.random.normal(subkey, state.r.shape) * state.stepsize)
     return new_state, 0.0
 
 @functools.partial(jax.vmap, in_axes=(MCMC_BATCH_AXES,), out_axes=(MCMC_BATCH_AXES, 0))
@@ -141,14 +208,15 @@ def _propose_normal_one_el(state: MCMCState):
 
     new_state = copy.copy(state)
     new_state.rng_state, subkey = jax.random.split(state.rng_state)
-    new_state.r = new_state.r.at[..., index, :].add(jax.random.normal(subkey, state.r[..., index, :].shape) * state.stepsize)
+    delta_r = jax.random.normal(subkey, state.r[..., index, :].shape) * state.stepsize
+    new_state.r = new_state.r.at[..., index, :].add(_mask_displacement(state, delta_r, index))
     return new_state, 0.0
 
 @functools.partial(jax.vmap, in_axes=(MCMC_BATCH_AXES,), out_axes=(MCMC_BATCH_AXES, 0))
 def _propose_cauchy(state: MCMCState):
     new_state = copy.copy(state)
     new_state.rng_state, subkey = jax.random.split(state.rng_state)
-    new_state.r += jax.random.cauchy(subkey, state.r.shape) * state.stepsize
+    new_state.r += _mask_displacement(state, jax.random.cauchy(subkey, state.r.shape) * state.stepsize)
     return new_state, 0.0
 
 
@@ -172,7 +240,7 @@ def _propose_step_local_stepsize(state: MCMCState, config: LocalStepsizeProposal
 
     dist_closest = jnp.min(get_el_ion_distance_matrix(state.r, state.R)[1], axis=-1)
     s = state.stepsize * jnp.clip(dist_closest, config.r_min, config.r_max)
-    new_state.r += jax.random.normal(subkey, state.r.shape) * s[..., None]
+    new_state.r += _mask_displacement(state, jax.random.normal(subkey, state.r.shape) * s[..., None])
 
     dist_closest = jnp.min(get_el_ion_distance_matrix(new_state.r, state.R)[1], axis=-1)
     s_new = state.stepsize * jnp.clip(dist_closest, config.r_min, config.r_max)
@@ -193,7 +261,8 @@ def _propose_step_local_stepsize_one_el(state: MCMCState, config: LocalStepsizeP
     #new_state.r += jax.random.normal(subkey, state.r.shape) * s[..., None]
     dist_closest = jnp.min(get_el_ion_distance_matrix(state.r, state.R)[1], axis=-1).at[..., index].get()
     s = state.stepsize * jnp.clip(dist_closest, config.r_min, config.r_max)
-    new_state.r = new_state.r.at[..., index, :].add(jax.random.normal(subkey, state.r.shape[:-2] + (3,)) * s[..., None])
+    delta_r = jax.random.normal(subkey, state.r.shape[:-2] + (3,)) * s[..., None]
+    new_state.r = new_state.r.at[..., index, :].add(_mask_displacement(state, delta_r, index))
 
     dist_closest = jnp.min(get_el_ion_distance_matrix(new_state.r, state.R)[1], axis=-1).at[..., index].get()
     s_new = state.stepsize * jnp.clip(dist_closest, config.r_min, config.r_max)
@@ -220,7 +289,7 @@ def _propose_step_local_approximated_langevin(state: MCMCState, config: MCMCLang
     s, g_r = _calculate_stepsize_and_langevin_bias(
         state.r, state.R, state.Z, state.stepsize, config.langevin_scale, config.r_min, config.r_max
     )
-    new_state.r += jax.random.normal(subkey, state.r.shape) * s + g_r * s ** 2
+    new_state.r += _mask_displacement(state, jax.random.normal(subkey, state.r.shape) * s + g_r * s ** 2)
     s_new, g_r_new = _calculate_stepsize_and_langevin_bias(
         new_state.r, state.R, state.Z, state.stepsize, config.langevin_scale, config.r_min, config.r_max
     )
@@ -243,9 +312,33 @@ class MetropolisHastingsMonteCarlo:
     The actual state is stored in an MCMCState object.
     """
 
-    def __init__(self, mcmc_config: MCMCConfig):
+    def __init__(self, mcmc_config: MCMCConfig, slater_func: Callable = None, slater_row_func: Callable = None,
+                 determinant_schema: str = "block_diag"):
+        """
+        Args:
+            mcmc_config: MCMC configuration
+            slater_func: Function (params, n_up, n_dn, r, R, Z, fixed_params) -> (mo_up, mo_dn) returning the Slater matrices of the sampled density.
+                Only required for config.determinant_updates == 'sherman_morrison'. Each row of the Slater matrices must only depend on
+                the position of its own electron (e.g. baseline orbitals), since otherwise a one-electron move is not a rank-1 update.
+            slater_row_func: Function (params, n_up, n_dn, r, R, Z, fixed_params, index) -> [batch x n_dets x n_el] returning row
+                index of get_full_slater_matrix(*slater_func(...)), evaluating only the orbitals of electron index.
+                Only required for config.determinant_updates == 'sherman_morrison'.
+            determinant_schema: Determinant schema of the model (model.orbitals.determinant_schema), which is used to build the
+                baseline surrogate for config.delayed_acceptance
+        """
         self.config: MCMCConfig = mcmc_config
+        self.slater_func = slater_func
+        self.slater_row_func = slater_row_func
+        self.surrogate_func = build_log_psi_squared_baseline(determinant_schema) if self.config.delayed_acceptance else None
         self._build_proposal_function()
+        if self.config.delayed_acceptance and (self.config.determinant_updates != "full"):
+            raise ValueError("Delayed acceptance can not be combined with Sherman-Morrison determinant updates")
+        if self.config.determinant_updates == "sherman_morrison":
+            if self.config.proposal.name not in ["normal_one_el", "local_one_el"]:
+                raise ValueError(f"Sherman-Morrison determinant updates require a single-electron proposal, got: {self.config.proposal.name}")
+            if (self.slater_func is None) or (self.slater_row_func is None):
+                raise ValueError("Sherman-Morrison determinant updates require a Slater-matrix function with single-particle orbitals, "
+                                 "which is not available for this sampling density")
 
     def _build_proposal_function(self):
         if self.config.proposal.name == "normal":
@@ -265,9 +358,115 @@ class MetropolisHastingsMonteCarlo:
 
     def make_mcmc_step(self, func, state: MCMCState):
         # Propose a new state
-        state_new, log_q_ratio = self.propose(state)
-        state_new.log_psi_sqr = func(state_new)
+        with jax.named_scope("mcmc_proposal"):
+            state_new, log_q_ratio = self.propose(state)
+        with jax.named_scope("log_psi"):
+            state_new.log_psi_sqr = func(state_new)
+        state_new, _ = self._accept_or_reject(state, state_new, log_q_ratio)
+        return state_new
+
+    def make_mcmc_step_sherman_morrison(self, slater_func, slater_row_func, state: MCMCState):
+        """
+        MCMC step for single-electron proposals, which evaluates the determinant ratio as a rank-1 update of the current inverse Slater matrix.
+
+        Costs O(n_el^2) per step instead of the O(n_el^3) of a fresh determinant. The inverses are re-computed from scratch
+        every config.determinant_refresh_interval steps to avoid accumulating round-off errors.
+        """
+        n_el = state.r.shape[-2]
+        index = state.step_nr % n_el
+        with jax.named_scope("mcmc_proposal"):
+            state_new, log_q_ratio = self.propose(state)
+
+        # Row of the moved electron (only its own orbitals are evaluated) and column of the inverse, both [batch x n_dets x n_el]
+        with jax.named_scope("log_psi"):
+            mo_row = slater_row_func(state_new, index)
+        mo_inv_col = state.mo_inv[..., :, index]
+        det_ratio = jnp.sum(mo_row * mo_inv_col, axis=-1)
+        state_new.log_det = state.log_det + jnp.log(jnp.abs(det_ratio))
+        state_new.sign_det = state.sign_det * jnp.sign(det_ratio)
+        state_new.log_psi_sqr = sum_of_determinants_from_slogdet(state_new.sign_det, state_new.log_det)
+        state_new, do_accept = self._accept_or_reject(state, state_new, log_q_ratio)
+
+        # Sherman-Morrison: A'^-1 = A^-1 - (A^-1 e_k) (u^T A^-1 - e_k^T) / (u^T A^-1 e_k)
+        u_times_inv = jnp.einsum("...j,...jl->...l", mo_row, state.mo_inv) - jax.nn.one_hot(index, n_el, dtype=mo_row.dtype)
+        det_ratio = jnp.where(det_ratio == 0, 1e-30, det_ratio)
+        mo_inv_new = state.mo_inv - mo_inv_col[..., :, None] * u_times_inv[..., None, :] / det_ratio[..., None, None]
+        state_new.mo_inv = jnp.where(do_accept[..., None, None, None], mo_inv_new, state.mo_inv)
+        state_new.log_det = jnp.where(do_accept[..., None], state_new.log_det, state.log_det)
+        state_new.sign_det = jnp.where(do_accept[..., None], state_new.sign_det, state.sign_det)
+
+        state_new = jax.lax.cond(state_new.step_nr % self.config.determinant_refresh_interval == 0,
+                                 lambda s: self._init_determinant_state(slater_func, s),
+                                 lambda s: s,
+                                 state_new)
+        return state_new
+
+    def make_mcmc_step_delayed_acceptance(self, func, surrogate_func, state: MCMCState):
+        """
+        Two-stage Metropolis-Hastings step (Christen & Fox, 2005).
+
+        Stage 1 accepts with min(1, q_ratio * s(r')/s(r)) using the cheap surrogate density s. Only survivors of stage 1
+        need the full wavefunction and are accepted with min(1, [p(r')/p(r)] / [s(r')/s(r)]), which keeps detailed balance
+        w.r.t. the full density p exact.
+        """
+        with jax.named_scope("mcmc_proposal"):
+            state_new, log_q_ratio = self.propose(state)
+        with jax.named_scope("log_psi_surrogate"):
+            state_new.log_psi_sqr_surrogate = surrogate_func(state_new)
+        log_ratio_surrogate = state_new.log_psi_sqr_surrogate - state.log_psi_sqr_surrogate
+
+        subkeys = jax.vmap(lambda k: jax.random.fold_in(k, 1))(state.rng_state)
+        thr_accept = jax.vmap(lambda k: jax.random.uniform(k, ()))(subkeys)
+        accept_stage1 = jnp.exp(log_ratio_surrogate + log_q_ratio) > thr_accept
+        needs_full_eval = jnp.logical_or(accept_stage1, state.walker_age >= self.config.max_age)
+        with jax.named_scope("log_psi"):
+            state_new.log_psi_sqr = self._evaluate_compacted(func, state_new, needs_full_eval, state.log_psi_sqr)
+
+        # Stage 2: proposal ratio is replaced by the inverse surrogate ratio; walkers rejected in stage 1 are never accepted (unless too old)
+        log_q_ratio_stage2 = jnp.where(accept_stage1, -log_ratio_surrogate, -jnp.inf)
+        state_new, do_accept = self._accept_or_reject(state, state_new, log_q_ratio_stage2)
+        state_new.log_psi_sqr_surrogate = jnp.where(do_accept, state_new.log_psi_sqr_surrogate, state.log_psi_sqr_surrogate)
+
+        n_stage1 = psum(jnp.sum(accept_stage1))
+        acc_rate_stage1 = pmean(jnp.mean(accept_stage1))
+        acc_rate_stage2 = psum(jnp.sum(jnp.logical_and(do_accept, accept_stage1))) / jnp.maximum(n_stage1, 1)
+        state_new.acc_rate_stage1 = 0.9 * state.acc_rate_stage1 + 0.1 * acc_rate_stage1
+        state_new.acc_rate_stage2 = 0.9 * state.acc_rate_stage2 + 0.1 * acc_rate_stage2
+        return state_new
 
+    def _evaluate_compacted(self, func, state: MCMCState, mask, fill_value):
+        """
+        Evaluates func only for walkers where mask is True and returns fill_value for all others.
+
+        If at most a fraction delayed_acceptance_capacity of walkers is selected, they are gathered into a smaller batch before evaluation;
+        otherwise all walkers are evaluated.
+        """
+        n_walkers = mask.shape[0]
+        capacity = int(np.ceil(self.config.delayed_acceptance_capacity * n_walkers))
+        if capacity >= n_walkers:
+            return jnp.where(mask, func(state), fill_value)
+
+        def _all_walkers(_):
+            return jnp.where(mask, func(state), fill_value)
+
+        def _compacted(_):
+            idx_selected = jnp.argsort(jnp.logical_not(mask).astype(jnp.int32))[:capacity]
+            state_compacted = copy.copy(state)
+            state_compacted.r = state.r[idx_selected]
+            values = fill_value.at[idx_selected].set(func(state_compacted))
+            return jnp.where(mask, values, fill_value)
+
+        return jax.lax.cond(jnp.sum(mask) <= capacity, _compacted, _all_walkers, None)
+
+    def _init_determinant_state(self, slater_func, state: MCMCState):
+        state = copy.copy(state)
+        mo_matrix = get_full_slater_matrix(*slater_func(state))
+        state.sign_det, state.log_det = jnp.linalg.slogdet(mo_matrix)
+        state.mo_inv = jnp.linalg.inv(mo_matrix)
+        state.log_psi_sqr = sum_of_determinants_from_slogdet(state.sign_det, state.log_det)
+        return state
+
+    def _accept_or_reject(self, state: MCMCState, state_new: MCMCState, log_q_ratio):
         # Decide which samples to accept and which ones to reject
         p_accept = jnp.exp(state_new.log_psi_sqr - state.log_psi_sqr + log_q_ratio)
         state_new.rng_state, subkeys = batch_rng_split(state.rng_state)
@@ -286,7 +485,7 @@ class MetropolisHastingsMonteCarlo:
                                           self._adjust_stepsize,
                                           lambda x: x[0],
                                           (state.stepsize, state.acc_rate))
-        return state_new
+        return state_new, do_accept
 
 
     def _adjust_stepsize(self, args):
@@ -297,18 +496,93 @@ class MetropolisHastingsMonteCarlo:
         stepsize = jnp.clip(stepsize, self.config.min_stepsize_scale, self.config.max_stepsize_scale)
         return stepsize
 
-    def _run_mcmc_steps(self, func, state, params, n_up, n_dn, fixed_params, n_steps):
+    def _prepare_run(self, func, state, params, n_up, n_dn, fixed_params):
+        """Initializes all transient parts of the MCMC state and returns it together with the function performing a single MCMC step"""
         def partial_func(s):
             return func(params, n_up, n_dn, *s.build_batch(fixed_params))
+
+        if self.config.determinant_updates == "sherman_morrison":
+            def partial_slater_func(s):
+                return self.slater_func(params, n_up, n_dn, *s.build_batch(fixed_params))
+            def partial_slater_row_func(s, index):
+                return self.slater_row_func(params, n_up, n_dn, *s.build_batch(fixed_params), index)
+            state = self._init_determinant_state(partial_slater_func, state)
+            return state, functools.partial(self.make_mcmc_step_sherman_morrison, partial_slater_func, partial_slater_row_func)
+
         if state.log_psi_sqr is None:
             state.log_psi_sqr = partial_func(state)
-        def _loop_body(i, _state):
-            return self.make_mcmc_step(partial_func, _state)
-        return jax.lax.fori_loop(0, n_steps, _loop_body, state)
+
+        if self.config.delayed_acceptance:
+            def partial_surrogate_func(s):
+                return self.surrogate_func(params, n_up, n_dn, *s.build_batch(fixed_params))
+            state = copy.copy(state)
+            state.log_psi_sqr_surrogate = partial_surrogate_func(state)
+            if state.acc_rate_stage1 is None:
+                state.acc_rate_stage1 = jnp.zeros_like(state.acc_rate)
+                state.acc_rate_stage2 = jnp.zeros_like(state.acc_rate)
+            return state, functools.partial(self.make_mcmc_step_delayed_acceptance, partial_func, partial_surrogate_func)
+
+        return state, functools.partial(self.make_mcmc_step, partial_func)
+
+    @staticmethod
+    def _finalize_run(state: MCMCState):
+        """Drops all parts of the state that are only required during an MCMC run"""
+        state.mo_inv, state.log_det, state.sign_det = None, None, None
+        state.log_psi_sqr_surrogate = None
+        return state
+
+    def _run_mcmc_steps(self, func, state, params, n_up, n_dn, fixed_params, n_steps):
+        state, step_func = self._prepare_run(func, state, params, n_up, n_dn, fixed_params)
+        state = jax.lax.fori_loop(0, n_steps, lambda i, s: step_func(s), state)
+        return self._finalize_run(state)
+
+    def _run_adaptive_mcmc_steps(self, func, state, params, n_up, n_dn, fixed_params):
+        """
+        Runs state.n_inter_steps MCMC steps and adapts the number of steps for the next run to the measured autocorrelation time.
+
+        The lag-1 autocorrelation rho of cheap observables (log(psi^2) and the mean electron distance from the origin) is measured across
+        all walkers and steps. Assuming AR(1)-like decay, the integrated autocorrelation time is tau = (1 + rho) / (1 - rho).
+        The next run uses ceil(target_tau_factor * tau) steps, with tau being smoothed over epochs and the step count clipped to the configured bounds.
+        """
+        config = self.config.adaptive_inter_steps
+        state, step_func = self._prepare_run(func, state, params, n_up, n_dn, fixed_params)
+        if state.n_inter_steps is None:
+            state.n_inter_steps = jnp.array(self.config.n_inter_steps, dtype=int)
+            state.autocorr_time = jnp.array(-1.0)
+
+        def _get_observables(s):
+            return jnp.stack([s.log_psi_sqr, jnp.mean(jnp.linalg.norm(s.r, axis=-1), axis=-1)], axis=-1)  # [batch x n_obs]
+
+        def _loop_body(i, carry):
+            s, (sum_cov, sum_var) = carry
+            obs_old = _get_observables(s)
+            s = step_func(s)
+            obs_new = _get_observables(s)
+            obs_mean = pmean(jnp.mean(obs_old, axis=0))
+            sum_cov += jnp.sum((obs_old - obs_mean) * (obs_new - obs_mean), axis=0)
+            sum_var += jnp.sum((obs_old - obs_mean) ** 2, axis=0)
+            return s, (sum_cov, sum_var)
+
+        n_obs = 2
+        state, (sum_cov, sum_var) = jax.lax.fori_loop(0, state.n_inter_steps, _loop_body,
+                                                      (state, (jnp.zeros(n_obs), jnp.zeros(n_obs))))
+        rho = psum(sum_cov) / jnp.maximum(psum(sum_var), 1e-12)
+        rho = jnp.clip(rho, 0.0, 0.999)
+        tau = jnp.max((1 + rho) / (1 - rho))
+        state.autocorr_time = jnp.where(state.autocorr_time < 0, tau, config.smoothing * state.autocorr_time + (1 - config.smoothing) * tau)
+        n_inter_steps = jnp.ceil(config.target_tau_factor * state.autocorr_time).astype(int)
+        state.n_inter_steps = jnp.clip(n_inter_steps, config.min_inter_steps, config.max_inter_steps)
+        return self._finalize_run(state)
+
+    def _run_inter_steps(self, func, state, params, n_up, n_dn, fixed_params):
+        """Un-pmapped version of run_inter_steps, e.g. for use inside an already pmapped optimization epoch"""
+        if self.config.adaptive_inter_steps:
+            return self._run_adaptive_mcmc_steps(func, state, params, n_up, n_dn, fixed_params)
+        return self._run_mcmc_steps(func, state, params, n_up, n_dn, fixed_params, self.config.n_inter_steps)
 
     @functools.partial(pmap, static_broadcasted_argnums=(0,1,4,5))
     def run_inter_steps(self, func, state: MCMCState, params, n_up, n_dn, fixed_params):
-        return self._run_mcmc_steps(func, state, params, n_up, n_dn, fixed_params, self.config.n_inter_steps)
+        return self._run_inter_steps(func, state, params, n_up, n_dn, fixed_params)
 
     @functools.partial(pmap, static_broadcasted_argnums=(0,1,4,5))
     def run_burn_in(self, func, state: MCMCState, params, n_up, n_dn, fixed_params):
@@ -11,6 +11,7 @@ from deeperwin.configuration import (
 )
 from deeperwin.model.definitions import *
 from deeperwin.model.mlp import MLP
+from deeperwin.model.padding import masked_sum, masked_mean
 
 
 class ScalarSymmetricProduct(hk.Module):
@@ -48,8 +49,9 @@ class SymmetricFeatures(hk.Module):
         self.mlp_config = mlp_config
         self.n_up = n_up
 
-    def __call__(self, h_one, h_ion, h_el_el, h_el_ion):
+    def __call__(self, h_one, h_ion, h_el_el, h_el_ion, el_mask=None, ion_mask=None):
         n_el = h_one.shape[-2]
+        mask_up, mask_dn = (None, None) if el_mask is None else (el_mask[:self.n_up], el_mask[self.n_up:])
         features = []
         if self.config.use_h_one:
             features.append(h_one)
@@ -57,8 +59,8 @@ class SymmetricFeatures(hk.Module):
 
         # Average over all h_ones from 1-el-stream
         if self.config.use_average_h_one:
-            avg_h_one_up = jnp.mean(h_one[..., :self.n_up, :], keepdims=True, axis=-2)
-            avg_h_one_dn = jnp.mean(h_one[..., self.n_up:, :], keepdims=True, axis=-2)
+            avg_h_one_up = masked_mean(h_one[..., :self.n_up, :], mask_up, keepdims=True, axis=-2)
+            avg_h_one_dn = masked_mean(h_one[..., self.n_up:, :], mask_dn, keepdims=True, axis=-2)
             if self.config.use_h_one_same_diff:
                 avg_h_one_same = jnp.concatenate([
                     jnp.tile(avg_h_one_up, [self.n_up, 1]), 
@@ -75,16 +77,17 @@ class SymmetricFeatures(hk.Module):
         # Average over 2-el-stream
         if self.config.use_average_h_two:
             assert not self.config.use_h_two_same_diff, "Averaging over 2-el-stream only implemented for use_h_two_same_diff==False"
-            f_pairs_with_up = jnp.mean(h_el_el[..., : self.n_up, :], axis=-2)
-            f_pairs_with_dn = jnp.mean(h_el_el[..., self.n_up :, :], axis=-2)
+            f_pairs_with_up = masked_mean(h_el_el[..., : self.n_up, :], mask_up, axis=-2)
+            f_pairs_with_dn = masked_mean(h_el_el[..., self.n_up :, :], mask_dn, axis=-2)
             features += [f_pairs_with_up, f_pairs_with_dn]
 
         # Average of el-ion-stream
         if self.config.use_el_ion_stream and not self.config.use_schnet_features:
-            features.append(jnp.mean(h_el_ion, axis=-2))
+            features.append(masked_mean(h_el_ion, ion_mask, axis=-2))
 
         if self.config.use_schnet_features:
-            el_el, el_ion, el_el_mult = ConvolutionalFeatures(self.config, self.mlp_config, self.n_up)(h_one, h_ion, h_el_el, h_el_ion)
+            el_el, el_ion, el_el_mult = ConvolutionalFeatures(self.config, self.mlp_config, self.n_up)(h_one, h_ion, h_el_el, h_el_ion,
+                                                                                                    el_mask, ion_mask)
             features += [el_el, el_ion]
         else:
             el_el_mult = None
@@ -99,17 +102,18 @@ class ConvolutionalFeatures(hk.Module):
         self.mlp_config = mlp_config
         self.n_up = n_up
 
-        self.aggregation = dict(sum=jnp.sum, mean=jnp.mean)[self.config.schnet_aggregation]
+        self.aggregation = dict(sum=masked_sum, mean=masked_mean)[self.config.schnet_aggregation]
 
-    def __call__(self, h_one, h_ion, h_el_el, h_el_ion):
+    def __call__(self, h_one, h_ion, h_el_el, h_el_ion, el_mask=None, ion_mask=None):
         batch_dims = h_one.shape[:-2]
         n_el = h_one.shape[-2]
         n_up, n_dn = self.n_up, n_el - self.n_up
+        mask_up, mask_dn = (None, None) if el_mask is None else (el_mask[:n_up], el_mask[n_up:])
 
         if (not self.config.use_w_mapping) and (not self.config.use_h_two_same_diff):
             # Simple case where we do not differentiate between same and different at all (not in input streams and not in the mappings)
             h_mapped = MLP([h_el_el.shape[-1]], self.mlp_config, output_bias=self.config.use_schnet_bias_feat, name="h_map")(h_one)
-            embeddings_el_el = jnp.sum(h_el_el * h_mapped[..., None, :, :], axis=-2)
+            embeddings_el_el = masked_sum(h_el_el * h_mapped[..., None, :, :], el_mask, axis=-2)
         else:
             if self.config.use_h_two_same_diff:
                 w_same, w_diff = h_el_el
@@ -149,13 +153,13 @@ class ConvolutionalFeatures(hk.Module):
 
             mult_dn_up = w_du * h_u
             mult_dn_dn = w_dd * h_d
-            emb_up = self.aggregation(mult_up_up, axis=-2) + self.aggregation(mult_up_dn, axis=-2)
-            emb_dn = self.aggregation(mult_dn_up, axis=-2) + self.aggregation(mult_dn_dn, axis=-2)
+            emb_up = self.aggregation(mult_up_up, mask_up, axis=-2) + self.aggregation(mult_up_dn, mask_dn, axis=-2)
+            emb_dn = self.aggregation(mult_dn_up, mask_up, axis=-2) + self.aggregation(mult_dn_dn, mask_dn, axis=-2)
             embeddings_el_el = jnp.concatenate([emb_up, emb_dn], axis=-2)
 
         if self.config.use_el_ion_stream:
             h_ion_mapped = MLP([h_el_ion.shape[-1]], self.mlp_config, output_bias=self.config.use_schnet_bias_feat, name="h_ion_map")(h_ion)
-            embeddings_el_ions = self.aggregation(h_el_ion * h_ion_mapped[..., None, :, :], axis=-2)
+            embeddings_el_ions = self.aggregation(h_el_ion * h_ion_mapped[..., None, :, :], ion_mask, axis=-2)
             return embeddings_el_el, embeddings_el_ions, jnp.concatenate([jnp.concatenate([mult_up_up, mult_up_dn], axis=-2),
                                                                           jnp.concatenate([mult_dn_up, mult_dn_dn], axis=-2)], axis=-3)
         else:
@@ -178,7 +182,8 @@ class FermiNetEmbedding(hk.Module):
         h_dd = features_el_el[..., n_up :, n_up :, :].reshape(batch_dims + (n_dn * n_dn, -1))
         return [jnp.concatenate([h_uu, h_dd], axis=-2), jnp.concatenate([h_ud, h_du], axis=-2)]
 
-    def __call__(self, features: InputFeatures, n_up: int):
+    def __call__(self, features: InputFeatures, n_up: int, el_mask=None, ion_mask=None):
+        """el_mask and ion_mask mark the real particles of geometries padded with ghost particles; ghosts do not contribute to any aggregation"""
         h_el = features.el
         h_ion = features.ion
         h_el_ion = features.el_ion
@@ -192,7 +197,9 @@ class FermiNetEmbedding(hk.Module):
             h_el, h_el_el_schnet = SymmetricFeatures(self.config, self.mlp_config, n_up, name=f"symm_features_{i}")(h_el,
                                                                                                     h_ion,
                                                                                                     h_el_el,
-                                                                                                    h_el_ion)
+                                                                                                    h_el_ion,
+                                                                                                    el_mask,
+                                                                                                    ion_mask)
             if self.config.use_deep_schnet_feat:
                 h_el_el = self._split_into_same_diff(h_el_el_schnet, n_up)
 
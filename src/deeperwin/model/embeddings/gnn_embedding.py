@@ -40,7 +40,6 @@ class GNNEmbedding(hk.Module):
         el_ion = self.mlp_el_ion(features.el_ion)
         same = self.mlp_same(same)
         diff = self.mlp_diff(diff)
-        ion_ion = self.ion_ion(features.ion_ion)
 
         up_up = same[..., :(n_up * n_up), :].reshape(batch_dims + (n_up, n_up, -1))
         up_dn = diff[..., :(n_up * n_dn), :].reshape(batch_dims + (n_up, n_dn, -1))
@@ -49,7 +48,23 @@ class GNNEmbedding(hk.Module):
         up = jnp.concatenate([up_up, up_dn], axis=-2)
         dn = jnp.concatenate([dn_up, dn_dn], axis=-2)
         el_el = jnp.concatenate([up, dn], axis=-3)
-        return el_ion, el_el, ion_ion
+        return el_ion, el_el
+
+    def embed_ions(self, features_ion, features_ion_ion):
+        """
+        Ion-only part of the embedding, which does not depend on the electron coordinates.
+
+        Can be evaluated on un-batched ion features, so that it only needs to be computed once per geometry.
+        """
+        edge_ion_ion = self.ion_ion(features_ion_ion)
+        if self.config.ion_gnn.name == "phisnet_ion_emb":
+            emb_ion = self.phisnet_downmapping(features_ion)
+            emb_ion, _ = self.phisnet_mpnn(emb_ion, edges=edge_ion_ion)
+        elif self.config.ion_gnn.name == "ion_gnn":
+            emb_ion, _ = self.ion_gnn(features_ion, edges=edge_ion_ion)
+        else:
+            emb_ion = features_ion
+        return emb_ion
 
     def _get_distance_mask(self, dist):
         if self.config.cutoff_type == "constant":
@@ -66,21 +81,23 @@ class GNNEmbedding(hk.Module):
             raise ValueError(f"Unsupported mask: {self.config.cutoff_type}")
 
 
-    def __call__(self, diff_dist: DiffAndDistances, features: InputFeatures, n_up: int):
-        edge_el_ion, edge_el_el, edge_ion_ion = self._embed_edges(features, n_up)
+    def __call__(self, diff_dist: DiffAndDistances, features: InputFeatures, n_up: int, emb_ion=None):
+        """
+        Args:
+            emb_ion: Optional pre-computed (e.g. cached) output of embed_ions for the un-batched geometry
+        """
+        edge_el_ion, edge_el_el = self._embed_edges(features, n_up)
         mask_el_ion = self._get_distance_mask(diff_dist.dist_el_ion)
         mask_el_el = self._get_distance_mask(diff_dist.dist_el_el)
 
-        if self.config.ion_gnn.name == "phisnet_ion_emb":
-            batch_dim = features.el_el.shape[:-3]
-            features_ion = jnp.tile(features.ion, batch_dim + (1, 1))
-            emb_ion = self.phisnet_downmapping(features_ion)
-            emb_ion, _ = self.phisnet_mpnn(emb_ion, edges=edge_ion_ion)
-
-        elif self.config.ion_gnn.name == "ion_gnn":
-            emb_ion, _ = self.ion_gnn(features.ion, edges=edge_ion_ion)
+        batch_dim = features.el_el.shape[:-3]
+        if emb_ion is None:
+            features_ion = features.ion
+            if self.config.ion_gnn.name == "phisnet_ion_emb":
+                features_ion = jnp.tile(features_ion, batch_dim + (1, 1))
+            emb_ion = self.embed_ions(features_ion, features.ion_ion)
         else:
-            emb_ion = features.ion
+            emb_ion = jnp.broadcast_to(emb_ion, batch_dim + emb_ion.shape[-2:])
 
         emb_el, edge_el_ion = self.el_ion_mpnn(features.el, emb_ion, edge_el_ion, mask_el_ion)
         emb_el, edge_el_el = self.gnn(emb_el, edges=edge_el_el, mask=mask_el_el)
@@ -12,6 +12,7 @@ from deeperwin.configuration import (
 )
 from deeperwin.model.definitions import *
 from deeperwin.model.mlp import MLP, get_rbf_features, get_gauss_env_features
+from deeperwin.model.padding import masked_sum, mask_particles
 from deeperwin.utils.utils import get_distance_matrix, get_el_ion_distance_matrix
 from deeperwin.model.e3nn_utils import to_irreps_array
 import e3nn_jax as e3nn
@@ -91,33 +92,19 @@ class InputPreprocessor(hk.Module):
         self.Z_max = wavefunction_definition.Z_max
         self.Z_min = wavefunction_definition.Z_min
 
-    def __call__(
-        self, 
-        n_up: int, 
-        n_dn: int, 
-        r: jnp.ndarray, 
-        R: jnp.ndarray, 
-        Z: jnp.ndarray, 
-        fixed_params: Dict = None
-    ) -> Tuple[DiffAndDistances, InputFeatures]:
-        Z = jnp.array(Z, int)
-        if Z.ndim == 1: # no batch-dim for Z => tile across batch
-            Z = jnp.tile(Z, r.shape[:-2] + (1,))
-        if R.ndim == 2:  # no batch-dim for R => tile across batch
-            R = jnp.tile(R, r.shape[:-2] + (1, 1))
+    @hk.experimental.name_like("__call__")
+    def get_ion_features(self, R: jnp.ndarray, Z: jnp.ndarray, fixed_params: Dict = None) -> Dict[str, Optional[jnp.ndarray]]:
+        """
+        Computes all input features that only depend on the geometry: ion-ion differences, distances and features and the ion embeddings.
 
-        # Compute cartesian distances and difference vectors
+        These do not depend on the electron coordinates and can therefore be pre-computed on the (un-batched) geometry, i.e. once per
+        geometry instead of once per walker, and passed to __call__ (via the cache of the wavefunction).
+        """
+        Z = jnp.array(Z, int)
         if self.config.coordinates == "global_rot":
-            r = jnp.einsum("ni,...i->...n", fixed_params['global_rotation'], r)
             R = jnp.einsum("ni,...i->...n", fixed_params['global_rotation'], R)
-        diff_el_el, dist_el_el = get_distance_matrix(r)
-        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r, R)
         diff_ion_ion, dist_ion_ion = get_distance_matrix(R)
 
-        if self.config.coordinates == "local_rot":
-            diff_el_ion = jnp.einsum("Jni,...Ji->...Jn", fixed_params["local_rotations"], diff_el_ion)
-
-
         # Ion-ion features
         if self.config.n_ion_ion_rbf_features > 0:
             diff_ion_ion, dist_ion_ion = get_distance_matrix(R, full=True) # use pairwise features
@@ -126,7 +113,6 @@ class InputPreprocessor(hk.Module):
         else:
             features_ion_ion = None
 
-        
         # Ion features
         if self.config.ion_embed_type is None:
             features_ion = None
@@ -144,6 +130,49 @@ class InputPreprocessor(hk.Module):
             features_ion = self.ion_embedding(Z[..., None].astype(float))
         else:
             raise ValueError(f"Unknown ion_embed_type {self.config.ion_embed_type}")
+        return dict(diff_ion_ion=diff_ion_ion,
+                    dist_ion_ion=dist_ion_ion,
+                    features_ion=features_ion,
+                    features_ion_ion=features_ion_ion)
+
+    def __call__(
+        self, 
+        n_up: int, 
+        n_dn: int, 
+        r: jnp.ndarray, 
+        R: jnp.ndarray, 
+        Z: jnp.ndarray, 
+        fixed_params: Dict = None,
+        ion_features: Dict = None,
+        el_mask: Optional[jnp.ndarray] = None,
+        ion_mask: Optional[jnp.ndarray] = None,
+    ) -> Tuple[DiffAndDistances, InputFeatures]:
+        batch_shape = r.shape[:-2]
+        if ion_features is None:
+            # Evaluated in-graph (e.g. in the gradient pass of the loss): compute the ion features per walker, so that the ion MLPs
+            # see one sample per walker (e.g. for the curvature estimate of KFAC), as without caching
+            ion_features = self.get_ion_features(jnp.broadcast_to(R, batch_shape + R.shape[-2:]),
+                                                 jnp.broadcast_to(jnp.asarray(Z), batch_shape + jnp.shape(Z)[-1:]), fixed_params)
+
+        def _broadcast_to_batch(x, n_dims):
+            if x is None:
+                return None
+            return jnp.broadcast_to(x, batch_shape + x.shape[-n_dims:])
+
+        diff_ion_ion = _broadcast_to_batch(ion_features['diff_ion_ion'], 3)
+        dist_ion_ion = _broadcast_to_batch(ion_features['dist_ion_ion'], 2)
+        features_ion_ion = _broadcast_to_batch(ion_features['features_ion_ion'], 3)
+        features_ion = _broadcast_to_batch(ion_features['features_ion'], 2)
+
+        # Compute cartesian distances and difference vectors
+        if self.config.coordinates == "global_rot":
+            r = jnp.einsum("ni,...i->...n", fixed_params['global_rotation'], r)
+            R = jnp.einsum("ni,...i->...n", fixed_params['global_rotation'], R)
+        diff_el_el, dist_el_el = get_distance_matrix(r)
+        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r, R)
+
+        if self.config.coordinates == "local_rot":
+            diff_el_ion = jnp.einsum("Jni,...Ji->...Jn", fixed_params["local_rotations"], diff_el_ion)
 
         # Electron features
         features_el_el = self.features_el_el(diff_el_el, dist_el_el)
@@ -159,7 +188,7 @@ class InputPreprocessor(hk.Module):
                                                            mlp_config=self.mlp_config,
                                                            name="el_el_features")
             el_el_edges = el_el_features_fct(features_el_el, dist_el_el)
-            features_el.append(jnp.sum(el_el_edges, axis=-2))
+            features_el.append(masked_sum(el_el_edges, el_mask, axis=-2))
 
         if self.config.init_with_el_ion_feat:
             el_ion_features_fct = functools.partial(init_particle_features,
@@ -171,7 +200,7 @@ class InputPreprocessor(hk.Module):
                                                            name="el_ion_features")
 
             el_ion_edges = el_ion_features_fct(features_el_ion, dist_el_ion)
-            features_el.append(jnp.sum(el_ion_edges, axis=-2)) # sum over ions
+            features_el.append(masked_sum(el_ion_edges, ion_mask, axis=-2)) # sum over ions
 
         if self.config.use_el_spin:
             spin_features = np.ones([*r.shape[:-1], 1])
@@ -179,7 +208,8 @@ class InputPreprocessor(hk.Module):
             features_el.append(spin_features)
         if self.config.concatenate_el_ion_features:
             # concatenate all el-ion features into a long h_one feature
-            features_el.append(jnp.reshape(features_el_ion, features_el_ion.shape[:-2] + (-1,)))
+            features_el_ion_concat = mask_particles(features_el_ion, ion_mask, axis=-2)
+            features_el.append(jnp.reshape(features_el_ion_concat, features_el_ion.shape[:-2] + (-1,)))
         if len(features_el) == 0:
             if self.config.init_as_zeros:
                 features_el.append(jnp.zeros(r.shape[:-1] + (1,)))
@@ -56,6 +56,28 @@ class MLP(hk.Module):
         return x
 
 
+def dense_layers_in_dtype(dtype):
+    """
+    Context manager, which evaluates all dense layers (hk.Linear) of haiku models applied within the context in the given dtype.
+
+    Inputs and parameters of each dense layer are cast to dtype (e.g. bfloat16); all other parameters and operations are unchanged.
+    Since the casts are part of the traced function, derivatives w.r.t. the (full-precision) parameters keep the parameter dtype.
+    """
+    def _cast(tree):
+        return jax.tree_util.tree_map(lambda x: x.astype(dtype) if jnp.issubdtype(jnp.result_type(x), jnp.floating) else x, tree)
+
+    def _getter(next_getter, value, context):
+        return next_getter(_cast(value))
+
+    def _interceptor(next_f, args, kwargs, context):
+        if not (isinstance(context.module, hk.Linear) and (context.method_name == "__call__")):
+            return next_f(*args, **kwargs)
+        with hk.custom_getter(_getter):
+            return next_f(*_cast(args), **kwargs)
+
+    return hk.intercept_methods(_interceptor)
+
+
 def get_activation(activation: str) -> Callable:
     if isinstance(activation, Callable):
         return activation
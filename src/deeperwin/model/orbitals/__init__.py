@@ -1,4 +1,4 @@
 from deeperwin.model.orbitals.orbital_net import OrbitalNet
 from deeperwin.model.orbitals.baseline_orbitals import BaselineOrbitals
 from deeperwin.model.orbitals.transferable_atomic_orbitals import TAOExponents, TAOBackflow, TransferableAtomicOrbitals
-from deeperwin.model.orbitals.baseline_orbitals import BaselineOrbitals, get_baseline_slater_matrices
\ No newline at end of file
+from deeperwin.model.orbitals.baseline_orbitals import BaselineOrbitals, get_baseline_slater_matrices, get_baseline_slater_row
\ No newline at end of file
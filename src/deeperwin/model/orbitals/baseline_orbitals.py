@@ -71,6 +71,45 @@ def get_baseline_slater_matrices(diff_el_ion, dist_el_ion, orbital_params: Orbit
     return mo_matrix_up, mo_matrix_dn
 
 
+def get_baseline_slater_row(diff_el_ion, dist_el_ion, orbital_params: OrbitalParams, index):
+    """
+    Row of a single electron of the square Slater matrix get_full_slater_matrix(*get_baseline_slater_matrices(...)).
+
+    Only the orbitals of this electron are evaluated, i.e. the cost is O(n_el) instead of O(n_el^2) for the full matrices.
+
+    Args:
+        diff_el_ion: [(batch) x n_ions x 3] differences between the electron and all ions
+        dist_el_ion: [(batch) x n_ions] distances between the electron and all ions
+        index: Index of the electron (may be traced); electrons < n_up are spin-up
+    Returns:
+        [(batch) x n_dets x n_el]
+    """
+    n_dets, n_up = orbital_params.idx_orbitals[0].shape
+    n_dn = orbital_params.idx_orbitals[1].shape[1]
+
+    def _eval_orbitals(spin):
+        mos = evaluate_molecular_orbitals(
+            diff_el_ion[..., None, :, :],
+            dist_el_ion[..., None, :],
+            orbital_params.atomic_orbitals,
+            orbital_params.mo_coeff[spin],
+            orbital_params.mo_cusp_params[spin]
+        )
+        return mos[..., 0, orbital_params.idx_orbitals[spin]]  # [(batch) x n_dets x n_spin]
+
+    mo_up = _eval_orbitals(0)
+    mo_dn = _eval_orbitals(1)
+    batch_shape = mo_up.shape[:-2]
+
+    # Same CI weights as in get_baseline_slater_matrices
+    ci_weights = orbital_params.ci_weights[:, None]
+    ci_weights_up = jnp.abs(ci_weights)**(1/n_up)
+    ci_weights_up *= jnp.concatenate([jnp.sign(ci_weights), jnp.ones([n_dets, n_up-1])], axis=-1)
+    row_up = jnp.concatenate([mo_up * ci_weights_up, jnp.zeros(batch_shape + (n_dets, n_dn))], axis=-1)
+    row_dn = jnp.concatenate([jnp.zeros(batch_shape + (n_dets, n_up)), mo_dn], axis=-1)
+    return jnp.where(index < n_up, row_up, row_dn)
+
+
 class BaselineOrbitals(hk.Module):
     """
     Base class representing a set of baseline (spin) orbitals, obtained from for example CASSCF,
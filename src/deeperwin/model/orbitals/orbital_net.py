@@ -1,4 +1,4 @@
-from typing import Tuple, Dict
+from typing import Tuple, Dict, Optional
 
 import haiku as hk
 from jax import numpy as jnp
@@ -9,6 +9,7 @@ from deeperwin.model.orbitals.baseline_orbitals import BaselineOrbitals, _determ
 from deeperwin.model.orbitals.transferable_atomic_orbitals import TransferableAtomicOrbitals
 from deeperwin.model.orbitals.e3_transferable_atomic_orbitals import E3TransferableAtomicOrbitals
 from deeperwin.model.orbitals.envelope_orbitals import EnvelopeOrbitals
+from deeperwin.model.padding import mask_slater_matrices
 from deeperwin.orbitals import OrbitalParams
 
 
@@ -72,7 +73,9 @@ class OrbitalNet(hk.Module):
         cache: Dict,
         n_ions: int,
         n_up: int,
-        n_dn: int
+        n_dn: int,
+        el_mask: Optional[jnp.ndarray] = None,
+        ion_mask: Optional[jnp.ndarray] = None,
     ) -> Tuple[jnp.ndarray, jnp.ndarray]:
         if self.config.envelope_orbitals:
             mo_up, mo_dn = EnvelopeOrbitals(
@@ -104,7 +107,8 @@ class OrbitalNet(hk.Module):
                                              n_up,
                                              n_dn,
                                              tao_params['features'],
-                                             cache.get('taos') if cache else None)
+                                             cache.get('taos') if cache else None,
+                                             ion_mask)
             mo_up += mo_up_tao
             mo_dn += mo_dn_tao
         if self.e3_taos:
@@ -122,4 +126,6 @@ class OrbitalNet(hk.Module):
         if n_up < self.wavefunction_definition.max_n_up_orbitals or n_dn < self.wavefunction_definition.max_n_dn_orbitals:
             mo_up, mo_dn = self._truncate_predicted_orbitals(mo_up, mo_dn)
 
+        # Ghost electrons of padded geometries only occupy their own ghost orbital
+        mo_up, mo_dn = mask_slater_matrices(mo_up, mo_dn, el_mask)
         return mo_up, mo_dn
@@ -5,6 +5,7 @@ from deeperwin.configuration import MLPConfig, TransferableAtomicOrbitalsConfig,
 from deeperwin.model import MLP, antisymmetrize, symmetrize, DiffAndDistances, Embeddings
 from deeperwin.model.mlp import get_rbf_features
 from deeperwin.model.gnn import DenseGNN
+from deeperwin.model.padding import mask_particles
 from typing import Optional, Dict
 
 class TAOBackflow(hk.Module):
@@ -86,7 +87,7 @@ class OrbitalFeatureGNN(hk.Module):
         self.gnn = DenseGNN(config, mlp_config)
         self.n_edge_features = n_edge_features
 
-    def __call__(self, orb_features: jax.Array, ion_ion_diff: jax.Array, ion_ion_dist: jax.Array, ):
+    def __call__(self, orb_features: jax.Array, ion_ion_diff: jax.Array, ion_ion_dist: jax.Array, ion_mask: Optional[jax.Array] = None):
         orb_features = jnp.moveaxis(orb_features, -2, -3) # [... x ion x orb x features] -> [... orb x ion x features]
         # Calculate edge features as (rbf(|r|), rbf(|r|) * x, rbf(|r|) * y, rbf(|r|) * z)
         rbfs = get_rbf_features(ion_ion_dist, n_features=self.n_edge_features, r_max=5.0)
@@ -96,7 +97,9 @@ class OrbitalFeatureGNN(hk.Module):
                                          rbfs * ion_ion_diff[..., 2:3],
                                          ], axis=-1)
         ion_ion_edges = ion_ion_edges[..., None, None, :, :, :] # add dummy-dim for orbitals and antisymmetrization
-        orb_features = antisymmetrize(lambda nodes: self.gnn(nodes, edges=ion_ion_edges)[0],
+        # Ghost ions do not send any messages (exact for linear weighting and sum-aggregation)
+        mask = None if ion_mask is None else ion_mask[None, :]
+        orb_features = antisymmetrize(lambda nodes: self.gnn(nodes, edges=ion_ion_edges, mask=mask)[0],
                                       tmp_axis=-4)(orb_features)
         orb_features = jnp.moveaxis(orb_features, -3, -2)
         return orb_features
@@ -123,7 +126,7 @@ class TransferableAtomicOrbitals(hk.Module):
         assert determinant_schema in ["full_det"], f"TAO currently not implemented for determinant_schema {determinant_schema}"
 
     @hk.experimental.name_like("__call__")
-    def get_exponents_and_backflows(self, orbital_features: jax.Array, n_up, n_dn, el_emb_dim, tile_dims, ion_ion_diff, ion_ion_dist, get_envelopes=True, get_backflows=True):
+    def get_exponents_and_backflows(self, orbital_features: jax.Array, n_up, n_dn, el_emb_dim, tile_dims, ion_ion_diff, ion_ion_dist, get_envelopes=True, get_backflows=True, ion_mask=None):
         exponents = [None, None]
         prefacs = [None, None]
         backflows = [None, None]
@@ -167,6 +170,7 @@ class TransferableAtomicOrbitals(hk.Module):
                                                  name=f"orbital_gnn_{spin}")(orb_features,
                                                                              ion_ion_diff,
                                                                              ion_ion_dist,
+                                                                             ion_mask,
                                                                              )
 
             if get_envelopes:
@@ -202,6 +206,7 @@ class TransferableAtomicOrbitals(hk.Module):
                  n_dn: int,
                  orbital_features: jnp.array,  # [n_ions, n_orbitals, feature_dim]
                  cache: Optional[Dict] = None,
+                 ion_mask: Optional[jnp.array] = None,
                  ):
         emb_el = embeddings.el
         if self.config.el_feature_dim is not None:
@@ -216,6 +221,7 @@ class TransferableAtomicOrbitals(hk.Module):
                                                                               batch_dims,
                                                                               diff_dist.diff_ion_ion,
                                                                               diff_dist.dist_ion_ion,
+                                                                              ion_mask=ion_mask,
                                                                               )
         else:
             exponents, backflows, prefacs = cache['exponents'], cache['backflows'], cache['prefacs']
@@ -242,6 +248,9 @@ class TransferableAtomicOrbitals(hk.Module):
             if prefac is not None:
                 envelope_same *= prefac[..., None, :, :, 0, :]
                 envelope_diff *= prefac[..., None, :, :, 1, :]
+            # Ghost ions do not contribute to any orbital
+            envelope_same = mask_particles(envelope_same, ion_mask, axis=-3)
+            envelope_diff = mask_particles(envelope_diff, ion_mask, axis=-3)
 
             bf_same = backflow[..., :, :, 0, :, :]
             bf_diff = backflow[..., :, :, 1, :, :]
@@ -0,0 +1,71 @@
+"""
+Masking of ghost particles, i.e. electrons and ions which are only added to pad a geometry to a larger shape (see deeperwin.bucketing).
+
+All functions are no-ops if no mask is given, so that un-padded geometries are evaluated exactly as before.
+"""
+from typing import Dict, Optional, Tuple
+import jax.numpy as jnp
+
+
+def get_padding_masks(fixed_params: Optional[Dict]) -> Tuple[Optional[jnp.ndarray], Optional[jnp.ndarray]]:
+    """Returns the masks (el_mask, ion_mask) of a padded geometry, with 1 for real and 0 for ghost particles, or (None, None) for un-padded geometries"""
+    padding = (fixed_params or {}).get("padding")
+    if padding is None:
+        return None, None
+    return padding["el_mask"], padding["ion_mask"]
+
+
+def _expand_mask(mask, axis):
+    # Mask is aligned with the given (negative) axis of the array and broadcast over all trailing axes
+    assert axis < 0
+    return mask.reshape(mask.shape + (1,) * (-axis - 1))
+
+
+def mask_particles(x, mask, axis):
+    """Sets all entries of ghost particles along the given axis to zero"""
+    if mask is None:
+        return x
+    return x * _expand_mask(mask, axis)
+
+
+def masked_sum(x, mask, axis, keepdims=False):
+    """Sum over all real particles along the given axis"""
+    return jnp.sum(mask_particles(x, mask, axis), axis=axis, keepdims=keepdims)
+
+
+def masked_mean(x, mask, axis, keepdims=False):
+    """Mean over all real particles along the given axis"""
+    if mask is None:
+        return jnp.mean(x, axis=axis, keepdims=keepdims)
+    n_real = jnp.maximum(jnp.sum(mask), 1)
+    return masked_sum(x, mask, axis, keepdims) / n_real
+
+
+def mask_slater_matrices(mo_up, mo_dn, el_mask):
+    """
+    Replaces all rows and columns of ghost electrons in the Slater matrices by rows/columns of the identity matrix.
+
+    The electron axis is ordered [up-electrons, ghost up, dn-electrons, ghost dn] and the orbitals are ordered correspondingly,
+    so every ghost electron is paired with its own ghost orbital. The determinants (and therefore log|psi|) are unchanged by the
+    padding, independent of the (arbitrary) orbital values predicted for the ghosts.
+
+    Args:
+        mo_up: Slater matrices of the up-electrons [batch x dets x n_up x n_orbitals]
+        mo_dn: Slater matrices of the dn-electrons [batch x dets x n_dn x n_orbitals]
+        el_mask: Mask of real electrons [n_el]
+    """
+    if el_mask is None:
+        return mo_up, mo_dn
+    n_up = mo_up.shape[-2]
+    mask_up, mask_dn = el_mask[:n_up], el_mask[n_up:]
+    is_full_det = mo_up.shape[-1] == len(el_mask)
+    if is_full_det:
+        masks_orb, offset_dn = (el_mask, el_mask), n_up
+    else:
+        masks_orb, offset_dn = (mask_up, mask_dn), 0
+
+    def _mask(mo, mask_el, mask_orb, offset):
+        identity = jnp.eye(mo.shape[-2], mo.shape[-1], k=offset, dtype=mo.dtype)
+        return mo * (mask_el[:, None] * mask_orb[None, :]) + identity * (1 - mask_el)[:, None]
+
+    return _mask(mo_up, mask_up, masks_orb[0], 0), _mask(mo_dn, mask_dn, masks_orb[1], offset_dn)
@@ -4,6 +4,7 @@ File containing the wavefunction model & function to build the model
 
 import haiku.experimental
 import jax
+import numpy as np
 import jax.numpy as jnp
 from typing import Optional, Dict, Callable, Any, Tuple, Union, List
 import haiku as hk
@@ -19,9 +20,11 @@ from deeperwin.model.input_features import InputPreprocessor
 from deeperwin.model.mlp import MLP
 from deeperwin.model.embeddings import *
 from deeperwin.model.orbitals import OrbitalNet
+from deeperwin.model.orbitals.baseline_orbitals import get_baseline_slater_matrices
 from deeperwin.model.orbitals.transferable_atomic_orbitals import TransferableAtomicOrbitals
 from deeperwin.model.definitions import *
-from deeperwin.utils.utils import get_distance_matrix, get_param_size_summary
+from deeperwin.model.padding import get_padding_masks, masked_sum
+from deeperwin.utils.utils import get_distance_matrix, get_el_ion_distance_matrix, get_param_size_summary
 from deeperwin.orbitals import get_baseline_solution, get_atomic_orbital_descriptors, get_envelope_exponents_from_atomic_orbitals, get_n_basis_per_Z
 from deeperwin.model.ml_orbitals.ml_orbitals import get_phisnet_solution
 from deeperwin.local_features import build_local_rotation_matrices, build_global_rotation_matrix
@@ -32,28 +35,62 @@ import e3nn_jax as e3nn
 LOGGER = logging.getLogger("dpe")
 
 
+def _at_least_float32(x):
+    """Upcasts low-precision (e.g. bfloat16) arrays to float32, e.g. before determinants or reductions over electrons"""
+    return x.astype(jnp.promote_types(x.dtype, jnp.float32))
+
+
 class JastrowFactor(hk.Module):
     def __init__(self, config: JastrowConfig, mlp_config: MLPConfig, name=None):
         super().__init__(name=name)
         self.config = config
         self.mlp_config = mlp_config
 
-    def __call__(self, embeddings: Embeddings, n_up: int):
+    def __call__(self, embeddings: Embeddings, n_up: int, el_mask=None):
         if self.config.differentiate_spins:
+            mask_up, mask_dn = (None, None) if el_mask is None else (el_mask[:n_up], el_mask[n_up:])
             jastrow_up = MLP(self.config.n_hidden + [1], self.mlp_config, linear_out=True, output_bias=False, name="up")(
                 embeddings.el[..., : n_up, :])
             jastrow_dn = MLP(self.config.n_hidden + [1], self.mlp_config, linear_out=True, output_bias=False, name="dn")(
                 embeddings.el[..., n_up:, :])
-            jastrow = jnp.sum(jastrow_up, axis=(-2, -1)) + jnp.sum(jastrow_dn, axis=(-2, -1))
+            jastrow_up, jastrow_dn = _at_least_float32(jastrow_up), _at_least_float32(jastrow_dn)
+            jastrow = jnp.sum(masked_sum(jastrow_up, mask_up, axis=-2), axis=-1) + jnp.sum(masked_sum(jastrow_dn, mask_dn, axis=-2), axis=-1)
         else:
             jastrow = MLP(self.config.n_hidden + [1], linear_out=True, output_bias=False, name="mlp")(embeddings.el)
-            jastrow = jnp.sum(jastrow, axis=(-2, -1))
+            jastrow = jnp.sum(masked_sum(_at_least_float32(jastrow), el_mask, axis=-2), axis=-1)
         return jastrow
 
 
-def evaluate_sum_of_determinants(mo_matrix_up, mo_matrix_dn):
+def get_full_slater_matrix(mo_matrix_up, mo_matrix_dn):
+    """
+    Combines the up- and down-blocks into a single square matrix of shape [... x n_dets x n_el x n_el] with one row per electron.
+
+    For block-diagonal schemas the off-diagonal blocks are zero, so that det(full) = det(up) * det(dn) in both cases.
+    """
+    # determinant_schema is full_det or restricted_closed_shell
+    if mo_matrix_up.shape[-1] != mo_matrix_up.shape[-2] and mo_matrix_dn.shape[-1] != mo_matrix_dn.shape[-2]:
+        return jnp.concatenate([mo_matrix_up, mo_matrix_dn], axis=-2)
+    # determinant schema is block diagonal
+    n_up, n_dn = mo_matrix_up.shape[-1], mo_matrix_dn.shape[-1]
+    mo_matrix_up = jnp.concatenate([mo_matrix_up, jnp.zeros(mo_matrix_up.shape[:-1] + (n_dn,))], axis=-1)
+    mo_matrix_dn = jnp.concatenate([jnp.zeros(mo_matrix_dn.shape[:-1] + (n_up,)), mo_matrix_dn], axis=-1)
+    return jnp.concatenate([mo_matrix_up, mo_matrix_dn], axis=-2)
+
+
+def sum_of_determinants_from_slogdet(sign_total, log_total):
+    """Computes log(psi^2) of a sum of determinants, given sign and log-abs of each determinant (last axis = determinants)"""
     LOG_EPSILON = 1e-8
 
+    log_shift = jnp.max(log_total, axis=-1, keepdims=True)
+    psi = jnp.exp(log_total - log_shift) * sign_total
+    psi = jnp.sum(psi, axis=-1)  # sum over determinants
+    log_psi_sqr = 2 * (jnp.log(jnp.abs(psi) + LOG_EPSILON) + jnp.squeeze(log_shift, -1))
+    return log_psi_sqr
+
+
+def evaluate_sum_of_determinants(mo_matrix_up, mo_matrix_dn):
+    # Determinants are always evaluated in (at least) single precision, even if the network runs in lower precision
+    mo_matrix_up, mo_matrix_dn = _at_least_float32(mo_matrix_up), _at_least_float32(mo_matrix_dn)
     # determinant_schema is full_det or restricted_closed_shell
     if mo_matrix_up.shape[-1] != mo_matrix_up.shape[-2] and mo_matrix_dn.shape[-1] != mo_matrix_dn.shape[-2]:
         mo_matrix = jnp.concatenate([mo_matrix_up, mo_matrix_dn], axis=-2)
@@ -64,11 +101,24 @@ def evaluate_sum_of_determinants(mo_matrix_up, mo_matrix_dn):
         sign_dn, log_dn = jnp.linalg.slogdet(mo_matrix_dn)
         log_total = log_up + log_dn
         sign_total = sign_up * sign_dn
+    return sum_of_determinants_from_slogdet(sign_total, log_total)
 
-    log_shift = jnp.max(log_total, axis=-1, keepdims=True)
-    psi = jnp.exp(log_total - log_shift) * sign_total
-    psi = jnp.sum(psi, axis=-1)  # sum over determinants
-    log_psi_sqr = 2 * (jnp.log(jnp.abs(psi) + LOG_EPSILON) + jnp.squeeze(log_shift, -1))
+
+def build_log_psi_squared_baseline(determinant_schema="block_diag"):
+    """
+    Returns log(psi^2) of the baseline (HF/CASSCF) wavefunction stored in the fixed parameters, using the same signature as the full model.
+    It does not depend on trainable parameters and is therefore a cheap surrogate, e.g. for delayed-acceptance MCMC.
+    """
+    def log_psi_sqr(params, n_up, n_dn, r, R, Z, fixed_params):
+        if "orbitals" in fixed_params:
+            orbital_params = fixed_params["orbitals"]
+        elif "transferable_atomic_orbitals" in fixed_params:
+            orbital_params = fixed_params["transferable_atomic_orbitals"]["orbitals"]
+        else:
+            raise ValueError("No baseline orbitals found in fixed params")
+        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r, R)
+        mo_up, mo_dn = get_baseline_slater_matrices(diff_el_ion, dist_el_ion, orbital_params, determinant_schema)
+        return evaluate_sum_of_determinants(mo_up, mo_dn)
     return log_psi_sqr
 
 
@@ -111,7 +161,9 @@ class Wavefunction(hk.Module):
 
     def __call__(self, n_up: int, n_dn: int, r, R, Z, fixed_params: Optional[Dict] = None):
         fixed_params = fixed_params or {}
-        diff_dist, features = self.input_preprocessor(n_up, n_dn, r, R, Z, fixed_params.get('input'))
+        cache = fixed_params.get('cache') or {}
+        el_mask, ion_mask = get_padding_masks(fixed_params)
+        diff_dist, features = self.input_preprocessor(n_up, n_dn, r, R, Z, fixed_params.get('input'), cache.get('ions'), el_mask, ion_mask)
 
         if self.config.embedding.name == "gnn" and self.config.embedding.ion_gnn.name == "phisnet_ion_emb":
             # TODO switch features.ion from constance to features generated by phisnet in fixed_params
@@ -119,40 +171,44 @@ class Wavefunction(hk.Module):
             features_ion = fixed_params['transferable_atomic_orbitals']['features_ion_phisnet']
             features = InputFeatures(features.el, features_ion, features.el_el, features.el_ion, features.ion_ion)
 
-        embeddings = self._calculate_embedding(diff_dist, features, n_up)
+        embeddings = self._calculate_embedding(diff_dist, features, n_up, cache.get('ion_embedding'), el_mask, ion_mask)
         mo_up, mo_dn = self._calculate_orbitals(diff_dist, embeddings, fixed_params, Z.shape[-1], n_up, n_dn)
         log_psi_sqr = evaluate_sum_of_determinants(mo_up, mo_dn)
 
         # Jastrow factor to the total wavefunction
         if self.jastrow:
-            log_psi_sqr += self.jastrow(embeddings, n_up)
+            log_psi_sqr += self.jastrow(embeddings, n_up, el_mask)
 
         # Electron-electron-cusps
         if self.config.use_el_el_cusp_correction:
-            log_psi_sqr += self._el_el_cusp(diff_dist.dist_el_el, n_up)
+            log_psi_sqr += self._el_el_cusp(_at_least_float32(diff_dist.dist_el_el), n_up, el_mask)
         return log_psi_sqr
 
     def get_slater_matrices(self, n_up, n_dn, r, R, Z, fixed_params: Optional[Dict] = None):
         assert n_up + n_dn == r.shape[-2] # assert down & up electrons equal total amount of electrons
 
         fixed_params = fixed_params or {}
-        diff_dist, features = self.input_preprocessor(n_up, n_dn, r, R, Z, fixed_params.get('input'))
+        cache = fixed_params.get('cache') or {}
+        el_mask, ion_mask = get_padding_masks(fixed_params)
+        diff_dist, features = self.input_preprocessor(n_up, n_dn, r, R, Z, fixed_params.get('input'), cache.get('ions'), el_mask, ion_mask)
         if self.config.embedding.name == "gnn" and self.config.embedding.ion_gnn.name == "phisnet_ion_emb":
             features_ion = fixed_params['transferable_atomic_orbitals']['features_ion_phisnet']
             features = InputFeatures(features.el, features_ion, features.el_el, features.el_ion, features.ion_ion)
 
-        embeddings = self._calculate_embedding(diff_dist, features, n_up)
+        embeddings = self._calculate_embedding(diff_dist, features, n_up, cache.get('ion_embedding'), el_mask, ion_mask)
         mo_up, mo_dn = self._calculate_orbitals(diff_dist, embeddings, fixed_params, Z.shape[-1], n_up, n_dn)
         return mo_up, mo_dn
 
     @haiku.experimental.name_like("__call__")
-    def _calculate_embedding(self, diff_dist, features, n_up):
+    def _calculate_embedding(self, diff_dist, features, n_up, ion_embedding=None, el_mask=None, ion_mask=None):
         if self.config.embedding.name in ["ferminet", "dpe4"]:
             return FermiNetEmbedding(self.config.embedding,
-                                     self.config.mlp)(features, n_up)
+                                     self.config.mlp)(features, n_up, el_mask, ion_mask)
+        if el_mask is not None:
+            raise NotImplementedError(f"Padding with ghost particles is not supported for embedding {self.config.embedding.name}")
         if self.config.embedding.name == "gnn":
             return GNNEmbedding(self.config.embedding,
-                                self.config.mlp)(diff_dist, features, n_up)
+                                self.config.mlp)(diff_dist, features, n_up, ion_embedding)
         elif self.config.embedding.name == "dpe1":
             return PauliNetEmbedding(self.config.embedding,
                                      self.config.mlp)(features, n_up)
@@ -176,12 +232,28 @@ class Wavefunction(hk.Module):
                             fixed_params.get("cache"),
                             n_ions,
                             n_up,
-                            n_dn)
+                            n_dn,
+                            *get_padding_masks(fixed_params))
+
+    @haiku.experimental.name_like("__call__")
+    def _calculate_ion_embedding(self, features_ion, features_ion_ion):
+        return GNNEmbedding(self.config.embedding, self.config.mlp).embed_ions(features_ion, features_ion_ion)
 
     def _calculate_cache(self, n_up: int, n_dn: int, r, R, Z, fixed_params: Optional[Dict] = None):
         cache = dict()
         if not self.config.use_cache:
             return None
+        fixed_params = fixed_params or {}
+
+        # Geometry-only input features and ion embeddings, which would otherwise be recomputed for every walker
+        cache['ions'] = self.input_preprocessor.get_ion_features(R, Z, fixed_params.get('input'))
+        if self.config.embedding.name == "gnn":
+            if self.config.embedding.ion_gnn.name == "phisnet_ion_emb":
+                features_ion = fixed_params['transferable_atomic_orbitals']['features_ion_phisnet']
+            else:
+                features_ion = cache['ions']['features_ion']
+            cache['ion_embedding'] = self._calculate_ion_embedding(features_ion, cache['ions']['features_ion_ion'])
+
         if self.config.orbitals.transferable_atomic_orbitals and self.config.orbitals.transferable_atomic_orbitals.name == "taos":
             cache['taos'] = dict()
             diff, dist = get_distance_matrix(R)
@@ -203,7 +275,8 @@ class Wavefunction(hk.Module):
                 diff,
                 dist,
                 True,
-                True)
+                True,
+                get_padding_masks(fixed_params)[1])
             cache['taos']['exponents'] = exp
             cache['taos']['backflows'] = bf
             cache['taos']['prefacs'] = pf
@@ -224,7 +297,7 @@ class Wavefunction(hk.Module):
         return cache
 
 
-    def _el_el_cusp(self, el_el_dist, n_up):
+    def _el_el_cusp(self, el_el_dist, n_up, el_mask=None):
         # # No factor 0.5 here, e.g. when comparing to NatChem 2020, [doi.org/10.1038/s41557-020-0544-y], because:
         # # A) We double-count electron-pairs because we take the full distance matrix (and not only the upper triangle)
         # # B) We model log(psi^2)=2*log(|psi|) vs log(|psi|) int NatChem 2020, i.e. the cusp correction needs a factor 2
@@ -233,20 +306,37 @@ class Wavefunction(hk.Module):
         factor_same = -0.25
         factor_diff = -0.5
 
-        flat_shape = el_el_dist.shape[:-2] + (-1,)
-        if el_el_dist.shape[-1] == el_el_dist.shape[-2]:
-            # Full el-el-distance matrix (including distance to itself, which is 0)
-            dist_same = jnp.concatenate([el_el_dist[..., :n_up, :n_up].reshape(flat_shape),
-                                         el_el_dist[..., n_up:, n_up:].reshape(flat_shape)], axis=-1)
-            dist_diff = jnp.concatenate([el_el_dist[..., :n_up, n_up:].reshape(flat_shape),
-                                         el_el_dist[..., n_up:, :n_up].reshape(flat_shape)], axis=-1)
-        else:
-            dist_same = jnp.concatenate([el_el_dist[..., :n_up, :n_up-1].reshape(flat_shape),
-                                         el_el_dist[..., n_up:, n_up:].reshape(flat_shape)], axis=-1)
-            dist_diff = jnp.concatenate([el_el_dist[..., :n_up, n_up-1:].reshape(flat_shape),
-                                         el_el_dist[..., n_up:, :n_up].reshape(flat_shape)], axis=-1)
-        cusp_same = jnp.sum(alpha_same ** 2 / (alpha_same + dist_same), axis=-1)
-        cusp_diff = jnp.sum(alpha_diff ** 2 / (alpha_diff + dist_diff), axis=-1)
+        n_el = el_el_dist.shape[-2]
+        is_full = el_el_dist.shape[-1] == n_el
+
+        def split_same_diff(pair_matrix):
+            flat_shape = pair_matrix.shape[:-2] + (-1,)
+            if is_full:
+                # Full el-el-distance matrix (including distance to itself, which is 0)
+                same = [pair_matrix[..., :n_up, :n_up], pair_matrix[..., n_up:, n_up:]]
+                diff = [pair_matrix[..., :n_up, n_up:], pair_matrix[..., n_up:, :n_up]]
+            else:
+                # Distance matrix without the diagonal, i.e. row i contains the distances to all electrons j != i
+                same = [pair_matrix[..., :n_up, :n_up-1], pair_matrix[..., n_up:, n_up:]]
+                diff = [pair_matrix[..., :n_up, n_up-1:], pair_matrix[..., n_up:, :n_up]]
+            return (jnp.concatenate([x.reshape(flat_shape) for x in same], axis=-1),
+                    jnp.concatenate([x.reshape(flat_shape) for x in diff], axis=-1))
+
+        dist_same, dist_diff = split_same_diff(el_el_dist)
+        cusp_same = alpha_same ** 2 / (alpha_same + dist_same)
+        cusp_diff = alpha_diff ** 2 / (alpha_diff + dist_diff)
+        if el_mask is not None:
+            # Only pairs of 2 real electrons
+            if is_full:
+                pair_mask = el_mask[:, None] * el_mask[None, :]
+            else:
+                idx_others = np.array([[j for j in range(n_el) if j != i] for i in range(n_el)], dtype=int).reshape([n_el, n_el - 1])
+                pair_mask = el_mask[:, None] * el_mask[idx_others]
+            mask_same, mask_diff = split_same_diff(pair_mask)
+            cusp_same *= mask_same
+            cusp_diff *= mask_diff
+        cusp_same = jnp.sum(cusp_same, axis=-1)
+        cusp_diff = jnp.sum(cusp_diff, axis=-1)
         return factor_same * cusp_same + factor_diff * cusp_diff
 
 
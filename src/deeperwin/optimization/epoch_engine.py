@@ -0,0 +1,144 @@
+"""
+Fused optimization epochs: cache refresh, MCMC inter-steps, local energies and parameter update in a single compiled program.
+"""
+from typing import Callable, Dict, Tuple
+import jax
+import jax.numpy as jnp
+
+from deeperwin.loggers import OPT_STATS_PREFIXES
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+from deeperwin.optimization.opt_utils import _fold_walker_keys
+from deeperwin.optimizers import OptaxWrapper
+from deeperwin.srcg import SRCGOptimizer
+from deeperwin.utils.utils import pmean, get_from_devices
+
+
+class FusedEpochEngine:
+    """
+    Runs one or several complete optimization epochs per dispatch to the devices.
+
+    All steps of an epoch (cache refresh, log(psi^2) of the current walkers, MCMC inter-steps, local energies and the
+    parameter update) are traced into a single pmapped program, which is compiled once per geometry shape (i.e. spin state and
+    number of electrons/ions) and number of epochs per dispatch. Multiple epochs are run with lax.scan. Walkers, parameters
+    and optimizer state never leave the devices; only scalar metrics are transferred back to the host.
+    """
+    def __init__(
+            self,
+            log_psi_squared: Callable,
+            cache_func: Callable,
+            mcmc: MetropolisHastingsMonteCarlo,
+            optimizer,
+            n_epochs_per_dispatch: int,
+            laplacian_keys: bool = False,
+    ):
+        if not self.supports(optimizer):
+            raise ValueError(f"Fused optimization epochs are not supported for optimizer {type(optimizer).__name__}")
+        if n_epochs_per_dispatch < 1:
+            raise ValueError(f"Number of epochs per dispatch must be >= 1, got {n_epochs_per_dispatch}")
+        self.log_psi_squared = log_psi_squared
+        self.cache_func = cache_func
+        self.mcmc = mcmc
+        self.optimizer = optimizer
+        self.n_epochs_per_dispatch = n_epochs_per_dispatch
+        self.laplacian_keys = laplacian_keys
+        # The structure of the states can change during the first epoch (e.g. lazily initialized clipping state,
+        # preconditioner or MCMC statistics), which is not allowed for the carry of lax.scan
+        self._is_warmed_up = False
+        self._run_epochs_pmapped = jax.pmap(self._run_epochs,
+                                            axis_name="devices",
+                                            static_broadcasted_argnums=(0, 1),
+                                            donate_argnums=(2, 3, 5))
+
+    @staticmethod
+    def supports(optimizer):
+        """Whether the optimizer exposes an un-jitted _step(params, state, static_args, rng, batch, func_state), that can be traced into the fused program"""
+        return isinstance(optimizer, (OptaxWrapper, SRCGOptimizer))
+
+    def get_n_epochs(self, n_epoch: int, n_epoch_end: int, is_boundary: Callable[[int], bool]):
+        """
+        Returns the number of epochs to run in the next dispatch, starting at n_epoch.
+
+        A dispatch never extends past n_epoch_end and never skips an epoch for which is_boundary returns True (e.g. checkpoints or
+        intermediate evaluations), so that these can still be handled in between dispatches.
+        """
+        n_epochs = self.n_epochs_per_dispatch
+        if (not self._is_warmed_up) or (n_epoch + n_epochs > n_epoch_end):
+            return 1
+        if any(is_boundary(n) for n in range(n_epoch + 1, n_epoch + n_epochs)):
+            return 1
+        return n_epochs
+
+    def run(
+            self,
+            params,
+            opt_state,
+            clipping_state,
+            mcmc_state: MCMCState,
+            fixed_params: Dict,
+            spin_state: Tuple[int],
+            rng,
+            n_epochs: int = 1,
+    ):
+        """
+        Runs n_epochs optimization epochs on the devices.
+
+        All inputs are expected to be replicated (or split) across devices. The buffers of params, opt_state and mcmc_state are
+        donated and must not be used after calling this function.
+
+        Returns:
+            A tuple (params, opt_state, clipping_state, mcmc_state, fixed_params, metrics), where metrics is a dict of (unfetched)
+            device arrays with shape [n_epochs]
+        """
+        params, opt_state, clipping_state, mcmc_state, fixed_params, metrics = self._run_epochs_pmapped(
+            spin_state, n_epochs, params, opt_state, clipping_state, mcmc_state, fixed_params, rng
+        )
+        self._is_warmed_up = True
+        return params, opt_state, clipping_state, mcmc_state, fixed_params, get_from_devices(metrics)
+
+    def _run_epochs(self, spin_state, n_epochs, params, opt_state, clipping_state, mcmc_state, fixed_params, rng):
+        def _epoch(carry, _):
+            return self._run_epoch(spin_state, rng, carry)
+
+        carry = (params, opt_state, clipping_state, mcmc_state, fixed_params)
+        if n_epochs == 1:
+            carry, metrics = _epoch(carry, None)
+            metrics = jax.tree_util.tree_map(lambda x: x[None], metrics)
+        else:
+            carry, metrics = jax.lax.scan(_epoch, carry, None, length=n_epochs)
+        return (*carry, metrics)
+
+    def _run_epoch(self, spin_state, rng, carry):
+        params, opt_state, clipping_state, mcmc_state, fixed_params = carry
+        fixed_params = dict(fixed_params)
+        if self.cache_func is not None:
+            fixed_params["cache"] = self.cache_func(params, *spin_state, *mcmc_state.build_batch(fixed_params))
+        r_old = mcmc_state.r
+        mcmc_state = mcmc_state.replace(log_psi_sqr=self.log_psi_squared(params, *spin_state, *mcmc_state.build_batch(fixed_params)))
+        mcmc_state = self.mcmc._run_inter_steps(self.log_psi_squared, mcmc_state, params, *spin_state, fixed_params)
+        if self.laplacian_keys:
+            fixed_params["rng_laplacian"] = _fold_walker_keys(mcmc_state.rng_state)
+
+        params, opt_state, clipping_state, stats = self.optimizer._step(params,
+                                                                        opt_state,
+                                                                        spin_state,
+                                                                        rng,
+                                                                        mcmc_state.build_batch(fixed_params),
+                                                                        clipping_state)
+        metrics = self._get_scalar_metrics(stats, mcmc_state, r_old)
+        return (params, opt_state, clipping_state, mcmc_state, fixed_params), metrics
+
+    @staticmethod
+    def _get_scalar_metrics(stats, mcmc_state: MCMCState, r_old):
+        metrics = {k: v for k, v in stats["aux"].items() if (not k.startswith("E_loc")) and (jnp.ndim(v) == 0)}
+        metrics.update({k: v for k, v in stats.items() if k.startswith(OPT_STATS_PREFIXES) and (jnp.ndim(v) == 0)})
+        metrics["mcmc_stepsize"] = mcmc_state.stepsize
+        metrics["mcmc_acc_rate"] = mcmc_state.acc_rate
+        metrics["mcmc_max_age"] = jax.lax.pmax(jnp.max(mcmc_state.walker_age), axis_name="devices")
+        if mcmc_state.acc_rate_stage1 is not None:
+            metrics["mcmc_acc_rate_stage1"] = mcmc_state.acc_rate_stage1
+            metrics["mcmc_acc_rate_stage2"] = mcmc_state.acc_rate_stage2
+        if mcmc_state.n_inter_steps is not None:
+            metrics["mcmc_n_inter_steps"] = mcmc_state.n_inter_steps
+            metrics["mcmc_autocorr_time"] = mcmc_state.autocorr_time
+        metrics["mcmc_delta_r_mean"] = pmean(jnp.mean(jnp.linalg.norm(mcmc_state.r - r_old, axis=-1)))
+        return metrics
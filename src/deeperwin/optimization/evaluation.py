@@ -6,7 +6,7 @@ from typing import Tuple, Optional, Dict
 import jax
 import functools
 from deeperwin.configuration import EvaluationConfig, PhysicalConfig
-from deeperwin.hamiltonian import get_local_energy, calculate_forces
+from deeperwin.hamiltonian import build_local_energy_func, calculate_forces
 from deeperwin.loggers import DataLogger, LoggerCollection, WavefunctionLogger
 from deeperwin.mcmc import MCMCState, MetropolisHastingsMonteCarlo
 from deeperwin.utils.utils import pmap, pmean, replicate_across_devices, merge_from_devices
@@ -25,7 +25,8 @@ def evaluate_wavefunction(
         rng_seed: int,
         loggers: LoggerCollection = None,
         opt_epoch_nr: int = None,
-        extra_summary_metrics: Optional[Dict] = None
+        extra_summary_metrics: Optional[Dict] = None,
+        determinant_schema: str = "block_diag",
 ):
     # Burn-in MCMC
     rng = jax.random.PRNGKey(rng_seed)
@@ -34,7 +35,10 @@ def evaluate_wavefunction(
     log_psi_squared_pmapped = jax.pmap(log_psi_sqr, axis_name="devices", static_broadcasted_argnums=(1, 2))
     cache_func_pmapped = jax.pmap(cache_func, axis_name="devices", static_broadcasted_argnums=(1, 2))
 
-    mcmc = MetropolisHastingsMonteCarlo(config.mcmc)
+    mcmc = MetropolisHastingsMonteCarlo(config.mcmc, determinant_schema=determinant_schema)
+    if config.local_energy.laplacian == "hutchinson":
+        raise ValueError("Evaluation requires an exact laplacian; the hutchinson estimator is only supported for optimization")
+    get_local_energy = build_local_energy_func(config.local_energy)
     mcmc_state = MCMCState.resize_or_init(mcmc_state, config.mcmc.n_walkers, phys_config, config.mcmc.initialization, rng)
     mcmc_state = mcmc_state.split_across_devices()
 
@@ -48,7 +52,7 @@ def evaluate_wavefunction(
     def get_observables(params, fixed_params, spin_state: Tuple[int], mcmc_state: MCMCState):
         metrics = dict()
         if config.calculate_energies:
-            energies = get_local_energy(log_psi_sqr, params, spin_state, *mcmc_state.build_batch(fixed_params))
+            energies, _ = get_local_energy(log_psi_sqr, params, spin_state, *mcmc_state.build_batch(fixed_params))
             metrics['E_mean'] = pmean(jnp.nanmean(energies))
             metrics['E_var'] = pmean(jnp.nanmean((energies - metrics['E_mean'])**2))
         if config.forces:
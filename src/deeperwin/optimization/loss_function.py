@@ -2,8 +2,8 @@ import logging
 import jax
 import jax.numpy as jnp
 import kfac_jax
-from deeperwin.configuration import ClippingConfig
-from deeperwin.hamiltonian import get_local_energy
+from deeperwin.configuration import ClippingConfig, LocalEnergyConfig
+from deeperwin.hamiltonian import build_local_energy_func
 from deeperwin.utils.utils import pmean, without_cache
 import functools
 
@@ -42,34 +42,41 @@ def _clip_energies(E, clipping_state, clipping_config: ClippingConfig):
     new_clipping_state = _update_clipping_state(clipped_energies, clipping_state, clipping_config)
     return clipped_energies, new_clipping_state
 
-def build_value_and_grad_func(log_psi_sqr_func, clipping_config: ClippingConfig):
+def build_value_and_grad_func(log_psi_sqr_func, clipping_config: ClippingConfig, local_energy_config: LocalEnergyConfig = None):
     """
     Returns a callable that computes the gradient of the mean local energy for a given set of MCMC walkers with respect to the model defined by `log_psi_func`.
 
     Args:
         log_psi_sqr_func (callable): A function representing the wavefunction model
         clipping_config (ClippingConfig): Clipping hyperparameters
-        use_fwd_fwd_hessian (bool): If true, the second partial derivatives required for computing the local energy are obtained with a forward-forward scheme.
+        local_energy_config (LocalEnergyConfig): Settings for computing the local energy, e.g. the laplacian backend
 
     """
+    local_energy_config = local_energy_config or LocalEnergyConfig()
+    get_local_energy = build_local_energy_func(local_energy_config)
 
     # Build custom total energy jvp. Based on https://github.com/deepmind/ferminet/blob/jax/ferminet/train.py
     @functools.partial(jax.custom_jvp, nondiff_argnums=(2,))
     def total_energy(params, state, spin_state, batch):
         # TODO: why is spin state no integer anymore here now??
         clipping_state = state 
-        E_loc = get_local_energy(log_psi_sqr_func, params, spin_state, *batch)
-        E_mean = pmean(jnp.nanmean(E_loc))
-        E_var = pmean(jnp.nanmean((E_loc - E_mean) ** 2))
-
-        E_loc_clipped, clipping_state = _clip_energies(E_loc, clipping_state, clipping_config)
-        E_mean_clipped = pmean(jnp.nanmean(E_loc_clipped))
-        E_var_clipped = pmean(jnp.nanmean((E_loc_clipped - E_mean_clipped) ** 2))
+        with jax.named_scope("local_energy"):
+            E_loc, E_loc_estimator_var = get_local_energy(log_psi_sqr_func, params, spin_state, *batch)
+        with jax.named_scope("clipping_and_reductions"):
+            E_mean = pmean(jnp.nanmean(E_loc))
+            E_var = pmean(jnp.nanmean((E_loc - E_mean) ** 2))
+
+            E_loc_clipped, clipping_state = _clip_energies(E_loc, clipping_state, clipping_config)
+            E_mean_clipped = pmean(jnp.nanmean(E_loc_clipped))
+            E_var_clipped = pmean(jnp.nanmean((E_loc_clipped - E_mean_clipped) ** 2))
         aux = dict(E_mean=E_mean,
                    E_var=E_var,
                    E_mean_clipped=E_mean_clipped,
                    E_var_clipped=E_var_clipped,
                    E_loc_clipped=E_loc_clipped)
+        if local_energy_config.laplacian == "hutchinson":
+            # Variance added on top of the sampling variance by the stochastic laplacian; already contained in E_var
+            aux["E_var_hutchinson"] = pmean(jnp.nanmean(E_loc_estimator_var))
         loss = E_mean_clipped
         return loss, (clipping_state, aux)
 
@@ -1,3 +1,5 @@
+import functools
+import logging
 from typing import Callable, Dict, Tuple, Literal
 import jax
 import jax.numpy as jnp
@@ -5,6 +7,10 @@ import optax
 import haiku as hk
 from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
 from deeperwin.configuration import StandardOptimizerConfig
+from deeperwin.utils.compilation import call_program, get_abstract_values, eval_abstract_values, is_warmup_enabled, warmup_programs
+from deeperwin.utils.utils import without_cache
+
+LOGGER = logging.getLogger("dpe")
 
 
 def _run_mcmc_with_cache(
@@ -18,27 +24,171 @@ def _run_mcmc_with_cache(
     split_mcmc=True,
     merge_mcmc=True,
     mode: Literal["burnin", "intersteps"] = "intersteps",
+    laplacian_keys: bool = False,
 ):
     if split_mcmc:
         mcmc_state = mcmc_state.split_across_devices()
 
+    # All programs are called through call_program, so that executables compiled by warmup_optimization_programs are re-used.
+    # The cache and the walker keys of the previous epoch are dropped (and recomputed), so that fixed_params has the same structure in
+    # the burn-in and in every epoch, as assumed by the warm-up.
+    fixed_params = _without_recomputed_fixed_params(fixed_params, cache_func)
     if cache_func is not None:
-        cache_func_pmapped = jax.pmap(cache_func, axis_name="devices", static_broadcasted_argnums=(1, 2))
-        fixed_params["cache"] = cache_func_pmapped(params, *spin_state, *mcmc_state.build_batch(fixed_params))
+        fixed_params["cache"] = call_program(_pmap_model_func(cache_func), params, *spin_state, *mcmc_state.build_batch(fixed_params),
+                                             static_argnums=(1, 2))
 
-    log_psi_squared_pmapped = jax.pmap(log_psi_sqr_func, axis_name="devices", static_broadcasted_argnums=(1, 2))
-    mcmc_state.log_psi_sqr = log_psi_squared_pmapped(params, *spin_state, *mcmc_state.build_batch(fixed_params))
+    mcmc_state.log_psi_sqr = call_program(_pmap_model_func(log_psi_sqr_func), params, *spin_state, *mcmc_state.build_batch(fixed_params),
+                                          static_argnums=(1, 2))
     if mode == "burnin":
-        mcmc_state = mcmc.run_burn_in(log_psi_sqr_func, mcmc_state, params, *spin_state, fixed_params)
+        mcmc_func = MetropolisHastingsMonteCarlo.run_burn_in
     elif mode == "intersteps":
-        mcmc_state = mcmc.run_inter_steps(log_psi_sqr_func, mcmc_state, params, *spin_state, fixed_params)
+        mcmc_func = MetropolisHastingsMonteCarlo.run_inter_steps
     else:
         raise ValueError(f"Unknown MCMC mode: {mode}")
+    mcmc_state = call_program(mcmc_func, mcmc, log_psi_sqr_func, mcmc_state, params, *spin_state, fixed_params,
+                              static_argnums=_MCMC_STATIC_ARGNUMS)
+    # Independent per-walker keys for stochastic estimators in the loss (i.e. the hutchinson laplacian)
+    if laplacian_keys:
+        fixed_params["rng_laplacian"] = call_program(_derive_walker_keys, mcmc_state.rng_state)
     if merge_mcmc:
         mcmc_state = mcmc_state.merge_devices()
     return mcmc_state, fixed_params
 
 
+# Static arguments (mcmc, func, n_up, n_dn) of MetropolisHastingsMonteCarlo.run_burn_in/run_inter_steps
+_MCMC_STATIC_ARGNUMS = (0, 1, 4, 5)
+
+
+@functools.lru_cache(maxsize=None)
+def _pmap_model_func(func):
+    """pmapped func(params, n_up, n_dn, r, R, Z, fixed_params); created once per func, so that its compiled programs are re-used"""
+    return jax.pmap(func, axis_name="devices", static_broadcasted_argnums=(1, 2))
+
+
+# Data folded into the walker keys to derive the keys of the laplacian estimator. Must differ from any other data folded into the
+# walker keys (e.g. 1 for the stage-1 proposals of delayed-acceptance MCMC), so that the random streams are independent.
+_LAPLACIAN_KEY_DATA = 0x6C61706C
+
+
+def _fold_walker_keys(rng_state):
+    return jax.vmap(lambda k: jax.random.fold_in(k, _LAPLACIAN_KEY_DATA))(rng_state)
+
+
+def strip_walker_keys(fixed_params: Dict) -> Dict:
+    """Returns fixed_params without the per-walker keys of the laplacian estimator, e.g. for checkpoints"""
+    return {k: v for k, v in fixed_params.items() if k != "rng_laplacian"}
+
+
+_derive_walker_keys = jax.pmap(_fold_walker_keys, axis_name="devices")
+
+
+def _without_recomputed_fixed_params(fixed_params: Dict, cache_func: Callable) -> Dict:
+    """Returns fixed_params without the entries, which _run_mcmc_with_cache recomputes: the cache (if any) and the walker keys"""
+    fixed_params = strip_walker_keys(fixed_params)
+    return without_cache(fixed_params) if cache_func is not None else fixed_params
+
+
+def warmup_optimization_programs(
+    log_psi_sqr_func: Callable,
+    cache_func: Callable,
+    mcmc: MetropolisHastingsMonteCarlo,
+    optimizer,
+    params: Dict,
+    opt_state,
+    spin_state: Tuple[int],
+    mcmc_state: MCMCState,
+    fixed_params: Dict,
+    clipping_state,
+    rng,
+    laplacian_keys: bool = False,
+) -> Dict[str, float]:
+    """
+    Compiles the programs of the optimization loop ahead of time, before the burn-in starts (see deeperwin.utils.compilation).
+
+    All inputs are replaced by their abstract values and the inputs of later programs (e.g. the MCMC state after burn-in) are derived
+    by tracing the earlier programs (see eval_abstract_values), so no wavefunction is evaluated. Expects replicated params/fixed_params
+    and an un-split mcmc_state.
+    The KFAC step is staged inside kfac_jax and cannot be lowered separately; it only profits from the persistent compilation cache.
+    """
+    if not is_warmup_enabled():
+        return {}
+    try:
+        programs = _get_optimization_programs(log_psi_sqr_func, cache_func, mcmc, optimizer, params, opt_state, spin_state, mcmc_state,
+                                              fixed_params, clipping_state, rng, laplacian_keys)
+    except Exception as e:
+        LOGGER.warning(f"AOT warm-up of optimization programs failed; compiling on first call instead: {e!r}")
+        return {}
+    return warmup_programs(programs)
+
+
+def warmup_shared_optimization_programs(
+    log_psi_sqr_func: Callable,
+    cache_func: Callable,
+    mcmc: MetropolisHastingsMonteCarlo,
+    optimizer,
+    params: Dict,
+    opt_state,
+    geometries_data_stores,
+    rng,
+    laplacian_keys: bool = False,
+) -> Dict[str, float]:
+    """
+    Same as warmup_optimization_programs, but for all geometries of a shared optimization at once. Expects each geometry to hold its
+    spin_state, replicated fixed_params/clipping_state and un-split mcmc_state. Geometries with identical shapes share their programs.
+    """
+    if not is_warmup_enabled():
+        return {}
+    programs = dict()
+    try:
+        for idx, g in enumerate(geometries_data_stores):
+            geometry_programs = _get_optimization_programs(log_psi_sqr_func, cache_func, mcmc, optimizer, params, opt_state, g.spin_state,
+                                                           g.mcmc_state, g.fixed_params, g.clipping_state, rng, laplacian_keys)
+            programs.update({f"{name}_geom{idx}": program for name, program in geometry_programs.items()})
+    except Exception as e:
+        LOGGER.warning(f"AOT warm-up of optimization programs failed; compiling on first call instead: {e!r}")
+        return {}
+    return warmup_programs(programs)
+
+
+def _get_optimization_programs(log_psi_sqr_func, cache_func, mcmc, optimizer, params, opt_state, spin_state, mcmc_state, fixed_params,
+                               clipping_state, rng, laplacian_keys=False):
+    n_up, n_dn = spin_state
+    fixed_params = _without_recomputed_fixed_params(fixed_params, cache_func)
+    params, fixed_params, clipping_state, rng = get_abstract_values((params, fixed_params, clipping_state, rng))
+    mcmc_state = get_abstract_values(mcmc_state.split_across_devices())
+    programs = dict()
+
+    # Same callables and static arguments as in _run_mcmc_with_cache and the optimizer step, so that the loop uses the compiled programs
+    if cache_func is not None:
+        cache_func_pmapped = _pmap_model_func(cache_func)
+        programs["cache"] = (cache_func_pmapped, (params, n_up, n_dn, *mcmc_state.build_batch(fixed_params)), (1, 2))
+        # New dicts instead of in-place updates, because the args of the programs registered so far must keep their structure
+        fixed_params = dict(fixed_params, cache=eval_abstract_values(lambda p, *batch: cache_func_pmapped(p, n_up, n_dn, *batch),
+                                                                     params, *mcmc_state.build_batch(fixed_params)))
+
+    programs["log_psi_sqr"] = (_pmap_model_func(log_psi_sqr_func), (params, n_up, n_dn, *mcmc_state.build_batch(fixed_params)), (1, 2))
+    mcmc_state.log_psi_sqr = eval_abstract_values(lambda p, *batch: _pmap_model_func(log_psi_sqr_func)(p, n_up, n_dn, *batch),
+                                                  params, *mcmc_state.build_batch(fixed_params))
+    programs["mcmc_burn_in"] = (MetropolisHastingsMonteCarlo.run_burn_in,
+                                (mcmc, log_psi_sqr_func, mcmc_state, params, n_up, n_dn, fixed_params), _MCMC_STATIC_ARGNUMS)
+    mcmc_state = eval_abstract_values(lambda s, p, f: mcmc.run_burn_in(log_psi_sqr_func, s, p, n_up, n_dn, f), mcmc_state, params,
+                                      fixed_params)
+    programs["mcmc_inter_steps"] = (MetropolisHastingsMonteCarlo.run_inter_steps,
+                                    (mcmc, log_psi_sqr_func, mcmc_state, params, n_up, n_dn, fixed_params), _MCMC_STATIC_ARGNUMS)
+    if laplacian_keys:
+        programs["walker_keys"] = (_derive_walker_keys, (mcmc_state.rng_state,), ())
+        fixed_params = dict(fixed_params, rng_laplacian=eval_abstract_values(_derive_walker_keys, mcmc_state.rng_state))
+
+    # Local import to avoid a circular import (deeperwin.optimizers imports build_optax_optimizer from this module)
+    from deeperwin.optimizers import OptaxWrapper
+    if isinstance(optimizer, OptaxWrapper):
+        if opt_state is None:
+            opt_state = eval_abstract_values(lambda p: optimizer.init(p, None, None), params)
+        programs["optimizer_step"] = (optimizer._jit_step, (params, get_abstract_values(opt_state), spin_state, rng,
+                                                            mcmc_state.build_batch(fixed_params), clipping_state), (2,))
+    return programs
+
+
 def build_lr_schedule(base_lr, schedule_config):
     if schedule_config.name == "inverse":
         def get_lr(t):
@@ -7,10 +7,13 @@ import jax.numpy as jnp
 import numpy as np
 
 from deeperwin.configuration import PreTrainingConfig, ModelConfig, PhysicalConfig, DistortionConfig
+from deeperwin.bucketing import (ShapeBucket, CompilationStats, get_geometry_shape, get_electron_indices, pad_electron_coordinates,
+                                 pad_fixed_params, pad_geometry, pad_mcmc_state, pad_slater_matrices, unpad_mcmc_state)
 from deeperwin.loggers import DataLogger
 from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
 from deeperwin.utils.utils import get_el_ion_distance_matrix, without_cache
-from deeperwin.model import evaluate_sum_of_determinants, get_baseline_slater_matrices, init_model_fixed_params
+from deeperwin.model import evaluate_sum_of_determinants, get_baseline_slater_matrices, get_baseline_slater_row, init_model_fixed_params
+from deeperwin.model.padding import get_padding_masks
 from deeperwin.orbitals import get_baseline_solution, get_sum_of_atomic_exponentials
 from deeperwin.optimizers import build_optimizer
 from deeperwin.utils.utils import replicate_across_devices, get_from_devices, get_next_geometry_index
@@ -29,40 +32,92 @@ def _get_orbitals(fixed_params):
     else:
         raise ValueError("No orbitals found for pretrianing in fixed params")
 
+def get_pretraining_targets(r, R, fixed_params, n_up, pretrain_config, model_config):
+    """Calculates the HF / CASSCF reference orbitals, which the neural net orbitals are fitted to"""
+    diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r, R)
+    mo_up_ref, mo_dn_ref = get_baseline_slater_matrices(
+        diff_el_ion, dist_el_ion, _get_orbitals(fixed_params), model_config.orbitals.determinant_schema
+    )
+
+    if pretrain_config.use_only_leading_determinant:
+        mo_up_ref = mo_up_ref[..., :1, :, :]
+        mo_dn_ref = mo_dn_ref[..., :1, :, :]
+
+    if (pretrain_config.off_diagonal_mode == "exponential") and (model_config.orbitals.determinant_schema != "block_diag"):
+        phi_exp = get_sum_of_atomic_exponentials(
+            dist_el_ion, exponent=pretrain_config.off_diagonal_exponent, scale=pretrain_config.off_diagonal_scale
+        )  # [batch x n_el]
+        mo_up_ref = mo_up_ref.at[..., :, :, n_up:].set(phi_exp[..., None, :n_up, None])
+        mo_dn_ref = mo_dn_ref.at[..., :, :, :n_up].set(phi_exp[..., None, n_up:, None])
+    return mo_up_ref, mo_dn_ref
+
+
+def _get_residual_masks(el_mask, mo_up, n_up):
+    # Masks of all entries of the Slater matrices that belong to a real electron and a real orbital
+    if mo_up.shape[-1] == len(el_mask):  # full_det
+        orb_mask_up, orb_mask_dn = el_mask, el_mask
+    else:
+        orb_mask_up, orb_mask_dn = el_mask[:n_up], el_mask[n_up:]
+    return el_mask[:n_up, None] * orb_mask_up[None, :], el_mask[n_up:, None] * orb_mask_dn[None, :]
+
+
+def _masked_mean(x, mask):
+    if mask is None:
+        return jnp.mean(x)
+    mask = jnp.broadcast_to(mask, x.shape)
+    return jnp.sum(x * mask) / jnp.sum(mask)
+
+
 def build_pretraining_loss_func(orbital_func, pretrain_config, model_config):
     def loss_func(params, batch, spin_state):
         r, R, Z, fixed_params = batch
         n_up, n_dn = spin_state
 
-        # Calculate HF / CASSCF reference orbitals
-        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r, R)
-        mo_up_ref, mo_dn_ref = get_baseline_slater_matrices(
-            diff_el_ion, dist_el_ion, _get_orbitals(fixed_params), model_config.orbitals.determinant_schema
-        )
-
-        if pretrain_config.use_only_leading_determinant:
-            mo_up_ref = mo_up_ref[..., :1, :, :]
-            mo_dn_ref = mo_dn_ref[..., :1, :, :]
-
-        if (pretrain_config.off_diagonal_mode == "exponential") and (model_config.orbitals.determinant_schema != "block_diag"):
-            phi_exp = get_sum_of_atomic_exponentials(
-                dist_el_ion, exponent=pretrain_config.off_diagonal_exponent, scale=pretrain_config.off_diagonal_scale
-            )  # [batch x n_el]
-            mo_up_ref = mo_up_ref.at[..., :, :, n_up:].set(phi_exp[..., None, :n_up, None])
-            mo_dn_ref = mo_dn_ref.at[..., :, :, :n_up].set(phi_exp[..., None, n_up:, None])
+        if "pretrain_targets" in fixed_params:
+            # Geometries padded with ghost particles: Targets have been calculated on the un-padded geometry
+            mo_up_ref, mo_dn_ref = fixed_params["pretrain_targets"]
+        else:
+            mo_up_ref, mo_dn_ref = get_pretraining_targets(r, R, fixed_params, n_up, pretrain_config, model_config)
 
         # Calculate neural net orbitals
         mo_up, mo_dn = orbital_func(params, n_up, n_dn, r, R, Z, without_cache(fixed_params))
         residual_up = mo_up - mo_up_ref
         residual_dn = mo_dn - mo_dn_ref
+        el_mask = get_padding_masks(fixed_params)[0]
+        mask_up, mask_dn = (None, None) if el_mask is None else _get_residual_masks(el_mask, mo_up, n_up)
         if pretrain_config.off_diagonal_mode == "ignore":
             residual_up = residual_up[..., :, :n_up]
             residual_dn = residual_dn[..., :, n_up:]
-        return jnp.mean(residual_up ** 2) + jnp.mean(residual_dn ** 2)
+            if el_mask is not None:
+                mask_up, mask_dn = mask_up[:, :n_up], mask_dn[:, n_up:]
+        return _masked_mean(residual_up ** 2, mask_up) + _masked_mean(residual_dn ** 2, mask_dn)
 
     return loss_func
 
 
+def build_padded_batch_func(pretrain_config, model_config):
+    """
+    Returns a pmapped function that pads a pre-training batch of a geometry to its shape bucket (see deeperwin.bucketing).
+
+    The electron coordinates can stem from an MCMC run on the padded or on the un-padded geometry. The reference orbitals require
+    the baseline solution of the molecule and are therefore calculated here on the un-padded geometry (which is cheap, but compiled
+    for every molecule) and passed to the loss as fixed_params['pretrain_targets'].
+    """
+    def get_padded_batch(n_up, n_dn, n_ions, bucket, r, R, Z, fixed_params, padded_fixed_params):
+        R, Z = R[:n_ions], Z[:n_ions]
+        if r.shape[-2] == n_up + n_dn:
+            r_padded = pad_electron_coordinates(r, R, n_up, n_dn, bucket)
+        else:
+            r_padded, r = r, r[..., get_electron_indices(n_up, n_dn, bucket), :]
+        mo_up_ref, mo_dn_ref = get_pretraining_targets(r, R, fixed_params, n_up, pretrain_config, model_config)
+        R_padded, Z_padded = pad_geometry(R, Z, bucket)
+        padded_fixed_params = dict(padded_fixed_params,
+                                   pretrain_targets=pad_slater_matrices(mo_up_ref, mo_dn_ref, n_up, n_dn, bucket))
+        return r_padded, R_padded, Z_padded, padded_fixed_params
+
+    return jax.pmap(get_padded_batch, axis_name="devices", static_broadcasted_argnums=(0, 1, 2, 3))
+
+
 def build_log_psi_sqr_func_for_sampling(orbital_func, pretrain_config, model_config):
     def log_psi_squared_func(params, n_up, n_dn, r, R, Z, fixed_params):
         if pretrain_config.sampling_density == "model":
@@ -79,6 +134,28 @@ def build_log_psi_sqr_func_for_sampling(orbital_func, pretrain_config, model_con
     return log_psi_squared_func
 
 
+def build_slater_funcs_for_sampling(pretrain_config, model_config):
+    """
+    Returns functions yielding the Slater matrices of the sampling density and the Slater-matrix row of a single electron,
+    if all orbitals are single-particle orbitals; (None, None) otherwise
+    """
+    if pretrain_config.sampling_density != "reference":
+        return None, None
+
+    def slater_func(params, n_up, n_dn, r, R, Z, fixed_params):
+        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r, R)
+        return get_baseline_slater_matrices(
+            diff_el_ion, dist_el_ion, _get_orbitals(fixed_params), model_config.orbitals.determinant_schema
+        )
+
+    def slater_row_func(params, n_up, n_dn, r, R, Z, fixed_params, index):
+        r_el = jnp.take(r, index, axis=-2)[..., None, :]
+        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r_el, R)
+        return get_baseline_slater_row(diff_el_ion[..., 0, :, :], dist_el_ion[..., 0, :], _get_orbitals(fixed_params), index)
+
+    return slater_func, slater_row_func
+
+
 def pretrain_orbitals(
     orbital_func: Callable,
     cache_func: Callable,
@@ -110,7 +187,7 @@ def pretrain_orbitals(
     # Init MCMC
     rng_mcmc, rng_opt = jax.random.split(jax.random.PRNGKey(rng_seed), 2)
     logging.debug(f"Starting pretraining...")
-    mcmc = MetropolisHastingsMonteCarlo(pretrain_config.mcmc)
+    mcmc = MetropolisHastingsMonteCarlo(pretrain_config.mcmc, *build_slater_funcs_for_sampling(pretrain_config, model_config))
     mcmc_state = MCMCState.resize_or_init(
         mcmc_state, pretrain_config.mcmc.n_walkers, phys_config, pretrain_config.mcmc.initialization, rng_mcmc
     )
@@ -188,7 +265,15 @@ def pretrain_orbitals_shared(
     phisnet_model = None,
     N_ions_max = None,
     nb_orbitals_per_Z = None,
+    shape_buckets: Optional[List[ShapeBucket]] = None,
 ) -> Tuple[Dict, Any]:
+    """
+    Pre-trains the orbitals of the shared wavefunction on all geometries in a round-robin fashion.
+
+    If shape_buckets are given, the model is evaluated on geometries padded to their bucket (see deeperwin.bucketing). Sampling
+    the model density then also runs on the padded geometries; sampling the reference density runs on the un-padded geometries,
+    because it requires the baseline solution of each molecule.
+    """
     # for each geometry set the pretraining orbital targets
     for idx_geom, g in enumerate(geometries_data_stores):
         if model_config.orbitals.baseline_orbitals and (model_config.orbitals.baseline_orbitals.baseline == pretrain_config.baseline):
@@ -213,10 +298,40 @@ def pretrain_orbitals_shared(
     # Init MCMC
     logging.debug(f"Starting pretraining...")
     rng_opt = jax.random.PRNGKey(rng_seed)
-    mcmc = MetropolisHastingsMonteCarlo(pretrain_config.mcmc)
+    mcmc = MetropolisHastingsMonteCarlo(pretrain_config.mcmc, *build_slater_funcs_for_sampling(pretrain_config, model_config))
     params, opt_state, rng_opt = replicate_across_devices((params, opt_state, rng_opt))
 
+    # With shape bucketing, padded_fixed_params hold the (replicated) model inputs of each padded geometry
+    padded_fixed_params = [None] * len(geometries_data_stores)
+    sample_padded = bool(shape_buckets) and (pretrain_config.sampling_density == "model")
+    padded_batch_func = build_padded_batch_func(pretrain_config, model_config) if shape_buckets else None
+
+    def _run_mcmc(idx, g: GeometryDataStore, merge_mcmc, mode):
+        if sample_padded:
+            g.mcmc_state, padded_fixed_params[idx] = _run_mcmc_with_cache(
+                log_psi_squared_func, cache_func, mcmc, params, g.spin_state, g.mcmc_state, padded_fixed_params[idx],
+                split_mcmc=True, merge_mcmc=merge_mcmc, mode=mode,
+            )
+        else:
+            # The cache of the model is not required for sampling the reference density
+            g.mcmc_state, g.fixed_params = _run_mcmc_with_cache(
+                log_psi_squared_func, None if shape_buckets else cache_func, mcmc, params, g.spin_state, g.mcmc_state, g.fixed_params,
+                split_mcmc=True, merge_mcmc=merge_mcmc, mode=mode,
+            )
+
+    def _get_step_inputs(idx, g: GeometryDataStore, mcmc_state: MCMCState):
+        if not shape_buckets:
+            return g.spin_state, mcmc_state.build_batch(g.fixed_params)
+        n_up, n_dn, n_ions = get_geometry_shape(g.physical_config)
+        bucket = shape_buckets[idx]
+        batch = padded_batch_func(n_up, n_dn, n_ions, bucket, mcmc_state.r, mcmc_state.R, mcmc_state.Z, g.fixed_params, padded_fixed_params[idx])
+        return (bucket.n_up, bucket.n_dn), batch
+
+    def _get_model_inputs(idx, g: GeometryDataStore):
+        return g.mcmc_state, (padded_fixed_params[idx] if shape_buckets else g.fixed_params)
+
     # create MCMC state & run burn in for each geometry
+    compile_stats = CompilationStats("Shared pre-training")
     for idx, g in enumerate(geometries_data_stores):
         logging.debug(f"Running burn-in for geom {idx}")
         g.spin_state = (g.physical_config.n_up, g.physical_config.n_dn)
@@ -227,28 +342,22 @@ def pretrain_orbitals_shared(
             pretrain_config.mcmc.initialization,
             jax.random.PRNGKey(rng_seed + idx),
         )
+        if shape_buckets:
+            bucket = shape_buckets[idx]
+            padded_fixed_params[idx] = replicate_across_devices(pad_fixed_params(g.fixed_params, g.physical_config, bucket))
+            if sample_padded:
+                g.mcmc_state = pad_mcmc_state(g.mcmc_state, g.physical_config, bucket)
+                g.spin_state = (bucket.n_up, bucket.n_dn)
         g.fixed_params = replicate_across_devices(g.fixed_params)
-        g.mcmc_state, g.fixed_params = _run_mcmc_with_cache(
-            log_psi_squared_func,
-            cache_func,
-            mcmc,
-            params,
-            g.spin_state,
-            g.mcmc_state,
-            g.fixed_params,
-            split_mcmc=True,
-            merge_mcmc=True,
-            mode="burnin",
-        )
+        compile_stats.start_step(shape_buckets[idx] if shape_buckets else g.shape, idx, ("burnin", g.spin_state), *_get_model_inputs(idx, g))
+        _run_mcmc(idx, g, merge_mcmc=True, mode="burnin")
+        compile_stats.end_step(g.mcmc_state.r)
 
     # Init loss and optimizer
     optimizer = build_optimizer(jax.value_and_grad(loss_func), pretrain_config.optimizer, False, False)
-    opt_state = opt_state or optimizer.init(
-        params=params,
-        rng=rng_opt,
-        batch=geometries_data_stores[0].mcmc_state.split_across_devices().build_batch(geometries_data_stores[0].fixed_params),
-        static_args=geometries_data_stores[0].spin_state,
-    )
+    if opt_state is None:
+        spin_state, batch = _get_step_inputs(0, geometries_data_stores[0], geometries_data_stores[0].mcmc_state.split_across_devices())
+        opt_state = optimizer.init(params=params, rng=rng_opt, batch=batch, static_args=spin_state)
 
     # Pre-training optimization loop
     geometry_permutation = np.asarray(jax.random.permutation(jax.random.PRNGKey(rng_seed), len(geometries_data_stores)))
@@ -275,23 +384,16 @@ def pretrain_orbitals_shared(
             g.fixed_params, g.clipping_state = replicate_across_devices((g.fixed_params, g.clipping_state))
 
         # Step 2: Split MCMC state across devices and run MCMC intersteps
-        g.mcmc_state, g.fixed_params = _run_mcmc_with_cache(
-            log_psi_squared_func,
-            cache_func,
-            mcmc,
-            params,
-            g.spin_state,
-            g.mcmc_state,
-            g.fixed_params,
-            split_mcmc=True,
-            merge_mcmc=False,
-            mode="intersteps",
-        )
+        shape = shape_buckets[next_geometry_index] if shape_buckets else g.shape
+        compile_stats.start_step(shape, next_geometry_index, ("epoch", g.spin_state), *_get_model_inputs(next_geometry_index, g))
+        _run_mcmc(next_geometry_index, g, merge_mcmc=False, mode="intersteps")
 
         # Step 3: Optimize wavefunction
+        spin_state, batch = _get_step_inputs(next_geometry_index, g, g.mcmc_state)
         params, opt_state, stats = optimizer.step(
-            params, opt_state, static_args=g.spin_state, rng=rng_opt, batch=g.mcmc_state.build_batch(g.fixed_params)
+            params, opt_state, static_args=spin_state, rng=rng_opt, batch=batch
         )
+        compile_stats.end_step(params, g.mcmc_state.r)
 
         # Step 4. gather states across devices again
         g.mcmc_state = g.mcmc_state.merge_devices()
@@ -310,8 +412,12 @@ def pretrain_orbitals_shared(
             metric_type="pre",
         )
 
+    compile_stats.log_summary()
     params, opt_state = get_from_devices((params, opt_state))
-    for g in geometries_data_stores:
+    for idx, g in enumerate(geometries_data_stores):
         g.fixed_params = get_from_devices(g.fixed_params)
         g.mcmc_state = g.mcmc_state.merge_devices()
+        if sample_padded:
+            g.mcmc_state = unpad_mcmc_state(g.mcmc_state, g.physical_config, shape_buckets[idx])
+            g.spin_state = (g.physical_config.n_up, g.physical_config.n_dn)
     return params, opt_state
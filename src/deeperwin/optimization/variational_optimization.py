@@ -7,13 +7,17 @@ import numpy as np
 from deeperwin.configuration import Configuration, OptimizationConfig, EvaluationConfig, PhysicalConfig
 from deeperwin.optimization.evaluation import evaluate_wavefunction
 from deeperwin.geometries import GeometryDataStore, distort_geometry
-from deeperwin.checkpoints import is_checkpoint_required, delete_obsolete_checkpoints
-from deeperwin.loggers import DataLogger, WavefunctionLogger
+from deeperwin.bucketing import ShapeBucket, CompilationStats
+from deeperwin.checkpoints import is_checkpoint_required, delete_obsolete_checkpoints, delete_unreferenced_blobs
+from deeperwin.loggers import DataLogger, WavefunctionLogger, MetricsBuffer, OPT_STATS_PREFIXES
 from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
-from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
-from deeperwin.optimization.opt_utils import _run_mcmc_with_cache
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState, get_mcmc_metrics
+from deeperwin.optimization.opt_utils import _run_mcmc_with_cache, warmup_optimization_programs, warmup_shared_optimization_programs, \
+    strip_walker_keys
+from deeperwin.optimization.epoch_engine import FusedEpochEngine
 from deeperwin.optimizers import build_optimizer
 from deeperwin.utils.utils import replicate_across_devices, get_from_devices, get_next_geometry_index
+from deeperwin.utils.profiling import PhaseTimer
 from deeperwin.model import init_model_fixed_params
 
 
@@ -32,6 +36,7 @@ def optimize_wavefunction(
         logger: DataLogger = None,
         initial_opt_state=None,
         initial_clipping_state=None,
+        determinant_schema: str = "block_diag",
 ):
     """
     Minimizes the energy of the wavefunction defined by the callable `log_psi_squared` by adjusting the trainable parameters.
@@ -57,7 +62,7 @@ def optimize_wavefunction(
     LOGGER.debug(f"Starting burn-in for optimization: {opt_config.mcmc.n_burn_in} steps")
 
     rng_mcmc, rng_opt = jax.random.split(jax.random.PRNGKey(rng_seed), 2)
-    mcmc = MetropolisHastingsMonteCarlo(opt_config.mcmc)
+    mcmc = MetropolisHastingsMonteCarlo(opt_config.mcmc, determinant_schema=determinant_schema)
     mcmc_state = MCMCState.resize_or_init(mcmc_state, opt_config.mcmc.n_walkers, phys_config, opt_config.mcmc.initialization, rng_mcmc)
 
     if opt_config.init_clipping_with_None:
@@ -69,15 +74,22 @@ def optimize_wavefunction(
     params, fixed_params, initial_opt_state, clipping_state, rng_opt = replicate_across_devices(
         (params, fixed_params, initial_opt_state, clipping_state, rng_opt))
 
-    mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_squared, cache_func, mcmc, params, spin_state, mcmc_state,
-                                                    fixed_params, split_mcmc=True, merge_mcmc=False, mode="burnin")
-
     # Initialize loss and optimizer
-    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_squared, opt_config.clipping), 
+    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_squared, opt_config.clipping, opt_config.local_energy), 
                                 opt_config=opt_config.optimizer, 
                                 value_func_has_aux=True, 
                                 value_func_has_state=True,
                                 log_psi_squared_func=log_psi_squared)
+
+    # Compile the programs of the optimization loop ahead of time (no-op unless enabled in the computation config)
+    laplacian_keys = opt_config.local_energy.laplacian == "hutchinson"
+    warmup_optimization_programs(log_psi_squared, cache_func, mcmc, optimizer, params, initial_opt_state, spin_state, mcmc_state,
+                                 fixed_params, clipping_state, rng_opt, laplacian_keys)
+
+    mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_squared, cache_func, mcmc, params, spin_state, mcmc_state,
+                                                    fixed_params, split_mcmc=True, merge_mcmc=False, mode="burnin",
+                                                    laplacian_keys=laplacian_keys)
+
     opt_state = initial_opt_state or optimizer.init(params=params, 
                                                     rng=rng_opt, 
                                                     batch=mcmc_state.build_batch(fixed_params),
@@ -86,55 +98,95 @@ def optimize_wavefunction(
 
     # Set-up check-points
     eval_checkpoints = set(opt_config.intermediate_eval.opt_epochs) if opt_config.intermediate_eval else set()
+    n_epoch_end = opt_config.n_epochs_prev + opt_config.n_epochs
+
+    epoch_engine = None
+    if opt_config.epochs_per_dispatch:
+        # Unsupported optimizers are rejected by the config validation (and by FusedEpochEngine itself)
+        epoch_engine = FusedEpochEngine(log_psi_squared, cache_func, mcmc, optimizer, opt_config.epochs_per_dispatch, laplacian_keys)
+    n_epoch_next = opt_config.n_epochs_prev
 
     wf_logger = WavefunctionLogger(logger, prefix="opt", n_step=opt_config.n_epochs_prev, smoothing=0.05)
-    for n_epoch in range(opt_config.n_epochs_prev, opt_config.n_epochs_prev+opt_config.n_epochs+1):
+    metrics_buffer = MetricsBuffer(opt_config.metrics_flush_every, opt_config.async_metrics)
+    timer = PhaseTimer("Optimization")
+    for n_epoch in range(opt_config.n_epochs_prev, n_epoch_end+1):
+        if n_epoch < n_epoch_next:
+            continue  # already run as part of a fused dispatch
+        timer.update_trace(n_epoch)
+        timer.start()
         if is_checkpoint_required(n_epoch, opt_config.checkpoints) and (logger is not None):
             LOGGER.debug(f"Saving checkpoint n_epoch={n_epoch}")
+            metrics_buffer.flush()
             params_merged, fixed_params_merged, opt_state_merged, clipping_state_merged = get_from_devices(
-                (params, fixed_params, opt_state, clipping_state))
+                (params, strip_walker_keys(fixed_params), opt_state, clipping_state))
             mcmc_state_merged = mcmc_state.merge_devices()
-            logger.log_checkpoint(n_epoch, params_merged, fixed_params_merged, mcmc_state_merged, opt_state_merged, clipping_state_merged)
+            with metrics_buffer.lock:
+                logger.log_checkpoint(n_epoch, params_merged, fixed_params_merged, mcmc_state_merged, opt_state_merged, clipping_state_merged)
             delete_obsolete_checkpoints(n_epoch, opt_config.checkpoints)
+            timer.record("checkpoint")
 
         if n_epoch in eval_checkpoints:
             LOGGER.debug(f"opt epoch {n_epoch:5d}: Running intermediate evaluation...")
+            metrics_buffer.flush()
             params_merged, fixed_params_merged = get_from_devices((params, fixed_params))
             mcmc_state_merged = mcmc_state.merge_devices()
-            evaluate_wavefunction(
-                log_psi_squared, cache_func, params_merged, fixed_params_merged, mcmc_state_merged, opt_config.intermediate_eval, phys_config,
-                rng_seed, logger, n_epoch,
-            )
-        if n_epoch == (opt_config.n_epochs_prev + opt_config.n_epochs):
+            with metrics_buffer.lock:
+                evaluate_wavefunction(
+                    log_psi_squared, cache_func, params_merged, fixed_params_merged, mcmc_state_merged, opt_config.intermediate_eval,
+                    phys_config, rng_seed, logger, n_epoch, determinant_schema=determinant_schema,
+                )
+            timer.record("intermediate_eval")
+        if n_epoch == n_epoch_end:
             break
-        mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_squared, cache_func, mcmc, params, spin_state,
-                                                        mcmc_state,
-                                                        fixed_params, split_mcmc=False, merge_mcmc=False,
-                                                        mode="intersteps")
-        params, opt_state, clipping_state, stats = optimizer.step(params=params,
-                                                                  state=opt_state,
-                                                                  static_args=spin_state,
-                                                                  rng=rng_opt,
-                                                                  batch=mcmc_state.build_batch(fixed_params),
-                                                                  func_state=clipping_state)
-        mcmc_state_merged = mcmc_state.merge_devices()
-
-        metrics = {k: float(v[0]) for k,v in stats['aux'].items() if not k.startswith('E_loc')}
-        wf_logger.log_step(metrics,
-                           E_ref=phys_config.E_ref,
-                           mcmc_state=mcmc_state_merged,
-                           opt_stats=get_from_devices(stats))
-
-        if opt_config.stop_on_nan:
-            E = metrics.get('E_mean', 0.0)
-            if not np.isfinite(E):
-                LOGGER.warning(f"opt epoch {n_epoch:5d}: Hit non-finite optimization energy opt_E_mean={E}. Dumping checkpoint.")
-                params_merged, fixed_params_merged, opt_state_merged, clipping_state_merged = get_from_devices(
-                    (params, fixed_params, opt_state, clipping_state))
-                logger.log_checkpoint(n_epoch, params_merged, fixed_params_merged, mcmc_state_merged, opt_state_merged,
+
+        if epoch_engine is not None:
+            n_epochs_fused = epoch_engine.get_n_epochs(
+                n_epoch, n_epoch_end, lambda n: (n in eval_checkpoints) or is_checkpoint_required(n, opt_config.checkpoints))
+            params, opt_state, clipping_state, mcmc_state, fixed_params, metrics = epoch_engine.run(
+                params, opt_state, clipping_state, mcmc_state, fixed_params, spin_state, rng_opt, n_epochs_fused)
+            timer.record("fused_epochs", params, mcmc_state.r)
+            metrics.update(timer.get_metrics(n_epochs_fused))
+            metrics_buffer.push(wf_logger, metrics, n_epoch, E_ref=phys_config.E_ref, n_epochs=n_epochs_fused)
+            n_epoch_next = n_epoch + n_epochs_fused
+        else:
+            r_old = mcmc_state.r
+            mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_squared, cache_func, mcmc, params, spin_state,
+                                                            mcmc_state,
+                                                            fixed_params, split_mcmc=False, merge_mcmc=False,
+                                                            mode="intersteps", laplacian_keys=laplacian_keys)
+            timer.record("mcmc", mcmc_state.r, fixed_params)
+            params, opt_state, clipping_state, stats = optimizer.step(params=params,
+                                                                      state=opt_state,
+                                                                      static_args=spin_state,
+                                                                      rng=rng_opt,
+                                                                      batch=mcmc_state.build_batch(fixed_params),
+                                                                      func_state=clipping_state)
+            metrics = {k: v[0] for k, v in stats['aux'].items() if not k.startswith('E_loc')}
+            metrics.update({k: v[0] for k, v in stats.items() if k.startswith(OPT_STATS_PREFIXES)})
+            timer.record("opt_step", params, stats)
+            metrics.update(get_mcmc_metrics(mcmc_state, r_old))
+            # Recorded before the push, so that t_logging is logged with the metrics of the epoch it belongs to
+            timer.record("logging")
+            metrics.update(timer.get_metrics())
+            metrics_buffer.push(wf_logger, metrics, n_epoch, E_ref=phys_config.E_ref)
+            n_epoch_next = n_epoch + 1
+
+        if opt_config.stop_on_nan and (metrics_buffer.non_finite_epoch is not None):
+            # Non-finite energies are only detected once the metrics have been transferred, i.e. possibly a few epochs late
+            LOGGER.warning(f"opt epoch {metrics_buffer.non_finite_epoch:5d}: Hit non-finite optimization energy "
+                           f"opt_E_mean={metrics_buffer.non_finite_energy}. Dumping checkpoint at epoch {n_epoch_next}.")
+            metrics_buffer.close()
+            params_merged, fixed_params_merged, opt_state_merged, clipping_state_merged = get_from_devices(
+                (params, strip_walker_keys(fixed_params), opt_state, clipping_state))
+            with metrics_buffer.lock:
+                logger.log_checkpoint(n_epoch_next, params_merged, fixed_params_merged, mcmc_state.merge_devices(), opt_state_merged,
                                       clipping_state_merged)
-                raise ValueError("Aborting due to nan-energy")
+            raise ValueError("Aborting due to nan-energy")
 
+    if hasattr(optimizer, "close"):
+        optimizer.close()
+    metrics_buffer.close()
+    timer.log_summary()
     LOGGER.debug("Finished wavefunction optimization...")
     params, opt_state, clipping_state = get_from_devices((params, opt_state, clipping_state))
     return mcmc_state, params, opt_state, clipping_state
@@ -153,10 +205,13 @@ def optimize_shared_wavefunction(
     phisnet_model = None,
     N_ions_max = None,
     nb_orbitals_per_Z = None,
+    shape_buckets: Optional[List[ShapeBucket]] = None,
 ) -> Tuple[Dict, Any, List[GeometryDataStore], Dict]:
     """
     Minimizes the energy of the wavefunction defined by the callable `log_psi_squared` by adjusting the trainable parameters for
     multiple geometries at once sharing all trainable parameters.
+    If shape_buckets are given, each geometry is padded to its bucket during optimization (see deeperwin.bucketing); checkpoints,
+    evaluations and the returned data stores always refer to the un-padded geometries.
 
     Args:
         log_psi_func (callable): A function representing the wavefunction model
@@ -179,15 +234,20 @@ def optimize_shared_wavefunction(
     # Run burn-in of monte carlo chain
     LOGGER.debug(f"Starting burn-in for optimization: {config.optimization.mcmc.n_burn_in} steps")
 
+    if config.optimization.epochs_per_dispatch:
+        LOGGER.warning("Fused epochs are not supported for shared optimization; using regular epoch loop")
+
     # init MCMC
     rng_opt = jax.random.PRNGKey(rng_seed)
-    mcmc = MetropolisHastingsMonteCarlo(config.optimization.mcmc)
+    mcmc = MetropolisHastingsMonteCarlo(config.optimization.mcmc, determinant_schema=config.model.orbitals.determinant_schema)
     params, initial_opt_state, rng_opt = replicate_across_devices((params, initial_opt_state, rng_opt))
 
     # init ema params as a copy of params
     ema_params = jax.tree_map(lambda x: x, params)
 
-    # create MCMC state & run burn in for each goemetry
+    # create MCMC state for each geometry
+    compile_stats = CompilationStats("Shared optimization")
+    laplacian_keys = config.optimization.local_energy.laplacian == "hutchinson"
     for idx, g in enumerate(geometries_data_stores):
         logging.debug(f"Running burn-in before variational optimization for geom {idx}")
         g.spin_state = (g.physical_config.n_up, g.physical_config.n_dn)
@@ -195,11 +255,27 @@ def optimize_shared_wavefunction(
                                                 g.physical_config,
                                                 config.optimization.mcmc.initialization,
                                                 jax.random.PRNGKey(rng_seed + idx))
+        if shape_buckets:
+            g.apply_shape_bucket(shape_buckets[idx])
         if config.optimization.init_clipping_with_None:
             g.clipping_state = (None, None)
         else:
             g.clipping_state = initial_clipping_state or init_clipping_state()  # do not clip at first epoch, then adjust
         g.fixed_params, g.clipping_state = replicate_across_devices((g.fixed_params, g.clipping_state))
+
+    # Initialize loss and optimizer
+    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_squared, config.optimization.clipping, config.optimization.local_energy), 
+                                opt_config=config.optimization.optimizer, 
+                                value_func_has_aux=True, 
+                                value_func_has_state=True,
+                                log_psi_squared_func=log_psi_squared)
+
+    # Compile the programs of all geometries ahead of time (no-op unless enabled in the computation config)
+    warmup_shared_optimization_programs(log_psi_squared, cache_func, mcmc, optimizer, params, initial_opt_state, geometries_data_stores,
+                                        rng_opt, laplacian_keys)
+
+    for idx, g in enumerate(geometries_data_stores):
+        compile_stats.start_step(g.shape, idx, ("burnin", g.spin_state), g.mcmc_state, g.fixed_params)
         g.mcmc_state, g.fixed_params = _run_mcmc_with_cache(log_psi_squared,
                                                             cache_func,
                                                             mcmc,
@@ -207,17 +283,14 @@ def optimize_shared_wavefunction(
                                                             g.spin_state,
                                                             g.mcmc_state,
                                                             g.fixed_params,
-                                                            mode="burnin")
+                                                            merge_mcmc=False,
+                                                            mode="burnin",
+                                                            laplacian_keys=laplacian_keys)
+        compile_stats.end_step(g.mcmc_state.r)
 
-    # Initialize loss and optimizer
-    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_squared, config.optimization.clipping), 
-                                opt_config=config.optimization.optimizer, 
-                                value_func_has_aux=True, 
-                                value_func_has_state=True,
-                                log_psi_squared_func=log_psi_squared)
     opt_state = initial_opt_state or optimizer.init(params=params, 
                                                     rng=rng_opt, 
-                                                    batch=geometries_data_stores[0].mcmc_state.split_across_devices().build_batch(
+                                                    batch=geometries_data_stores[0].mcmc_state.build_batch(
                                                             geometries_data_stores[0].fixed_params
                                                     ), 
                                                     static_args=geometries_data_stores[0].spin_state,
@@ -227,35 +300,50 @@ def optimize_shared_wavefunction(
     eval_checkpoints = set(config.optimization.intermediate_eval.opt_epochs * len(geometries_data_stores)) if config.optimization.intermediate_eval else set()
 
     geometry_permutation = np.asarray(jax.random.permutation(jax.random.PRNGKey(rng_seed), len(geometries_data_stores)))
+    metrics_buffer = MetricsBuffer(config.optimization.metrics_flush_every, config.optimization.async_metrics)
+    timer = PhaseTimer("Shared optimization")
     for n_epoch in range(config.optimization.n_epochs + 1):
+        timer.update_trace(n_epoch)
+        timer.start()
         if is_checkpoint_required(n_epoch, config.optimization.checkpoints):
             LOGGER.debug(f"Saving checkpoint n_epoch={n_epoch}")
-            params_merged, opt_state_merged, ema_params_merged = get_from_devices((params, opt_state, ema_params))
+            metrics_buffer.flush()
+            # Transfer the shared state to the host once, so that all geometry checkpoints share the same host arrays
+            params_merged, opt_state_merged, ema_params_merged = jax.device_get(get_from_devices((params, opt_state, ema_params)))
+            # With a blob store, the optimizer state is stored only once anyway, so every geometry checkpoint can be restored on its own
+            blob_dir = config.logging.pickle.checkpoint_blob_dir if config.logging.pickle else None
             for idx_geom, g in enumerate(geometries_data_stores):
                 if config.optimization.checkpoints.log_only_zero_geom and idx_geom != 0:
                     continue
 
-                fixed_params, clipping_state = get_from_devices((g.fixed_params, g.clipping_state))
-                g.mcmc_state = g.mcmc_state.merge_devices()
-                g.wavefunction_logger.loggers.log_checkpoint(n_epoch,
-                                                             params_merged,
-                                                             fixed_params,
-                                                             g.mcmc_state,
-                                                             opt_state_merged if idx_geom == 0 else None,
-                                                             clipping_state,
-                                                             ema_params_merged)
+                clipping_state = get_from_devices(g.clipping_state)
+                fixed_params, mcmc_state_merged = g.get_unpadded_state()
+                with metrics_buffer.lock:
+                    g.wavefunction_logger.loggers.log_checkpoint(n_epoch,
+                                                                 params_merged,
+                                                                 strip_walker_keys(fixed_params),
+                                                                 mcmc_state_merged,
+                                                                 opt_state_merged if (idx_geom == 0) or blob_dir else None,
+                                                                 clipping_state,
+                                                                 ema_params_merged)
                 delete_obsolete_checkpoints(n_epoch, config.optimization.checkpoints, directory=f"{idx_geom:04d}")
+            if blob_dir and (jax.process_index() == 0):
+                delete_unreferenced_blobs(blob_dir)
+            timer.record("checkpoint")
 
         if n_epoch in eval_checkpoints:
             LOGGER.debug(f"opt epoch {n_epoch:5d}: Running intermediate evaluation...")
+            metrics_buffer.flush()
             params_merged = get_from_devices(params)
             for idx_geom, g in enumerate(geometries_data_stores):
-                fixed_params = get_from_devices(g.fixed_params)
-                g.mcmc_state = g.mcmc_state.merge_devices()
-                evaluate_wavefunction(
-                    log_psi_squared, cache_func, params_merged, fixed_params, g.mcmc_state, config.optimization.intermediate_eval, g.physical_config,
-                    rng_seed, g.wavefunction_logger.loggers, g.n_opt_epochs, dict(opt_n_epoch=n_epoch, geom_id=idx_geom)
-                )
+                fixed_params, mcmc_state_merged = g.get_unpadded_state()
+                with metrics_buffer.lock:
+                    evaluate_wavefunction(
+                        log_psi_squared, cache_func, params_merged, fixed_params, mcmc_state_merged, config.optimization.intermediate_eval,
+                        g.physical_config, rng_seed, g.wavefunction_logger.loggers, g.n_opt_epochs,
+                        dict(opt_n_epoch=n_epoch, geom_id=idx_geom), config.model.orbitals.determinant_schema
+                    )
+            timer.record("intermediate_eval")
         if n_epoch == config.optimization.n_epochs:
             break
 
@@ -273,7 +361,9 @@ def optimize_shared_wavefunction(
             g.fixed_params, g.clipping_state = get_from_devices((g.fixed_params, g.clipping_state))
             if jax.process_index() == 0:
                 E_old = g.fixed_params["baseline_energies"].get("E_hf", np.nan)
+                g.mcmc_state = g.mcmc_state.merge_devices()
                 g = distort_geometry(g, config.optimization.shared_optimization.distortion)
+                g.mcmc_state = g.mcmc_state.split_across_devices()
                 g.fixed_params = init_model_fixed_params(config.model, 
                                                          g.physical_config, 
                                                          phisnet_model,
@@ -282,9 +372,11 @@ def optimize_shared_wavefunction(
                 E_new = g.fixed_params["baseline_energies"].get("E_hf", np.nan)
                 LOGGER.debug(f"New geometry: geom_id={g.idx}; R_new={g.physical_config.R}; U_new={g.rotation.tolist()}, delta_E={E_new-E_old:.6f}")
             g.fixed_params, g.clipping_state = replicate_across_devices((g.fixed_params, g.clipping_state))
+            timer.record("distortion", g.fixed_params)
 
-
-        # Step 2. Split MCMC and do MCMC + optimization step
+        # Step 2. MCMC + optimization step; the MCMC states stay split across devices and are only merged for checkpoints/evaluation
+        r_old = g.mcmc_state.r
+        compile_stats.start_step(g.shape, next_geometry_index, ("epoch", g.spin_state), g.mcmc_state, g.fixed_params, g.clipping_state)
         g.mcmc_state, g.fixed_params = _run_mcmc_with_cache(log_psi_squared,
                                                             cache_func,
                                                             mcmc,
@@ -292,8 +384,11 @@ def optimize_shared_wavefunction(
                                                             g.spin_state,
                                                             g.mcmc_state,
                                                             g.fixed_params,
+                                                            split_mcmc=False,
                                                             merge_mcmc=False,
-                                                            mode="intersteps")
+                                                            mode="intersteps",
+                                                            laplacian_keys=laplacian_keys)
+        timer.record("mcmc", g.mcmc_state.r, g.fixed_params)
 
         params, opt_state, g.clipping_state, stats = optimizer.step(params=params,
                                                                     state=opt_state,
@@ -301,42 +396,60 @@ def optimize_shared_wavefunction(
                                                                     rng=rng_opt,
                                                                     batch=g.mcmc_state.build_batch(g.fixed_params),
                                                                     func_state=g.clipping_state)
+        compile_stats.end_step(params, g.mcmc_state.r)
+        timer.record("opt_step", params, stats)
 
         # Update ema params with updated params
         ema_params = jax.tree_map(lambda old, new: config.optimization.params_ema_factor * old + (1 - config.optimization.params_ema_factor) * new, ema_params, params)
 
-        # Step 3. gather states across devices again
-        g.mcmc_state = g.mcmc_state.merge_devices()
-
-        # Step 4. update & log metrics
-        g.current_metrics = {k: float(v[0]) for k,v in stats['aux'].items() if not k.startswith('E_loc')}
-        g.current_metrics["damping"] = stats.get("damping")
+        # Step 3. update & log metrics (metrics stay on device until the buffer is flushed)
+        g.current_metrics = {k: v[0] for k,v in stats['aux'].items() if not k.startswith('E_loc')}
+        g.current_metrics["damping"] = stats["damping"][0] if stats.get("damping") is not None else None
         g.n_opt_epochs += 1
         g.n_opt_epochs_last_dist += 1
         g.last_epoch_optimized = n_epoch
         g.current_metrics['n_epoch'] = n_epoch
-        g.wavefunction_logger.log_step(metrics=g.current_metrics,
-                                              E_ref=g.physical_config.E_ref,
-                                              mcmc_state=g.mcmc_state,
-                                              opt_stats=get_from_devices(stats),
-                                              epoch=g.n_opt_epochs,
-                                              extra_metrics=dict(geom_id=next_geometry_index))
-
-        if config.optimization.stop_on_nan:
-            E = g.current_metrics.get('E_mean', 0.0)
-            if not np.isfinite(E):
-                LOGGER.warning(f"opt epoch {n_epoch:5d}: Hit non-finite optimization energy opt_E_mean={E}. Dumping checkpoint.")
-                params_merged, fixed_params_merged, opt_state_merged, clipping_state_merged, ema_params_merged = get_from_devices(
-                    (params, g.fixed_params, opt_state, g.clipping_state, ema_params))
-                g.wavefunction_logger.loggers.log_checkpoint(n_epoch, params_merged, fixed_params_merged, g.mcmc_state, opt_state_merged,
-                                      clipping_state_merged, ema_params_merged)
-                raise ValueError("Aborting due to nan-energy")
-
-    # Step 5. gather all states across devices again for final evaluation
+        metrics = dict(g.current_metrics)
+        metrics.update({k: v[0] for k, v in stats.items() if k.startswith(OPT_STATS_PREFIXES)})
+        metrics.update(get_mcmc_metrics(g.mcmc_state, r_old))
+        # Recorded before the push, so that t_logging is logged with the metrics of the epoch (and geometry) it belongs to
+        timer.record("logging")
+        metrics.update(timer.get_metrics())
+        metrics_buffer.push(g.wavefunction_logger,
+                            metrics,
+                            n_epoch,
+                            E_ref=g.physical_config.E_ref,
+                            epoch=g.n_opt_epochs,
+                            extra_metrics=dict(geom_id=next_geometry_index))
+
+        if config.optimization.stop_on_nan and (metrics_buffer.non_finite_epoch is not None):
+            # Non-finite energies are only detected once the metrics have been transferred, i.e. possibly a few epochs late and
+            # possibly for another geometry than the current one: Dump the checkpoint of the geometry that hit the non-finite energy
+            idx_geom = metrics_buffer.non_finite_extra_metrics["geom_id"]
+            g_non_finite = geometries_data_stores[idx_geom]
+            LOGGER.warning(f"opt epoch {metrics_buffer.non_finite_epoch:5d}: Hit non-finite optimization energy "
+                           f"opt_E_mean={metrics_buffer.non_finite_energy} for geometry {idx_geom}. Dumping checkpoint at epoch {n_epoch}.")
+            metrics_buffer.close()
+            params_merged, opt_state_merged, clipping_state_merged, ema_params_merged = get_from_devices(
+                (params, opt_state, g_non_finite.clipping_state, ema_params))
+            fixed_params_merged, mcmc_state_merged = g_non_finite.get_unpadded_state()
+            g_non_finite.wavefunction_logger.loggers.log_checkpoint(n_epoch, params_merged, strip_walker_keys(fixed_params_merged),
+                                                                    mcmc_state_merged, opt_state_merged, clipping_state_merged,
+                                                                    ema_params_merged)
+            raise ValueError("Aborting due to nan-energy")
+
+    if hasattr(optimizer, "close"):
+        optimizer.close()
+    metrics_buffer.close()
+    compile_stats.log_summary()
+    timer.log_summary()
+
+    # Step 4. gather all states across devices again for final evaluation
     LOGGER.debug("Finished wavefunction optimization...")
     params, opt_state = get_from_devices((params, opt_state))
     for g in geometries_data_stores:
-        g.clipping_state, g.fixed_params = get_from_devices((g.clipping_state, g.fixed_params))
+        g.clipping_state, g.fixed_params = get_from_devices((g.clipping_state, strip_walker_keys(g.fixed_params)))
         g.mcmc_state = g.mcmc_state.merge_devices()
+        g.remove_shape_bucket()
 
     return params, opt_state, geometries_data_stores, ema_params
@@ -13,7 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
+import functools
+import inspect
+import time
 import kfac_jax
+import numpy as np
 import optax
 from typing import Optional, Any, Callable, Tuple, Mapping, Iterator, Union
 import jax
@@ -22,6 +27,7 @@ from deeperwin.configuration import OptimizerConfigKFAC, BFGSOptimizerConfig, Op
     StandardOptimizerConfig
 from deeperwin.optimization.opt_utils import build_lr_schedule, build_optax_optimizer
 from deeperwin.srcg import SRCGOptimizer
+from deeperwin.utils.compilation import call_program
 from deeperwin import curvature_tags_and_blocks
 import haiku as hk
 import re
@@ -157,18 +163,150 @@ class OptaxWrapper:
                Tuple[kfac_jax.utils.Params, Any,
                      Mapping[str, jnp.ndarray]]]:
         """A step with similar interface to KFAC."""
-        result = self._jit_step(
+        # Uses the executable compiled by the AOT warm-up (if any) for steps with the same signature
+        result = call_program(
+            self._jit_step,
             params,
             state,
             static_args,
             rng,
             batch,
             func_state,
+            static_argnums=(2,),
         )
         return result
 
 
 
+class AsyncInverseKFACOptimizer(kfac_jax.Optimizer):
+    """KFAC optimizer, which computes the inverses of the Kronecker factors on the host instead of inside the optimizer step.
+
+    Every inverse_update_period steps, a snapshot of the curvature factors is inverted in a background thread on the CPU, while
+    training continues with the previous (stale) inverses. A finished inversion is swapped into the optimizer state before the next
+    step. If the inverses in use are older than max_inverse_staleness steps, the next step waits for the pending inversion.
+    Only the very first step computes its inverses inline.
+
+    In addition to the regular KFAC stats, the step returns inverse_staleness (age of the inverses used in this step, in steps) and
+    inverse_time (wall time of the last finished inversion, in seconds).
+    """
+
+    def __init__(self, *args, inverse_update_period: int = 1, max_inverse_staleness: int = 10, **kwargs):
+        assert max_inverse_staleness >= 1, "Asynchronously computed inverses are always at least 1 step old"
+        # The inline inverse update is replaced by overriding a private method of kfac_jax.Optimizer
+        base_method = getattr(kfac_jax.Optimizer, "_maybe_update_inverse_cache", None)
+        if (base_method is None) or (list(inspect.signature(base_method).parameters) != ["self", "state"]):
+            raise NotImplementedError(f"Asynchronous KFAC inverses are not supported by kfac_jax {kfac_jax.__version__}: "
+                                      f"Optimizer._maybe_update_inverse_cache(self, state) not found")
+        super().__init__(*args, inverse_update_period=inverse_update_period, **kwargs)
+        self._async_inverse_period = inverse_update_period
+        self._max_inverse_staleness = max_inverse_staleness
+        self._inverse_device = jax.devices("cpu")[0]
+        self._inverse_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._invert = jax.jit(self._compute_inverses)
+        self._pending_inverse = None  # (future, index of the last step included in the curvature snapshot)
+        self._n_steps = None
+        self._inverse_step = None
+        self._inverse_staleness = 0
+        self._t_inverse = 0.0
+
+    def _maybe_update_inverse_cache(self, state):
+        state = state.copy()
+        state.estimator_state = jax.lax.cond(
+            state.step_counter == 0,
+            functools.partial(
+                self.estimator.update_cache,
+                identity_weight=self.l2_reg + state.damping,
+                exact_powers=None,
+                approx_powers=-1,
+                eigenvalues=False,
+                pmap_axis_name=self.pmap_axis_name,
+            ),
+            lambda state_: state_,
+            state.estimator_state
+        )
+        return state
+
+    def _compute_inverses(self, estimator_state, identity_weight):
+        estimator_state = self.estimator.update_cache(estimator_state,
+                                                      identity_weight=identity_weight,
+                                                      exact_powers=None,
+                                                      approx_powers=-1,
+                                                      eigenvalues=False,
+                                                      pmap_axis_name=None)
+        return tuple(block_state.cache for block_state in estimator_state.blocks_states)
+
+    def _run_inversion(self, estimator_state, identity_weight):
+        t_start = time.perf_counter()
+        caches = jax.block_until_ready(self._invert(estimator_state, identity_weight))
+        return caches, time.perf_counter() - t_start
+
+    def _submit_inversion(self, state):
+        # Curvature factors are synced across devices, so the factors of the first device are representative
+        estimator_state = jax.device_put(jax.tree_util.tree_map(lambda x: x[0], state.estimator_state), self._inverse_device)
+        # The returned state only contains the damping when it is adapted; otherwise it follows the schedule of the next step
+        damping = state.damping[0] if state.damping is not None else self._damping_schedule(state.step_counter[0])
+        identity_weight = jax.device_put(self.l2_reg + damping, self._inverse_device)
+        future = self._inverse_executor.submit(self._run_inversion, estimator_state, identity_weight)
+        self._pending_inverse = (future, self._n_steps - 1)
+
+    def _collect_inversion(self, state):
+        """Waits for the pending inversion and replaces the cached inverses of all blocks in the (replicated) optimizer state"""
+        future, self._inverse_step = self._pending_inverse
+        self._pending_inverse = None
+        caches, self._t_inverse = future.result()
+        caches = jax.device_put_replicated(caches, jax.local_devices())
+
+        state = state.copy()
+        estimator_state = state.estimator_state.copy()
+        blocks_states = []
+        for block_state, cache in zip(estimator_state.blocks_states, caches):
+            block_state = block_state.copy()
+            block_state.cache = cache
+            blocks_states.append(block_state)
+        estimator_state.blocks_states = tuple(blocks_states)
+        state.estimator_state = estimator_state
+        return state
+
+    def _swap_in_inverses(self, state):
+        if self._n_steps is None:
+            self._n_steps = int(state.step_counter[0])
+            self._inverse_step = self._n_steps
+        if (self._pending_inverse is not None) and self._pending_inverse[0].done():
+            state = self._collect_inversion(state)
+        while (self._n_steps - self._inverse_step) > self._max_inverse_staleness:
+            # A fresh snapshot has a staleness of 1, so this terminates after at most one additional inversion
+            if self._pending_inverse is None:
+                self._submit_inversion(state)
+            state = self._collect_inversion(state)
+        self._inverse_staleness = self._n_steps - self._inverse_step
+        return state
+
+    def step(self, params, state, *args, **kwargs):
+        state = self._swap_in_inverses(state)
+        outputs = super().step(params, state, *args, **kwargs)
+        state, stats = outputs[1], outputs[-1]
+        self._n_steps += 1
+        if (self._pending_inverse is None) and (self._n_steps % self._async_inverse_period == 0):
+            self._submit_inversion(state)
+
+        n_devices = jax.local_device_count()
+        stats["inverse_staleness"] = np.full(n_devices, self._inverse_staleness)
+        stats["inverse_time"] = np.full(n_devices, self._t_inverse)
+        return outputs
+
+    def close(self):
+        """Discards a pending inversion and shuts down the background thread"""
+        if self._pending_inverse is not None:
+            self._pending_inverse[0].cancel()
+            self._pending_inverse = None
+        self._inverse_executor.shutdown(wait=False)
+
+    def __del__(self):
+        executor = getattr(self, "_inverse_executor", None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
 def build_optimizer(value_and_grad_func,
                     opt_config: OptimizerConfigType,
                     value_func_has_aux=False,
@@ -179,7 +317,12 @@ def build_optimizer(value_and_grad_func,
         internal_optimizer = build_optax_optimizer(opt_config.internal_optimizer)
         damping_scheduler = build_lr_schedule(opt_config.damping,
                                               opt_config.damping_schedule)
-        return kfac_jax.Optimizer(value_and_grad_func,
+        kfac_kwargs = {}
+        kfac_class = kfac_jax.Optimizer
+        if opt_config.async_inverses:
+            kfac_class = AsyncInverseKFACOptimizer
+            kfac_kwargs["max_inverse_staleness"] = opt_config.max_inverse_staleness
+        return kfac_class(value_and_grad_func,
                                   l2_reg=opt_config.l2_reg,
                                   value_func_has_aux=value_func_has_aux,
                                   value_func_has_state=value_func_has_state,
@@ -207,6 +350,7 @@ def build_optimizer(value_and_grad_func,
                                   ),
                                   include_norms_in_stats=True,
                                   include_per_param_norms_in_stats=False,
+                                  **kfac_kwargs,
                                   )
     elif opt_config.name == 'slbfgs':
         raise NotImplementedError("BFGS currently not yet implemented")
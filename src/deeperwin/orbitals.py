@@ -13,6 +13,7 @@ import pyscf.mcscf
 import numpy as np
 from deeperwin.configuration import PhysicalConfig, CASSCFConfig
 from deeperwin.utils.utils import get_el_ion_distance_matrix, generate_exp_distributed, PERIODIC_TABLE
+from deeperwin.utils.baseline_cache import get_baseline_cache, get_baseline_cache_key
 from collections import Counter
 import chex
 from typing import List, Tuple, Optional, Union, Dict
@@ -457,6 +458,19 @@ def get_local_orb_energy_estimate(mo_coeff, mo_coeff_loc, mo_E):
 
 
 def get_baseline_solution(physical_config: PhysicalConfig, casscf_config: CASSCFConfig, n_dets: int):
+    cache = get_baseline_cache()
+    if cache is None:
+        return _calculate_baseline_solution(physical_config, casscf_config, n_dets)
+    key = get_baseline_cache_key("baseline",
+                                 physical_config,
+                                 casscf_config=casscf_config.dict(),
+                                 n_dets=n_dets,
+                                 n_cas_orbitals=physical_config.n_cas_orbitals,
+                                 n_cas_electrons=physical_config.n_cas_electrons)
+    return cache.get_or_compute(key, lambda: _calculate_baseline_solution(physical_config, casscf_config, n_dets))
+
+
+def _calculate_baseline_solution(physical_config: PhysicalConfig, casscf_config: CASSCFConfig, n_dets: int):
     n_el, n_up, R, Z = physical_config.get_basic_params()
     n_dn = n_el - n_up
     atomic_orbitals, hf = get_hartree_fock_solution(physical_config, casscf_config.basis_set)
@@ -613,6 +627,14 @@ def initialize_walkers_with_exponential_radial_pdf(rng, R, Z, N_walkers, n_el, n
 
 
 def _get_atomic_orbital_envelope_exponents(physical_config: PhysicalConfig, basis_set):
+    cache = get_baseline_cache()
+    if cache is None:
+        return _calculate_atomic_orbital_envelope_exponents(physical_config, basis_set)
+    key = get_baseline_cache_key("envelope_exponents", physical_config, basis_set=basis_set)
+    return cache.get_or_compute(key, lambda: _calculate_atomic_orbital_envelope_exponents(physical_config, basis_set))
+
+
+def _calculate_atomic_orbital_envelope_exponents(physical_config: PhysicalConfig, basis_set):
     molecule = build_pyscf_molecule_from_physical_config(physical_config, basis_set)
     atomic_orbitals = _get_atomic_orbital_basis_functions(molecule)
 
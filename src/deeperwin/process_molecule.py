@@ -37,6 +37,20 @@ def _setup_environment(raw_config: Dict, config: Configuration) -> None:
     root_logger = build_dpe_root_logger(config.logging.basic)
     disable_slave_loggers(root_logger)
 
+    from deeperwin.utils.baseline_cache import configure_baseline_cache
+    configure_baseline_cache(config.computation.baseline_cache_dir, config.computation.baseline_cache_max_size_mb)
+
+    from deeperwin.utils.compilation import configure_compilation_cache
+    configure_compilation_cache(config.computation.compilation_cache_dir,
+                                config.computation.compilation_cache_min_compile_time_secs,
+                                config.computation.n_aot_warmup_threads)
+
+    from deeperwin.utils.profiling import configure_profiler
+    configure_profiler(config.computation.use_profiler, config.computation.profiler_trace_epochs, config.computation.profiler_trace_dir)
+
+    from deeperwin.checkpoints import configure_checkpoint_writer
+    configure_checkpoint_writer(config.computation.background_checkpoints, config.computation.max_pending_checkpoints)
+
 
     """ Set random seed """
     if config.computation.rng_seed is None:
@@ -72,6 +86,7 @@ def process_single_molecule(config_file: str):
     from deeperwin.utils.utils import merge_params
     from deeperwin.utils.setup_utils import initialize_training_loggers, finalize_experiment_run
     from deeperwin.loggers import LoggerCollection
+    from deeperwin.checkpoints import load_history_reference
     from deeperwin.orbitals import _get_all_basis_functions, _get_orbital_mapping
     from deeperwin.model.ml_orbitals.ml_orbitals import build_phisnet_model
     from deeperwin.orbitals import get_n_basis_per_Z
@@ -105,7 +120,12 @@ def process_single_molecule(config_file: str):
     """ Initialize training loggers """
     use_wandb_group = False
     exp_idx_in_group = None
-    training_loggers: LoggerCollection = initialize_training_loggers(config, params, fixed_params, use_wandb_group, exp_idx_in_group)
+    resume_history = None
+    if (config.reuse is not None) and (config.reuse.mode == "restart") and config.reuse.path:
+        # Continue the history file of the restarted run (if restarted in the same directory) after the rows of the checkpoint
+        resume_history = load_history_reference(config.reuse.path)
+    training_loggers: LoggerCollection = initialize_training_loggers(config, params, fixed_params, use_wandb_group, exp_idx_in_group,
+                                                                     resume_history=resume_history)
 
     """ STEP 1: Supervised pre-training of wavefunction orbitals """
     if config.pre_training and config.pre_training.n_epochs > 0:
@@ -128,6 +148,7 @@ def process_single_molecule(config_file: str):
             training_loggers,
             opt_state,
             clipping_state,
+            config.model.orbitals.determinant_schema,
         )
 
     """ STEP 3: Wavefunction evaluation  """ 
@@ -144,6 +165,7 @@ def process_single_molecule(config_file: str):
             rng_seed,
             training_loggers,
             config.optimization.n_epochs_total,
+            determinant_schema=config.model.orbitals.determinant_schema,
         )
     
     """ Finalize run"""
@@ -175,6 +197,10 @@ def process_multiple_molecules_shared(config_file: str) -> None:
     from deeperwin.orbitals import _get_all_basis_functions, _get_orbital_mapping
     from deeperwin.model.ml_orbitals.ml_orbitals import build_phisnet_model
     from deeperwin.orbitals import get_n_basis_per_Z
+    from deeperwin.utils.parallel_init import init_fixed_params_parallel
+    from deeperwin.bucketing import check_shape_bucketing_support, get_shape_buckets
+    import jax
+    import jax.numpy as jnp
 
     physical_configs = config.physical.create_geometry_list(raw_config['physical'].get('changes'))
 
@@ -194,6 +220,11 @@ def process_multiple_molecules_shared(config_file: str) -> None:
         nb_orbitals_per_Z = get_n_basis_per_Z(config.model.orbitals.transferable_atomic_orbitals.basis_set,
                                               tuple(config.model.orbitals.transferable_atomic_orbitals.atom_types))
 
+    shape_buckets = None
+    if config.optimization.shared_optimization.shape_bucketing is not None:
+        check_shape_bucketing_support(config)
+        shape_buckets = get_shape_buckets(config.model, physical_configs, config.optimization.shared_optimization.shape_bucketing)
+
     """ Build wavefunction / initialize model """
     log_psi_squared, orbital_func, cache_func, params, fixed_params = build_log_psi_squared(config.model, physical_configs, fixed_params, rng_seed, phisnet_model, N_ions_max, nb_orbitals_per_Z)
 
@@ -202,6 +233,21 @@ def process_multiple_molecules_shared(config_file: str) -> None:
 
 
     """ Create geometry data stores """
+    shared_opt_config = config.optimization.shared_optimization
+    pickle_config = config.logging.pickle
+    if shared_opt_config and shared_opt_config.deduplicate_checkpoints and pickle_config and (pickle_config.checkpoint_format == "tensors"):
+        # Store the shared parameters and optimizer state only once instead of once per geometry checkpoint
+        if pickle_config.checkpoint_blob_dir is None:
+            pickle_config.checkpoint_blob_dir = "checkpoint_blobs"
+            root_logger.info(f"Deduplicating checkpoints: storing checkpoint arrays in {pickle_config.checkpoint_blob_dir}")
+
+    fixed_params_per_geom = [None] * len(physical_configs)
+    if (config.computation.n_init_workers > 1) and (phisnet_model is None):
+        for idx, fixed_params_geom in init_fixed_params_parallel(config.model, physical_configs, config.computation):
+            # Only array leaves (returned by the workers as numpy arrays) are converted; all other leaves keep their type
+            fixed_params_per_geom[idx] = jax.tree_util.tree_map(lambda x: jnp.array(x) if isinstance(x, np.ndarray) else x,
+                                                                fixed_params_geom)
+
     geometries_data_stores = []
     for idx, physical_config in enumerate(physical_configs):
         config_to_log = copy.deepcopy(config)
@@ -210,7 +256,7 @@ def process_multiple_molecules_shared(config_file: str) -> None:
         geometry_data_store.idx = idx
         geometry_data_store.physical_config = physical_config
         geometry_data_store.physical_config_original = copy.deepcopy(physical_config) # TODO Necessary?
-        geometry_data_store.fixed_params = init_model_fixed_params(config.model, physical_config, phisnet_model, N_ions_max)
+        geometry_data_store.fixed_params = fixed_params_per_geom[idx] or init_model_fixed_params(config.model, physical_config, phisnet_model, N_ions_max)
         geometry_data_store.init_wave_function_logger(config_to_log, params)
         if (config.optimization.shared_optimization.distortion is not None) and (config.optimization.shared_optimization.distortion.init_distortion_age  == "random"):
             geometry_data_store.n_opt_epochs_last_dist = np.random.randint(0, config.optimization.shared_optimization.distortion.max_age)
@@ -231,7 +277,8 @@ def process_multiple_molecules_shared(config_file: str) -> None:
             None,
             phisnet_model,
             N_ions_max,
-            nb_orbitals_per_Z
+            nb_orbitals_per_Z,
+            shape_buckets=shape_buckets,
         )
 
     ema_params = None
@@ -250,7 +297,8 @@ def process_multiple_molecules_shared(config_file: str) -> None:
             clipping_state,
             phisnet_model,
             N_ions_max,
-            nb_orbitals_per_Z
+            nb_orbitals_per_Z,
+            shape_buckets=shape_buckets,
         )
 
     """ STEP 3: Wavefunction evaluation  """ 
@@ -268,12 +316,19 @@ def process_multiple_molecules_shared(config_file: str) -> None:
                 rng_seed,
                 geometry.wavefunction_logger.loggers,
                 geometry.n_opt_epochs,
-                dict(opt_n_epoch=config.optimization.n_epochs, geom_id=idx_geom)
+                dict(opt_n_epoch=config.optimization.n_epochs, geom_id=idx_geom),
+                config.model.orbitals.determinant_schema,
             )
     
     """ Finalize run"""
+    # Transfer the shared state to the host once, instead of once per geometry checkpoint
+    params, opt_state, ema_params = jax.device_get((params, opt_state, ema_params))
     for geometry in geometries_data_stores:
         finalize_experiment_run(config, geometry.wavefunction_logger.loggers, params, geometry.fixed_params, mcmc_state, opt_state, geometry.clipping_state, ema_params)
+    if pickle_config and pickle_config.checkpoint_blob_dir and (jax.process_index() == 0):
+        from deeperwin.checkpoints import delete_unreferenced_blobs, wait_for_pending_checkpoints
+        delete_unreferenced_blobs(pickle_config.checkpoint_blob_dir)
+        wait_for_pending_checkpoints()
 
 
 if __name__ == '__main__':
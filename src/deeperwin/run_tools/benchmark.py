@@ -0,0 +1,215 @@
+"""
+Benchmark suite for the wavefunction: forward pass, gradient w.r.t. electron coordinates, local energy and a full optimizer step.
+
+Every combination of embedding, orbital type, number of electrons (=length of a hydrogen chain) and batch size is timed separately.
+For each program the time of the first call (dominated by compilation) is reported separately from the steady-state time per call.
+Results are written as JSON, so that benchmarks of different code versions can be compared (see compare_benchmarks).
+"""
+import datetime
+import json
+import logging
+import time
+import traceback
+from typing import Dict, List, Any
+
+import jax
+import jax.numpy as jnp
+
+from deeperwin.configuration import Configuration
+from deeperwin.run_tools.benchmark_laplacian import build_hydrogen_chain
+
+LOGGER = logging.getLogger("dpe")
+
+# Config changes to select each embedding; some embeddings are only available as part of a specific model
+EMBEDDINGS = {
+    "ferminet": {"model.name": "ferminet"},
+    "dpe4": {"model.name": "dpe4"},
+    "dpe1": {"model.name": "dpe1"},
+    "gnn": {"model.name": "dpe4", "model.embedding.name": "gnn"},
+    "transformer": {"model.name": "transformer"},
+    "axial_transformer": {"model.name": "dpe4", "model.embedding.name": "axial_transformer"},
+    "e3mpnn": {"model.name": "e3mpnn"},
+}
+
+ORBITALS = {
+    "envelope": {"model.orbitals.envelope_orbitals": {}, "model.orbitals.baseline_orbitals": None},
+    "baseline": {"model.orbitals.envelope_orbitals": None, "model.orbitals.baseline_orbitals": {}},
+    "taos": {"model.orbitals.envelope_orbitals": None, "model.orbitals.baseline_orbitals": None,
+             "model.orbitals.transferable_atomic_orbitals": {"name": "taos", "atom_types": [1], "basis_set": "STO-3G"}},
+}
+
+PROGRAMS = ["log_psi_sqr", "grad_r", "local_energy", "opt_step"]
+
+
+def build_benchmark_config(embedding: str, orbitals: str, n_el: int, config_changes: Dict[str, Any] = None) -> Configuration:
+    phys_config = build_hydrogen_chain(n_el)
+    config_dict = dict(physical=dict(R=phys_config.R, Z=phys_config.Z))
+    changes = dict(EMBEDDINGS[embedding])
+    changes.update(ORBITALS[orbitals])
+    changes.update(config_changes or {})
+    _, config = Configuration.update_configdict_and_validate(config_dict, changes)
+    return config
+
+
+def time_program(func, *args, n_reps=3):
+    """
+    Returns the output of func and a dict with the time of the first call (t_first, including compilation) and the mean time
+    of n_reps subsequent calls (t_step). func must return its next arguments as first output, so that programs with donated arguments
+    can be repeated (see benchmark_wavefunction).
+    """
+    t_start = time.perf_counter()
+    args, result = jax.block_until_ready(func(*args))
+    t_first = time.perf_counter() - t_start
+
+    t_start = time.perf_counter()
+    for _ in range(n_reps):
+        args, result = jax.block_until_ready(func(*args))
+    t_step = (time.perf_counter() - t_start) / n_reps
+    return result, dict(t_first=t_first, t_step=t_step, t_compile=max(t_first - t_step, 0.0))
+
+
+def benchmark_wavefunction(config: Configuration, batch_size: int, programs: List[str] = None, n_reps: int = 3,
+                           rng_seed: int = 0) -> Dict[str, Dict[str, float]]:
+    """Times each program for a single wavefunction and returns {program_name: timings}"""
+    from deeperwin.model import build_log_psi_squared
+    from deeperwin.orbitals import get_n_basis_per_Z
+    from deeperwin.mcmc import MCMCState
+    from deeperwin.hamiltonian import build_local_energy_func
+    from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+    from deeperwin.optimizers import build_optimizer
+    from deeperwin.optimization.opt_utils import _derive_walker_keys
+    from deeperwin.utils.utils import replicate_across_devices
+
+    programs = programs or PROGRAMS
+    phys_config = config.physical
+    n_up, n_dn = phys_config.n_up, phys_config.n_dn
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, rng_seed, None, None, nb_orbitals_per_Z
+    )
+    mcmc_state = MCMCState.initialize_around_nuclei(batch_size, phys_config, "exponential", jax.random.PRNGKey(rng_seed))
+    if cache_func is not None:
+        fixed_params["cache"] = cache_func(params, n_up, n_dn, *mcmc_state.build_batch(fixed_params))
+    batch = mcmc_state.build_batch(fixed_params)
+
+    timings = {}
+    if "log_psi_sqr" in programs:
+        func = jax.jit(lambda p, r, R, Z, fp: log_psi_sqr(p, n_up, n_dn, r, R, Z, fp))
+        _, timings["log_psi_sqr"] = time_program(lambda *args: (args, func(*args)), params, *batch, n_reps=n_reps)
+
+    if "grad_r" in programs:
+        func = jax.jit(jax.grad(lambda r, p, R, Z, fp: jnp.sum(log_psi_sqr(p, n_up, n_dn, r, R, Z, fp))))
+        _, timings["grad_r"] = time_program(lambda *args: (args, func(*args)), batch[0], params, *batch[1:], n_reps=n_reps)
+
+    if "local_energy" in programs:
+        local_energy_func = build_local_energy_func(config.optimization.local_energy)
+        func = jax.jit(lambda p, r, R, Z, fp: local_energy_func(log_psi_sqr, p, (n_up, n_dn), r, R, Z, fp))
+        _, timings["local_energy"] = time_program(lambda *args: (args, func(*args)), params, *batch, n_reps=n_reps)
+
+    if "opt_step" in programs:
+        # Uses the same (pmapped) code path as the optimization, i.e. including reductions across devices
+        optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_sqr, config.optimization.clipping,
+                                                                                  config.optimization.local_energy),
+                                    opt_config=config.optimization.optimizer,
+                                    value_func_has_aux=True,
+                                    value_func_has_state=True,
+                                    log_psi_squared_func=log_psi_sqr)
+        rng = jax.random.PRNGKey(rng_seed)
+        params_rep, fixed_params_rep, clipping_state, rng = replicate_across_devices((params, fixed_params, init_clipping_state(), rng))
+        mcmc_state_rep = mcmc_state.split_across_devices()
+        if config.optimization.local_energy.laplacian == "hutchinson":
+            fixed_params_rep["rng_laplacian"] = _derive_walker_keys(mcmc_state_rep.rng_state)
+        batch_rep = mcmc_state_rep.build_batch(fixed_params_rep)
+        opt_state = optimizer.init(params=params_rep, rng=rng, batch=batch_rep, static_args=(n_up, n_dn), func_state=clipping_state)
+
+        def _step(p, s, c):
+            p, s, c, stats = optimizer.step(params=p, state=s, static_args=(n_up, n_dn), rng=rng, batch=batch_rep, func_state=c)
+            return (p, s, c), stats
+        _, timings["opt_step"] = time_program(_step, params_rep, opt_state, clipping_state, n_reps=n_reps)
+
+    for t in timings.values():
+        t["walkers_per_sec"] = batch_size / t["t_step"]
+    return timings
+
+
+def run_benchmark_suite(embeddings: List[str], orbitals: List[str], n_electrons: List[int], batch_sizes: List[int],
+                        programs: List[str] = None, n_reps: int = 3, config_changes: Dict[str, Any] = None, rng_seed: int = 0) -> Dict:
+    """
+    Runs benchmark_wavefunction for every combination of embedding, orbitals, number of electrons and batch size.
+
+    Combinations that cannot be built or fail to run (e.g. unsupported model/orbital combinations) are recorded with their error
+    instead of aborting the suite.
+    """
+    results = []
+    for embedding in embeddings:
+        for orbital_type in orbitals:
+            for n_el in n_electrons:
+                for batch_size in batch_sizes:
+                    record = dict(embedding=embedding, orbitals=orbital_type, n_el=n_el, batch_size=batch_size)
+                    try:
+                        config = build_benchmark_config(embedding, orbital_type, n_el, config_changes)
+                        record["programs"] = benchmark_wavefunction(config, batch_size, programs, n_reps, rng_seed)
+                    except Exception as e:
+                        LOGGER.debug(traceback.format_exc())
+                        record["error"] = repr(e)
+                    results.append(record)
+                    LOGGER.info(format_record(record))
+    return dict(metadata=get_benchmark_metadata(), results=results)
+
+
+def get_benchmark_metadata() -> Dict[str, Any]:
+    from deeperwin.utils.utils import getCodeVersion
+    return dict(code_version=getCodeVersion(),
+                jax_version=jax.__version__,
+                backend=jax.default_backend(),
+                devices=[str(d) for d in jax.devices()],
+                n_devices=jax.device_count(),
+                float64=bool(jax.config.read("jax_enable_x64")),
+                date=datetime.datetime.now().isoformat())
+
+
+def format_record(record: Dict) -> str:
+    label = f"{record['embedding']:<18} {record['orbitals']:<9} n_el={record['n_el']:<4d} batch={record['batch_size']:<5d}"
+    if "error" in record:
+        return f"{label} FAILED: {record['error']}"
+    return label + " " + " ".join([f"{name}: {t['t_step'] * 1e3:.2f} ms (compile {t['t_compile']:.1f} s)"
+                             for name, t in record["programs"].items()])
+
+
+def _get_key(record):
+    return record["embedding"], record["orbitals"], record["n_el"], record["batch_size"]
+
+
+def compare_benchmarks(baseline: Dict, current: Dict) -> List[Dict[str, Any]]:
+    """Returns the speed-up (t_baseline / t_current) of the steady-state time and compile time for each benchmark present in both results"""
+    baseline_records = {_get_key(r): r for r in baseline["results"] if "programs" in r}
+    comparison = []
+    for record in current["results"]:
+        record_baseline = baseline_records.get(_get_key(record))
+        if (record_baseline is None) or ("programs" not in record):
+            continue
+        for name, t in record["programs"].items():
+            if name not in record_baseline["programs"]:
+                continue
+            t_baseline = record_baseline["programs"][name]
+            comparison.append(dict(zip(["embedding", "orbitals", "n_el", "batch_size"], _get_key(record)),
+                                   program=name,
+                                   speedup_step=t_baseline["t_step"] / t["t_step"],
+                                   speedup_compile=t_baseline["t_compile"] / max(t["t_compile"], 1e-9)))
+    return comparison
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    jax.config.update("jax_enable_x64", args.float64)
+    results = run_benchmark_suite(args.embeddings, args.orbitals, args.n_el, args.batch_size, args.programs, args.n_reps)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    LOGGER.info(f"Benchmark results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        for c in compare_benchmarks(baseline, results):
+            print(f"{c['embedding']:<18} {c['orbitals']:<9} n_el={c['n_el']:<4d} batch={c['batch_size']:<5d} {c['program']:<13} "
+                  f"speed-up: {c['speedup_step']:.2f}x (compile: {c['speedup_compile']:.2f}x)")
@@ -0,0 +1,108 @@
+"""
+Benchmark of the checkpoint formats: time to save, time to load and file size of a given checkpoint in each format.
+
+Loading is timed twice: 'load' reads the checkpoint and materializes all arrays in memory (i.e. the cost of restarting from the
+checkpoint), 'load_lazy' only opens it (which for uncompressed tensors-checkpoints memory-maps the arrays without reading them).
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+LOGGER = logging.getLogger("dpe")
+
+# (checkpoint_format, compression) of each variant
+VARIANTS = {
+    "pickle_bzip2": ("pickle", None),
+    "tensors": ("tensors", None),
+    "tensors_zlib": ("tensors", "zlib"),
+    "tensors_zstd": ("tensors", "zstd"),
+    "tensors_lz4": ("tensors", "lz4"),
+}
+
+
+def _materialize(data):
+    import jax
+    from deeperwin.checkpoints import ARRAY_FIELDS
+    n_bytes = 0
+    for key in ARRAY_FIELDS:
+        for leaf in jax.tree_util.tree_leaves(getattr(data, key)):
+            n_bytes += np.array(leaf).nbytes
+    return n_bytes
+
+
+def benchmark_checkpoint_format(data, checkpoint_format: str, compression: str, directory: str, n_reps: int = 3) -> Dict:
+    from deeperwin.checkpoints import save_run, load_run
+    fname = os.path.join(directory, f"chkpt_{checkpoint_format}_{compression}.zip")
+    t_save, t_load, t_load_lazy = [], [], []
+    for _ in range(n_reps):
+        t_start = time.perf_counter()
+        save_run(fname, data, checkpoint_format, compression)
+        t_save.append(time.perf_counter() - t_start)
+
+        t_start = time.perf_counter()
+        loaded = load_run(fname, parse_config=False)
+        t_load_lazy.append(time.perf_counter() - t_start)
+        n_bytes = _materialize(loaded)
+        t_load.append(time.perf_counter() - t_start)
+        del loaded
+    file_size = os.path.getsize(fname)
+    os.remove(fname)
+    return dict(t_save=float(np.median(t_save)),
+                t_load=float(np.median(t_load)),
+                t_load_lazy=float(np.median(t_load_lazy)),
+                file_size_mb=file_size / 1024**2,
+                array_size_mb=n_bytes / 1024**2)
+
+
+def run_checkpoint_benchmark(fname: str, variants: List[str], n_reps: int = 3, directory: str = None) -> Dict:
+    """Loads a checkpoint (of any format) and re-writes it in each variant; speed-ups are relative to pickle_bzip2 if benchmarked"""
+    from deeperwin.checkpoints import load_run
+    data = load_run(fname, parse_config=False, mmap=False)
+    results = []
+    with tempfile.TemporaryDirectory(dir=directory) as tmp_dir:
+        for variant in variants:
+            checkpoint_format, compression = VARIANTS[variant]
+            record = dict(variant=variant)
+            try:
+                record.update(benchmark_checkpoint_format(data, checkpoint_format, compression, tmp_dir, n_reps))
+            except ImportError as e:
+                record["error"] = f"Compression not available: {e}"
+            results.append(record)
+            LOGGER.info(format_checkpoint_table([record], header=(len(results) == 1)))
+
+    reference = next((r for r in results if (r["variant"] == "pickle_bzip2") and ("error" not in r)), None)
+    for record in results:
+        if (reference is not None) and ("error" not in record):
+            record["speedup_save"] = reference["t_save"] / record["t_save"]
+            record["speedup_load"] = reference["t_load"] / record["t_load"]
+
+    from deeperwin.run_tools.benchmark import get_benchmark_metadata
+    metadata = dict(get_benchmark_metadata(), checkpoint=fname, n_reps=n_reps)
+    return dict(metadata=metadata, results=results)
+
+
+def format_checkpoint_table(results: List[Dict], header=True) -> str:
+    columns = [("t_save", "{:>8.3f}"), ("t_load", "{:>8.3f}"), ("t_load_lazy", "{:>11.3f}"), ("file_size_mb", "{:>12.1f}"),
+               ("speedup_save", "{:>12.2f}"), ("speedup_load", "{:>12.2f}")]
+    lines = [f"{'variant':>13} " + " ".join([f"{name:>{len(fmt.format(0))}}" for name, fmt in columns])] if header else []
+    for r in results:
+        if "error" in r:
+            lines.append(f"{r['variant']:>13} FAILED: {r['error']}")
+            continue
+        lines.append(f"{r['variant']:>13} " + " ".join([fmt.format(r[name]) if name in r else " " * len(fmt.format(0))
+                                                     for name, fmt in columns]))
+    return "\n".join(lines)
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = run_checkpoint_benchmark(args.checkpoint, args.variants, args.n_reps, args.tmp_dir)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(format_checkpoint_table(results["results"]))
+    LOGGER.info(f"Checkpoint benchmark written to {args.output}")
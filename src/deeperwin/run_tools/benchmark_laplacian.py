@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Numerical check and runtime benchmark of the laplacian backends used for local energies (LocalEnergyConfig.laplacian).
+
+Builds a wavefunction for hydrogen chains of increasing size and compares local energies and runtimes of every backend
+against the reference 'loop' implementation.
+"""
+import argparse
+import time
+import jax
+import numpy as np
+from deeperwin.configuration import Configuration, PhysicalConfig, LocalEnergyConfig
+
+
+def build_hydrogen_chain(n_el, spacing=1.8):
+    return PhysicalConfig(R=[[i * spacing, 0.0, 0.0] for i in range(n_el)], Z=[1] * n_el)
+
+
+def build_model(config: Configuration, phys_config: PhysicalConfig, rng_seed=0):
+    from deeperwin.model import build_log_psi_squared
+    from deeperwin.orbitals import get_n_basis_per_Z
+
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, rng_seed, None, None, nb_orbitals_per_Z
+    )
+    return log_psi_sqr, cache_func, params, fixed_params
+
+
+def time_function(func, *args, n_reps=3):
+    result = jax.block_until_ready(func(*args))  # compilation
+    t_start = time.perf_counter()
+    for _ in range(n_reps):
+        result = jax.block_until_ready(func(*args))
+    return result, (time.perf_counter() - t_start) / n_reps
+
+
+def benchmark_laplacian(config: Configuration, n_electrons, methods, n_walkers, n_reps, rng_seed=0):
+    from deeperwin.hamiltonian import build_local_energy_func
+    from deeperwin.mcmc import MCMCState
+
+    results = []
+    for n_el in n_electrons:
+        phys_config = build_hydrogen_chain(n_el)
+        log_psi_sqr, cache_func, params, fixed_params = build_model(config, phys_config, rng_seed)
+        spin_state = (phys_config.n_up, phys_config.n_dn)
+        mcmc_state = MCMCState.initialize_around_nuclei(n_walkers, phys_config, "exponential", jax.random.PRNGKey(rng_seed))
+        fixed_params["cache"] = cache_func(params, *spin_state, *mcmc_state.build_batch(fixed_params))
+
+        E_ref = None
+        for method in methods:
+            local_energy_func = build_local_energy_func(LocalEnergyConfig(laplacian=method))
+            func = jax.jit(lambda p, r, R, Z, fp: local_energy_func(log_psi_sqr, p, spin_state, r, R, Z, fp))
+            (E_loc, _), t = time_function(func, params, *mcmc_state.build_batch(fixed_params), n_reps=n_reps)
+            E_loc = np.array(E_loc)
+            E_ref = E_loc if E_ref is None else E_ref
+            results.append(dict(n_el=n_el,
+                                method=method,
+                                t_per_walker=t / n_walkers,
+                                max_abs_deviation=float(np.max(np.abs(E_loc - E_ref))),
+                                max_rel_deviation=float(np.max(np.abs(E_loc - E_ref) / np.abs(E_ref)))))
+            print(" ".join([f"{k}={v:.3e}" if isinstance(v, float) else f"{k}={v}" for k, v in results[-1].items()]), flush=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare and time the laplacian backends for the local energy")
+    parser.add_argument("--config", default=None, help="Config file to take the model settings from; defaults to the default model")
+    parser.add_argument("--n-el", type=int, nargs="+", default=[10, 20, 30, 40, 50, 60], help="Number of electrons (=length of the H-chain)")
+    parser.add_argument("--methods", nargs="+", default=["loop", "forward"], help="Laplacian backends; the first one is used as reference")
+    parser.add_argument("--n-walkers", type=int, default=32)
+    parser.add_argument("--n-reps", type=int, default=3)
+    parser.add_argument("--float32", action="store_true", help="Use single precision instead of double precision")
+    args = parser.parse_args()
+
+    jax.config.update("jax_enable_x64", not args.float32)
+    if args.config:
+        _, config = Configuration.load_configuration_file(args.config)
+    else:
+        config = Configuration(physical=None)
+    benchmark_laplacian(config, args.n_el, args.methods, args.n_walkers, args.n_reps)
@@ -0,0 +1,185 @@
+"""
+MCMC efficiency benchmark: Compares the proposal functions of MetropolisHastingsMonteCarlo by effective samples per wall-second.
+
+The sampled density is either the wavefunction of a trained checkpoint or the baseline (HF/CASSCF) wavefunction of a list of molecules.
+For each molecule and proposal, the walkers are burned in and then advanced by a fixed number of MCMC steps per sample. The local energy
+of every walker is recorded after each sample to estimate its integrated autocorrelation time tau (in samples), so that the effective
+number of samples is n_walkers * n_samples / tau. Only the time spent in MCMC steps is counted as wall time.
+"""
+import json
+import logging
+import time
+from typing import Dict, List, Any, Optional
+
+import jax
+import numpy as np
+
+from deeperwin.configuration import Configuration, MCMCConfigOptimization, MCMCSimpleProposalConfig, MCMCLangevinProposalConfig, \
+    LocalStepsizeProposalConfig, LocalEnergyConfig
+
+LOGGER = logging.getLogger("dpe")
+
+PROPOSALS = {
+    "normal": MCMCSimpleProposalConfig(name="normal"),
+    "cauchy": MCMCSimpleProposalConfig(name="cauchy"),
+    "langevin": MCMCLangevinProposalConfig(),
+    "local": LocalStepsizeProposalConfig(name="local"),
+    "normal_one_el": MCMCSimpleProposalConfig(name="normal_one_el"),
+    "local_one_el": LocalStepsizeProposalConfig(name="local_one_el"),
+}
+
+
+def get_integrated_autocorrelation_time(x: np.ndarray, c: float = 5.0) -> float:
+    """
+    Integrated autocorrelation time of a set of chains x [n_samples x n_chains], using Sokal's automatic windowing.
+
+    The normalized autocorrelation function is averaged over all chains and summed up to the smallest window M with M >= c * tau(M).
+    """
+    x = x - np.mean(x, axis=0)
+    n_samples = x.shape[0]
+    # Autocorrelation of all chains at once via FFT (zero-padded to avoid circular correlations)
+    f = np.fft.rfft(x, n=2 * n_samples, axis=0)
+    acf = np.fft.irfft(f * np.conj(f), axis=0)[:n_samples]
+    acf = np.mean(acf, axis=1)
+    if acf[0] <= 0:
+        return 1.0
+    rho = acf / acf[0]
+    tau = 2 * np.cumsum(rho) - 1
+    window = np.arange(n_samples) >= c * tau
+    M = np.argmax(window) if np.any(window) else n_samples - 1
+    return float(max(tau[M], 1.0))
+
+
+def load_wavefunction_from_checkpoint(fname: str, rng_seed: int = 0):
+    """Returns (config, log_psi_sqr, cache_func, params, fixed_params) of a trained single-geometry checkpoint"""
+    from deeperwin.checkpoints import load_run
+    from deeperwin.model import build_log_psi_squared
+    from deeperwin.orbitals import get_n_basis_per_Z
+
+    data = load_run(fname, parts=["config", "params", "fixed_params"])
+    config = data.config
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(config.physical.Z))
+    log_psi_sqr, _, cache_func, _, fixed_params = build_log_psi_squared(config.model, config.physical, data.fixed_params, rng_seed, None,
+                                                                        None, nb_orbitals_per_Z)
+    params = jax.tree_util.tree_map(jax.numpy.array, data.params)
+    return config, log_psi_sqr, cache_func, params, fixed_params
+
+
+def build_baseline_wavefunction(molecule: str):
+    """Returns (config, log_psi_sqr, cache_func, params, fixed_params) of the baseline (HF/CASSCF) wavefunction of a molecule"""
+    from deeperwin.model import init_model_fixed_params
+    from deeperwin.model.wavefunction import build_log_psi_squared_baseline
+    from deeperwin.run_tools.benchmark import ORBITALS
+
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name=molecule)), ORBITALS["baseline"])
+    fixed_params = init_model_fixed_params(config.model, config.physical, None, None)
+    return config, build_log_psi_squared_baseline(config.model.orbitals.determinant_schema), None, {}, fixed_params
+
+
+def benchmark_proposal(log_psi_sqr, cache_func, params, fixed_params, config: Configuration, proposal: str, n_walkers: int,
+                       n_burn_in: int, n_samples: int, n_steps_per_sample: int, rng_seed: int = 0) -> Dict[str, Any]:
+    from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+    from deeperwin.hamiltonian import build_local_energy_func
+    from deeperwin.optimization.opt_utils import _run_mcmc_with_cache
+    from deeperwin.utils.utils import replicate_across_devices
+
+    phys_config = config.physical
+    n_up, n_dn = phys_config.n_up, phys_config.n_dn
+    mcmc_config = MCMCConfigOptimization(proposal=PROPOSALS[proposal], n_walkers=n_walkers, n_burn_in=n_burn_in,
+                                         n_inter_steps=n_steps_per_sample)
+    mcmc = MetropolisHastingsMonteCarlo(mcmc_config, determinant_schema=config.model.orbitals.determinant_schema)
+    mcmc_state = MCMCState.initialize_around_nuclei(n_walkers, phys_config, mcmc_config.initialization, jax.random.PRNGKey(rng_seed))
+    params, fixed_params = replicate_across_devices((params, fixed_params))
+    mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, (n_up, n_dn), mcmc_state, fixed_params,
+                                                    split_mcmc=True, merge_mcmc=False, mode="burnin")
+
+    local_energy_func = build_local_energy_func(LocalEnergyConfig())
+    get_local_energy = jax.pmap(lambda p, r, R, Z, fp: local_energy_func(log_psi_sqr, p, (n_up, n_dn), r, R, Z, fp)[0],
+                                axis_name="devices")
+    # Compile the inter-steps before timing them
+    jax.block_until_ready(mcmc.run_inter_steps(log_psi_sqr, mcmc_state, params, n_up, n_dn, fixed_params))
+
+    E_loc, acc_rate = [], []
+    t_mcmc = 0.0
+    for _ in range(n_samples):
+        t_start = time.perf_counter()
+        mcmc_state = jax.block_until_ready(mcmc.run_inter_steps(log_psi_sqr, mcmc_state, params, n_up, n_dn, fixed_params))
+        t_mcmc += time.perf_counter() - t_start
+        E_loc.append(np.asarray(get_local_energy(params, *mcmc_state.build_batch(fixed_params))).reshape(-1))
+        acc_rate.append(float(mcmc_state.acc_rate[0]))
+
+    E_loc = np.stack(E_loc, axis=0)  # [n_samples x n_walkers]
+    E_loc = E_loc[:, np.all(np.isfinite(E_loc), axis=0)]
+    tau = get_integrated_autocorrelation_time(E_loc)
+    n_effective = E_loc.shape[1] * n_samples / tau
+    return dict(proposal=proposal,
+                molecule=phys_config.name,
+                n_el=phys_config.n_electrons,
+                n_walkers=n_walkers,
+                n_steps_per_sample=n_steps_per_sample,
+                acceptance_rate=float(np.mean(acc_rate)),
+                stepsize=float(np.asarray(mcmc_state.stepsize).reshape(-1)[0]),
+                tau_samples=tau,
+                tau_steps=tau * n_steps_per_sample,
+                E_mean=float(np.mean(E_loc)),
+                t_per_step=t_mcmc / (n_samples * n_steps_per_sample),
+                effective_samples_per_sec=n_effective / t_mcmc)
+
+
+def run_mcmc_benchmark(proposals: List[str], molecules: Optional[List[str]] = None, checkpoint: Optional[str] = None, n_walkers: int = 256,
+                       n_burn_in: int = 500, n_samples: int = 200, n_steps_per_sample: int = 1, rng_seed: int = 0) -> Dict:
+    """Benchmarks every proposal for the trained wavefunction of a checkpoint or, if no checkpoint is given, the baseline wavefunction of each molecule"""
+    if checkpoint:
+        wavefunctions = [load_wavefunction_from_checkpoint(checkpoint, rng_seed)]
+    else:
+        wavefunctions = [build_baseline_wavefunction(m) for m in molecules]
+
+    results = []
+    for config, log_psi_sqr, cache_func, params, fixed_params in wavefunctions:
+        for proposal in proposals:
+            try:
+                record = benchmark_proposal(log_psi_sqr, cache_func, params, dict(fixed_params), config, proposal, n_walkers, n_burn_in,
+                                            n_samples, n_steps_per_sample, rng_seed)
+            except Exception as e:
+                record = dict(proposal=proposal, molecule=config.physical.name, n_el=config.physical.n_electrons, error=repr(e))
+            results.append(record)
+            LOGGER.info(json.dumps(record))
+
+    from deeperwin.run_tools.benchmark import get_benchmark_metadata
+    metadata = dict(get_benchmark_metadata(), checkpoint=checkpoint, n_walkers=n_walkers, n_burn_in=n_burn_in, n_samples=n_samples,
+                    n_steps_per_sample=n_steps_per_sample)
+    return dict(metadata=metadata, results=results)
+
+
+def format_mcmc_report(results: List[Dict]) -> str:
+    """Markdown report with one table per molecule (sorted by size), ranking the proposals by effective samples per second"""
+    lines = ["# MCMC proposal comparison", ""]
+    molecules = sorted({(r["n_el"], r["molecule"] or "") for r in results})
+    for n_el, molecule in molecules:
+        records = [r for r in results if (r["n_el"] == n_el) and ((r["molecule"] or "") == molecule)]
+        records = sorted(records, key=lambda r: -r.get("effective_samples_per_sec", -1))
+        best = records[0].get("effective_samples_per_sec")
+        lines += [f"## {molecule} ({n_el} electrons)", "",
+                  "| proposal | acceptance | tau [steps] | t / step [ms] | eff. samples / s | relative |",
+                  "|---|---|---|---|---|---|"]
+        for r in records:
+            if "error" in r:
+                lines.append(f"| {r['proposal']} | failed: {r['error']} | | | | |")
+                continue
+            lines.append(f"| {r['proposal']} | {r['acceptance_rate']:.3f} | {r['tau_steps']:.1f} | {1e3 * r['t_per_step']:.3f} | "
+                         f"{r['effective_samples_per_sec']:.1f} | {r['effective_samples_per_sec'] / best:.2f} |")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    jax.config.update("jax_enable_x64", args.float64)
+    results = run_mcmc_benchmark(args.proposals, args.molecules, args.checkpoint, args.n_walkers, args.n_burn_in, args.n_samples,
+                                 args.n_steps_per_sample)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    report = format_mcmc_report(results["results"])
+    with open(args.report, "w") as f:
+        f.write(report)
+    print(report)
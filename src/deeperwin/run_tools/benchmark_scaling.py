@@ -0,0 +1,194 @@
+"""
+End-to-end scaling benchmark of the data-parallel optimization over the number of (local) devices and walkers.
+
+Each point of the sweep runs a short optimization with a fixed seed in a separate process, because the number of devices can only be
+set before jax is initialized. On CPU, devices are emulated using XLA's --xla_force_host_platform_device_count (i.e. force_device_count).
+Besides the throughput of the optimization, the cost of the host-side data movement between devices (split_across_devices,
+merge_devices and replicate_across_devices) is measured separately.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Any
+
+import jax
+
+from deeperwin.configuration import Configuration
+
+LOGGER = logging.getLogger("dpe")
+RESULT_PREFIX = "BENCHMARK_RESULT:"
+
+
+def _time_call(func, *args, n_reps=3):
+    jax.block_until_ready(func(*args))
+    t_start = time.perf_counter()
+    for _ in range(n_reps):
+        jax.block_until_ready(func(*args))
+    return (time.perf_counter() - t_start) / n_reps
+
+
+def run_scaling_point(config: Configuration, n_epochs: int, n_warmup_epochs: int) -> Dict[str, float]:
+    """Runs burn-in, n_warmup_epochs (incl. compilation) and n_epochs timed optimization epochs in the current process"""
+    from deeperwin.model import build_log_psi_squared
+    from deeperwin.orbitals import get_n_basis_per_Z
+    from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+    from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+    from deeperwin.optimization.opt_utils import _run_mcmc_with_cache
+    from deeperwin.optimizers import build_optimizer
+    from deeperwin.utils.utils import replicate_across_devices
+
+    opt_config = config.optimization
+    phys_config = config.physical
+    rng_seed = config.computation.rng_seed
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, rng_seed, None, None, nb_orbitals_per_Z
+    )
+    rng_mcmc, rng_opt = jax.random.split(jax.random.PRNGKey(rng_seed), 2)
+    mcmc = MetropolisHastingsMonteCarlo(opt_config.mcmc, determinant_schema=config.model.orbitals.determinant_schema)
+    mcmc_state = MCMCState.initialize_around_nuclei(opt_config.mcmc.n_walkers, phys_config, opt_config.mcmc.initialization, rng_mcmc)
+
+    # Host-side data movement between devices
+    t_replicate = _time_call(replicate_across_devices, (params, fixed_params))
+    t_split = _time_call(lambda s: s.split_across_devices(), mcmc_state)
+    mcmc_state_split = mcmc_state.split_across_devices()
+    t_merge = _time_call(lambda s: s.merge_devices(), mcmc_state_split)
+
+    params, fixed_params, clipping_state, rng_opt = replicate_across_devices((params, fixed_params, init_clipping_state(), rng_opt))
+    mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state, fixed_params,
+                                                    split_mcmc=True, merge_mcmc=False, mode="burnin")
+    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_sqr, opt_config.clipping, opt_config.local_energy),
+                                opt_config=opt_config.optimizer,
+                                value_func_has_aux=True,
+                                value_func_has_state=True,
+                                log_psi_squared_func=log_psi_sqr)
+    opt_state = optimizer.init(params=params, rng=rng_opt, batch=mcmc_state.build_batch(fixed_params), static_args=spin_state,
+                               func_state=clipping_state)
+
+    def _run_epochs(n, params, opt_state, clipping_state, mcmc_state, fixed_params):
+        for _ in range(n):
+            mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state, fixed_params,
+                                                            split_mcmc=False, merge_mcmc=False, mode="intersteps")
+            params, opt_state, clipping_state, _ = optimizer.step(params=params, state=opt_state, static_args=spin_state, rng=rng_opt,
+                                                                  batch=mcmc_state.build_batch(fixed_params), func_state=clipping_state)
+        jax.block_until_ready((params, mcmc_state.r))
+        return params, opt_state, clipping_state, mcmc_state, fixed_params
+
+    t_start = time.perf_counter()
+    state = _run_epochs(n_warmup_epochs, params, opt_state, clipping_state, mcmc_state, fixed_params)
+    t_warmup = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    _run_epochs(n_epochs, *state)
+    t_epochs = time.perf_counter() - t_start
+
+    epochs_per_sec = n_epochs / t_epochs
+    n_walkers = opt_config.mcmc.n_walkers
+    return dict(n_devices=jax.device_count(),
+                n_walkers=n_walkers,
+                t_warmup=t_warmup,
+                epochs_per_sec=epochs_per_sec,
+                walker_steps_per_sec=epochs_per_sec * n_walkers * opt_config.mcmc.n_inter_steps,
+                local_energies_per_sec=epochs_per_sec * n_walkers,
+                t_replicate=t_replicate,
+                t_split=t_split,
+                t_merge=t_merge)
+
+
+def _run_point_in_subprocess(config_file: str, n_devices: int, n_walkers: int, n_epochs: int, n_warmup_epochs: int,
+                             config_changes: Dict[str, Any]) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env["JAX_PLATFORMS"] = "cpu"
+    env["XLA_FLAGS"] = f"{env.get('XLA_FLAGS', '')} --xla_force_host_platform_device_count={n_devices}".strip()
+    cmd = [sys.executable, "-m", "deeperwin.run_tools.benchmark_scaling", config_file,
+           "--n-devices", str(n_devices), "--n-walkers", str(n_walkers), "--n-epochs", str(n_epochs),
+           "--n-warmup-epochs", str(n_warmup_epochs), "--config-changes", json.dumps(config_changes)]
+    r = subprocess.run(cmd, env=env, capture_output=True, encoding="utf-8")
+    for line in r.stdout.splitlines()[::-1]:
+        if line.startswith(RESULT_PREFIX):
+            return json.loads(line[len(RESULT_PREFIX):])
+    return dict(n_devices=n_devices, n_walkers=n_walkers, error=(r.stderr.strip().splitlines() or ["unknown error"])[-1])
+
+
+def run_scaling_benchmark(config_file: str, n_devices: List[int], n_walkers: List[int], n_epochs: int = 20,
+                          n_warmup_epochs: int = 3, config_changes: Dict[str, Any] = None) -> Dict:
+    """
+    Runs a short optimization for every combination of device count and walker count, each in its own process.
+
+    Speed-up and parallel efficiency of each point are computed relative to the smallest device count with the same number of walkers.
+    """
+    results = []
+    for n_w in n_walkers:
+        for n_dev in sorted(n_devices):
+            if n_w % n_dev != 0:
+                LOGGER.warning(f"Skipping n_devices={n_dev}, n_walkers={n_w}: walkers are not evenly divisible across devices")
+                continue
+            record = _run_point_in_subprocess(config_file, n_dev, n_w, n_epochs, n_warmup_epochs, config_changes or {})
+            results.append(record)
+            LOGGER.info(format_scaling_table([record], header=(len(results) == 1)))
+
+    for record in results:
+        reference = next((r for r in results if (r["n_walkers"] == record["n_walkers"]) and ("error" not in r)), None)
+        if ("error" in record) or (reference is None):
+            continue
+        record["speedup"] = record["epochs_per_sec"] / reference["epochs_per_sec"]
+        record["parallel_efficiency"] = record["speedup"] * reference["n_devices"] / record["n_devices"]
+
+    from deeperwin.run_tools.benchmark import get_benchmark_metadata
+    return dict(metadata=dict(get_benchmark_metadata(), config_file=config_file, n_epochs=n_epochs, n_warmup_epochs=n_warmup_epochs),
+                results=results)
+
+
+def format_scaling_table(results: List[Dict], header=True) -> str:
+    columns = [("n_devices", "{:>9d}"), ("n_walkers", "{:>9d}"), ("epochs_per_sec", "{:>14.3f}"), ("walker_steps_per_sec", "{:>20.0f}"),
+               ("local_energies_per_sec", "{:>22.0f}"), ("t_split", "{:>9.2e}"), ("t_merge", "{:>9.2e}"), ("t_replicate", "{:>11.2e}"),
+               ("speedup", "{:>7.2f}"), ("parallel_efficiency", "{:>19.2f}")]
+    lines = [" ".join([f"{name:>{len(fmt.format(0))}}" for name, fmt in columns])] if header else []
+    for r in results:
+        if "error" in r:
+            lines.append(f"{r['n_devices']:>9d} {r['n_walkers']:>9d} FAILED: {r['error']}")
+            continue
+        lines.append(" ".join([fmt.format(r[name]) if name in r else " " * len(fmt.format(0)) for name, fmt in columns]))
+    return "\n".join(lines)
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = run_scaling_benchmark(args.config_file, args.n_devices, args.n_walkers, args.n_epochs, args.n_warmup_epochs)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(format_scaling_table(results["results"]))
+    LOGGER.info(f"Scaling benchmark written to {args.output}")
+
+
+def _worker_main():
+    """Runs a single point of the sweep; called by _run_point_in_subprocess with the device count already set in XLA_FLAGS"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file")
+    parser.add_argument("--n-devices", type=int, required=True)
+    parser.add_argument("--n-walkers", type=int, required=True)
+    parser.add_argument("--n-epochs", type=int, required=True)
+    parser.add_argument("--n-warmup-epochs", type=int, required=True)
+    parser.add_argument("--config-changes", default="{}")
+    args = parser.parse_args()
+
+    raw_config, _ = Configuration.load_configuration_file(args.config_file)
+    changes = {"computation.n_local_devices": args.n_devices,
+               "computation.force_device_count": True,
+               "computation.rng_seed": 0,
+               "optimization.mcmc.n_walkers": args.n_walkers}
+    changes.update(json.loads(args.config_changes))
+    _, config = Configuration.update_configdict_and_validate(raw_config, changes)
+    jax.config.update("jax_enable_x64", config.computation.float_precision == "float64")
+    assert jax.device_count() == args.n_devices, f"Expected {args.n_devices} devices, but found {jax.device_count()}"
+
+    result = run_scaling_point(config, args.n_epochs, args.n_warmup_epochs)
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+
+
+if __name__ == '__main__':
+    _worker_main()
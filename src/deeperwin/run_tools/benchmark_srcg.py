@@ -0,0 +1,158 @@
+"""
+Benchmark of the CG options of the SRCG optimizer: wall time per optimizer step and energy convergence.
+
+For each variant (see get_srcg_variants), the same short optimization (same config, same seed) is run with the SRCG optimizer.
+Variants differ only in the relative residual tolerance of CG (cg_tol=0 always runs maxiter iterations) and the dtype of the Fisher
+matrix-vector products. MCMC and the optimizer step are timed separately, so that t_opt_step reflects the cost of the solver.
+"""
+import json
+import logging
+import time
+from typing import Dict, List, Any, Optional
+
+import jax
+import numpy as np
+
+from deeperwin.configuration import Configuration
+
+LOGGER = logging.getLogger("dpe")
+
+
+def get_srcg_variants(cg_tol: float, fisher_matmul_dtype: Optional[str] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Config changes of each benchmarked variant, relative to the SRCG optimizer config of the benchmarked config file.
+    The low-precision variants are only available if a fisher_matmul_dtype is given.
+    """
+    variants = {
+        "maxiter": {"optimization.optimizer.cg_tol": 0.0, "optimization.optimizer.fisher_matmul_dtype": None},
+        "tol": {"optimization.optimizer.cg_tol": cg_tol, "optimization.optimizer.fisher_matmul_dtype": None},
+    }
+    if fisher_matmul_dtype is not None:
+        variants["low_precision"] = {"optimization.optimizer.cg_tol": 0.0, "optimization.optimizer.fisher_matmul_dtype": fisher_matmul_dtype}
+        variants["tol_low_precision"] = {"optimization.optimizer.cg_tol": cg_tol,
+                                         "optimization.optimizer.fisher_matmul_dtype": fisher_matmul_dtype}
+    return variants
+
+
+def run_srcg_optimization(config: Configuration, n_epochs: int, n_warmup_epochs: int) -> Dict[str, Any]:
+    """Runs burn-in and n_epochs optimization epochs, recording the energy, CG statistics and timings of every epoch"""
+    from deeperwin.model import build_log_psi_squared
+    from deeperwin.orbitals import get_n_basis_per_Z
+    from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+    from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+    from deeperwin.optimization.opt_utils import _run_mcmc_with_cache
+    from deeperwin.optimizers import build_optimizer
+    from deeperwin.utils.utils import replicate_across_devices
+
+    jax.config.update("jax_enable_x64", config.computation.float_precision == "float64")
+    opt_config = config.optimization
+    phys_config = config.physical
+    rng_seed = config.computation.rng_seed
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, rng_seed, None, None, nb_orbitals_per_Z
+    )
+    rng_mcmc, rng_opt = jax.random.split(jax.random.PRNGKey(rng_seed), 2)
+    mcmc = MetropolisHastingsMonteCarlo(opt_config.mcmc, determinant_schema=config.model.orbitals.determinant_schema)
+    mcmc_state = MCMCState.initialize_around_nuclei(opt_config.mcmc.n_walkers, phys_config, opt_config.mcmc.initialization, rng_mcmc)
+    params, fixed_params, clipping_state, rng_opt = replicate_across_devices((params, fixed_params, init_clipping_state(), rng_opt))
+    mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state, fixed_params,
+                                                    split_mcmc=True, merge_mcmc=False, mode="burnin")
+    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_sqr, opt_config.clipping, opt_config.local_energy),
+                                opt_config=opt_config.optimizer,
+                                value_func_has_aux=True,
+                                value_func_has_state=True,
+                                log_psi_squared_func=log_psi_sqr)
+    opt_state = optimizer.init(params=params, rng=rng_opt, batch=mcmc_state.build_batch(fixed_params), static_args=spin_state,
+                               func_state=clipping_state)
+
+    history = dict(E_mean=[], cg_n_iterations=[], cg_residual=[], t_mcmc=[], t_opt_step=[])
+    for _ in range(n_epochs):
+        t_start = time.perf_counter()
+        mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state, fixed_params,
+                                                        split_mcmc=False, merge_mcmc=False, mode="intersteps")
+        jax.block_until_ready(mcmc_state.r)
+        t_mcmc = time.perf_counter()
+        params, opt_state, clipping_state, stats = optimizer.step(params=params, state=opt_state, static_args=spin_state, rng=rng_opt,
+                                                                  batch=mcmc_state.build_batch(fixed_params), func_state=clipping_state)
+        jax.block_until_ready((params, stats))
+        t_opt_step = time.perf_counter()
+        history["t_mcmc"].append(t_mcmc - t_start)
+        history["t_opt_step"].append(t_opt_step - t_mcmc)
+        history["E_mean"].append(float(stats["aux"]["E_mean"][0]))
+        history["cg_n_iterations"].append(int(stats["cg_n_iterations"][0]) if "cg_n_iterations" in stats else None)
+        history["cg_residual"].append(float(stats["cg_residual"][0]) if "cg_residual" in stats else None)
+
+    timed = slice(n_warmup_epochs, None)
+    n_final = max(n_epochs // 5, 1)
+    cg_n_iterations = [n for n in history["cg_n_iterations"][timed] if n is not None]
+    return dict(t_opt_step=float(np.mean(history["t_opt_step"][timed])),
+                t_mcmc=float(np.mean(history["t_mcmc"][timed])),
+                t_compile=max(history["t_opt_step"][0] - float(np.mean(history["t_opt_step"][timed])), 0.0),
+                E_final=float(np.nanmean(history["E_mean"][-n_final:])),
+                cg_n_iterations=float(np.mean(cg_n_iterations)) if cg_n_iterations else None,
+                history=history)
+
+
+def run_srcg_benchmark(config_file: str, variants: List[str], n_epochs: int = 200, n_warmup_epochs: int = 3, cg_tol: float = 1e-3,
+                       fisher_matmul_dtype: Optional[str] = None, config_changes: Optional[Dict[str, Any]] = None) -> Dict:
+    """
+    Runs the same optimization for each SRCG variant. The config file must use the srcg optimizer.
+
+    Speed-up is relative to the first variant; E_final is the mean energy over the last 20% of epochs.
+    """
+    all_variants = get_srcg_variants(cg_tol, fisher_matmul_dtype)
+    unknown_variants = [v for v in variants if v not in all_variants]
+    if unknown_variants:
+        raise ValueError(f"Unknown or unavailable SRCG variants {unknown_variants}; available: {list(all_variants)}. "
+                         f"Low-precision variants require an explicit fisher_matmul_dtype")
+    raw_config, _ = Configuration.load_configuration_file(config_file)
+    results = []
+    for variant in variants:
+        changes = {"computation.rng_seed": 0}
+        changes.update(config_changes or {})
+        changes.update(all_variants[variant])
+        record = dict(variant=variant, cg_tol=changes["optimization.optimizer.cg_tol"],
+                      fisher_matmul_dtype=changes["optimization.optimizer.fisher_matmul_dtype"])
+        try:
+            _, config = Configuration.update_configdict_and_validate(raw_config, changes)
+            assert config.optimization.optimizer.name == "srcg", "The benchmarked config must use the srcg optimizer"
+            record.update(run_srcg_optimization(config, n_epochs, n_warmup_epochs))
+        except Exception as e:
+            record["error"] = repr(e)
+        results.append(record)
+        LOGGER.info(format_srcg_table([record], header=(len(results) == 1)))
+
+    reference = next((r for r in results if "error" not in r), None)
+    for record in results:
+        if ("error" not in record) and (reference is not None):
+            record["speedup"] = reference["t_opt_step"] / record["t_opt_step"]
+            record["delta_E_final"] = record["E_final"] - reference["E_final"]
+
+    from deeperwin.run_tools.benchmark import get_benchmark_metadata
+    metadata = dict(get_benchmark_metadata(), config_file=config_file, n_epochs=n_epochs, n_warmup_epochs=n_warmup_epochs)
+    return dict(metadata=metadata, results=results)
+
+
+def format_srcg_table(results: List[Dict], header=True) -> str:
+    columns = [("variant", "{:>17s}"), ("t_opt_step", "{:>10.4f}"), ("t_mcmc", "{:>8.4f}"), ("cg_n_iterations", "{:>15.1f}"),
+               ("E_final", "{:>12.5f}"), ("delta_E_final", "{:>13.5f}"), ("speedup", "{:>7.2f}")]
+    lines = [" ".join([f"{name:>{len(fmt.format('' if 's' in fmt else 0))}}" for name, fmt in columns])] if header else []
+    for r in results:
+        if "error" in r:
+            lines.append(f"{r['variant']:>17s} FAILED: {r['error']}")
+            continue
+        lines.append(" ".join([fmt.format(r[name]) if r.get(name) is not None else " " * len(fmt.format('' if 's' in fmt else 0))
+                               for name, fmt in columns]))
+    return "\n".join(lines)
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = run_srcg_benchmark(args.config_file, args.variants, args.n_epochs, args.n_warmup_epochs, args.cg_tol,
+                                 args.fisher_matmul_dtype)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(format_srcg_table(results["results"]))
+    LOGGER.info(f"SRCG benchmark written to {args.output}")
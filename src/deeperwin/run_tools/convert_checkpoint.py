@@ -61,6 +61,16 @@ def convert_checkpoint(fname_in, fname_out,
     zf_in.close()
     zf_out.close()
 
+def convert_checkpoint_format(fname_in, fname_out, checkpoint_format="tensors", compression=None):
+    """
+    Re-writes a checkpoint (of any format) in the given checkpoint format, e.g. to convert old pickle-checkpoints to tensors.
+    The rows of the run's history file, which the checkpoint references, are copied into the new checkpoint.
+    """
+    from deeperwin.checkpoints import load_run, save_run, load_history_reference
+    data = load_run(fname_in, parse_config=False, load_pkl=True, mmap=False)
+    data.history = load_history_reference(fname_in)
+    save_run(fname_out, data, checkpoint_format, compression, embed_history=True)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-file", type=str, required=True, default=".")
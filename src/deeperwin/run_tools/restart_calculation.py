@@ -15,7 +15,7 @@ def _get_last_checkpoint(directory):
         full_fname = directory.joinpath(fname)
         if not full_fname.is_file():
             continue
-        match = re.match(R'chkpt(\d+).zip', fname)
+        match = re.match(R'chkpt(\d+)\.zip$', fname)
         if match and (n := int(match.group(1))) >= latest_epoch:
             latest_epoch = n
             latest_chkpt = str(full_fname.absolute())
@@ -23,7 +23,7 @@ def _get_last_checkpoint(directory):
 
 
 def _create_restart_config(chkpt_fname: str, n_epochs_done: int):
-    chkpt_data = load_run(chkpt_fname, parse_config=True, load_pkl=False)
+    chkpt_data = load_run(chkpt_fname, parse_config=True, parts=["config"])
     restart_config = chkpt_data.config
 
     n_epochs_remaining = restart_config.optimization.n_epochs_prev + restart_config.optimization.n_epochs - n_epochs_done
@@ -348,7 +348,7 @@ def train_phisnet(config_file):
 
     if config.load_checkpoint:
         root_logger.info(f"Loading checkpoint {config.load_checkpoint}")
-        checkpoint_data = load_run(config.load_checkpoint, parse_config=False, parse_csv=False, load_pkl=True)
+        checkpoint_data = load_run(config.load_checkpoint, parts=["params"])
         assert hk.data_structures.tree_size(checkpoint_data.params) == hk.data_structures.tree_size(params), "Number of parameters don't match: checkpoint: {}, model: {}".format(
             hk.data_structures.tree_size(checkpoint_data.params), hk.data_structures.tree_size(params)
         )
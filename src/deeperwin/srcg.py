@@ -1,12 +1,53 @@
 import jax
 import jax.numpy as jnp
-import jax.scipy.sparse.linalg
+import jax.scipy.linalg
+from jax.flatten_util import ravel_pytree
 from typing import Any, Callable, Optional, Tuple, Union
 from deeperwin.configuration import SRCGOptimizerConfig
+from deeperwin.hamiltonian import map_over_walker_chunks
+from deeperwin.model.mlp import dense_layers_in_dtype
 from deeperwin.optimization.opt_utils import build_optax_optimizer, build_lr_schedule
-from deeperwin.utils.utils import pmap, pmean, tree_dot, tree_norm
+from deeperwin.utils.utils import pmap, pmean, tree_dot, tree_norm, without_cache
 import optax
 
+
+def conjugate_gradient(matmul: Callable, b, x0, maxiter: int, tol: float = 1e-5, M: Optional[Callable] = None):
+    """
+    Preconditioned conjugate gradients for pytrees, stopping once |b - A x| <= tol * |b| or after maxiter iterations.
+
+    Same iteration and stopping criterion as jax.scipy.sparse.linalg.cg, but additionally returns the number of iterations and the
+    final relative residual.
+
+    Returns:
+        Tuple (x, n_iterations, relative_residual)
+    """
+    M = M or (lambda x: x)
+    b_norm = tree_norm(b)
+
+    def _axpy(a, x, y):
+        return jax.tree_util.tree_map(lambda x_, y_: a * x_ + y_, x, y)
+
+    def cond_fun(state):
+        x, r, p, rz, k = state
+        return (k < maxiter) & (tree_norm(r) > tol * b_norm)
+
+    def body_fun(state):
+        x, r, p, rz, k = state
+        Ap = matmul(p)
+        alpha = rz / tree_dot(p, Ap)
+        x = _axpy(alpha, p, x)
+        r = _axpy(-alpha, Ap, r)
+        z = M(r)
+        rz_new = tree_dot(r, z)
+        p = _axpy(rz_new / rz, p, z)
+        return x, r, p, rz_new, k + 1
+
+    r0 = jax.tree_util.tree_map(jnp.subtract, b, matmul(x0))
+    z0 = M(r0)
+    x, r, _, _, n_iter = jax.lax.while_loop(cond_fun, body_fun, (x0, r0, z0, tree_dot(r0, z0), 0))
+    return x, n_iter, tree_norm(r) / b_norm
+
+
 class SRCGOptimizer():
     def __init__(
         self,
@@ -54,6 +95,7 @@ class SRCGOptimizer():
     def _get_gradient_variance_preconditioner(self, params, mean_grads, last_variance, damping, static_args, batch):
         """Compute the diagonal of S (which corresponds to the variance of the gradients) and use its inverse as a preconditioner."""
         r, R, Z, fixed_params = batch
+        fixed_params = without_cache(fixed_params)
         batch_size = r.shape[0]
         n_subbatches = batch_size // self.config.preconditioner_batch_size
         r_batches = r.reshape((n_subbatches, self.config.preconditioner_batch_size, -1, 3))
@@ -77,7 +119,54 @@ class SRCGOptimizer():
         def precond(x):
             return jax.tree_util.tree_map(lambda x_, v: x_ / (v + damping), x, variance)
         return precond, variance
-        
+
+    def _get_jacobian(self, params, static_args, batch):
+        """Per-sample gradients of log(psi) w.r.t. all params, flattened to a matrix [batch_size x n_params]"""
+        r, R, Z, fixed_params = batch
+        fixed_params = without_cache(fixed_params)
+
+        def flat_grad(r_):
+            grad = jax.grad(lambda p: self.log_psi_squared(p, *static_args, r_, R, Z, fixed_params) / 2)(params)
+            return ravel_pytree(grad)[0]
+        return map_over_walker_chunks(jax.vmap(flat_grad), self.config.jacobian_chunk_size, r)
+
+    def _solve_woodbury(self, params, loss_grads, damping, static_args, batch):
+        """
+        Solves (O^T O + damping * I) x = g in sample space, where O [n_samples x n_params] is the (centered) Jacobian of log(psi)
+        of all walkers across all devices, scaled by 1/sqrt(n_samples). By the Woodbury identity:
+            x = (g - O^T (O O^T + damping * I)^-1 O g) / damping
+        Each device only holds its own rows of O. The blocks of the kernel O O^T are computed by passing the local Jacobians around
+        the ring of devices, so that only the [n_samples x n_samples] kernel (and no full Jacobian) is gathered on every device.
+        O g and the back-projection O^T y are computed from the local rows and reduced across devices.
+        """
+        jac = self._get_jacobian(params, static_args, batch)
+        n_local = jac.shape[0]
+        n_devices = jax.lax.psum(1, axis_name="devices")
+        n_samples_total = n_local * n_devices
+        if self.config.center_gradients:
+            jac = jac - pmean(jnp.mean(jac, axis=0))
+        jac = jac / jnp.sqrt(n_samples_total)
+
+        # Block k holds jac_d @ jac_(d-k)^T, where d is the index of this device
+        device_index = jax.lax.axis_index("devices")
+        ring = [(i, (i + 1) % n_devices) for i in range(n_devices)]
+        jac_other = jac
+        blocks = [jac @ jac.T]
+        for _ in range(n_devices - 1):
+            jac_other = jax.lax.ppermute(jac_other, axis_name="devices", perm=ring)
+            blocks.append(jac @ jac_other.T)
+        blocks = jnp.stack(blocks)[(device_index - jnp.arange(n_devices)) % n_devices]  # [device of columns x n_local x n_local]
+        kernel_rows = jnp.transpose(blocks, (1, 0, 2)).reshape((n_local, n_samples_total))
+        kernel = jax.lax.all_gather(kernel_rows, axis_name="devices").reshape((n_samples_total, n_samples_total))
+        kernel = kernel + damping * jnp.eye(n_samples_total, dtype=kernel.dtype)
+
+        grad_flat, unravel = ravel_pytree(loss_grads)
+        jac_grad = jax.lax.all_gather(jac @ grad_flat, axis_name="devices").reshape((n_samples_total,))
+        y = jax.scipy.linalg.cho_solve(jax.scipy.linalg.cho_factor(kernel), jac_grad)
+        y_local = jax.lax.dynamic_slice(y, (device_index * n_local,), (n_local,))
+        nat_grad = (grad_flat - jax.lax.psum(jac.T @ y_local, axis_name="devices")) / damping
+        return unravel(nat_grad)
+
 
     def _step(
             self,
@@ -97,22 +186,36 @@ class SRCGOptimizer():
         internal_opt_state, previous_nat_grad, preconditioner_state, step_count = opt_state
         damping = self.damping(step_count)
         batch_size = batch[0].shape[0]
+        # The cache holds param-dependent quantities (e.g. ion embeddings), which must be recomputed to get their derivatives
+        batch_uncached = (*batch[:3], without_cache(batch[3]))
 
-        def log_psi(params): 
-            return self.log_psi_squared(params, *static_args, *batch) / 2
+        def log_psi(params):
+            return self.log_psi_squared(params, *static_args, *batch_uncached) / 2
 
-        if self.config.center_gradients or self.config.preconditioner:
+        if self.config.fisher_matmul_dtype:
+            # Evaluate the dense layers in the JVP/VJP of the Fisher matvecs in reduced precision. The batch (r, R, Z, fixed_params),
+            # all other parameters, determinants and reductions stay in (at least) float32. The casts are part of the traced function,
+            # so tangents and cotangents of the parameters keep the parameter dtype.
+            matmul_dtype = jnp.dtype(self.config.fisher_matmul_dtype)
+            def log_psi_matmul(params):
+                with dense_layers_in_dtype(matmul_dtype):
+                    log_psi_sqr = self.log_psi_squared(params, *static_args, *batch_uncached)
+                return log_psi_sqr.astype(jnp.promote_types(log_psi_sqr.dtype, jnp.float32)) / 2
+        else:
+            log_psi_matmul = log_psi
+
+        if (self.config.solver == "cg") and (self.config.center_gradients or self.config.preconditioner):
             mean_grads = jax.grad(lambda p: jnp.mean(log_psi(p)))(params)
             mean_grads = pmean(mean_grads)
 
-        if self.config.linearize_jvp:
-            jvp_func = jax.linearize(log_psi, params)[1]
+        if self.config.linearize_jvp and (self.config.solver == "cg"):
+            jvp_func = jax.linearize(log_psi_matmul, params)[1]
         else:
-            jvp_func = lambda x: jax.jvp(log_psi, (params,), (x,))[1]
+            jvp_func = lambda x: jax.jvp(log_psi_matmul, (params,), (x,))[1]
         def fisher_matmul(x):
             # Compute 1/batch_size * VJP(log_psi, JVP(log_psi, x))
             log_psi_jac_x = jvp_func(x)
-            update, = jax.vjp(log_psi, params)[1](log_psi_jac_x / batch_size)
+            update, = jax.vjp(log_psi_matmul, params)[1](log_psi_jac_x / batch_size)
             if self.config.center_gradients:
                 # update = update - g * <g, x>
                 innerprod = tree_dot(mean_grads, x)
@@ -127,7 +230,7 @@ class SRCGOptimizer():
         (loss, (new_func_state, aux_metrics)), loss_grads = self.value_and_grad_func(params, func_state, static_args, batch)
         loss_grads = pmean(loss_grads)
 
-        if self.config.preconditioner == "variance":
+        if (self.config.solver == "cg") and (self.config.preconditioner == "variance"):
             preconditioner, preconditioner_state = self._get_gradient_variance_preconditioner(params, mean_grads, preconditioner_state, damping, static_args, batch)
         else:
             preconditioner = None
@@ -140,7 +243,13 @@ class SRCGOptimizer():
             x0 = loss_grads
             
         # Actually solve linear system S * nat_grad = loss_grads
-        nat_grad, _ = jax.scipy.sparse.linalg.cg(fisher_matmul, loss_grads, x0=x0, maxiter=self.config.maxiter, M=preconditioner)
+        solver_stats = {}
+        if self.config.solver == "woodbury":
+            nat_grad = self._solve_woodbury(params, loss_grads, damping, static_args, batch)
+        else:
+            nat_grad, n_iter, residual = conjugate_gradient(fisher_matmul, loss_grads, x0, self.config.maxiter, self.config.cg_tol,
+                                                            preconditioner)
+            solver_stats = dict(cg_n_iterations=n_iter, cg_residual=residual)
         nat_grad = pmean(nat_grad)
 
         # Compute norms for logging
@@ -162,5 +271,6 @@ class SRCGOptimizer():
                      grad_norm = grad_norm,
                      precon_grad_norm=precon_grad_norm,
                      norm_constraint_factor=norm_constraint_factor,
-                     aux=aux_metrics)
+                     aux=aux_metrics,
+                     **solver_stats)
         return params, new_opt_state, new_func_state, stats
\ No newline at end of file
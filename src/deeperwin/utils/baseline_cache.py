@@ -0,0 +1,171 @@
+"""
+Persistent on-disk cache for baseline solutions (e.g. Hartree-Fock / CASSCF orbitals), shared between runs and local processes.
+"""
+import contextlib
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+import time
+from typing import Any, Callable, Optional
+
+from deeperwin.configuration import PhysicalConfig
+from deeperwin.run_tools.geometry_database import Geometry
+
+LOGGER = logging.getLogger("dpe")
+
+# Increase whenever the content of cached results changes, to invalidate all existing entries
+CACHE_VERSION = 1
+
+_baseline_cache: Optional["BaselineCache"] = None
+# Temporary files older than this are left over from crashed processes and are deleted during eviction
+_STALE_TMP_SECONDS = 3600
+
+
+def _try_remove_unused_lock(fname) -> bool:
+    """Removes a lock file, unless it is currently held (or waited for) by another process"""
+    try:
+        with open(fname, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            # A process, which opened the file before it is removed, may still lock the removed file; this can only lead to an
+            # entry being computed twice, which is harmless since entries are replaced atomically
+            os.remove(fname)
+            return True
+    except FileNotFoundError:
+        return False
+
+
+@contextlib.contextmanager
+def _file_lock(fname):
+    """Exclusive advisory lock, which is held across processes (and released automatically if a process dies)"""
+    with open(fname, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class BaselineCache:
+    """
+    Content-addressed cache of pickled results, with a size cap and least-recently-used eviction.
+
+    Entries are written to a temporary file and atomically renamed, so readers never see partial files. Computation of a missing
+    entry holds a per-key lock, so that concurrent processes requesting the same entry compute it only once. Eviction also removes
+    unused lock files and temporary files of crashed processes, and counts the remaining ones against the size cap.
+    """
+    def __init__(self, cache_dir: str, max_size_mb: float):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size_bytes = max_size_mb * 1024 ** 2
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _get_fname(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pkl")
+
+    def load(self, key) -> Optional[Any]:
+        fname = self._get_fname(key)
+        try:
+            with open(fname, "rb") as f:
+                value = pickle.load(f)
+            os.utime(fname)  # mark as recently used
+            return value
+        except FileNotFoundError:
+            return None
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError) as e:
+            LOGGER.warning(f"Ignoring unreadable baseline cache entry {fname}: {e}")
+            return None
+
+    def store(self, key, value):
+        f = tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix=".tmp", delete=False)
+        try:
+            with f:
+                pickle.dump(value, f)
+            os.replace(f.name, self._get_fname(key))
+        finally:
+            # Only left over if writing failed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(f.name)
+        self._evict()
+
+    def get_or_compute(self, key, compute_func: Callable[[], Any]):
+        value = self.load(key)
+        if value is not None:
+            LOGGER.debug(f"Baseline cache hit: {key}")
+            return value
+        with _file_lock(self._get_fname(key) + ".lock"):
+            # Another process might have computed the entry while we were waiting for the lock
+            value = self.load(key)
+            if value is None:
+                LOGGER.debug(f"Baseline cache miss: {key}")
+                value = compute_func()
+                self.store(key, value)
+        return value
+
+    def _remove_stale_files(self) -> int:
+        """Removes unused lock files and old temporary files and returns the total size of the remaining ones"""
+        size = 0
+        for fname in glob.glob(os.path.join(self.cache_dir, "*.pkl.lock")):
+            if not _try_remove_unused_lock(fname):
+                with contextlib.suppress(FileNotFoundError):
+                    size += os.stat(fname).st_size
+        for fname in glob.glob(os.path.join(self.cache_dir, "*.tmp")):
+            try:
+                stat = os.stat(fname)
+                if time.time() - stat.st_mtime > _STALE_TMP_SECONDS:
+                    os.remove(fname)
+                    LOGGER.debug(f"Removed stale temporary baseline cache file {fname}")
+                else:
+                    size += stat.st_size
+            except FileNotFoundError:
+                continue
+        return size
+
+    def _evict(self):
+        with _file_lock(os.path.join(self.cache_dir, ".eviction.lock")):
+            total_size = self._remove_stale_files()
+            entries = []
+            for fname in glob.glob(os.path.join(self.cache_dir, "*.pkl")):
+                try:
+                    stat = os.stat(fname)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, fname))
+            entries.sort()
+            total_size += sum(e[1] for e in entries)
+            # Always keep the most recently used entry, even if it exceeds the size cap on its own
+            for _, size, fname in entries[:-1]:
+                if total_size <= self.max_size_bytes:
+                    break
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(fname)
+                total_size -= size
+                LOGGER.debug(f"Evicted baseline cache entry {fname}")
+
+
+def configure_baseline_cache(cache_dir: Optional[str], max_size_mb: float = 1000):
+    """Enables (or, for cache_dir=None, disables) the baseline cache for this process"""
+    global _baseline_cache
+    _baseline_cache = BaselineCache(cache_dir, max_size_mb) if cache_dir else None
+
+
+def get_baseline_cache() -> Optional[BaselineCache]:
+    return _baseline_cache
+
+
+def get_baseline_cache_key(kind: str, physical_config: PhysicalConfig, **settings):
+    """
+    Key for a cached baseline result, consisting of the hash of the geometry (positions, charges, total charge and spin; see Geometry.hash)
+    and of all settings that affect the result (e.g. basis set, localization and cusp corrections).
+    """
+    n_el, n_up, R, Z = physical_config.get_basic_params()
+    geometry = Geometry(R, Z, charge=int(sum(Z)) - n_el, spin=2 * n_up - n_el)
+    settings = json.dumps(settings, sort_keys=True, default=str)
+    settings_hash = hashlib.md5(f"{CACHE_VERSION}_{geometry.hash}_{settings}".encode()).hexdigest()
+    return f"{kind}_{settings_hash}"
@@ -0,0 +1,233 @@
+"""
+Persistent XLA compilation cache and ahead-of-time (AOT) warm-up of compiled programs.
+"""
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import jax
+
+LOGGER = logging.getLogger("dpe")
+
+CACHE_HIT_EVENT = "/jax/compilation_cache/cache_hits"
+CACHE_MISS_EVENT = "/jax/compilation_cache/cache_misses"
+BACKEND_COMPILE_EVENT = "/jax/core/compile/backend_compile_duration"
+
+_n_warmup_threads = 0
+_compilation_stats: Optional["CompilationEventCounter"] = None
+
+
+class CompilationEventCounter:
+    """Counts persistent cache hits/misses and accumulated XLA compile time, based on the events reported by jax.monitoring"""
+    def __init__(self):
+        self.n_cache_hits = 0
+        self.n_cache_misses = 0
+        self.n_compilations = 0
+        self.t_compile = 0.0
+        self._lock = threading.Lock()
+
+    def on_event(self, event: str, **kwargs):
+        with self._lock:
+            if event == CACHE_HIT_EVENT:
+                self.n_cache_hits += 1
+            elif event == CACHE_MISS_EVENT:
+                self.n_cache_misses += 1
+
+    def on_duration(self, event: str, duration: float, **kwargs):
+        if event == BACKEND_COMPILE_EVENT:
+            with self._lock:
+                self.n_compilations += 1
+                self.t_compile += duration
+
+    def get_summary(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(compile_cache_hits=self.n_cache_hits,
+                        compile_cache_misses=self.n_cache_misses,
+                        n_compilations=self.n_compilations,
+                        t_compile=self.t_compile)
+
+
+def _enable_persistent_cache(cache_dir: str, min_compile_time_secs: float):
+    try:
+        jax.config.update("jax_compilation_cache_dir", cache_dir)
+        jax.config.update("jax_persistent_cache_min_compile_time_secs", min_compile_time_secs)
+    except AttributeError:
+        # Older jax versions without the config options
+        from jax.experimental.compilation_cache import compilation_cache
+        compilation_cache.initialize_cache(cache_dir)
+
+
+def configure_compilation_cache(cache_dir: Optional[str], min_compile_time_secs: float = 1.0, n_warmup_threads: int = 0):
+    """
+    Enables the persistent compilation cache (for cache_dir != None) and ahead-of-time warm-up (for n_warmup_threads > 0) for this process.
+
+    Must be called before the first program is compiled.
+    """
+    global _n_warmup_threads, _compilation_stats
+    if cache_dir:
+        cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        _enable_persistent_cache(cache_dir, min_compile_time_secs)
+        LOGGER.info(f"Using persistent compilation cache: {cache_dir}")
+    elif n_warmup_threads > 0:
+        LOGGER.warning("AOT warm-up without a persistent compilation cache only reduces the start-up time of the current run")
+    _n_warmup_threads = n_warmup_threads
+
+    if (_compilation_stats is None) and hasattr(jax, "monitoring"):
+        _compilation_stats = CompilationEventCounter()
+        jax.monitoring.register_event_listener(_compilation_stats.on_event)
+        jax.monitoring.register_event_duration_secs_listener(_compilation_stats.on_duration)
+
+
+def get_compilation_stats() -> Dict[str, float]:
+    """Cache hits/misses, number of XLA compilations and accumulated compile time (in sec) of this process"""
+    return _compilation_stats.get_summary() if _compilation_stats else {}
+
+
+def log_compilation_stats(prefix: str = "Compilation"):
+    stats = get_compilation_stats()
+    if stats:
+        LOGGER.info(f"{prefix}: {stats['n_compilations']} compilations in {stats['t_compile']:.1f} sec; "
+                    f"persistent cache hits: {stats['compile_cache_hits']}, misses: {stats['compile_cache_misses']}")
+
+
+def is_warmup_enabled() -> bool:
+    return _n_warmup_threads > 0
+
+
+def _get_weak_type(x) -> bool:
+    if isinstance(x, (int, float, complex)) and not isinstance(x, bool):
+        return True  # python scalars are weakly typed
+    return bool(getattr(x, "weak_type", False))
+
+
+def _get_aval_signature(x):
+    """Shape, (canonical) dtype and weak type of a concrete or abstract array or a python scalar"""
+    if hasattr(x, "shape") and hasattr(x, "dtype"):
+        return tuple(x.shape), jax.dtypes.canonicalize_dtype(x.dtype), _get_weak_type(x)
+    return tuple(jax.numpy.shape(x)), jax.numpy.result_type(x), _get_weak_type(x)
+
+
+def _get_abstract_value(x):
+    shape, dtype, weak_type = _get_aval_signature(x)
+    try:
+        return jax.ShapeDtypeStruct(shape, dtype, weak_type=weak_type)
+    except TypeError:
+        # Older jax versions: ShapeDtypeStruct has no weak type, but abstract arrays can be used for lowering directly
+        return jax.core.ShapedArray(shape, dtype, weak_type=weak_type)
+
+
+def get_abstract_values(tree):
+    """
+    Replaces all arrays by abstract values (shape, dtype and weak type), so that programs can be lowered without allocating or computing
+    their inputs. Weak types are kept, because they are part of the signature of a compiled program.
+    """
+    return jax.tree_util.tree_map(_get_abstract_value, tree)
+
+
+def eval_abstract_values(func: Callable, *args):
+    """
+    Same as jax.eval_shape(func, *args) followed by get_abstract_values, but keeps the weak types of the outputs (which jax.eval_shape
+    drops in some jax versions), so that the outputs can be used as inputs of programs to warm up.
+    """
+    closed_jaxpr, out_shape = jax.make_jaxpr(func, return_shape=True)(*args)
+    out_tree = jax.tree_util.tree_structure(out_shape)
+    return get_abstract_values(jax.tree_util.tree_unflatten(out_tree, closed_jaxpr.out_avals))
+
+
+def _get_signature(args):
+    leaves, treedef = jax.tree_util.tree_flatten(args)
+    return treedef, tuple(_get_aval_signature(x) for x in leaves)
+
+
+def _split_static_args(args, static_argnums):
+    static_args = tuple(args[i] for i in static_argnums)
+    dynamic_args = tuple(a for i, a in enumerate(args) if i not in static_argnums)
+    return static_args, dynamic_args
+
+
+def _get_program_key(func, args, static_argnums):
+    static_args, dynamic_args = _split_static_args(args, static_argnums)
+    key = (func, static_args, _get_signature(dynamic_args))
+    hash(key)
+    return key
+
+
+# Executables compiled by warmup_programs, by (function, static arguments, signature of the dynamic arguments)
+_compiled_programs = dict()
+
+
+def call_program(func: Callable, *args, static_argnums: Sequence[int] = ()):
+    """
+    Calls the jitted/pmapped function func(*args). If warmup_programs has compiled func for the same static arguments and the same
+    shapes, dtypes and weak types of all other arguments, its executable is called directly instead of compiling func again.
+    """
+    if _compiled_programs:
+        try:
+            key = _get_program_key(func, args, static_argnums)
+        except TypeError:  # unhashable static arguments
+            key = None
+        compiled = _compiled_programs.get(key)
+        if compiled is not None:
+            return compiled(*_split_static_args(args, static_argnums)[1])
+    return func(*args)
+
+
+def warmup_programs(programs: Dict[str, Tuple[Callable, Sequence, Sequence[int]]]) -> Dict[str, float]:
+    """
+    Lowers and compiles jitted/pmapped programs ahead of time in parallel threads.
+
+    Args:
+        programs: Dict of {name: (func, args, static_argnums)}, where func is a jitted or pmapped function and args are its (concrete or
+            abstract, see get_abstract_values) arguments, including the static arguments at positions static_argnums.
+
+    Returns:
+        Compile time in seconds of each successfully compiled program. The executables are kept and used by call_program, so that calling
+        func through call_program with arguments of the same signature does not compile again; they are also stored in the persistent
+        compilation cache. Programs with identical function, static arguments and signature are compiled only once.
+        Warm-up is best-effort: Programs that fail to compile are logged and compiled on their first call instead.
+        Returns an empty dict if warm-up is disabled.
+    """
+    if (not is_warmup_enabled()) or (not programs):
+        return {}
+
+    unique_programs = dict()
+    for name, (func, args, static_argnums) in programs.items():
+        key = _get_program_key(func, args, static_argnums)
+        if (key not in _compiled_programs) and (key not in unique_programs.values()):
+            unique_programs[name] = key
+    programs = {name: programs[name] for name in unique_programs}
+    if not programs:
+        return {}
+
+    def _compile(func, args, static_argnums):
+        t_start = time.time()
+        compiled = func.lower(*args).compile()
+        return compiled, time.time() - t_start
+
+    stats_before = get_compilation_stats()
+    t_start = time.time()
+    compile_times = {}
+    with concurrent.futures.ThreadPoolExecutor(min(_n_warmup_threads, len(programs))) as executor:
+        futures = {executor.submit(_compile, *program): name for name, program in programs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                compiled, compile_times[name] = future.result()
+            except Exception as e:
+                LOGGER.warning(f"AOT warm-up of {name} failed; compiling on first call instead: {e!r}")
+                continue
+            _compiled_programs[unique_programs[name]] = compiled
+            LOGGER.debug(f"AOT warm-up: compiled {name} in {compile_times[name]:.1f} sec")
+
+    msg = f"AOT warm-up: compiled {len(compile_times)}/{len(programs)} programs in {time.time() - t_start:.1f} sec " \
+          f"(sum over programs: {sum(compile_times.values()):.1f} sec)"
+    stats_after = get_compilation_stats()
+    if stats_after:
+        msg += f"; persistent cache hits: {stats_after['compile_cache_hits'] - stats_before['compile_cache_hits']}, " \
+               f"misses: {stats_after['compile_cache_misses'] - stats_before['compile_cache_misses']}"
+    LOGGER.info(msg)
+    return compile_times
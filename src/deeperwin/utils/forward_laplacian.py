@@ -0,0 +1,208 @@
+"""
+Forward laplacian (Li et al., 2023): Computes value, gradient and laplacian of a scalar function in a single forward pass.
+
+Instead of computing the 3N diagonal entries of the Hessian with 3N second-order passes, every intermediate quantity y of the
+function is represented by the triple (y, J_y, lap_y), where J_y = dy/dx is its Jacobian w.r.t. the input x (one row per input
+coordinate) and lap_y = sum_i d^2y/dx_i^2 its laplacian. The triples are propagated through the function by interpreting its jaxpr:
+
+- Affine operations (add, reshape, indexing, concatenation, multiplication with constants, ...) act on J_y row by row and on the
+  single laplacian tangent lap_y: (f(y), f'[J_y], f'[lap_y])
+- Elementwise non-linearities use the chain rule lap_f = f'(y) * lap_y + f''(y) * sum_i J_y,i^2 with f' and f'' evaluated only once
+- Bilinear operations (mul, dot_general) of two input-dependent operands add the cross term 2 * sum_i f(J_a,i, J_b,i)
+- All other operations (e.g. determinants, reductions like max, control flow) fall back to forward-over-forward derivatives of that
+  single operation along the rows of J
+
+Only the laplacian is a single tangent, i.e. the cost is that of one forward-mode gradient (3N tangents of first order) instead of
+3N second-order passes through the whole function.
+"""
+import functools
+from typing import Callable
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+# Operations, which are affine in all of their input-dependent (floating point) operands
+_LINEAR_PRIMITIVES = {
+    "neg", "add", "sub", "add_any", "reduce_sum", "reshape", "broadcast_in_dim", "transpose", "squeeze", "expand_dims", "slice",
+    "dynamic_slice", "dynamic_update_slice", "gather", "scatter-add", "scatter_add", "concatenate", "pad", "select_n",
+    "convert_element_type", "copy", "copy_p", "rev", "cumsum", "reduce_precision", "real", "imag", "conj",
+}
+# Operations, which are linear in each of their two operands
+_BILINEAR_PRIMITIVES = {"mul", "dot_general", "conv_general_dilated"}
+# Elementwise operations, for which derivatives are evaluated elementwise
+_ELEMENTWISE_PRIMITIVES = {
+    "exp", "exp2", "log", "log1p", "expm1", "tanh", "logistic", "sin", "cos", "tan", "asin", "acos", "atan", "sinh", "cosh", "asinh",
+    "acosh", "atanh", "sqrt", "rsqrt", "cbrt", "erf", "erfc", "erf_inv", "lgamma", "digamma", "abs", "sign", "floor", "ceil", "round",
+    "integer_pow", "pow", "max", "min", "div", "atan2", "rem", "square",
+}
+# Operations, whose outputs do not depend on their inputs in terms of derivatives
+_CONSTANT_PRIMITIVES = {"stop_gradient"}
+# Call-like operations, which are interpreted recursively
+_CALL_PRIMITIVES = {"pjit", "jit", "xla_call", "closed_call", "core_call", "named_call", "remat_call", "remat", "remat2", "checkpoint",
+                    "custom_vjp_call", "custom_vjp_call_jaxpr"}
+
+
+class _ForwardLaplacianValue:
+    """Value x of an intermediate quantity, together with its Jacobian [n_inputs x *x.shape] and laplacian [*x.shape]"""
+    def __init__(self, x, jac, lap):
+        self.x = x
+        self.jac = jac
+        self.lap = lap
+
+
+def _is_float(aval) -> bool:
+    return jnp.issubdtype(aval.dtype, jnp.inexact)
+
+
+def _is_literal(var) -> bool:
+    return type(var).__name__ == "Literal"
+
+
+def _bind(eqn, *args):
+    bind_params = eqn.primitive.get_bind_params(eqn.params)
+    if isinstance(bind_params, tuple):
+        subfuns, params = bind_params
+    else:  # newer jax versions pass sub-functions as a parameter
+        subfuns, params = (), bind_params
+    outputs = eqn.primitive.bind(*subfuns, *args, **params)
+    return list(outputs) if eqn.primitive.multiple_results else [outputs]
+
+
+def _partial_bind(eqn, values, is_dependent):
+    """Function of the input-dependent operands only, with all other operands fixed to their values"""
+    def f(*dependent_args):
+        dependent_args = iter(dependent_args)
+        return _bind(eqn, *[next(dependent_args) if dep else v for v, dep in zip(values, is_dependent)])
+    return f
+
+
+def _broadcast_rows(jac, ndim_out):
+    """Inserts axes after the row axis, so that the jacobian of a (broadcast) operand aligns with an output of rank ndim_out"""
+    return jac.reshape(jac.shape[:1] + (1,) * (ndim_out - jac.ndim + 1) + jac.shape[1:])
+
+
+def _linear_rule(f, xs, jacs, laps):
+    """f is affine in xs: apply its linear part to all rows of the jacobian and to the laplacian at once"""
+    n_rows = jacs[0].shape[0]
+    tangents = tuple(jnp.concatenate([j, l[None]], axis=0) for j, l in zip(jacs, laps))
+    outputs, out_tangents = jax.vmap(lambda *t: jax.jvp(f, xs, t), out_axes=(None, 0))(*tangents)
+    return [(y, t[:n_rows], t[n_rows]) for y, t in zip(outputs, out_tangents)]
+
+
+def _bilinear_rule(f, xs, jacs, laps):
+    """f is bilinear in its two operands: lap f(a, b) = f(lap_a, b) + f(a, lap_b) + 2 sum_i f(J_a,i, J_b,i)"""
+    outputs = _linear_rule(f, xs, jacs, laps)
+    cross_terms = jax.vmap(f)(*jacs)
+    return [(y, jac, lap + 2 * jnp.sum(cross, axis=0)) for (y, jac, lap), cross in zip(outputs, cross_terms)]
+
+
+def _elementwise_rule(f, xs, jacs, laps):
+    """f acts elementwise: first and second derivatives w.r.t. each operand are evaluated elementwise once"""
+    n_args = len(xs)
+    ones = [tuple(jnp.ones_like(x) if i == k else jnp.zeros_like(x) for i, x in enumerate(xs)) for k in range(n_args)]
+    first_derivative = lambda k: (lambda *args: jax.jvp(f, args, ones[k])[1][0])
+    (y,), _ = jax.jvp(f, xs, ones[0])
+    ndim = y.ndim
+
+    jac_out = 0
+    lap_out = 0
+    for k in range(n_args):
+        f_k = first_derivative(k)(*xs)
+        jac_out = jac_out + f_k * _broadcast_rows(jacs[k], ndim)
+        lap_out = lap_out + f_k * laps[k]
+        for l in range(k, n_args):
+            _, f_kl = jax.jvp(first_derivative(k), xs, ones[l])
+            jac_products = jnp.sum(_broadcast_rows(jacs[k], ndim) * _broadcast_rows(jacs[l], ndim), axis=0)
+            lap_out = lap_out + (1 if k == l else 2) * f_kl * jac_products
+    jac_out = jnp.broadcast_to(jac_out, jacs[0].shape[:1] + y.shape).astype(y.dtype)
+    lap_out = jnp.broadcast_to(lap_out, y.shape).astype(y.dtype)
+    return [(y, jac_out, lap_out)]
+
+
+def _dense_rule(f, xs, jacs, laps):
+    """Generic rule for any differentiable f: forward-over-forward derivatives of f along every row of the jacobian"""
+    outputs, lap_first_order = jax.jvp(f, xs, laps)
+
+    def _second_order(*t):
+        return jax.jvp(lambda *args: jax.jvp(f, args, t)[1], xs, t)
+    jac_out, second_order = jax.vmap(_second_order)(*jacs)
+    return [(y, j, l + jnp.sum(s, axis=0)) if jnp.issubdtype(y.dtype, jnp.inexact) else (y, None, None)
+            for y, j, l, s in zip(outputs, jac_out, lap_first_order, second_order)]
+
+
+def _get_inner_jaxpr(params):
+    for key in ["jaxpr", "call_jaxpr", "fun_jaxpr"]:
+        if key in params:
+            inner = params[key]
+            if hasattr(inner, "consts"):
+                return inner.jaxpr, inner.consts
+            return inner, []
+    return None, None
+
+
+def _eval_equation(eqn, invals):
+    is_dependent = [isinstance(v, _ForwardLaplacianValue) for v in invals]
+    values = [v.x if dep else v for v, dep in zip(invals, is_dependent)]
+    name = eqn.primitive.name
+    if (not any(is_dependent)) or (name in _CONSTANT_PRIMITIVES) or not any(_is_float(v.aval) for v in eqn.outvars):
+        return _bind(eqn, *values)
+
+    if name in _CALL_PRIMITIVES:
+        inner_jaxpr, inner_consts = _get_inner_jaxpr(eqn.params)
+        if inner_jaxpr is not None:
+            return _eval_jaxpr(inner_jaxpr, inner_consts, *invals)
+
+    dependent = [v for v in invals if isinstance(v, _ForwardLaplacianValue)]
+    xs = tuple(v.x for v in dependent)
+    jacs = tuple(v.jac for v in dependent)
+    laps = tuple(v.lap for v in dependent)
+    f = _partial_bind(eqn, values, is_dependent)
+    if name in _LINEAR_PRIMITIVES:
+        rule = _linear_rule
+    elif (name == "div") and not is_dependent[1]:
+        rule = _linear_rule  # division by a constant
+    elif name in _BILINEAR_PRIMITIVES:
+        rule = _linear_rule if len(dependent) == 1 else _bilinear_rule
+    elif name in _ELEMENTWISE_PRIMITIVES:
+        rule = _elementwise_rule
+    else:
+        rule = _dense_rule
+    outputs = rule(f, xs, jacs, laps)
+    return [_ForwardLaplacianValue(y, jac, lap) if _is_float(outvar.aval) else y
+            for (y, jac, lap), outvar in zip(outputs, eqn.outvars)]
+
+
+def _eval_jaxpr(jaxpr, consts, *args):
+    env = {}
+
+    def read(var):
+        return var.val if _is_literal(var) else env[var]
+
+    for var, value in zip(jaxpr.constvars, consts):
+        env[var] = value
+    for var, value in zip(jaxpr.invars, args):
+        env[var] = value
+    for eqn in jaxpr.eqns:
+        outvals = _eval_equation(eqn, [read(v) for v in eqn.invars])
+        for var, value in zip(eqn.outvars, outvals):
+            env[var] = value
+    return [read(v) for v in jaxpr.outvars]
+
+
+def forward_laplacian(f: Callable) -> Callable:
+    """
+    Transforms a function f(x) -> scalar into a function x -> (f(x), grad f(x), laplacian f(x)), computed in a single forward pass.
+
+    f is traced into a jaxpr for the shape of x; everything else f depends on (e.g. parameters) must be closed over.
+    """
+    @functools.wraps(f)
+    def _forward_laplacian(x):
+        closed_jaxpr = jax.make_jaxpr(f)(x)
+        n_inputs = int(np.prod(x.shape))
+        x_in = _ForwardLaplacianValue(x, jnp.eye(n_inputs, dtype=x.dtype).reshape((n_inputs,) + x.shape), jnp.zeros_like(x))
+        output, = _eval_jaxpr(closed_jaxpr.jaxpr, closed_jaxpr.consts, x_in)
+        if not isinstance(output, _ForwardLaplacianValue):
+            return output, jnp.zeros_like(x), jnp.zeros_like(output)
+        return output.x, output.jac.reshape(x.shape + output.x.shape), output.lap
+    return _forward_laplacian
@@ -0,0 +1,255 @@
+"""
+Append-only, columnar storage of the metric history of a run.
+
+Rows (dicts of metrics) are buffered in memory and appended to the file as one chunk per flush, so that memory use is bounded by the
+flush interval and writing costs only as much as the new rows, no matter how long the run is. Each chunk consists of
+    <8 bytes: little-endian length of the header> <JSON header> <one buffer per column>
+The header lists the number of rows and the name, dtype, offset and size of each column buffer. Columns, which only contain numbers,
+are stored as raw int64/float64 arrays (missing values as NaN), all other columns (e.g. strings or arrays) as a JSON list.
+Reading a single column therefore only reads the chunk headers and the buffers of that column.
+
+Chunks are only ever appended, so the first n bytes of the file always contain the first rows of the history. Checkpoints therefore
+only store a reference (file name, number of rows and bytes) to the history up to the checkpoint. A run, which is restarted from a
+checkpoint in the same directory, continues the history file after the rows referenced by the checkpoint.
+"""
+import contextlib
+import io
+import json
+import logging
+import os
+import struct
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+
+LOGGER = logging.getLogger("dpe")
+
+HISTORY_FNAME = "history.bin"
+_MAGIC = b"DPEHIST1"
+_HEADER_LENGTH = struct.Struct("<Q")
+
+
+@dataclass
+class HistoryFileReference:
+    """Reference to the first n_rows rows (the first n_bytes bytes) of a history file"""
+    fname: str
+    n_rows: int
+    n_bytes: int
+
+
+def _is_number(x) -> bool:
+    if isinstance(x, (int, float, np.number)):
+        return True
+    # 0-d numpy or jax arrays
+    return (getattr(x, "shape", None) == ()) and (np.dtype(x.dtype).kind in "biuf")
+
+
+def _to_json(x):
+    if isinstance(x, np.generic):
+        return x.item()
+    if hasattr(x, "__array__"):
+        return np.asarray(x).tolist()
+    return str(x)
+
+
+def _is_device_array(x) -> bool:
+    return hasattr(x, "__array__") and not isinstance(x, (np.ndarray, np.generic))
+
+
+def _to_host_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Transfers all (device) arrays of a row to the host at once; 0-d arrays become numpy scalars"""
+    if any(_is_device_array(v) for v in row.values()):
+        import jax
+        row = jax.device_get(row)
+    return {k: v[()] if isinstance(v, np.ndarray) and (v.ndim == 0) else v for k, v in row.items()}
+
+
+def _encode_column(values: List[Any]):
+    present = [v for v in values if v is not None]
+    if all(_is_number(v) for v in present):
+        if present and (len(present) == len(values)) and all(isinstance(v, (int, np.integer)) and not isinstance(v, bool)
+                                                               for v in present):
+            return "int64", np.asarray(values, np.int64).tobytes()
+        return "float64", np.asarray([np.nan if v is None else v for v in values], np.float64).tobytes()
+    return "json", json.dumps(values, default=_to_json).encode("utf-8")
+
+
+def _decode_column(dtype: str, buffer: bytes) -> np.ndarray:
+    if dtype == "json":
+        values = json.loads(buffer.decode("utf-8"))
+        column = np.empty(len(values), dtype=object)
+        column[:] = values
+        return column
+    return np.frombuffer(buffer, dtype=dtype)
+
+
+class HistoryWriter:
+    """
+    Appends rows of metrics to a history file. Rows are buffered and written as one chunk every flush_every rows (or when flush is
+    called explicitly, e.g. before writing a checkpoint).
+
+    A run, which is resumed from a checkpoint (resume_from: the checkpoint's reference to the history file), continues the history
+    after the rows referenced by the checkpoint; all rows written after the checkpoint are discarded, so that no epoch is stored twice.
+    An existing history file, which is not referenced by resume_from, is never continued, but moved aside.
+    """
+    def __init__(self, fname: str, flush_every: int = 1000, resume_from: Optional[HistoryFileReference] = None):
+        assert flush_every >= 1, "Rows must be flushed at least every row"
+        self.fname = fname
+        self.flush_every = flush_every
+        self.n_rows_flushed = 0
+        self.n_bytes = len(_MAGIC)
+        self._rows = []
+        if os.path.exists(self.fname):
+            if (resume_from is not None) and _is_resumable(self.fname, resume_from):
+                with open(self.fname, "r+b") as f:
+                    f.truncate(resume_from.n_bytes)
+                self.n_rows_flushed = resume_from.n_rows
+                self.n_bytes = resume_from.n_bytes
+                LOGGER.info(f"Continuing history {self.fname} after {self.n_rows_flushed} rows")
+                return
+            fname_old = _get_unused_fname(self.fname + ".old")
+            LOGGER.warning(f"{self.fname} is not referenced by the checkpoint the run is resumed from; moving it to {fname_old}")
+            os.replace(self.fname, fname_old)
+        with open(self.fname, "wb") as f:
+            f.write(_MAGIC)
+
+    @property
+    def n_rows(self) -> int:
+        return self.n_rows_flushed + len(self._rows)
+
+    def append(self, row: Dict[str, Any]):
+        self._rows.append(_to_host_row(row))
+        if len(self._rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        keys = list(dict.fromkeys(k for row in self._rows for k in row.keys()))
+        columns_meta, buffers, offset = [], [], 0
+        for key in keys:
+            dtype, buffer = _encode_column([row.get(key) for row in self._rows])
+            columns_meta.append(dict(name=str(key), dtype=dtype, offset=offset, nbytes=len(buffer)))
+            buffers.append(buffer)
+            offset += len(buffer)
+        header = json.dumps(dict(n_rows=len(self._rows), columns=columns_meta)).encode("utf-8")
+        with open(self.fname, "ab") as f:
+            f.write(_HEADER_LENGTH.pack(len(header)) + header)
+            for buffer in buffers:
+                f.write(buffer)
+        self.n_rows_flushed += len(self._rows)
+        self.n_bytes += _HEADER_LENGTH.size + len(header) + offset
+        self._rows = []
+
+    def get_reference(self) -> HistoryFileReference:
+        """Flushes all buffered rows and returns a reference to the history up to now"""
+        self.flush()
+        return HistoryFileReference(self.fname, self.n_rows_flushed, self.n_bytes)
+
+
+def _is_resumable(fname: str, ref: HistoryFileReference) -> bool:
+    """Checks whether ref references (complete chunks of) the history file fname"""
+    if os.path.abspath(ref.fname) != os.path.abspath(fname):
+        return False
+    with open(fname, "rb") as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            return False
+        n_rows, n_bytes = 0, len(_MAGIC)
+        for header, data_offset in _iterate_chunks(f):
+            if n_bytes >= ref.n_bytes:
+                break
+            n_rows += header["n_rows"]
+            n_bytes = data_offset + sum(c["nbytes"] for c in header["columns"])
+    return (n_rows, n_bytes) == (ref.n_rows, ref.n_bytes)
+
+
+def _get_unused_fname(fname: str) -> str:
+    n = 0
+    candidate = fname
+    while os.path.exists(candidate):
+        n += 1
+        candidate = f"{fname}{n}"
+    return candidate
+
+
+def read_history_snapshot(ref: HistoryFileReference) -> bytes:
+    """Returns the first ref.n_bytes bytes of a history file, i.e. a complete history file containing the first ref.n_rows rows"""
+    with open(ref.fname, "rb") as f:
+        return f.read(ref.n_bytes)
+
+
+def _iterate_chunks(f):
+    """Yields (header, offset of the column buffers) of all complete chunks of an open history file"""
+    file_size = f.seek(0, os.SEEK_END)
+    f.seek(0)
+    magic = f.read(len(_MAGIC))
+    assert magic == _MAGIC, "Not a history file"
+    pos = len(_MAGIC)
+    while pos + _HEADER_LENGTH.size <= file_size:
+        f.seek(pos)
+        header_length = _HEADER_LENGTH.unpack(f.read(_HEADER_LENGTH.size))[0]
+        data_offset = pos + _HEADER_LENGTH.size + header_length
+        if data_offset > file_size:
+            break
+        header = json.loads(f.read(header_length))
+        pos = data_offset + sum(c["nbytes"] for c in header["columns"])
+        if pos > file_size:
+            break  # incomplete chunk, e.g. because the run was killed while flushing
+        yield header, data_offset
+
+
+def _open_history(source: Union[str, bytes]):
+    if isinstance(source, bytes):
+        return contextlib.nullcontext(io.BytesIO(source))
+    return open(source, "rb")
+
+
+def get_history_columns(source: Union[str, bytes]) -> List[str]:
+    """Names of all columns in a history file (given by its name or its content)"""
+    with _open_history(source) as f:
+        return list(dict.fromkeys(c["name"] for header, _ in _iterate_chunks(f) for c in header["columns"]))
+
+
+def read_history(source: Union[str, bytes], columns: Optional[List[str]] = None, n_rows: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    Reads columns of a history file as arrays (numeric columns as int64/float64 arrays, all other columns as object arrays).
+
+    Args:
+        source: File name or content of the history file (e.g. the snapshot stored in a checkpoint)
+        columns: Names of the columns to read. None: read all columns
+        n_rows: Only read the first n_rows rows (e.g. the history up to a checkpoint). None: read all rows
+    """
+    chunks = []
+    with _open_history(source) as f:
+        n_total = 0
+        for header, data_offset in _iterate_chunks(f):
+            n_chunk = header["n_rows"] if n_rows is None else min(header["n_rows"], n_rows - n_total)
+            if n_chunk <= 0:
+                break
+            chunk = {}
+            for c in header["columns"]:
+                if (columns is not None) and (c["name"] not in columns):
+                    continue
+                f.seek(data_offset + c["offset"])
+                chunk[c["name"]] = _decode_column(c["dtype"], f.read(c["nbytes"]))[:n_chunk]
+            chunks.append((n_chunk, chunk))
+            n_total += n_chunk
+
+    if columns is None:
+        columns = list(dict.fromkeys(name for _, chunk in chunks for name in chunk.keys()))
+    history = {}
+    for name in columns:
+        parts = [chunk.get(name) for _, chunk in chunks]
+        is_object = any((p is not None) and (p.dtype == object) for p in parts)
+        for i, (n_chunk, _) in enumerate(chunks):
+            if parts[i] is None:
+                parts[i] = np.full(n_chunk, None, dtype=object) if is_object else np.full(n_chunk, np.nan)
+        history[name] = np.concatenate(parts) if parts else np.zeros(0)
+    return history
+
+
+def read_history_dataframe(source: Union[str, bytes], columns: Optional[List[str]] = None, n_rows: Optional[int] = None):
+    """Same as read_history, but returns a pandas DataFrame"""
+    import pandas as pd
+    return pd.DataFrame(read_history(source, columns, n_rows))
@@ -0,0 +1,77 @@
+"""
+Parallel initialization of fixed parameters (i.e. baseline calculations) for many geometries using a pool of worker processes.
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from deeperwin.configuration import ModelConfig, PhysicalConfig, ComputationConfig
+
+LOGGER = logging.getLogger("dpe")
+
+
+def _init_worker(enable_x64: bool, baseline_cache_dir, baseline_cache_max_size_mb, n_threads: int):
+    # Workers only run pySCF and small host-side computations: Keep jax on the CPU and leave all accelerators to the main process
+    os.environ["JAX_PLATFORMS"] = "cpu"
+    os.environ["OMP_NUM_THREADS"] = str(n_threads)
+    import jax
+    jax.config.update("jax_enable_x64", enable_x64)
+
+    from deeperwin.utils.baseline_cache import configure_baseline_cache
+    configure_baseline_cache(baseline_cache_dir, baseline_cache_max_size_mb)
+
+
+def _init_fixed_params(model_config: ModelConfig, physical_config: PhysicalConfig):
+    import jax
+    import numpy as np
+    from deeperwin.model import init_model_fixed_params
+
+    fixed_params = init_model_fixed_params(model_config, physical_config, None, None)
+    # Transfer numpy arrays instead of arrays bound to the worker's jax backend; all other leaves (e.g. python scalars) are kept
+    is_device_array = lambda x: hasattr(x, "__array__") and not isinstance(x, (np.ndarray, np.generic))
+    return jax.tree_util.tree_map(lambda x: np.asarray(x) if is_device_array(x) else x, fixed_params)
+
+
+def init_fixed_params_parallel(model_config: ModelConfig,
+                               physical_configs: List[PhysicalConfig],
+                               computation_config: ComputationConfig) -> Iterator[Tuple[int, Dict]]:
+    """
+    Initializes the fixed parameters of all geometries in a pool of computation_config.n_init_workers processes.
+
+    Yields tuples (index of geometry, fixed_params) as soon as the geometries finish, i.e. not necessarily in order; fixed_params
+    contain numpy arrays. A failing geometry does not affect the others: All remaining geometries are still processed and a
+    RuntimeError listing all failed geometries is raised at the end.
+    PhisNet-based initialization is not supported, because the PhisNet model runs on the accelerators of the main process.
+    """
+    n_workers = max(1, min(computation_config.n_init_workers, len(physical_configs)))
+    n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    LOGGER.info(f"Initializing fixed params for {len(physical_configs)} geometries using {n_workers} processes")
+
+    failed = {}
+    t_start = time.time()
+    # Use spawn instead of fork, because forking a process that has already initialized jax can deadlock
+    with concurrent.futures.ProcessPoolExecutor(n_workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_worker,
+                                                initargs=(computation_config.float_precision == "float64",
+                                                          computation_config.baseline_cache_dir,
+                                                          computation_config.baseline_cache_max_size_mb,
+                                                          n_threads)) as executor:
+        futures = {executor.submit(_init_fixed_params, model_config, physical_config): idx
+                   for idx, physical_config in enumerate(physical_configs)}
+        for n_done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            idx = futures[future]
+            try:
+                fixed_params = future.result()
+            except Exception as e:
+                LOGGER.error(f"Initialization of fixed params failed for geometry {idx}: {e!r}")
+                failed[idx] = e
+                continue
+            LOGGER.info(f"Initialized fixed params for geometry {idx} ({n_done}/{len(futures)}; t={time.time() - t_start:.1f} sec)")
+            yield idx, fixed_params
+
+    if failed:
+        raise RuntimeError(f"Initialization of fixed params failed for {len(failed)} geometries: {sorted(failed)}")
@@ -0,0 +1,107 @@
+"""
+Per-phase timing of the optimization loop and optional JAX profiler traces.
+
+Phases are timed on the host: With phase profiling enabled, the outputs of each phase are blocked on before the phase ends, so that the
+asynchronously dispatched device work is attributed to the phase that launched it. Only whole compiled programs can be timed this way.
+The timings therefore do NOT contain separate entries for the phases inside a single compiled program: The laplacian, the potential
+energy and the clipping/reductions of the loss are all part of the optimizer step (t_opt_step, or t_fused_epochs for fused epochs), and the proposals and log(psi)
+evaluations are part of the MCMC phase (t_mcmc). These sub-phases are annotated with jax.named_scope and can only be told apart in a
+profiler trace (see configure_profiler).
+"""
+import collections
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import jax
+import numpy as np
+
+LOGGER = logging.getLogger("dpe")
+
+_profile_phases = False
+_trace_epochs: Optional[List[int]] = None
+_trace_dir = "profiler_trace"
+
+
+def configure_profiler(profile_phases: bool, trace_epochs: Optional[List[int]] = None, trace_dir: str = "profiler_trace"):
+    """Enables device-synchronised phase timings and/or a JAX profiler trace for the optimization epochs [start, end) of this process"""
+    global _profile_phases, _trace_epochs, _trace_dir
+    if trace_epochs is not None:
+        assert len(trace_epochs) == 2 and trace_epochs[0] < trace_epochs[1], "profiler_trace_epochs must be [start, end) with start < end"
+    _profile_phases = profile_phases
+    _trace_epochs = trace_epochs
+    _trace_dir = trace_dir
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall time of named phases of the optimization loop.
+
+    Usage: Call start() at the beginning of each epoch and record(name, *outputs) at the end of each phase. Each phase lasts from the
+    previous call of start/record until its outputs are ready. Timings are reported by get_metrics() as t_<name> (in seconds) and are
+    summed up over the whole run for log_summary(). All methods are no-ops unless phase profiling is enabled (see configure_profiler).
+    """
+    def __init__(self, name: str = "Optimization"):
+        self.name = name
+        self.enabled = _profile_phases
+        self._t_last = None
+        self._timings = collections.OrderedDict()
+        self._totals = collections.OrderedDict()
+        self._trace_active = False
+
+    def start(self):
+        if self.enabled:
+            self._t_last = time.perf_counter()
+
+    def record(self, name: str, *outputs):
+        if not self.enabled:
+            return
+        if outputs:
+            jax.block_until_ready(outputs)
+        t = time.perf_counter()
+        if self._t_last is not None:
+            self._timings[name] = self._timings.get(name, 0.0) + (t - self._t_last)
+            self._totals[name] = self._totals.get(name, 0.0) + (t - self._t_last)
+        self._t_last = t
+
+    def get_metrics(self, n_epochs: int = 1) -> Dict[str, np.ndarray]:
+        """
+        Returns the timings accumulated since the last call, averaged over n_epochs.
+
+        For n_epochs > 1 every timing is repeated along a leading axis of length n_epochs (as required by MetricsBuffer.push).
+        """
+        metrics = {}
+        for name, t in self._timings.items():
+            metrics[f"t_{name}"] = t / n_epochs if n_epochs == 1 else np.full(n_epochs, t / n_epochs)
+        self._timings = collections.OrderedDict()
+        return metrics
+
+    def update_trace(self, n_epoch: int):
+        """Starts or stops the JAX profiler trace when epoch n_epoch enters or leaves the configured trace window"""
+        if _trace_epochs is None:
+            return
+        start, end = _trace_epochs
+        if (not self._trace_active) and (start <= n_epoch < end):
+            LOGGER.info(f"Starting profiler trace at epoch {n_epoch}: {os.path.abspath(_trace_dir)}")
+            jax.profiler.start_trace(_trace_dir)
+            self._trace_active = True
+        elif self._trace_active and (n_epoch >= end):
+            self.stop_trace()
+
+    def stop_trace(self):
+        if self._trace_active:
+            jax.profiler.stop_trace()
+            self._trace_active = False
+            LOGGER.info("Stopped profiler trace")
+
+    def log_summary(self):
+        self.stop_trace()
+        if not self._totals:
+            return
+        t_total = sum(self._totals.values())
+        LOGGER.info(f"{self.name} timing: {t_total:.1f} sec in total")
+        for name, t in sorted(self._totals.items(), key=lambda x: -x[1]):
+            LOGGER.info(f"{self.name} timing: {name:<16} {t:9.1f} sec ({100 * t / t_total:5.1f}%)")
+        LOGGER.info(f"{self.name} timing: laplacian, potential and loss reductions are not timed separately, but are part of opt_step "
+                    f"(or fused_epochs); see the profiler trace for a breakdown")
@@ -6,7 +6,9 @@ from typing import Dict, Optional
 from deeperwin.configuration import Configuration
 from deeperwin.loggers import LoggerCollection
 from deeperwin.utils.utils import getCodeVersion
-from deeperwin.checkpoints import delete_obsolete_checkpoints
+from deeperwin.checkpoints import delete_obsolete_checkpoints, wait_for_pending_checkpoints
+from deeperwin.utils.compilation import log_compilation_stats
+from deeperwin.utils.history_store import HistoryFileReference
 
 
 def initialize_training_loggers(
@@ -17,6 +19,7 @@ def initialize_training_loggers(
         exp_idx_in_group: Optional[int] = None,
         save_path=".",
         parallel_wandb_logging=False,
+        resume_history: Optional[HistoryFileReference] = None,
 ) -> LoggerCollection:
     if jax.process_index() == 0:
         loggers = LoggerCollection(config=config.logging, 
@@ -24,7 +27,8 @@ def initialize_training_loggers(
                                    use_wandb_group=use_wandb_group,
                                    exp_idx_in_group=exp_idx_in_group,
                                    save_path=save_path,
-                                   parallel_wandb_logging=parallel_wandb_logging)
+                                   parallel_wandb_logging=parallel_wandb_logging,
+                                   resume_history=resume_history)
         loggers.on_run_begin()
         loggers.log_config(config)
         loggers.log_tags(config.logging.tags)
@@ -47,7 +51,9 @@ def finalize_experiment_run(
     clipping_state,
     ema_params=None
 ) -> None:
+    log_compilation_stats("Compilation during run")
     if jax.process_index() == 0:
         loggers.log_checkpoint(config.optimization.n_epochs_total, params, fixed_params, mcmc_state, opt_state, clipping_state, ema_params)
         delete_obsolete_checkpoints(config.optimization.n_epochs_total, config.optimization.checkpoints)
         loggers.on_run_end()
+        wait_for_pending_checkpoints()
@@ -0,0 +1,394 @@
+"""
+Pickle-free storage of pytrees in zip archives: The tree structure is stored as JSON metadata, the leaves as raw array buffers.
+
+Uncompressed buffers are stored without zip-compression, so that they can be memory-mapped directly from the archive when loading.
+Buffers can optionally be compressed with zlib (built-in), zstd (requires the 'zstandard' package) or lz4 (requires the 'lz4' package);
+compressed buffers are decompressed into memory when loading.
+
+Supported nodes are dicts (with string keys), lists, tuples, namedtuples, dataclasses (e.g. chex dataclasses such as MCMCState or
+the states of kfac_jax), None and JSON-serializable python scalars. Everything else that can be converted to a numpy array is stored
+as a leaf. Namedtuples and dataclasses are stored by the import path of their class; if a class cannot be imported when loading
+(e.g. because it was renamed in a newer library version), loading fails, unless strict=False is passed, in which case its fields are
+returned as a dict instead.
+
+Optionally, leaves can be stored outside the archive in a content-addressed BlobStore, so that arrays, which are contained in many
+archives (e.g. the shared parameters in the checkpoints of all geometries of a shared optimization), are only stored once.
+"""
+import collections.abc
+import dataclasses
+import hashlib
+import importlib
+import json
+import logging
+import os
+import struct
+import threading
+import weakref
+import zipfile
+import zlib
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+LOGGER = logging.getLogger("dpe")
+
+COMPRESSIONS = ("zlib", "zstd", "lz4")
+_ZIP_LOCAL_HEADER_SIZE = 30
+_MANIFEST_DIR = "refs"
+
+
+def _get_class_path(cls) -> str:
+    return f"{cls.__module__}:{cls.__qualname__}"
+
+
+def _import_class(path: str):
+    module_name, qualname = path.split(":")
+    obj = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        obj = getattr(obj, name)
+    return obj
+
+
+def _is_namedtuple(x) -> bool:
+    return isinstance(x, tuple) and hasattr(x, "_fields")
+
+
+def encode_tree(tree) -> Tuple[Any, List[np.ndarray]]:
+    """Splits a pytree into a JSON-serializable description of its structure and a list of its array leaves"""
+    leaves = []
+
+    def _encode(x):
+        if x is None:
+            return dict(type="none")
+        if isinstance(x, np.generic):
+            # numpy scalars (e.g. np.float64, which subclasses float) keep their dtype as 0-d array leaves
+            leaves.append(np.asarray(x))
+            return dict(type="array", index=len(leaves) - 1)
+        if isinstance(x, (bool, int, float, str)):
+            return dict(type="scalar", value=x)
+        if dataclasses.is_dataclass(x) and not isinstance(x, type):
+            # Checked before Mapping, since chex dataclasses (e.g. MCMCState) are also mappings
+            keys = [f.name for f in dataclasses.fields(x)]
+            return dict(type="dataclass", cls=_get_class_path(type(x)), keys=keys, children=[_encode(getattr(x, k)) for k in keys])
+        if isinstance(x, collections.abc.Mapping):
+            if not all(isinstance(k, str) for k in x.keys()):
+                raise TypeError(f"Only dicts with string keys can be stored, got keys {list(x.keys())}")
+            return dict(type="dict", keys=list(x.keys()), children=[_encode(v) for v in x.values()])
+        if _is_namedtuple(x):
+            return dict(type="namedtuple", cls=_get_class_path(type(x)), keys=list(x._fields), children=[_encode(v) for v in x])
+        if isinstance(x, (list, tuple)):
+            return dict(type=type(x).__name__, children=[_encode(v) for v in x])
+        try:
+            array = np.asarray(x)
+        except Exception:
+            raise TypeError(f"Cannot store object of type {type(x)}")
+        if array.dtype == object:
+            raise TypeError(f"Cannot store object of type {type(x)}")
+        leaves.append(array)
+        return dict(type="array", index=len(leaves) - 1)
+
+    return _encode(tree), leaves
+
+
+def _build_object(node, children, strict: bool = True):
+    keys = node["keys"]
+    try:
+        cls = _import_class(node["cls"])
+    except (ImportError, AttributeError) as e:
+        if strict:
+            raise ImportError(f"Cannot import class {node['cls']} of a stored {node['type']}; "
+                              f"load with strict=False to obtain its fields as dict instead") from e
+        LOGGER.warning(f"Could not import {node['cls']}; returning its fields as dict instead of a {node['type']}")
+        return dict(zip(keys, children))
+    if node["type"] == "namedtuple":
+        return cls(*children)
+    try:
+        return cls(**dict(zip(keys, children)))
+    except TypeError:
+        # Dataclasses with init=False fields or custom constructors
+        obj = cls.__new__(cls)
+        for k, v in zip(keys, children):
+            object.__setattr__(obj, k, v)
+        return obj
+
+
+def decode_tree(structure, leaves: List[Any], strict: bool = True):
+    """
+    Inverse of encode_tree.
+
+    Args:
+        strict: Raise an ImportError if the class of a stored namedtuple or dataclass cannot be imported. Otherwise, its fields are
+            returned as a dict
+    """
+    def _decode(node):
+        node_type = node["type"]
+        if node_type == "none":
+            return None
+        if node_type == "scalar":
+            return node["value"]
+        if node_type == "array":
+            return leaves[node["index"]]
+        children = [_decode(c) for c in node.get("children", [])]
+        if node_type == "dict":
+            return dict(zip(node["keys"], children))
+        if node_type == "list":
+            return children
+        if node_type == "tuple":
+            return tuple(children)
+        if node_type in ("namedtuple", "dataclass"):
+            return _build_object(node, children, strict)
+        raise ValueError(f"Unknown node type in tree structure: {node_type}")
+    return _decode(structure)
+
+
+def _compress(buffer, compression: str) -> bytes:
+    if compression == "zlib":
+        return zlib.compress(buffer, 1)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdCompressor(level=1).compress(buffer)
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.compress(buffer, compression_level=0)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _decompress(buffer: bytes, compression: str) -> bytes:
+    if compression == "zlib":
+        return zlib.decompress(buffer)
+    if compression == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(buffer)
+    if compression == "lz4":
+        import lz4.frame
+        return lz4.frame.decompress(buffer)
+    raise ValueError(f"Unknown compression: {compression}")
+
+
+def _get_dtype(name: str):
+    try:
+        return np.dtype(name)
+    except TypeError:
+        # Dtypes that are only known to jax, e.g. bfloat16
+        import jax.numpy as jnp
+        return jnp.dtype(name)
+
+
+def _get_bytes(leaf: np.ndarray):
+    leaf = np.require(leaf, requirements="C")  # unlike np.ascontiguousarray, this keeps 0-d arrays 0-d
+    return leaf.reshape(-1).view(np.uint8).data if leaf.size else b""
+
+
+class BlobStore:
+    """
+    Content-addressed storage of array buffers in a directory: Each buffer is stored as a file named by the SHA-256 of its content
+    (and its compression), so that a buffer, which is contained in many archives, is only written once.
+
+    The hashes are memoized per array object, i.e. storing the same (host) array in many archives only hashes it once. Arrays must
+    therefore not be modified in-place after they have been stored.
+
+    The store may be shared by several runs. Each run keeps a manifest (<directory>/refs/<run_id>.json) of the blobs it has created
+    and of the blobs referenced by each of its archives. Only blobs, which the run has created and which are neither referenced by
+    its own archives nor listed in the manifest of any other run, are deleted by delete_released.
+    """
+    def __init__(self, directory: str, run_id: Optional[str] = None):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(os.path.join(self.directory, _MANIFEST_DIR), exist_ok=True)
+        self._hashes = {}
+        self._lock = threading.Lock()
+        if run_id is None:
+            run_id = hashlib.sha256(os.getcwd().encode("utf-8")).hexdigest()[:16]
+        self.manifest_fname = os.path.join(self.directory, _MANIFEST_DIR, f"{run_id}.json")
+        # Restarting a run in the same directory continues its manifest
+        manifest = _read_manifest(self.manifest_fname)
+        self._created: Set[str] = set(manifest.get("created", []))
+        self._references: Dict[str, Set[str]] = {k: set(v) for k, v in manifest.get("archives", {}).items()}
+
+    def _get_hash(self, array: np.ndarray) -> str:
+        key = id(array)
+        ref, digest = self._hashes.get(key, (None, None))
+        if (ref is not None) and (ref() is array):
+            return digest
+        digest = hashlib.sha256(_get_bytes(array)).hexdigest()
+        try:
+            self._hashes[key] = (weakref.ref(array, lambda _, key=key: self._hashes.pop(key, None)), digest)
+        except TypeError:
+            pass  # objects which do not support weak references are hashed every time
+        return digest
+
+    def put(self, array: np.ndarray, compression: Optional[str] = None) -> str:
+        """Stores the buffer of an array (unless an identical buffer is already stored) and returns the name of its blob"""
+        blob = self._get_hash(array) + (f".{compression}" if compression else "")
+        fname = os.path.join(self.directory, blob)
+        if not os.path.exists(fname):
+            buffer = _get_bytes(array)
+            if compression is not None:
+                buffer = _compress(buffer, compression)
+            fname_tmp = f"{fname}.tmp{os.getpid()}"
+            try:
+                with open(fname_tmp, "wb") as f:
+                    f.write(buffer)
+                os.replace(fname_tmp, fname)
+            finally:
+                if os.path.exists(fname_tmp):
+                    os.remove(fname_tmp)
+            with self._lock:
+                self._created.add(blob)
+        return blob
+
+    def set_references(self, archive: str, blobs: Set[str]):
+        """Records the blobs referenced by an archive of this run (replacing the references of a previous archive of that name)"""
+        with self._lock:
+            self._references[os.path.abspath(archive)] = set(blobs)
+            self._write_manifest()
+
+    def release(self, archive: str):
+        """Drops the references of an archive of this run, e.g. because the archive has been deleted or overwritten"""
+        with self._lock:
+            if self._references.pop(os.path.abspath(archive), None) is not None:
+                self._write_manifest()
+
+    def delete_released(self) -> int:
+        """Deletes all blobs created by this run, which are no longer referenced by any archive, and returns their number"""
+        with self._lock:
+            referenced = set().union(*self._references.values())
+            manifest_dir = os.path.dirname(self.manifest_fname)
+            for fname in os.listdir(manifest_dir):
+                fname = os.path.join(manifest_dir, fname)
+                if fname.endswith(".json") and (fname != self.manifest_fname):
+                    manifest = _read_manifest(fname)
+                    referenced.update(manifest.get("created", []))
+                    referenced.update(*manifest.get("archives", {}).values())
+            released = self._created - referenced
+            for blob in released:
+                fname = os.path.join(self.directory, blob)
+                if os.path.exists(fname):
+                    os.remove(fname)
+            self._created -= released
+            if released:
+                self._write_manifest()
+        return len(released)
+
+    def _write_manifest(self):
+        manifest = dict(created=sorted(self._created), archives={k: sorted(v) for k, v in self._references.items()})
+        fname_tmp = f"{self.manifest_fname}.tmp{os.getpid()}"
+        with open(fname_tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(fname_tmp, self.manifest_fname)
+
+
+def _read_manifest(fname: str):
+    try:
+        with open(fname, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+
+
+def write_tree(zf: zipfile.ZipFile, name: str, tree, compression: Optional[str] = None,
+               blob_store: Optional[BlobStore] = None) -> Set[str]:
+    """
+    Writes a pytree as <name>.json (structure and leaf metadata) and <name>/<i> (raw leaf buffers) into an open zip file.
+
+    If a blob_store is given, the leaf buffers are stored in the blob store instead and only referenced (by a path relative to the
+    archive) in the metadata. Returns the names of the referenced blobs.
+    """
+    assert (compression is None) or (compression in COMPRESSIONS), f"Unknown compression: {compression}"
+    structure, leaves = encode_tree(tree)
+    if blob_store is not None:
+        blob_dir = os.path.relpath(blob_store.directory, os.path.dirname(os.path.abspath(zf.filename)))
+    leaves_meta = []
+    blobs = set()
+    for i, leaf in enumerate(leaves):
+        if blob_store is not None:
+            blob = blob_store.put(leaf, compression)
+            blobs.add(blob)
+            leaves_meta.append(dict(blob=blob, blob_dir=blob_dir, dtype=leaf.dtype.name,
+                                    shape=list(leaf.shape), compression=compression))
+            continue
+        leaf = np.require(leaf, requirements="C")
+        entry = f"{name}/{i}"
+        leaves_meta.append(dict(entry=entry, dtype=leaf.dtype.name, shape=list(leaf.shape), compression=compression))
+        if compression == "zlib":
+            zf.writestr(entry, leaf.tobytes(), compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+        elif compression is not None:
+            zf.writestr(zipfile.ZipInfo(entry), _compress(leaf.tobytes(), compression), compress_type=zipfile.ZIP_STORED)
+        else:
+            with zf.open(zipfile.ZipInfo(entry), "w", force_zip64=True) as f:
+                f.write(_get_bytes(leaf))
+    meta = dict(structure=structure, leaves=leaves_meta)
+    zf.writestr(f"{name}.json", json.dumps(meta), compress_type=zipfile.ZIP_DEFLATED)
+    return blobs
+
+
+def _get_data_offset(f, info: zipfile.ZipInfo) -> int:
+    """Offset of the (uncompressed) data of a zip entry within the archive file"""
+    f.seek(info.header_offset)
+    header = f.read(_ZIP_LOCAL_HEADER_SIZE)
+    assert header[:4] == b"PK\x03\x04", f"Invalid local file header for {info.filename}"
+    n_name, n_extra = struct.unpack("<HH", header[26:30])
+    return info.header_offset + _ZIP_LOCAL_HEADER_SIZE + n_name + n_extra
+
+
+def _get_blob_path(fname: str, leaf_meta) -> str:
+    return os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(fname)), leaf_meta["blob_dir"], leaf_meta["blob"]))
+
+
+def _read_blob(fname: str, leaf_meta, dtype, shape, mmap: bool):
+    blob_fname = _get_blob_path(fname, leaf_meta)
+    if (leaf_meta["compression"] is None) and mmap:
+        return np.memmap(blob_fname, dtype=dtype, mode="r", shape=(int(np.prod(shape)),)).reshape(shape)
+    with open(blob_fname, "rb") as f:
+        buffer = f.read()
+    if leaf_meta["compression"] is not None:
+        buffer = _decompress(buffer, leaf_meta["compression"])
+    return np.frombuffer(buffer, dtype=dtype).reshape(shape)
+
+
+def get_referenced_blobs(fname: str) -> Set[str]:
+    """Absolute paths of all blobs, which are referenced by the trees in an archive"""
+    blobs = set()
+    with zipfile.ZipFile(fname, "r") as zf:
+        for member in zf.namelist():
+            if not member.endswith(".json"):
+                continue
+            meta = json.loads(zf.read(member))
+            if not isinstance(meta, dict):
+                continue
+            for leaf_meta in meta.get("leaves", []):
+                if "blob" in leaf_meta:
+                    blobs.add(_get_blob_path(fname, leaf_meta))
+    return blobs
+
+
+def read_tree(fname: str, zf: zipfile.ZipFile, name: str, mmap: bool = False, strict: bool = True):
+    """
+    Reads a pytree, which has been written by write_tree.
+
+    With mmap=True, uncompressed leaves are returned as read-only numpy memmaps into the archive (or blob), i.e. they are only read
+    from disk when they are accessed. Otherwise (and for compressed leaves), leaves are read into memory.
+    See decode_tree for strict.
+    """
+    meta = json.loads(zf.read(f"{name}.json"))
+    leaves = []
+    with open(fname, "rb") as f:
+        for leaf_meta in meta["leaves"]:
+            dtype = _get_dtype(leaf_meta["dtype"])
+            shape = tuple(leaf_meta["shape"])
+            if int(np.prod(shape)) == 0:
+                leaves.append(np.zeros(shape, dtype))
+                continue
+            if "blob" in leaf_meta:
+                leaves.append(_read_blob(fname, leaf_meta, dtype, shape, mmap))
+                continue
+            info = zf.getinfo(leaf_meta["entry"])
+            if (leaf_meta["compression"] is None) and mmap and (info.compress_type == zipfile.ZIP_STORED):
+                leaf = np.memmap(fname, dtype=dtype, mode="r", offset=_get_data_offset(f, info), shape=(int(np.prod(shape)),))
+                leaf = leaf.reshape(shape)
+            else:
+                buffer = zf.read(info)
+                if leaf_meta["compression"] not in (None, "zlib"):
+                    buffer = _decompress(buffer, leaf_meta["compression"])
+                leaf = np.frombuffer(buffer, dtype=dtype).reshape(shape)
+            leaves.append(leaf)
+    return decode_tree(meta["structure"], leaves, strict)
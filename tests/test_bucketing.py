@@ -0,0 +1,74 @@
+import jax
+import numpy as np
+import pytest
+
+from deeperwin.bucketing import ShapeBucket, check_shape_bucketing_support, pad_fixed_params, pad_mcmc_state, unpad_mcmc_state
+from deeperwin.configuration import Configuration, LocalEnergyConfig
+from deeperwin.hamiltonian import build_local_energy_func
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+from deeperwin.model import build_log_psi_squared
+from deeperwin.orbitals import get_n_basis_per_Z
+
+
+def _get_bucketing_config(**extra_changes):
+    changes = {"model.name": "dpe4",
+               "model.embedding.name": "dpe4",
+               "model.embedding.n_iterations": 1,
+               "model.embedding.n_hidden_one_el": 32,
+               "model.features.concatenate_el_ion_features": False,
+               "model.orbitals.envelope_orbitals": None,
+               "model.orbitals.baseline_orbitals": None,
+               "model.orbitals.transferable_atomic_orbitals.name": "taos",
+               "model.orbitals.transferable_atomic_orbitals.atom_types": [1, 3],
+               "model.orbitals.n_determinants": 2,
+               "model.max_n_up_orbitals": 4,
+               "model.max_n_dn_orbitals": 4,
+               "model.max_n_ions": 3,
+               "optimization.shared_optimization.shape_bucketing.electron_bucket_size": 4,
+               **extra_changes}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+    return config
+
+
+def test_padding_does_not_change_wavefunction_and_local_energy():
+    config = _get_bucketing_config()
+    check_shape_bucketing_support(config)
+    phys_config = config.physical
+    tao_config = config.model.orbitals.transferable_atomic_orbitals
+    nb_orbitals_per_Z = get_n_basis_per_Z(tao_config.basis_set, tuple(tao_config.atom_types))
+    log_psi_sqr, _, _, params, fixed_params = build_log_psi_squared(config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z)
+
+    # LiH (2 up, 2 dn, 2 ions) padded with 2 ghost electrons per spin and 1 ghost ion
+    bucket = ShapeBucket(4, 4, 3)
+    mcmc_state = MCMCState.initialize_around_nuclei(5, phys_config, "gaussian", jax.random.PRNGKey(0))
+    padded_state = pad_mcmc_state(mcmc_state, phys_config, bucket)
+    padded_fixed_params = pad_fixed_params(fixed_params, phys_config, bucket)
+    spin_state, padded_spin_state = (phys_config.n_up, phys_config.n_dn), (bucket.n_up, bucket.n_dn)
+
+    log_psi = log_psi_sqr(params, *spin_state, *mcmc_state.build_batch(fixed_params))
+    log_psi_padded = log_psi_sqr(params, *padded_spin_state, *padded_state.build_batch(padded_fixed_params))
+    np.testing.assert_allclose(log_psi_padded, log_psi, rtol=1e-5, atol=1e-5)
+
+    local_energy_func = build_local_energy_func(LocalEnergyConfig(laplacian="loop"))
+    E_loc, _ = local_energy_func(log_psi_sqr, params, spin_state, *mcmc_state.build_batch(fixed_params))
+    E_loc_padded, _ = local_energy_func(log_psi_sqr, params, padded_spin_state, *padded_state.build_batch(padded_fixed_params))
+    np.testing.assert_allclose(E_loc_padded, E_loc, rtol=1e-4, atol=1e-4)
+
+    # Ghost electrons are never moved by the MCMC and are removed again without changing the real electrons
+    mcmc = MetropolisHastingsMonteCarlo(config.optimization.mcmc)
+    padded_state.log_psi_sqr = log_psi_padded
+    func = lambda s: log_psi_sqr(params, *padded_spin_state, *s.build_batch(padded_fixed_params))
+    step = jax.jit(jax.vmap(lambda s: mcmc.make_mcmc_step(func, s), axis_name="devices"))
+    padded_state_new = jax.tree_util.tree_map(lambda x: x[0], step(jax.tree_util.tree_map(lambda x: x[None], padded_state)))
+    is_ghost = np.array(padded_state.el_mask) == 0
+    np.testing.assert_array_equal(padded_state_new.r[:, is_ghost], padded_state.r[:, is_ghost])
+    assert np.any(padded_state_new.r[:, ~is_ghost] != padded_state.r[:, ~is_ghost])
+    unpadded_state = unpad_mcmc_state(padded_state, phys_config, bucket)
+    np.testing.assert_array_equal(unpadded_state.r, mcmc_state.r)
+    np.testing.assert_array_equal(unpadded_state.R, mcmc_state.R)
+
+
+def test_shape_bucketing_rejects_concatenated_el_ion_features():
+    config = _get_bucketing_config(**{"model.features.concatenate_el_ion_features": True})
+    with pytest.raises(NotImplementedError, match="concatenate_el_ion_features"):
+        check_shape_bucketing_support(config)
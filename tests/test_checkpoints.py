@@ -0,0 +1,142 @@
+import hashlib
+import os
+import zipfile
+
+import jax
+import jax.numpy as jnp
+import numpy as np
+import optax
+import pytest
+
+from deeperwin import checkpoints
+from deeperwin.checkpoints import LazyRunData, RunData, save_run, load_run, delete_obsolete_checkpoints, delete_unreferenced_blobs
+from deeperwin.configuration import CheckpointConfig
+from deeperwin.mcmc import MCMCState
+from deeperwin.utils.tensor_archive import BlobStore, encode_tree, decode_tree
+
+
+def _build_run_data():
+    params = dict(layer=dict(w=np.arange(6, dtype=np.float32).reshape(2, 3), b=jnp.zeros(3, dtype=jnp.bfloat16)))
+    mcmc_state = MCMCState(r=np.random.default_rng(0).normal(size=(4, 2, 3)), R=np.zeros((1, 3)), Z=np.ones(1),
+                           walker_age=np.zeros(4, dtype=int), stepsize=np.float64(0.1))
+    opt_state = (optax.ScaleByAdamState(count=np.array(3, dtype=np.int32), mu=params, nu=params), optax.EmptyState())
+    metadata = dict(n_epochs=10, E_mean=np.float64(-1.5), name="LiH", converged=True, empty=np.zeros((0, 3)), skipped=None,
+                    epochs=[1, 2.5, (3, "a")])
+    return RunData(params=params, mcmc_state=mcmc_state, opt_state=opt_state, metadata=metadata)
+
+
+def _assert_trees_equal(tree, expected):
+    assert jax.tree_util.tree_structure(tree) == jax.tree_util.tree_structure(expected)
+    for x, y in zip(jax.tree_util.tree_leaves(tree), jax.tree_util.tree_leaves(expected)):
+        if isinstance(y, (bool, int, float, str)) and not isinstance(y, np.generic):
+            assert type(x) == type(y)
+        else:
+            assert np.asarray(x).dtype == np.asarray(y).dtype
+        np.testing.assert_array_equal(np.asarray(x), np.asarray(y))
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+@pytest.mark.parametrize("mmap", [False, True])
+def test_tensor_checkpoint_round_trip(tmp_path, compression, mmap):
+    data = _build_run_data()
+    fname = str(tmp_path / "chkpt.zip")
+    save_run(fname, data, checkpoint_format="tensors", compression=compression)
+    loaded = load_run(fname, mmap=mmap)
+
+    for key in ["params", "mcmc_state", "opt_state", "metadata"]:
+        _assert_trees_equal(getattr(loaded, key), getattr(data, key))
+    assert isinstance(loaded.mcmc_state, MCMCState)
+    assert isinstance(loaded.opt_state[0], optax.ScaleByAdamState)
+    assert isinstance(loaded.metadata["epochs"][2], tuple)
+    # numpy scalars keep their dtype instead of becoming python floats
+    assert loaded.metadata["E_mean"].dtype == np.float64
+    assert loaded.params["layer"]["b"].dtype == jnp.bfloat16
+    if mmap and (compression is None):
+        assert isinstance(loaded.params["layer"]["w"], np.memmap)
+
+
+def test_decoding_unknown_class_is_strict():
+    structure, leaves = encode_tree(optax.ScaleByAdamState(count=np.array(1), mu=dict(w=np.ones(2)), nu=dict(w=np.zeros(2))))
+    structure["cls"] = "optax_renamed:ScaleByAdamState"
+    with pytest.raises(ImportError, match="strict=False"):
+        decode_tree(structure, leaves)
+
+    tree = decode_tree(structure, leaves, strict=False)
+    assert set(tree.keys()) == {"count", "mu", "nu"}
+    np.testing.assert_array_equal(tree["mu"]["w"], np.ones(2))
+
+
+@pytest.mark.parametrize("checkpoint_format", ["pickle", "tensors"])
+def test_load_selected_parts_lazily(tmp_path, monkeypatch, checkpoint_format):
+    data = _build_run_data()
+    data.config = dict(physical=dict(name="LiH"))
+    data.summary = dict(E_mean=-8.0)
+    fname = str(tmp_path / "chkpt.zip")
+    save_run(fname, data, checkpoint_format=checkpoint_format)
+
+    loaded = load_run(fname, parse_config=False, parts=["config", "params", "ema_params"])
+    assert loaded.config == data.config
+    _assert_trees_equal(loaded.params, data.params)
+    assert (loaded.ema_params is None) and (loaded.opt_state is None) and (loaded.mcmc_state is None) and (loaded.summary is None)
+    with pytest.raises(AssertionError, match="Unknown part"):
+        load_run(fname, parts=["parameters"])
+
+    # Count the decoded array fields of both formats
+    decoded_parts = []
+    read_tree, pickle_load = checkpoints.read_tree, checkpoints.pickle.load
+    monkeypatch.setattr(checkpoints, "read_tree", lambda *args: decoded_parts.append(args[2]) or read_tree(*args))
+    monkeypatch.setattr(checkpoints.pickle, "load", lambda f: decoded_parts.append(f.name) or pickle_load(f))
+
+    loaded = load_run(fname, parse_config=False, lazy=True)
+    assert isinstance(loaded, LazyRunData)
+    assert decoded_parts == []
+    _assert_trees_equal(loaded.opt_state, data.opt_state)
+    assert len(decoded_parts) == 1
+    _assert_trees_equal(loaded.opt_state, data.opt_state)
+    assert len(decoded_parts) == 1
+
+    # Assigning a part discards its loader, i.e. it is never read
+    loaded.params = None
+    assert loaded.params is None
+    assert len(decoded_parts) == 1
+    assert loaded.config == data.config
+    assert loaded.history is None
+
+
+def _get_blob_names(blob_dir):
+    return {f for f in os.listdir(blob_dir) if os.path.isfile(os.path.join(blob_dir, f))}
+
+
+def _get_blob_name(x):
+    return hashlib.sha256(x.tobytes()).hexdigest()
+
+
+def test_blob_store_deduplicates_and_collects_released_blobs(tmp_path):
+    blob_dir = str(tmp_path / "blobs")
+    shared_params = dict(w=np.arange(100, dtype=np.float32))
+    geom_arrays = {n_epoch: np.full(3, n_epoch, dtype=np.float32) for n_epoch in [50, 100, 200]}
+    # Another run sharing the blob store references the array of checkpoint 100
+    BlobStore(blob_dir, run_id="other_run").set_references(str(tmp_path / "other_run.zip"), {_get_blob_name(geom_arrays[100])})
+
+    for n_epoch, x in geom_arrays.items():
+        save_run(str(tmp_path / f"chkpt{n_epoch:06d}.zip"), RunData(params=shared_params, fixed_params=dict(x=x)),
+                 checkpoint_format="tensors", blob_dir=blob_dir)
+    # The shared parameters are only stored once; the archives only reference the blobs
+    assert _get_blob_names(blob_dir) == {_get_blob_name(x) for x in [shared_params["w"], *geom_arrays.values()]}
+    with zipfile.ZipFile(str(tmp_path / "chkpt000200.zip")) as zf:
+        assert not any(name.startswith("params/") for name in zf.namelist())
+
+    # Checkpoints 50 and 100 are deleted, but only the blob of checkpoint 50 is released, since the other run references the other one
+    blobs_before = _get_blob_names(blob_dir)
+    delete_obsolete_checkpoints(200, CheckpointConfig(keep_every_n_epochs=1000), directory=str(tmp_path))
+    delete_unreferenced_blobs(blob_dir)
+    assert blobs_before - _get_blob_names(blob_dir) == {_get_blob_name(geom_arrays[50])}
+
+    # Overwriting a checkpoint releases the blobs of its previous version
+    save_run(str(tmp_path / "chkpt000200.zip"), RunData(params=shared_params, fixed_params=dict(x=-geom_arrays[200])),
+             checkpoint_format="tensors", blob_dir=blob_dir)
+    delete_unreferenced_blobs(blob_dir)
+    assert _get_blob_names(blob_dir) == {_get_blob_name(x) for x in [shared_params["w"], geom_arrays[100], -geom_arrays[200]]}
+    loaded = load_run(str(tmp_path / "chkpt000200.zip"), mmap=True)
+    np.testing.assert_array_equal(loaded.params["w"], shared_params["w"])
+    np.testing.assert_array_equal(loaded.fixed_params["x"], -geom_arrays[200])
@@ -0,0 +1,63 @@
+import jax
+
+import deeperwin.optimization  # noqa: F401, deeperwin.optimizers must be imported through the optimization package (circular import)
+from deeperwin import optimizers
+from deeperwin.configuration import Configuration
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+from deeperwin.model import build_log_psi_squared
+from deeperwin.optimization import opt_utils
+from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+from deeperwin.orbitals import get_n_basis_per_Z
+from deeperwin.utils import compilation
+from deeperwin.utils.utils import replicate_across_devices
+
+
+def test_warmed_up_epoch_does_not_compile(monkeypatch):
+    changes = {"optimization.optimizer.name": "adam",
+               "optimization.local_energy.laplacian": "hutchinson",
+               "optimization.mcmc.n_walkers": 16,
+               "optimization.mcmc.n_burn_in": 2,
+               "optimization.mcmc.n_inter_steps": 2}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+    phys_config, opt_config = config.physical, config.optimization
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z
+    )
+
+    # Programs, which are called through call_program without an executable of the AOT warm-up, are compiled on their first call
+    monkeypatch.setattr(compilation, "_n_warmup_threads", 2)
+    monkeypatch.setattr(compilation, "_compiled_programs", dict())
+    not_warmed_up = []
+
+    def call_program_checked(func, *args, static_argnums=()):
+        if compilation._get_program_key(func, args, static_argnums) not in compilation._compiled_programs:
+            not_warmed_up.append(func)
+        return compilation.call_program(func, *args, static_argnums=static_argnums)
+    monkeypatch.setattr(opt_utils, "call_program", call_program_checked)
+    monkeypatch.setattr(optimizers, "call_program", call_program_checked)
+
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc = MetropolisHastingsMonteCarlo(opt_config.mcmc)
+    mcmc_state = MCMCState.initialize_around_nuclei(opt_config.mcmc.n_walkers, phys_config, "exponential", jax.random.PRNGKey(0))
+    params, fixed_params, clipping_state, rng = replicate_across_devices((params, fixed_params, init_clipping_state(), jax.random.PRNGKey(1)))
+    optimizer = optimizers.build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_sqr, opt_config.clipping, opt_config.local_energy),
+                                           opt_config=opt_config.optimizer,
+                                           value_func_has_aux=True,
+                                           value_func_has_state=True,
+                                           log_psi_squared_func=log_psi_sqr)
+    compile_times = opt_utils.warmup_optimization_programs(log_psi_sqr, cache_func, mcmc, optimizer, params, None, spin_state,
+                                                           mcmc_state, fixed_params, clipping_state, rng, laplacian_keys=True)
+    assert len(compile_times) > 0
+
+    mcmc_state, fixed_params = opt_utils._run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state, fixed_params,
+                                                              split_mcmc=True, merge_mcmc=False, mode="burnin", laplacian_keys=True)
+    opt_state = optimizer.init(params=params, rng=rng, batch=mcmc_state.build_batch(fixed_params), static_args=spin_state,
+                               func_state=clipping_state)
+    for _ in range(2):
+        mcmc_state, fixed_params = opt_utils._run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state,
+                                                                  fixed_params, split_mcmc=False, merge_mcmc=False, mode="intersteps",
+                                                                  laplacian_keys=True)
+        params, opt_state, clipping_state, _ = optimizer.step(params=params, state=opt_state, static_args=spin_state, rng=rng,
+                                                              batch=mcmc_state.build_batch(fixed_params), func_state=clipping_state)
+    assert not_warmed_up == []
@@ -0,0 +1,85 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+import deeperwin.optimization  # noqa: F401, deeperwin.optimizers must be imported through the optimization package (circular import)
+from deeperwin.configuration import Configuration
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+from deeperwin.model import build_log_psi_squared
+from deeperwin.optimization.epoch_engine import FusedEpochEngine
+from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+from deeperwin.optimization.opt_utils import _run_mcmc_with_cache
+from deeperwin.optimizers import build_optimizer
+from deeperwin.orbitals import get_n_basis_per_Z
+from deeperwin.utils.utils import replicate_across_devices
+
+
+def _copy(tree):
+    # The fused program donates its inputs
+    return jax.tree_util.tree_map(lambda x: jnp.array(x, copy=True), tree)
+
+
+def test_fused_epochs_match_epoch_loop():
+    changes = {"optimization.optimizer.name": "srcg",
+               "optimization.epochs_per_dispatch": 2,
+               "optimization.mcmc.n_walkers": 16,
+               "optimization.mcmc.n_burn_in": 2,
+               "optimization.mcmc.n_inter_steps": 2,
+               "model.embedding.n_iterations": 1,
+               "model.embedding.n_hidden_one_el": 32}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+    phys_config, opt_config = config.physical, config.optimization
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z
+    )
+
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc = MetropolisHastingsMonteCarlo(opt_config.mcmc)
+    optimizer = build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_sqr, opt_config.clipping, opt_config.local_energy),
+                                opt_config=opt_config.optimizer,
+                                value_func_has_aux=True,
+                                value_func_has_state=True,
+                                log_psi_squared_func=log_psi_sqr)
+    mcmc_state = MCMCState.initialize_around_nuclei(opt_config.mcmc.n_walkers, phys_config, "exponential", jax.random.PRNGKey(0))
+    params, fixed_params, clipping_state, rng = replicate_across_devices((params, fixed_params, init_clipping_state(), jax.random.PRNGKey(1)))
+    mcmc_state, fixed_params = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params, spin_state, mcmc_state, fixed_params,
+                                                    merge_mcmc=False, mode="burnin")
+    opt_state = optimizer.init(params=params, rng=rng, batch=mcmc_state.build_batch(fixed_params), static_args=spin_state,
+                               func_state=clipping_state)
+    initial_state = (params, opt_state, clipping_state, mcmc_state, fixed_params)
+
+    params_loop, opt_state_loop, clipping_state_loop, mcmc_state_loop, fixed_params_loop = _copy(initial_state)
+    E_loop = []
+    for _ in range(3):
+        mcmc_state_loop, fixed_params_loop = _run_mcmc_with_cache(log_psi_sqr, cache_func, mcmc, params_loop, spin_state, mcmc_state_loop,
+                                                                  fixed_params_loop, split_mcmc=False, merge_mcmc=False)
+        params_loop, opt_state_loop, clipping_state_loop, stats = optimizer.step(params=params_loop,
+                                                                                 state=opt_state_loop,
+                                                                                 static_args=spin_state,
+                                                                                 rng=rng,
+                                                                                 batch=mcmc_state_loop.build_batch(fixed_params_loop),
+                                                                                 func_state=clipping_state_loop)
+        E_loop.append(stats["aux"]["E_mean"][0])
+
+    # The first dispatch always runs a single epoch (see FusedEpochEngine.get_n_epochs)
+    engine = FusedEpochEngine(log_psi_sqr, cache_func, mcmc, optimizer, opt_config.epochs_per_dispatch)
+    params_fused, opt_state_fused, clipping_state_fused, mcmc_state_fused, fixed_params_fused = _copy(initial_state)
+    E_fused = []
+    for n_epoch, n_epochs_expected in [(0, 1), (1, 2)]:
+        n_epochs = engine.get_n_epochs(n_epoch, 3, lambda n: False)
+        assert n_epochs == n_epochs_expected
+        params_fused, opt_state_fused, clipping_state_fused, mcmc_state_fused, fixed_params_fused, metrics = engine.run(
+            params_fused, opt_state_fused, clipping_state_fused, mcmc_state_fused, fixed_params_fused, spin_state, rng, n_epochs)
+        E_fused.extend(metrics["E_mean"])
+
+    np.testing.assert_allclose(E_fused, E_loop, rtol=1e-4)
+    np.testing.assert_allclose(mcmc_state_fused.r, mcmc_state_loop.r, rtol=1e-4, atol=1e-5)
+    jax.tree_util.tree_map(lambda x, y: np.testing.assert_allclose(x, y, rtol=1e-3, atol=1e-5), params_fused, params_loop)
+
+
+def test_fused_epochs_rejected_for_kfac():
+    changes = {"optimization.optimizer.name": "kfac", "optimization.epochs_per_dispatch": 2}
+    with pytest.raises(ValueError, match="epochs_per_dispatch"):
+        Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
@@ -0,0 +1,106 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from deeperwin.configuration import Configuration, LocalEnergyConfig
+from deeperwin.hamiltonian import build_local_energy_func, get_kinetic_energy, get_kinetic_energy_forward_laplacian, \
+    get_kinetic_energy_hutchinson
+from deeperwin.mcmc import MCMCState
+from deeperwin.model import build_log_psi_squared
+from deeperwin.orbitals import get_n_basis_per_Z
+from deeperwin.utils.forward_laplacian import forward_laplacian
+
+
+def _build_model(molecule):
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name=molecule)), {})
+    phys_config = config.physical
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z
+    )
+    return phys_config, log_psi_sqr, cache_func, params, fixed_params
+
+
+def test_forward_laplacian_of_toy_function():
+    W = jax.random.normal(jax.random.PRNGKey(0), (3, 4))
+
+    def func(r):
+        h = jnp.tanh(r @ W)
+        dist = jnp.linalg.norm(r[:, None, :] - r[None, :, :] + jnp.eye(r.shape[0])[..., None], axis=-1)
+        return jnp.linalg.slogdet(h[:, :r.shape[0]] * jnp.exp(-dist))[1] + jnp.sum(jax.nn.softplus(h) / dist)
+
+    r = jax.random.normal(jax.random.PRNGKey(1), (4, 3))
+    value, grad, laplacian = forward_laplacian(func)(r)
+    flat_func = lambda x: func(x.reshape(r.shape))
+    np.testing.assert_allclose(value, func(r), rtol=1e-5)
+    np.testing.assert_allclose(grad, jax.grad(func)(r), rtol=1e-4, atol=1e-5)
+    np.testing.assert_allclose(laplacian, jnp.trace(jax.hessian(flat_func)(r.flatten())), rtol=1e-4, atol=1e-4)
+
+
+def test_forward_laplacian_matches_loop():
+    phys_config, log_psi_sqr, cache_func, params, fixed_params = _build_model("LiH")
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc_state = MCMCState.initialize_around_nuclei(8, phys_config, "exponential", jax.random.PRNGKey(0))
+    r, R, Z, fixed_params = mcmc_state.build_batch(fixed_params)
+    fixed_params["cache"] = cache_func(params, *spin_state, r, R, Z, fixed_params)
+
+    E_kin_loop = jax.vmap(get_kinetic_energy, in_axes=(None, None, None, 0, None, None, None))(
+        log_psi_sqr, params, spin_state, r, R, Z, fixed_params)
+    E_kin_forward = jax.vmap(get_kinetic_energy_forward_laplacian, in_axes=(None, None, None, 0, None, None, None))(
+        log_psi_sqr, params, spin_state, r, R, Z, fixed_params)
+    np.testing.assert_allclose(E_kin_forward, E_kin_loop, rtol=1e-3, atol=1e-3)
+
+    E_loc_loop, _ = build_local_energy_func(LocalEnergyConfig(laplacian="loop"))(log_psi_sqr, params, spin_state, r, R, Z, fixed_params)
+    E_loc_forward, _ = build_local_energy_func(LocalEnergyConfig(laplacian="forward"))(log_psi_sqr, params, spin_state, r, R, Z,
+                                                                                        fixed_params)
+    np.testing.assert_allclose(E_loc_forward, E_loc_loop, rtol=1e-3, atol=1e-3)
+
+
+def _toy_log_psi_sqr(params, n_up, n_dn, r, R, Z, fixed_params):
+    dist_el_ion = jnp.linalg.norm(r[..., :, None, :] - R, axis=-1)
+    return jnp.sum(jnp.tanh(r @ params["W"]) ** 2, axis=(-2, -1)) - 2 * jnp.sum(Z * dist_el_ion, axis=(-2, -1))
+
+
+def test_hutchinson_laplacian_is_unbiased():
+    n_keys, n_probes = 4000, 2
+    params = dict(W=jax.random.normal(jax.random.PRNGKey(0), (3, 5)))
+    r = jax.random.normal(jax.random.PRNGKey(1), (4, 3))
+    R, Z = jnp.array([[0.0, 0.0, 0.0], [1.5, 0.0, 0.0]]), jnp.array([3.0, 1.0])
+    spin_state = (2, 2)
+
+    E_kin_exact = get_kinetic_energy(_toy_log_psi_sqr, params, spin_state, r, R, Z, {})
+    E_kin, E_kin_var = jax.vmap(lambda k: get_kinetic_energy_hutchinson(_toy_log_psi_sqr, params, spin_state, r, R, Z, {}, k, n_probes))(
+        jax.random.split(jax.random.PRNGKey(2), n_keys))
+    assert np.std(E_kin) > 0
+    # The mean over independent estimates converges to the exact kinetic energy; the reported variance is the one of a single estimate
+    assert np.abs(np.mean(E_kin) - E_kin_exact) < 5 * np.sqrt(np.mean(E_kin_var) / n_keys)
+    np.testing.assert_allclose(np.mean(E_kin_var), np.var(E_kin), rtol=0.2)
+
+    # Same for local energies, where every walker draws its probes from its own key in fixed_params['rng_laplacian']
+    r_batch = jnp.tile(r, (n_keys, 1, 1))
+    fixed_params = dict(rng_laplacian=jax.random.split(jax.random.PRNGKey(3), n_keys))
+    E_loc, E_loc_var = build_local_energy_func(LocalEnergyConfig(laplacian="hutchinson", n_hutchinson_probes=n_probes))(
+        _toy_log_psi_sqr, params, spin_state, r_batch, R, Z, fixed_params)
+    E_loc_exact, _ = build_local_energy_func(LocalEnergyConfig(laplacian="loop"))(_toy_log_psi_sqr, params, spin_state, r[None], R, Z, {})
+    assert np.abs(np.mean(E_loc) - E_loc_exact[0]) < 5 * np.sqrt(np.mean(E_loc_var) / n_keys)
+
+
+def test_chunked_local_energy_matches_unchunked():
+    phys_config, log_psi_sqr, cache_func, params, fixed_params = _build_model("LiH")
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc_state = MCMCState.initialize_around_nuclei(7, phys_config, "exponential", jax.random.PRNGKey(0))
+    r, R, Z, fixed_params = mcmc_state.build_batch(fixed_params)
+    fixed_params["cache"] = cache_func(params, *spin_state, r, R, Z, fixed_params)
+
+    # 7 walkers in chunks of 3: the last chunk is padded
+    for laplacian in ["loop", "hutchinson"]:
+        fixed_params_walkers = dict(fixed_params)
+        if laplacian == "hutchinson":
+            fixed_params_walkers["rng_laplacian"] = jax.random.split(jax.random.PRNGKey(1), len(r))
+        E_loc, E_loc_var = build_local_energy_func(LocalEnergyConfig(laplacian=laplacian))(
+            log_psi_sqr, params, spin_state, r, R, Z, fixed_params_walkers)
+        E_loc_chunked, E_loc_var_chunked = build_local_energy_func(LocalEnergyConfig(laplacian=laplacian, chunk_size=3))(
+            log_psi_sqr, params, spin_state, r, R, Z, fixed_params_walkers)
+        assert E_loc_chunked.shape == (len(r),)
+        np.testing.assert_allclose(E_loc_chunked, E_loc, rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(E_loc_var_chunked, E_loc_var, rtol=1e-3, atol=1e-3)
@@ -0,0 +1,61 @@
+import os
+
+import numpy as np
+
+from deeperwin.checkpoints import RunData, save_run, load_run, load_history_reference
+from deeperwin.utils.history_store import HistoryWriter, read_history
+
+
+def _write_epochs(writer, epochs):
+    for epoch in epochs:
+        writer.append(dict(epoch=epoch, E=-1.0 - epoch))
+    return writer.get_reference()
+
+
+def test_resume_truncates_rows_after_checkpoint(tmp_path):
+    fname = str(tmp_path / "history.bin")
+    writer = HistoryWriter(fname, flush_every=2)
+    ref_checkpoint = _write_epochs(writer, range(3))
+    _write_epochs(writer, range(3, 6))
+    with open(fname, "ab") as f:
+        f.write(b"incomplete chunk")
+
+    writer = HistoryWriter(fname, flush_every=2, resume_from=ref_checkpoint)
+    assert writer.n_rows == 3
+    ref = _write_epochs(writer, range(3, 5))
+    assert ref.n_rows == 5
+    assert ref.n_bytes == os.path.getsize(fname)
+
+    history = read_history(fname)
+    np.testing.assert_array_equal(history["epoch"], np.arange(5))
+    np.testing.assert_allclose(history["E"], -1.0 - np.arange(5))
+
+
+def test_unreferenced_history_is_not_continued(tmp_path):
+    fname = str(tmp_path / "history.bin")
+    _write_epochs(HistoryWriter(fname), range(3))
+    other_ref = _write_epochs(HistoryWriter(str(tmp_path / "other.bin")), range(2))
+
+    writer = HistoryWriter(fname, resume_from=other_ref)
+    assert writer.n_rows == 0
+    _write_epochs(writer, [10])
+    np.testing.assert_array_equal(read_history(fname)["epoch"], [10])
+    np.testing.assert_array_equal(read_history(fname + ".old")["epoch"], np.arange(3))
+
+
+def test_checkpoint_references_history_rows(tmp_path):
+    writer = HistoryWriter(str(tmp_path / "history.bin"))
+    ref = _write_epochs(writer, range(3))
+    fname = str(tmp_path / "chkpt000003.zip")
+    save_run(fname, RunData(history=ref))
+    _write_epochs(writer, range(3, 5))
+
+    assert load_history_reference(fname) == ref
+    history = load_run(fname, parts=["history"]).history
+    np.testing.assert_array_equal(history["epoch"], np.arange(3))
+
+    fname_exported = str(tmp_path / "exported.zip")
+    save_run(fname_exported, RunData(history=ref), embed_history=True)
+    os.remove(tmp_path / "history.bin")
+    assert load_history_reference(fname_exported) is None
+    np.testing.assert_array_equal(load_run(fname_exported, parts=["history"]).history["epoch"], np.arange(3))
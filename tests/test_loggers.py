@@ -0,0 +1,48 @@
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from deeperwin.loggers import MetricsBuffer
+
+
+class _RecordingLogger:
+    def __init__(self):
+        self.steps = []
+
+    def log_step(self, metrics, E_ref=None, extra_metrics=None, epoch=None):
+        self.steps.append((metrics, extra_metrics, epoch))
+
+
+@pytest.mark.parametrize("use_thread", [False, True])
+def test_metrics_buffer_flushes_in_bulk(use_thread):
+    logger = _RecordingLogger()
+    buffer = MetricsBuffer(flush_every=3, use_thread=use_thread)
+    for n_epoch in range(2):
+        buffer.push(logger, dict(E_mean=jnp.array(-1.0 - n_epoch)), n_epoch)
+    assert logger.steps == []
+
+    # Fused epochs carry a leading axis of length n_epochs and complete the batch
+    buffer.push(logger, dict(E_mean=-jnp.arange(3.0, 5.0)), 2, n_epochs=2)
+    buffer.flush()
+    assert [m["E_mean"] for m, _, _ in logger.steps] == [-1.0, -2.0, -3.0, -4.0]
+    assert all(isinstance(m["E_mean"], float) and ("t_epoch" in m) for m, _, _ in logger.steps)
+
+    buffer.push(logger, dict(E_mean=jnp.array(-5.0)), 4)
+    buffer.close()
+    assert len(logger.steps) == 5
+
+
+def test_metrics_buffer_detects_first_non_finite_energy():
+    loggers = [_RecordingLogger(), _RecordingLogger()]
+    buffer = MetricsBuffer(flush_every=4)
+    energies = [-1.0, np.nan, np.inf, -1.0]
+    for n_epoch, E in enumerate(energies):
+        assert buffer.non_finite_epoch is None
+        idx_geom = n_epoch % 2
+        buffer.push(loggers[idx_geom], dict(E_mean=jnp.array(E)), n_epoch, epoch=n_epoch // 2, extra_metrics=dict(geom_id=idx_geom))
+    buffer.close()
+
+    assert buffer.non_finite_epoch == 1
+    assert np.isnan(buffer.non_finite_energy)
+    assert buffer.non_finite_extra_metrics == dict(geom_id=1)
+    assert [epoch for _, _, epoch in loggers[1].steps] == [0, 1]
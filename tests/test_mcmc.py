@@ -0,0 +1,120 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+from deeperwin.configuration import MCMCAdaptiveInterStepsConfig, MCMCConfig, MCMCSimpleProposalConfig
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+
+
+def _build_gaussian_state(n_walkers, std, rng):
+    r = jax.random.normal(rng, (n_walkers, 1, 3)) * std
+    state = MCMCState(r=r, R=jnp.zeros((1, 3)), Z=jnp.ones(1), walker_age=jnp.zeros(n_walkers, dtype=int),
+                      rng_state=jax.random.split(jax.random.fold_in(rng, 1), n_walkers), stepsize=jnp.array(1.0))
+    return state
+
+
+def _log_gaussian(state, std):
+    return -0.5 * jnp.sum(state.r ** 2, axis=(-2, -1)) / std ** 2
+
+
+def _run_on_device_axis(func, state):
+    # Only pmean/psum over the (single) device axis is required, which is provided by vmap
+    state = jax.tree_util.tree_map(lambda x: x[None], state)
+    outputs = jax.jit(jax.vmap(func, axis_name="devices"))(state)
+    return jax.tree_util.tree_map(lambda x: x[0], outputs)
+
+
+def _run_delayed_acceptance(mcmc, state, std_full, std_surrogate, n_steps):
+    def _run(s):
+        def func(s):
+            return _log_gaussian(s, std_full)
+
+        def surrogate_func(s):
+            return _log_gaussian(s, std_surrogate)
+
+        s.log_psi_sqr = func(s)
+        s.log_psi_sqr_surrogate = surrogate_func(s)
+        s.acc_rate_stage1 = s.acc_rate_stage2 = jnp.zeros_like(s.acc_rate)
+        return jax.lax.fori_loop(0, n_steps, lambda i, s: mcmc.make_mcmc_step_delayed_acceptance(func, surrogate_func, s), s)
+
+    return _run_on_device_axis(_run, state)
+
+
+def test_delayed_acceptance_samples_full_density():
+    std_full, std_surrogate = 1.0, 0.7
+    mcmc_config = MCMCConfig(n_inter_steps=1, n_burn_in=0, max_age=1000, stepsize_update_interval=1000000,
+                             proposal=MCMCSimpleProposalConfig(name="normal"), delayed_acceptance=True, delayed_acceptance_capacity=1.0)
+    mcmc = MetropolisHastingsMonteCarlo(mcmc_config)
+
+    # Walkers start in equilibrium w.r.t. the surrogate and must relax to the full density
+    state = _build_gaussian_state(4000, std_surrogate, jax.random.PRNGKey(0))
+    state = _run_delayed_acceptance(mcmc, state, std_full, std_surrogate, 1000)
+    r = np.array(state.r).reshape([-1, 3])
+    np.testing.assert_allclose(np.mean(r, axis=0), 0.0, atol=0.05)
+    np.testing.assert_allclose(np.var(r, axis=0), std_full ** 2, rtol=0.05)
+    assert 0 < state.acc_rate_stage2 < 1
+
+
+def test_delayed_acceptance_compaction_does_not_change_chain():
+    std_full, std_surrogate = 1.0, 0.5
+    states = []
+    for capacity in [1.0, 0.3]:
+        mcmc_config = MCMCConfig(n_inter_steps=1, n_burn_in=0, max_age=5, stepsize_update_interval=10,
+                                 proposal=MCMCSimpleProposalConfig(name="normal"), delayed_acceptance=True,
+                                 delayed_acceptance_capacity=capacity)
+        state = _build_gaussian_state(64, std_full, jax.random.PRNGKey(0))
+        states.append(_run_delayed_acceptance(MetropolisHastingsMonteCarlo(mcmc_config), state, std_full, std_surrogate, 50))
+    np.testing.assert_allclose(states[1].r, states[0].r, rtol=1e-6, atol=1e-6)
+    np.testing.assert_allclose(states[1].log_psi_sqr, states[0].log_psi_sqr, rtol=1e-6, atol=1e-6)
+    np.testing.assert_array_equal(states[1].walker_age, states[0].walker_age)
+
+
+def _get_lag1_autocorr_time(observables):
+    """Reference estimate of tau = (1 + rho) / (1 - rho) from recorded observables [n_steps+1 x batch x n_obs]"""
+    obs_old, obs_new = observables[:-1], observables[1:]
+    obs_mean = np.mean(obs_old, axis=1, keepdims=True)
+    rho = np.sum((obs_old - obs_mean) * (obs_new - obs_mean), axis=(0, 1)) / np.sum((obs_old - obs_mean) ** 2, axis=(0, 1))
+    rho = np.clip(rho, 0.0, 0.999)
+    return np.max((1 + rho) / (1 - rho))
+
+
+def test_adaptive_inter_steps_estimate_autocorrelation_time():
+    config = MCMCAdaptiveInterStepsConfig(min_inter_steps=2, max_inter_steps=100, target_tau_factor=2.0, smoothing=0.9)
+    n_steps = 20
+
+    def log_psi_sqr(params, n_up, n_dn, r, R, Z, fixed_params):
+        return -0.5 * jnp.sum(r ** 2, axis=(-2, -1))
+
+    autocorr_times = []
+    for stepsize in [0.1, 1.0]:
+        mcmc_config = MCMCConfig(n_inter_steps=n_steps, n_burn_in=0, max_age=1000, stepsize_update_interval=1000000,
+                                 proposal=MCMCSimpleProposalConfig(name="normal"), adaptive_inter_steps=config)
+        mcmc = MetropolisHastingsMonteCarlo(mcmc_config)
+        state = _build_gaussian_state(1000, 1.0, jax.random.PRNGKey(0))
+        state.stepsize = jnp.array(stepsize)
+        state.log_psi_sqr = log_psi_sqr(None, 1, 0, state.r, state.R, state.Z, None)
+
+        # Reference: record the (deterministic) chain step by step
+        def _record(s):
+            func = lambda s: log_psi_sqr(None, 1, 0, *s.build_batch(None))
+            get_obs = lambda s: jnp.stack([s.log_psi_sqr, jnp.mean(jnp.linalg.norm(s.r, axis=-1), axis=-1)], axis=-1)
+            def _step(s, _):
+                s = mcmc.make_mcmc_step(func, s)
+                return s, get_obs(s)
+            _, observables = jax.lax.scan(_step, s, None, length=n_steps)
+            return jnp.concatenate([get_obs(s)[None], observables], axis=0)
+        tau_ref = _get_lag1_autocorr_time(np.array(_run_on_device_axis(_record, state), dtype=np.float64))
+
+        run = lambda s: mcmc._run_inter_steps(log_psi_sqr, s, None, 1, 0, None)
+        state = _run_on_device_axis(run, state)
+        np.testing.assert_allclose(state.autocorr_time, tau_ref, rtol=1e-3)
+        assert state.n_inter_steps == np.clip(np.ceil(2.0 * state.autocorr_time), 2, 100)
+
+        # Subsequent runs smooth the estimate over epochs and use the adapted number of steps
+        tau_first = state.autocorr_time
+        state = _run_on_device_axis(run, state)
+        assert np.isclose(state.autocorr_time, tau_first, rtol=0.5) and (state.autocorr_time != tau_first)
+        autocorr_times.append(float(state.autocorr_time))
+
+    # Small steps decorrelate the chain more slowly
+    assert autocorr_times[0] > 2 * autocorr_times[1] > 2
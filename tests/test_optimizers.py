@@ -0,0 +1,59 @@
+import jax
+import numpy as np
+
+import deeperwin.optimization  # noqa: F401, deeperwin.optimizers must be imported through the optimization package (circular import)
+from deeperwin import optimizers
+from deeperwin.configuration import Configuration
+from deeperwin.mcmc import MCMCState
+from deeperwin.model import build_log_psi_squared
+from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+from deeperwin.orbitals import get_n_basis_per_Z
+from deeperwin.utils.utils import replicate_across_devices
+
+
+def test_async_inverse_kfac_overrides_inverse_update(monkeypatch):
+    # Relies on the private kfac_jax.Optimizer._maybe_update_inverse_cache(self, state) of the kfac-jax fork pinned in setup.cfg
+    changes = {"optimization.optimizer.async_inverses": True,
+               "optimization.optimizer.update_inverse_period": 1,
+               "optimization.optimizer.max_inverse_staleness": 1,
+               "optimization.mcmc.n_walkers": 16}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+    phys_config, opt_config = config.physical, config.optimization
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, _, params, fixed_params = build_log_psi_squared(config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z)
+
+    n_overridden_calls = []
+    override = optimizers.AsyncInverseKFACOptimizer._maybe_update_inverse_cache
+    def _maybe_update_inverse_cache(self, state):
+        n_overridden_calls.append(1)
+        return override(self, state)
+    monkeypatch.setattr(optimizers.AsyncInverseKFACOptimizer, "_maybe_update_inverse_cache", _maybe_update_inverse_cache)
+
+    optimizer = optimizers.build_optimizer(value_and_grad_func=build_value_and_grad_func(log_psi_sqr, opt_config.clipping,
+                                                                                         opt_config.local_energy),
+                                           opt_config=opt_config.optimizer,
+                                           value_func_has_aux=True,
+                                           value_func_has_state=True,
+                                           log_psi_squared_func=log_psi_sqr)
+    assert isinstance(optimizer, optimizers.AsyncInverseKFACOptimizer)
+
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc_state = MCMCState.initialize_around_nuclei(opt_config.mcmc.n_walkers, phys_config, "exponential", jax.random.PRNGKey(0))
+    mcmc_state = mcmc_state.split_across_devices()
+    params, fixed_params, clipping_state, rng = replicate_across_devices((params, fixed_params, init_clipping_state(), jax.random.PRNGKey(1)))
+    batch = mcmc_state.build_batch(fixed_params)
+    opt_state = optimizer.init(params=params, rng=rng, batch=batch, static_args=spin_state, func_state=clipping_state)
+
+    staleness = []
+    for _ in range(3):
+        params, opt_state, clipping_state, stats = optimizer.step(params=params, state=opt_state, static_args=spin_state, rng=rng,
+                                                                  batch=batch, func_state=clipping_state)
+        staleness.append(int(stats["inverse_staleness"][0]))
+    optimizer.close()
+
+    # The step of kfac_jax calls the override instead of updating the inverses inline (except for the very first step)
+    assert len(n_overridden_calls) > 0
+    # The first step uses inline inverses; afterwards the inverses of the host are swapped in and are never older than 1 step
+    assert staleness == [0, 1, 1]
+    assert stats["inverse_time"][0] > 0
+    assert all(np.all(np.isfinite(p)) for p in jax.tree_util.tree_leaves(params))
@@ -0,0 +1,88 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+import pytest
+
+from deeperwin.configuration import Configuration, MCMCConfigPreTrain, MCMCSimpleProposalConfig
+from deeperwin.mcmc import MetropolisHastingsMonteCarlo, MCMCState
+from deeperwin.model import init_model_fixed_params, get_baseline_slater_matrices, get_baseline_slater_row
+from deeperwin.model.wavefunction import get_full_slater_matrix
+from deeperwin.utils.utils import get_el_ion_distance_matrix
+
+
+def _build_baseline_orbitals(molecule, determinant_schema):
+    changes = {"model.orbitals.envelope_orbitals": None,
+               "model.orbitals.baseline_orbitals.use_bf_shift": True,
+               "model.orbitals.n_determinants": 1,
+               "model.orbitals.determinant_schema": determinant_schema}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name=molecule)), changes)
+    fixed_params = init_model_fixed_params(config.model, config.physical, None, None)
+    return config, fixed_params["orbitals"]
+
+
+@pytest.mark.parametrize("determinant_schema", ["block_diag", "full_det"])
+def test_baseline_slater_row_matches_full_matrix(determinant_schema):
+    config, orbitals = _build_baseline_orbitals("LiH", determinant_schema)
+    n_el = config.physical.n_electrons
+    R = np.array(config.physical.R)
+    r = np.array(jax.random.normal(jax.random.PRNGKey(0), (5, n_el, 3)))
+
+    full_matrix = get_full_slater_matrix(*get_baseline_slater_matrices(*get_el_ion_distance_matrix(r, R), orbitals, determinant_schema))
+    for index in range(n_el):
+        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(r[:, index:index + 1, :], R)
+        row = get_baseline_slater_row(diff_el_ion[:, 0], dist_el_ion[:, 0], orbitals, index)
+        np.testing.assert_allclose(row, full_matrix[..., index, :], rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("determinant_schema", ["block_diag", "full_det"])
+def test_sherman_morrison_step_matches_fresh_determinant(determinant_schema):
+    config, orbitals = _build_baseline_orbitals("LiH", determinant_schema)
+    n_el, n_walkers = config.physical.n_electrons, 8
+    mcmc_config = MCMCConfigPreTrain(proposal=MCMCSimpleProposalConfig(name="normal_one_el"),
+                                     determinant_updates="sherman_morrison",
+                                     determinant_refresh_interval=1000)
+
+    def slater_func(state):
+        return get_baseline_slater_matrices(*get_el_ion_distance_matrix(state.r, state.R), orbitals, determinant_schema)
+
+    def slater_row_func(state, index):
+        diff_el_ion, dist_el_ion = get_el_ion_distance_matrix(jnp.take(state.r, index, axis=-2)[..., None, :], state.R)
+        return get_baseline_slater_row(diff_el_ion[..., 0, :, :], dist_el_ion[..., 0, :], orbitals, index)
+
+    mcmc = MetropolisHastingsMonteCarlo(mcmc_config, slater_func, slater_row_func)
+    # Only pmean over the (single) device axis is required, which is provided by vmap
+    step = jax.jit(jax.vmap(lambda s: mcmc.make_mcmc_step_sherman_morrison(slater_func, slater_row_func, s), axis_name="devices"))
+
+    state = MCMCState.initialize_around_nuclei(n_walkers, config.physical, "gaussian", jax.random.PRNGKey(0))
+    state.stepsize = jnp.array(0.3)
+    state = mcmc._init_determinant_state(slater_func, state)
+    state = jax.tree_util.tree_map(lambda x: x[None], state)
+
+    # First half of the walkers is forced to accept, second half is forced to reject
+    is_accepted = np.arange(n_walkers) < n_walkers // 2
+    for _ in range(2 * n_el):
+        state.log_psi_sqr = jnp.where(is_accepted, -1e10, 1e10)[None]
+        state_new = step(state)
+        has_moved = np.any(state_new.r != state.r, axis=(-2, -1))[0]
+        np.testing.assert_array_equal(has_moved, is_accepted)
+
+        sign_ref, log_det_ref = np.linalg.slogdet(get_full_slater_matrix(*slater_func(state_new)))
+        np.testing.assert_allclose(state_new.log_det, log_det_ref, rtol=1e-4, atol=1e-4)
+        np.testing.assert_array_equal(state_new.sign_det, sign_ref)
+        log_det_ratio = state_new.log_det - state.log_det
+        np.testing.assert_array_equal(log_det_ratio[0][~is_accepted], 0.0)
+
+        mo_matrix = np.array(get_full_slater_matrix(*slater_func(state_new)), dtype=np.float64)
+        np.testing.assert_allclose(np.array(state_new.mo_inv), np.linalg.inv(mo_matrix), rtol=1e-2, atol=1e-3)
+        state = state_new
+
+
+def test_sherman_morrison_rejected_for_wavefunction_sampling():
+    changes = {"optimization.mcmc.proposal.name": "normal_one_el", "optimization.mcmc.determinant_updates": "sherman_morrison"}
+    with pytest.raises(ValueError, match="determinant_updates"):
+        Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+
+    changes = {"pre_training.mcmc.proposal.name": "normal_one_el", "pre_training.mcmc.determinant_updates": "sherman_morrison",
+               "pre_training.sampling_density": "reference"}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+    assert config.pre_training.mcmc.determinant_updates == "sherman_morrison"
@@ -0,0 +1,111 @@
+import jax
+import jax.numpy as jnp
+import numpy as np
+from jax.flatten_util import ravel_pytree
+
+import deeperwin.optimization  # noqa: F401, deeperwin.srcg must be imported through the optimization package (circular import)
+from deeperwin.configuration import Configuration, SRCGOptimizerConfig
+from deeperwin.mcmc import MCMCState
+from deeperwin.model import build_log_psi_squared
+from deeperwin.model.mlp import dense_layers_in_dtype
+from deeperwin.optimization.loss_function import build_value_and_grad_func, init_clipping_state
+from deeperwin.orbitals import get_n_basis_per_Z
+from deeperwin.srcg import SRCGOptimizer
+from deeperwin.utils.utils import replicate_across_devices, without_cache
+
+
+def _build_gnn_model(molecule):
+    changes = {"model.embedding.name": "gnn", "model.embedding.ion_gnn.name": "ion_gnn"}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name=molecule)), changes)
+    phys_config = config.physical
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, cache_func, params, fixed_params = build_log_psi_squared(
+        config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z
+    )
+    return phys_config, log_psi_sqr, cache_func, params, fixed_params
+
+
+def test_jacobian_includes_cached_ion_embedding():
+    phys_config, log_psi_sqr, cache_func, params, fixed_params = _build_gnn_model("LiH")
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc_state = MCMCState.initialize_around_nuclei(8, phys_config, "exponential", jax.random.PRNGKey(0))
+    r, R, Z, fixed_params = mcmc_state.build_batch(fixed_params)
+    fixed_params["cache"] = cache_func(params, *spin_state, r, R, Z, fixed_params)
+    assert "ion_embedding" in fixed_params["cache"]
+
+    optimizer = SRCGOptimizer(log_psi_sqr, None, SRCGOptimizerConfig())
+    jac_cached = optimizer._get_jacobian(params, spin_state, (r, R, Z, fixed_params))
+    jac_uncached = optimizer._get_jacobian(params, spin_state, (r, R, Z, without_cache(fixed_params)))
+    np.testing.assert_allclose(jac_cached, jac_uncached, rtol=1e-4, atol=1e-6)
+
+    is_ion_param = {module: jax.tree_util.tree_map(lambda p: jnp.full(p.shape, "ion_ion_gnn" in module), module_params)
+                    for module, module_params in params.items()}
+    is_ion_param = ravel_pytree(is_ion_param)[0]
+    assert np.any(is_ion_param)
+    assert np.linalg.norm(jac_cached[:, is_ion_param]) > 0
+
+
+def test_dense_layers_in_low_precision():
+    phys_config, log_psi_sqr, cache_func, params, fixed_params = _build_gnn_model("LiH")
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc_state = MCMCState.initialize_around_nuclei(8, phys_config, "exponential", jax.random.PRNGKey(0))
+    r, R, Z, fixed_params = mcmc_state.build_batch(fixed_params)
+
+    def log_psi_low_precision(p, r):
+        with dense_layers_in_dtype(jnp.bfloat16):
+            return log_psi_sqr(p, *spin_state, r, R, Z, fixed_params)
+
+    jaxpr = jax.make_jaxpr(log_psi_low_precision)(params, r).jaxpr
+    dot_dtypes = {eqn.outvars[0].aval.dtype for eqn in jaxpr.eqns if eqn.primitive.name == "dot_general"}
+    assert jnp.dtype(jnp.bfloat16) in dot_dtypes
+    assert jaxpr.outvars[0].aval.dtype == jnp.float32
+    # Only inputs of dense layers are cast, but not the electron coordinates themselves
+    r_var = jaxpr.invars[-1]
+    assert not any((eqn.primitive.name == "convert_element_type") and (r_var in eqn.invars) for eqn in jaxpr.eqns)
+
+    # Tangents and cotangents keep the parameter dtype
+    tangent = jax.tree_util.tree_map(jnp.zeros_like, params)
+    assert jax.jvp(lambda p: log_psi_low_precision(p, r), (params,), (tangent,))[1].dtype == jnp.float32
+    grads = jax.grad(lambda p: jnp.sum(log_psi_low_precision(p, r)))(params)
+    assert all(g.dtype == jnp.float32 for g in jax.tree_util.tree_leaves(grads))
+
+
+def test_woodbury_solver_matches_cg():
+    changes = {"optimization.optimizer.name": "srcg", "model.embedding.n_iterations": 1, "model.embedding.n_hidden_one_el": 32}
+    _, config = Configuration.update_configdict_and_validate(dict(physical=dict(name="LiH")), changes)
+    phys_config, opt_config = config.physical, config.optimization
+    nb_orbitals_per_Z = get_n_basis_per_Z(config.pre_training.baseline.basis_set, tuple(phys_config.Z))
+    log_psi_sqr, _, _, params, fixed_params = build_log_psi_squared(config.model, phys_config, None, 0, None, None, nb_orbitals_per_Z)
+    spin_state = (phys_config.n_up, phys_config.n_dn)
+    mcmc_state = MCMCState.initialize_around_nuclei(8, phys_config, "exponential", jax.random.PRNGKey(0))
+    r, R, Z, fixed_params = mcmc_state.build_batch(fixed_params)
+    # Large enough damping for both solvers to be accurate in float32
+    damping = 1.0
+
+    # Two devices (emulated by vmap) with 4 walkers each: The solution must satisfy (O^T O + damping * I) x = g for all 8 walkers
+    optimizer = SRCGOptimizer(log_psi_sqr, None, SRCGOptimizerConfig(solver="woodbury", jacobian_chunk_size=3))
+    g, unravel = ravel_pytree(params)
+    g = jax.random.normal(jax.random.PRNGKey(1), g.shape)
+    x = jax.vmap(lambda r_: optimizer._solve_woodbury(params, unravel(g), damping, spin_state, (r_, R, Z, fixed_params)),
+                 axis_name="devices")(r.reshape((2, 4, *r.shape[1:])))
+    x = jax.vmap(lambda x_: ravel_pytree(x_)[0])(x)
+    np.testing.assert_array_equal(x[0], x[1])
+    jac = np.array(optimizer._get_jacobian(params, spin_state, (r, R, Z, fixed_params)), dtype=np.float64)
+    jac = (jac - np.mean(jac, axis=0)) / np.sqrt(len(r))
+    x = np.array(x[0], dtype=np.float64)
+    residual = jac.T @ (jac @ x) + damping * x - g
+    assert np.linalg.norm(residual) < 1e-4 * np.linalg.norm(g)
+
+    # Full optimizer steps with both solvers yield the same natural gradient
+    value_and_grad_func = build_value_and_grad_func(log_psi_sqr, opt_config.clipping, opt_config.local_energy)
+    batch = mcmc_state.split_across_devices().build_batch(replicate_across_devices(fixed_params))
+    params, clipping_state, rng = replicate_across_devices((params, init_clipping_state(), jax.random.PRNGKey(1)))
+    nat_grads = []
+    for solver in ["cg", "woodbury"]:
+        optimizer = SRCGOptimizer(log_psi_sqr, value_and_grad_func, SRCGOptimizerConfig(solver=solver, damping=damping, initial_guess="zero",
+                                                                                        maxiter=500, cg_tol=1e-6))
+        opt_state = optimizer.init(params, rng, batch, spin_state, clipping_state)
+        _, opt_state, _, stats = optimizer.step(params, opt_state, spin_state, rng, batch, clipping_state)
+        nat_grads.append(ravel_pytree(jax.tree_util.tree_map(lambda x_: x_[0], opt_state[1]))[0])
+    assert stats["precon_grad_norm"][0] > 0
+    assert np.linalg.norm(nat_grads[1] - nat_grads[0]) < 5e-3 * np.linalg.norm(nat_grads[0])